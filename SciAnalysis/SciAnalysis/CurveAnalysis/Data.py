@@ -26,14 +26,15 @@
 import re # Regular expressions
 
 import numpy as np
-import pylab as plt
-import matplotlib as mpl
 #from scipy.optimize import leastsq
 #import scipy.special
 
 
 from .. import tools
-from ..Data import *
+from ..Data import * # Also provides mpl and (lazily-loaded) plt
+from ..Fit import get_model, fit_batch
+
+lmfit = tools.LazyModule('lmfit')
 
 
 
@@ -55,6 +56,7 @@ class DataLineStructured(DataLine):
         return results
         
         
+    @Trace.timed('plot')
     def plot(self, save=None, show=False, plot_range=[None,None,None,None], plot_buffers=[0.15,0.05,0.15,0.05], **kwargs):
         '''Plots the scattering data.
         
@@ -71,6 +73,28 @@ class DataLineStructured(DataLine):
         self._plot(save=save, show=show, plot_range=plot_range, plot_buffers=plot_buffers, **kwargs)
         
         
+    def fit_model(self, model, line, **run_args):
+        '''Fits the model (see SciAnalysis.Fit) to the line. Returns the lmfit
+        result, and the fit curve (at the points of the line, and on a finer
+        grid).'''
+        
+        lm_result = model.fit(line.x, line.y)
+        
+        if run_args['verbosity']>=5:
+            print('Fit results (lmfit):')
+            lmfit.report_fit(lm_result.params)
+            
+        fit_x = line.x
+        fit_y = model.eval(lm_result.params, fit_x)
+        fit_line = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
+        
+        fit_x = np.linspace(np.min(line.x), np.max(line.x), num=200)
+        fit_y = model.eval(lm_result.params, fit_x)
+        fit_line_extended = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
+        
+        return lm_result, fit_line, fit_line_extended
+        
+        
     # End class DataLineStructured(DataLine)
     ########################################
     
@@ -212,407 +236,44 @@ class DataLineStructuredSort(DataLineStructured):
         
         
     def fit_peaks(self, line, num_curves=6, **run_args):
-        
-        import lmfit
-        
-        def model(v, x):
-            '''Gaussian with linear background.'''
-            m = v['b']
-            for i in range(num_curves):
-                m += v['prefactor{:d}'.format(i+1)]*np.exp( -np.square(x-v['x_center{:d}'.format(i+1)])/(2*(v['sigma{:d}'.format(i+1)]**2)) )
-            return m
-        
-        def func2minimize(params, x, data):
-            
-            v = params.valuesdict()
-            m = model(v, x)
-            
-            return m - data
-        
-        params = lmfit.Parameters()
-        params.add('b', value=np.average(line.y))
-        
-        xspan = np.max(line.x) - np.min(line.x)
-        for i in range(num_curves):
-            xpos = np.min(line.x) + xspan*(1.*i/num_curves)
-            params.add('prefactor{:d}'.format(i+1), value=np.max(line.y))
-            params.add('x_center{:d}'.format(i+1), value=xpos)
-            params.add('sigma{:d}'.format(i+1), value=xspan/num_curves, min=0)
-        
-        
-        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y))
-        
-        if run_args['verbosity']>=5:
-            print('Fit results (lmfit):')
-            lmfit.report_fit(lm_result.params)
-            
-        fit_x = line.x
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
-        
-        fit_x = np.linspace(np.min(line.x), np.max(line.x), num=200)
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line_extended = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})        
-
-        return lm_result, fit_line, fit_line_extended
+        return self.fit_model(get_model('peaks', num_curves=num_curves), line, **run_args)
+    
     
     def fit_sines(self, line, num_curves=3, **run_args):
-        
-        import lmfit
-        
-        def model(v, x):
-            '''Gaussian with linear background.'''
-            m = x*0.0
-            for i in range(num_curves):
-                m += v['prefactor{:d}'.format(i+1)]*np.sin( 2.0*np.pi*(x-v['x_center{:d}'.format(i+1)]) /(v['period{:d}'.format(i+1)]) )
-            return m
-        
-        def func2minimize(params, x, data):
-            
-            v = params.valuesdict()
-            m = model(v, x)
-            
-            return m - data
-        
-        params = lmfit.Parameters()
-        params.add('b', value=np.average(line.y))
-        
-        xspan = np.max(line.x) - np.min(line.x)
-        for i in range(num_curves):
-            xpos = np.min(line.x) + xspan*(1.*i/num_curves)
-            params.add('prefactor{:d}'.format(i+1), value=np.max(line.y)*0.5)
-            params.add('x_center{:d}'.format(i+1), value=xpos)
-            params.add('period{:d}'.format(i+1), value=0.5/(i+1), min=0.05, max=2)
-        
-        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y))
-        
-        if run_args['verbosity']>=5:
-            print('Fit results (lmfit):')
-            lmfit.report_fit(lm_result.params)
-            
-        fit_x = line.x
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
-        
-        fit_x = np.linspace(np.min(line.x), np.max(line.x), num=200)
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line_extended = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})        
-
-        return lm_result, fit_line, fit_line_extended    
+        return self.fit_model(get_model('sines', num_curves=num_curves), line, **run_args)
+    
     
     def fit_eta(self, line, **run_args):
-        
-        import lmfit
-        
-        def model(v, x):
-            '''Eta orientation function.'''
-            m = v['prefactor']*( 1 - (v['eta']**2) )/( ((1+v['eta'])**2) - 4*v['eta']*( np.square(np.cos(  (v['symmetry']/2.0)*(x-v['x_center'])*(2.0*np.pi)  )) ) ) + v['baseline']
-            return m
-        
-        def func2minimize(params, x, data):
-            
-            v = params.valuesdict()
-            m = model(v, x)
-            
-            return m - data
-        
-        params = lmfit.Parameters()
-        params.add('prefactor', value=1.0, min=0)
-        params.add('x_center', value=0.5, min=np.min(line.x), max=np.max(line.x))
-        params.add('eta', value=0.4, min=0, max=1)
-        params.add('symmetry', value=4, min=0.5, max=20)
-        params.add('baseline', value=np.min(line.y), vary=False)
-        
-        
-        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y))
-        
-        if run_args['verbosity']>=5:
-            print('Fit results (lmfit):')
-            lmfit.report_fit(lm_result.params)
-            
-        
-        fit_x = line.x
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
-        
-        fit_x = np.linspace(np.min(line.x), np.max(line.x), num=200)
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line_extended = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
-
-        return lm_result, fit_line, fit_line_extended
+        return self.fit_model(get_model('eta'), line, **run_args)
     
     
     def fit_gauss(self, line, **run_args):
-        
-        import lmfit
-        
-        def model(v, x):
-            '''Gaussian with linear background.'''
-            m = v['prefactor']*np.exp( -np.square(x-v['x_center'])/(2*(v['sigma']**2)) )
-            return m
-        
-        def func2minimize(params, x, data):
-            
-            v = params.valuesdict()
-            m = model(v, x)
-            
-            return m - data
-        
-        params = lmfit.Parameters()
-        params.add('prefactor', value=1.0, min=0)
-        params.add('x_center', value=0.0, min=-4, max=+4)
-        params.add('sigma', value=1.0, min=0)
-        
-        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y))
-        
-        if run_args['verbosity']>=5:
-            print('Fit results (lmfit):')
-            lmfit.report_fit(lm_result.params)
-            
-        fit_x = line.x
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
-        
-        fit_x = np.linspace(np.min(line.x), np.max(line.x), num=200)
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line_extended = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})        
-
-        return lm_result, fit_line, fit_line_extended
+        return self.fit_model(get_model('gauss'), line, **run_args)
     
     
     def fit_lognormal(self, line, **run_args):
-        
-        import lmfit
-        
-        def model(v, x):
-            '''Gaussian with linear background.'''
-            x = np.maximum( x-v['x_zero'], x*0.0+1e-20 )
-            m = v['prefactor']*np.exp( -np.square( np.log(x) - v['mu'] )/(2*(v['sigma']**2)) )
-            return m
-        
-        def func2minimize(params, x, data):
-            
-            v = params.valuesdict()
-            m = model(v, x)
-            
-            return m - data
-        
-        params = lmfit.Parameters()
-        params.add('prefactor', value=1.0, min=0)
-        params.add('x_zero', value=-1.5, min=-4, max=+4)
-        params.add('mu', value=0.0, min=0)
-        params.add('sigma', value=0.5, min=0)
-        
-        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y))
-        
-        if run_args['verbosity']>=5:
-            print('Fit results (lmfit):')
-            lmfit.report_fit(lm_result.params)
-            
-        fit_x = line.x
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
-        
-        fit_x = np.linspace(np.min(line.x), np.max(line.x), num=200)
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line_extended = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})        
-
-        return lm_result, fit_line, fit_line_extended
+        return self.fit_model(get_model('lognormal'), line, **run_args)
     
     
     def fit_erf(self, line, **run_args):
-        
-        import lmfit
-        import scipy
-        
-        def model(v, x):
-            '''Error function (integral of Gaussian).'''
-            m = v['prefactor']*scipy.special.erf( (x-v['x_center'])/v['x_scale'] ) + v['baseline']
-            return m
-        
-        def func2minimize(params, x, data):
-            
-            v = params.valuesdict()
-            m = model(v, x)
-            
-            return m - data
-        
-        params = lmfit.Parameters()
-        params.add('prefactor', value=0.5, min=0, max=2.0)
-        params.add('x_center', value=0.0, min=-4, max=+4)
-        params.add('x_scale', value=1.0, min=0, max=8.0)
-        params.add('baseline', value=0.5, min=0, max=1)
-        
-        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y))
-        
-        if run_args['verbosity']>=5:
-            print('Fit results (lmfit):')
-            lmfit.report_fit(lm_result.params)
-            
-        fit_x = line.x
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
-        
-        fit_x = np.linspace(np.min(line.x), np.max(line.x), num=200)
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line_extended = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})        
-
-        return lm_result, fit_line, fit_line_extended    
+        return self.fit_model(get_model('erf'), line, **run_args)
+    
     
     def fit_erfinv(self, line, **run_args):
-        
-        import lmfit
-        import scipy
-        
-        def model(v, x):
-            '''Inverse error function.'''
-            x = np.clip(x, 0.001, 0.999) # Avoid infinities (asymptotes) at endpoints
-            m = v['prefactor']*scipy.special.erfinv( -(x*2-1) )
-            return m
-        
-        def func2minimize(params, x, data):
-            
-            v = params.valuesdict()
-            m = model(v, x)
-            
-            return m - data
-        
-        params = lmfit.Parameters()
-        params.add('prefactor', value=1.4, min=0)
-        
-        
-        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y))
-        
-        if run_args['verbosity']>=5:
-            print('Fit results (lmfit):')
-            lmfit.report_fit(lm_result.params)
-            
-        fit_x = line.x
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
-        
-        fit_x = np.linspace(np.min(line.x), np.max(line.x), num=200)
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line_extended = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})        
-
-        return lm_result, fit_line, fit_line_extended    
+        return self.fit_model(get_model('erfinv'), line, **run_args)
     
     
     def fit_nlog(self, line, **run_args):
-        
-        import lmfit
-        import scipy
-        
-        def model(v, x):
-            x = np.clip(x, 0.001, 1.0)
-            m = v['prefactor']*-1.0*np.log(x/v['x_scale']) + v['baseline']
-            return m
-        
-        def func2minimize(params, x, data):
-            
-            v = params.valuesdict()
-            m = model(v, x)
-            
-            return m - data
-        
-        params = lmfit.Parameters()
-        params.add('prefactor', value=1.0, min=0)
-        params.add('x_scale', value=1.0, min=0)
-        params.add('baseline', value=np.min(line.y))
-        
-        
-        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y))
-        
-        if run_args['verbosity']>=5:
-            print('Fit results (lmfit):')
-            lmfit.report_fit(lm_result.params)
-            
-        fit_x = line.x
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
-        
-        fit_x = np.linspace(np.min(line.x), np.max(line.x), num=200)
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line_extended = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})        
-
-        return lm_result, fit_line, fit_line_extended
+        return self.fit_model(get_model('nlog'), line, **run_args)
     
     
     def fit_expdecay(self, line, **run_args):
-        
-        import lmfit
-        import scipy
-        
-        def model(v, x):
-            x = np.clip(x, 0.001, 1.0)
-            m = v['prefactor']*np.exp(-x/v['x_scale']) + v['baseline']
-            return m
-        
-        def func2minimize(params, x, data):
-            
-            v = params.valuesdict()
-            m = model(v, x)
-            
-            return m - data
-        
-        params = lmfit.Parameters()
-        params.add('prefactor', value=3.0-np.min(line.y), min=0)
-        params.add('x_scale', value=0.5, min=0)
-        params.add('baseline', value=np.min(line.y), max=np.max(line.y))
-        
-        
-        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y))
-        
-        if run_args['verbosity']>=5:
-            print('Fit results (lmfit):')
-            lmfit.report_fit(lm_result.params)
-            
-        fit_x = line.x
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
-        
-        fit_x = np.linspace(np.min(line.x), np.max(line.x), num=200)
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line_extended = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})        
-
-        return lm_result, fit_line, fit_line_extended    
+        return self.fit_model(get_model('expdecay'), line, **run_args)
     
     
     def fit_linear(self, line, **run_args):
-        
-        import lmfit
-        
-        def model(v, x):
-            m = v['m']*x + v['b']
-            return m
-        
-        def func2minimize(params, x, data):
-            
-            v = params.valuesdict()
-            m = model(v, x)
-            
-            return m - data
-        
-        params = lmfit.Parameters()
-        params.add('m', value=-3.0)
-        params.add('b', value=line.x[0])
-        
-        
-        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y))
-        
-        if run_args['verbosity']>=5:
-            print('Fit results (lmfit):')
-            lmfit.report_fit(lm_result.params)
-            
-        fit_x = line.x
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
-        
-        fit_x = np.linspace(np.min(line.x), np.max(line.x), num=200)
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line_extended = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})        
-
-        return lm_result, fit_line, fit_line_extended        
+        return self.fit_model(get_model('linear'), line, **run_args)
+    
     
     # Plotting
     ########################################
@@ -797,10 +458,78 @@ class DataLineStructuredSort(DataLineStructured):
     ########################################
     
     
+# RollingStats
+################################################################################    
+class RollingStats(object):
+    '''Statistics of a curve over windows (of 2*half_points+1 points) centered
+    on each point, wrapping around at the ends of the curve. The window sums
+    of y and y^2 are differences of cumulative sums, so that the statistics
+    for all points (and for many window sizes at once) are computed without
+    looping over the points. y can also be a 2D array of curves (one per
+    row), which are then all handled at once.'''
+    
+    def __init__(self, y, max_half_points):
+        
+        y = np.asarray(y, dtype=float)
+        y = y - np.average(y, axis=-1)[...,np.newaxis] # Avoids loss of precision in y^2 (std is unchanged)
+        self.num_points = y.shape[-1]
+        self.num_curves = int(np.prod(y.shape[:-1]))
+        self.max_half_points = int(max_half_points)
+        
+        # Extend the curve (circularly) on both sides
+        H = self.max_half_points
+        y_ext = np.take(y, np.arange(-H, self.num_points+H), axis=-1, mode='wrap')
+        zeros = np.zeros(y.shape[:-1]+(1,))
+        self._sum_y = np.concatenate( (zeros, np.cumsum(y_ext, axis=-1)), axis=-1 )
+        self._sum_y2 = np.concatenate( (zeros, np.cumsum(y_ext*y_ext, axis=-1)), axis=-1 )
+        
+        
+    def std(self, half_points):
+        '''Returns the standard deviation within the window around each point,
+        for each of the window sizes (array of half_points); the result has
+        shape (len(half_points), num_points), or (num_curves, len(half_points),
+        num_points) for 2D y.'''
+        
+        h = np.asarray(half_points, dtype=int)
+        upper, lower = self.max_half_points+h+1, self.max_half_points-h
+        
+        # Row k of the views holds the cumulative sums starting at element k
+        N = self.num_points
+        sum_y = np.lib.stride_tricks.sliding_window_view(self._sum_y, N, axis=-1)
+        sum_y2 = np.lib.stride_tricks.sliding_window_view(self._sum_y2, N, axis=-1)
+        
+        inv_n = 1.0/(2*h+1).reshape(-1,1)
+        mean = sum_y[...,upper,:] - sum_y[...,lower,:]
+        mean *= inv_n
+        var = sum_y2[...,upper,:] - sum_y2[...,lower,:]
+        var *= inv_n
+        var -= mean*mean
+        np.clip(var, 0, None, out=var)
+        
+        return np.sqrt(var, out=var)
+    
+    
+    def sweep(self, half_points, max_values=2**18):
+        '''Iterates over the window sizes (in blocks, so that each block holds
+        at most max_values values), yielding (half_points, std) for each
+        block.'''
+        
+        half_points = np.asarray(half_points, dtype=int)
+        block = max( 1, int(max_values//max(self.num_points*self.num_curves, 1)) )
+        for i in range(0, len(half_points), block):
+            yield half_points[i:i+block], self.std(half_points[i:i+block])
+    
+    
+    # End class RollingStats(object)
+    ########################################
+    
+    
 # DataLineStructuredStd
 ################################################################################    
 class DataLineStructuredStd(DataLineStructured):
     
+    max_line_values = 2**22 # Keep at most this many values (in std_lines) for plotting
+    
     def analyze(self, outfile, plot=True, save=None, show=False, **run_args):
         
         results = {}
@@ -833,32 +562,49 @@ class DataLineStructuredStd(DataLineStructured):
         
         
         
+        # Standard deviation within windows of increasing size; every window
+        # size is computed (in blocks), with the histograms and averages
+        # accumulated as we go, but only a subset of the curves (std_lines) is
+        # kept for plotting if there are too many values
+        N = len(self.x)
+        half_points = np.arange(2, int( 0.5*(N-1) ), 2)
+        rolling = RollingStats(self.y, max_half_points=(half_points[-1] if len(half_points)>0 else 0))
+        keep_every = max( 1, int(np.ceil(len(half_points)*N/self.max_line_values)) )
+        
         self.std_lines = []
-        self.std_lines_x = []
-        self.std_lines_y = []
-        for half_points in range(2, int( 0.5*(len(self.x)-1) ), 2 ):
-            num_points = half_points*2 + 1
-            
-            curve = np.zeros(len(self.x))
-            for i, x in enumerate(self.x):
-                subrange = np.roll(self.y, +half_points-i)[:num_points]
-                curve[i] = np.std(subrange)
-            
-            self.std_lines.append(curve)
-            self.std_lines_x.append(num_points/len(self.x))
-            self.std_lines_y.append(np.average(curve))
-
-        vals = np.clip(np.asarray(self.std_lines).ravel(), 0, 2)
-        hist, bin_edges = np.histogram(vals, bins=20, range=[0,2])
+        self.std_lines_kept = [] # Index (in std_lines_x) of each kept curve
+        self.std_lines_x = 1.*(half_points*2 + 1)/N
+        self.std_lines_y = np.zeros(len(half_points))
+        self.std_lines_avg = np.zeros(N)
+        hist = np.zeros(20, dtype=int)
+        hist_loc = np.zeros(20, dtype=int)
+        
+        istart = 0
+        for halves, curves in rolling.sweep(half_points):
+            idx = np.arange(istart, istart+len(halves))
+            istart += len(halves)
+            
+            self.std_lines_y[idx] = np.average(curves, axis=1)
+            self.std_lines_avg += np.sum(curves, axis=0)
+            for i in np.nonzero(idx%keep_every==0)[0]:
+                self.std_lines.append(curves[i].copy())
+                self.std_lines_kept.append(idx[i])
+            
+            # Histogram (20 bins over [0,2], values clipped to the range)
+            bins = np.minimum( (np.clip(curves, 0, 2)*10).astype(int), 19 )
+            hist += np.bincount(bins.ravel(), minlength=20)
+            hist_loc += np.bincount(bins[idx<3].ravel(), minlength=20)
+        
+        if len(half_points)>0:
+            self.std_lines_avg /= len(half_points)
+        
+        bin_edges = np.linspace(0, 2, num=20+1)
         self.hist_s_x = bin_edges[:-1] + 0.5*(bin_edges[1]-bin_edges[0])
         self.hist_s_y = 1.*hist/np.max(hist)
         results['histogram_stds'] = self.hist_s_y
 
-        vals = np.clip(np.asarray(self.std_lines[:min(3,len(self.std_lines))]).ravel(), 0, 2)
-        #vals = np.clip(np.asarray(self.std_lines[0]).ravel(), 0, 2)
-        hist, bin_edges = np.histogram(vals, bins=20, range=[0,2])
         self.hist_sl_x = bin_edges[:-1] + 0.5*(bin_edges[1]-bin_edges[0])
-        self.hist_sl_y = 1.*hist/np.max(hist)
+        self.hist_sl_y = 1.*hist_loc/np.max(hist_loc)
         results['histogram_stds_loc'] = self.hist_sl_y
         
 
@@ -870,46 +616,7 @@ class DataLineStructuredStd(DataLineStructured):
     
     
     def fit_zones(self, line, num_curves=8, **run_args):
-        
-        import lmfit
-        
-        def model(v, x):
-            xspan = 0.5*(np.max(line.x) - np.min(line.x))/num_curves
-            m = x*0.0
-            for i in range(num_curves):
-                xpos = (i*2+1)*xspan
-                m += np.where(np.abs(x-xpos)<=xspan, v['prefactor{:d}'.format(i+1)], 0.0)
-            return m
-        
-        def func2minimize(params, x, data):
-            
-            v = params.valuesdict()
-            m = model(v, x)
-            
-            return m - data
-        
-        params = lmfit.Parameters()
-        
-        
-        for i in range(num_curves):
-            params.add('prefactor{:d}'.format(i+1), value=0.0)
-        
-        
-        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y))
-        
-        if run_args['verbosity']>=5:
-            print('Fit results (lmfit):')
-            lmfit.report_fit(lm_result.params)
-            
-        fit_x = line.x
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})
-        
-        fit_x = np.linspace(np.min(line.x), np.max(line.x), num=200)
-        fit_y = model(lm_result.params.valuesdict(), fit_x)
-        fit_line_extended = DataLine(x=fit_x, y=fit_y, plot_args={'linestyle':'-', 'color':'r', 'marker':None, 'linewidth':4.0})        
-
-        return lm_result, fit_line, fit_line_extended    
+        return self.fit_model(get_model('zones', num_curves=num_curves), line, **run_args)
     
     
     # Plotting
@@ -1006,19 +713,17 @@ class DataLineStructuredStd(DataLineStructured):
 
 
         # Lower plot
-        avg = self.x*0.0
         for i, line in enumerate(self.std_lines):
             amt = 1.*i/len(self.std_lines)
             color = (.2, .2, 1-amt*0.8)
             self.ax2f.plot(self.x, line, color=color, alpha=0.5)
-            avg += line
             
-            xs = line*0 + self.std_lines_x[i]
+            xs = line*0 + self.std_lines_x[self.std_lines_kept[i]]
             self.ax2r.plot(xs, line, 'o', color='0.5', alpha=0.05)
             
             
-        # Average curve
-        self.ax2f.plot(self.x, avg/len(self.std_lines), color='blue', alpha=0.75, linewidth=2.0)
+        # Average curve (over all the window sizes)
+        self.ax2f.plot(self.x, self.std_lines_avg, color='blue', alpha=0.75, linewidth=2.0)
 
 
         # Lower plot, upper part ("residuals") area used to plot how stdev varies with binning width
@@ -1334,3 +1039,260 @@ class DataLineStructuredFFT(DataLineStructured):
         
     # End class DataLineStructuredFFT(DataLineStructured)
     ########################################
+    
+    
+# DataLinesStructured
+################################################################################    
+class DataLinesStructured(object):
+    '''A set of curves sharing the same x values (y is a 2D array, with one
+    curve per row), analyzed together. The analyses give the same results as
+    DataLineStructuredSort, DataLineStructuredStd and DataLineStructuredFFT
+    (for each curve), but the normalization, histograms, sorting, rolling
+    statistics, FFTs and residuals are computed as array operations over all
+    the curves. The fits are done by SciAnalysis.Fit.fit_batch (using
+    run_args['num_jobs'] processes). No plots are made.'''
+    
+    def __init__(self, x, y, names=None, infiles=None):
+        
+        self.x = np.array(x, dtype=float)
+        self.y = np.array(y, dtype=float, ndmin=2)
+        
+        num_curves = len(self.y)
+        self.names = [None]*num_curves if names is None else list(names)
+        self.infiles = [None]*num_curves if infiles is None else list(infiles)
+        
+        
+    def __len__(self):
+        return len(self.y)
+    
+    
+    def subset(self, indices):
+        '''Returns a DataLinesStructured with only the selected curves.'''
+        return DataLinesStructured(self.x, self.y[indices], names=[self.names[i] for i in indices], infiles=[self.infiles[i] for i in indices])
+    
+    
+    def line(self, i):
+        '''Returns curve i as a DataLineStructured.'''
+        line = DataLineStructured(x=self.x.copy(), y=self.y[i].copy(), name=self.names[i])
+        line.infile = self.infiles[i]
+        return line
+        
+        
+    def smooth(self, sigma):
+        self.y = ndimage.gaussian_filter1d(self.y, sigma, axis=-1)
+        
+        
+    def normalize(self):
+        '''Rescales x into [0,1], and sets each curve to zero average and unit
+        standard deviation.'''
+        
+        self.x -= np.min(self.x) # Rezero
+        self.x *= 1.0/np.max(self.x) # Rescale
+        self.y -= np.average(self.y, axis=1)[:,np.newaxis] # Set zero to average
+        self.y /= np.std(self.y, axis=1)[:,np.newaxis] # Set yscale to standard deviation
+        
+        
+    # Data analysis
+    ########################################        
+    def stats(self, prepend='stats_'):
+        '''Returns the list (one dict per curve) of DataLine.stats results.'''
+        return self._stats_rows(self.y, prepend, 'zero_crossings', 0)
+    
+    
+    def fft_stats(self, prepend='stats_', threshold=0.25):
+        '''Returns the list of DataLineStructuredFFT.stats results (requires
+        analyze_fft).'''
+        return self._stats_rows(np.abs(self.fft_y), prepend, 'threshold_crossings', threshold)
+        
+        
+    def _stats_rows(self, y, prepend, crossings_name, threshold):
+        
+        num_curves, N = y.shape
+        v_max, v_min = np.max(y, axis=1), np.min(y, axis=1)
+        average, std = np.average(y, axis=1), np.std(y, axis=1)
+        total = np.sum(y, axis=1)
+        skew = stats.skew(y, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std_rel = std/average
+        crossings = np.count_nonzero(np.diff(np.signbit(y-threshold), axis=1), axis=1)
+        
+        results_list = []
+        for i in range(num_curves):
+            results = {}
+            results[prepend+'max'] = v_max[i]
+            results[prepend+'min'] = v_min[i]
+            results[prepend+'average'] = average[i]
+            results[prepend+'std'] = std[i]
+            results[prepend+'N'] = N
+            results[prepend+'total'] = total[i]
+            results[prepend+'skew'] = skew[i]
+            results[prepend+'spread'] = v_max[i] - v_min[i]
+            results[prepend+'std_rel'] = std_rel[i]
+            results[prepend+crossings_name] = int(crossings[i])
+            results_list.append(results)
+            
+        return results_list
+    
+    
+    def analyze_sort(self, **run_args):
+        '''Equivalent of DataLineStructuredSort.analyze, for all the curves
+        (which should already be normalized). Returns a list of results.'''
+        
+        results_list = [ {} for i in range(len(self)) ]
+        
+        # Fit primary data
+        for model in [get_model('sines', num_curves=3), get_model('eta')]:
+            self._fit(results_list, 'fit_{}'.format(model.name), model, self.x, self.y, **run_args)
+        
+        # Histogram
+        hist, bin_edges = self._histogram_rows(self.y, bins=20, range=[-4,+4])
+        self.hist_x = bin_edges[:-1] + 0.5*(bin_edges[1]-bin_edges[0])
+        self.hist_y = hist/np.max(hist, axis=1)[:,np.newaxis]
+        for results, hist_y in zip(results_list, self.hist_y):
+            results['histogram'] = hist_y
+        
+        for model in [get_model('gauss'), get_model('lognormal')]:
+            self._fit(results_list, 'histogram_fit_{}'.format(model.name), model, self.hist_x, self.hist_y, residuals=True, **run_args)
+            
+        # Cumulative Distribution Function
+        self.cdf_x = self.hist_x
+        self.cdf_y = np.cumsum(hist, axis=1)
+        self.cdf_y = self.cdf_y/np.max(self.cdf_y, axis=1)[:,np.newaxis]
+        
+        self._fit(results_list, 'cdf_fit_erf', get_model('erf'), self.cdf_x, self.cdf_y, residuals=True, **run_args)
+        
+        # Sorted data (monotonically decreasing curves)
+        self.y_sort = np.sort(self.y, axis=1)[:,::-1]
+        self.x_sort = self.x
+        x_residuals = np.linspace(0, 1.0-1e-10, num=40, endpoint=True)
+        for name in ['erfinv', 'nlog', 'expdecay', 'linear']:
+            self._fit(results_list, 'sort_fit_{}'.format(name), get_model(name), self.x_sort, self.y_sort, residuals=x_residuals, **run_args)
+            
+        return results_list
+    
+    
+    def analyze_std(self, max_values=2**18, **run_args):
+        '''Equivalent of DataLineStructuredStd.analyze, for all the curves
+        (which should already be normalized). Returns a list of results.'''
+        
+        results_list = [ {} for i in range(len(self)) ]
+        
+        # Fit primary data
+        self._fit(results_list, 'fit_zones', get_model('zones', num_curves=8), self.x, self.y, **run_args)
+        
+        # Histograms of the standard deviation within windows of increasing
+        # size; groups of curves are handled at once
+        num_curves, N = self.y.shape
+        half_points = np.arange(2, int( 0.5*(N-1) ), 2)
+        hist = np.zeros((num_curves, 20), dtype=int)
+        hist_loc = np.zeros((num_curves, 20), dtype=int)
+        
+        chunk = max( 1, int(max_values//max(N, 1)) )
+        for start in range(0, num_curves, chunk):
+            y = self.y[start:start+chunk]
+            nc = len(y)
+            offsets = 20*np.arange(nc).reshape(-1,1,1)
+            rolling = RollingStats(y, max_half_points=(half_points[-1] if len(half_points)>0 else 0))
+            
+            istart = 0
+            for halves, curves in rolling.sweep(half_points, max_values=max_values):
+                idx = np.arange(istart, istart+len(halves))
+                istart += len(halves)
+                
+                # Histogram (20 bins over [0,2], values clipped to the range)
+                bins = np.minimum( (np.clip(curves, 0, 2)*10).astype(int), 19 ) + offsets
+                hist[start:start+nc] += np.bincount(bins.ravel(), minlength=20*nc).reshape(nc, 20)
+                hist_loc[start:start+nc] += np.bincount(bins[:,idx<3].ravel(), minlength=20*nc).reshape(nc, 20)
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hist_s_y = 1.*hist/np.max(hist, axis=1)[:,np.newaxis]
+            hist_sl_y = 1.*hist_loc/np.max(hist_loc, axis=1)[:,np.newaxis]
+        for results, h_s, h_sl in zip(results_list, hist_s_y, hist_sl_y):
+            results['histogram_stds'] = h_s
+            results['histogram_stds_loc'] = h_sl
+            
+        return results_list
+    
+    
+    def analyze_fft(self, **run_args):
+        '''Equivalent of DataLineStructuredFFT.analyze, for all the curves
+        (which should already be normalized). Returns a list of results.'''
+        
+        self.fft_y = np.fft.fft(self.y, axis=1)
+        self.fft_y /= np.max(np.abs(self.fft_y), axis=1)[:,np.newaxis]
+        self.fft_x = np.arange(self.fft_y.shape[1])*2.0*np.pi/1.0
+        
+        fft_abs = np.abs(self.fft_y)
+        histogram_abs = self._interp_rows(self.fft_x, fft_abs, np.linspace(0, np.max(self.fft_x), num=40, endpoint=True))
+        spectral_spread = np.std(fft_abs, axis=1)
+        
+        return [ {'histogram_abs': h, 'spectral_spread': s} for h, s in zip(histogram_abs, spectral_spread) ]
+    
+    
+    def _fit(self, results_list, fit_name, model, x, y, residuals=False, **run_args):
+        '''Fits the model to each of the curves y (rows), adding the results
+        (with the same keys as DataLineStructured.analyze) to results_list.
+        Curves where the fit failed get no results for this fit. If residuals
+        is an array, the residuals are interpolated at these x values.'''
+        
+        processes = run_args['num_jobs'] if 'num_jobs' in run_args else 1
+        fit_results = fit_batch(model, [(x, y_i) for y_i in y], processes=processes)
+        
+        ok = [ i for i, fit_result in enumerate(fit_results) if fit_result is not None ]
+        if residuals is not False and len(ok)>0:
+            fit_y = np.asarray([ model.eval(fit_results[i].params, x) for i in ok ])
+            res = y[ok] - fit_y
+            if residuals is not True:
+                res = self._interp_rows(x, res, residuals)
+        
+        for j, i in enumerate(ok):
+            fit_result, results = fit_results[i], results_list[i]
+            prefactor_total = 0
+            for param_name, param in fit_result.params.items():
+                results['{}_{}'.format(fit_name, param_name)] = { 'value': param.value, 'error': param.stderr, }
+                if 'prefactor' in param_name:
+                    prefactor_total += np.abs(param.value)
+            
+            results['{}_prefactor_total'.format(fit_name)] = prefactor_total
+            results['{}_chi_squared'.format(fit_name)] = fit_result.chisqr/fit_result.nfree
+            if residuals is not False:
+                results['{}_residuals'.format(fit_name)] = res[j]
+    
+    
+    def _histogram_rows(self, y, bins, range):
+        '''Histogram (as np.histogram, with equal bins) of each row of y.'''
+        
+        first_edge, last_edge = range
+        bin_edges = np.linspace(first_edge, last_edge, bins+1, endpoint=True)
+        
+        rows = np.broadcast_to(np.arange(len(y)).reshape(-1,1), y.shape)
+        keep = (y>=first_edge) & (y<=last_edge)
+        values, rows = y[keep], rows[keep]
+        
+        # Bin indices, including np.histogram's corrections for round-off
+        indices = ((values - first_edge)*(bins/(last_edge - first_edge))).astype(np.intp)
+        indices[indices==bins] -= 1
+        indices[values<bin_edges[indices]] -= 1
+        indices[(values>=bin_edges[indices+1]) & (indices!=bins-1)] += 1
+        
+        hist = np.bincount(rows*bins + indices, minlength=len(y)*bins).reshape(len(y), bins)
+        
+        return hist, bin_edges
+    
+    
+    def _interp_rows(self, x, y, x_new):
+        '''Linear interpolation (as scipy.interpolate.interp1d) of each row of
+        y, for the shared x values.'''
+        
+        order = np.argsort(x, kind='mergesort')
+        x, y = x[order], y[:,order]
+        
+        hi = np.clip(np.searchsorted(x, x_new), 1, len(x)-1)
+        lo = hi - 1
+        slope = (y[:,hi] - y[:,lo])/(x[hi] - x[lo])
+        
+        return slope*(x_new - x[lo]) + y[:,lo]
+    
+    
+    # End class DataLinesStructured(object)
+    ########################################
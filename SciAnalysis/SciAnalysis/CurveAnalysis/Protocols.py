@@ -62,6 +62,112 @@ class ProcessorCurveStructure(ProcessorCurve):
         
         return data        
         
+        
+    def load_batch(self, infiles, **kwargs):
+        '''Loads the curves of many files, returning a list of
+        DataLinesStructured (curves sharing the same x values are grouped
+        together). Every column of a file (other than the x column) is a curve;
+        or specify the columns to use with 'ycolumns'. Curves from files with
+        several curves are named <filebase>_y<column>.'''
+        
+        load_args = {
+            'comment_char' : '#',
+            'xindex' : 0,
+            'ycolumns' : None,
+            }
+        load_args.update(kwargs)
+        
+        groups = {}
+        for infile in infiles:
+            if Filename(infile).get_ext()=='.npy':
+                data = np.load(infile)
+            else:
+                data = np.loadtxt(infile, comments=load_args['comment_char'])
+            
+            xindex = load_args['xindex'] % data.shape[1]
+            ycolumns = load_args['ycolumns']
+            if ycolumns is None:
+                ycolumns = [ j for j in range(data.shape[1]) if j!=xindex ]
+            
+            x = data[:,xindex]
+            name = Filename(infile).get_filebase()
+            for j in ycolumns:
+                curve_name = name if len(ycolumns)==1 else '{}_y{}'.format(name, j)
+                group = groups.setdefault( (x.shape, x.tobytes()), (x, [], [], []) )
+                group[1].append(data[:,j])
+                group[2].append(curve_name)
+                group[3].append(infile)
+                
+        return [ DataLinesStructured(x, ys, names=names, infiles=files) for x, ys, names, files in groups.values() ]
+        
+        
+    def run_batch(self, infiles=None, protocols=None, output_dir=None, force=False, ignore_errors=False, sort=False, load_args={}, run_args={}, verbosity=3, **kwargs):
+        '''Process the specified files using the specified protocols, with all
+        the curves loaded (see load_batch) and analyzed together. Protocols
+        that provide a run_batch method are applied to all the curves at
+        once (and the results stored in bulk); other protocols are run for
+        each curve in turn.'''
+        
+        l_args = self.load_args.copy()
+        l_args.update(load_args)
+        r_args = self.run_args.copy()
+        r_args.update(run_args)
+        
+        if infiles is None:
+            infiles = self.infiles
+        if sort:
+            infiles.sort()
+                
+        if protocols is None:
+            protocols = self.protocols
+        for protocol in protocols:
+            protocol._processor = self # Allow a protocol to access global connections
+            
+        if output_dir is None:
+            output_dir = self.output_dir
+            
+        md = {}
+        if 'full_name' in l_args:
+            md['full_name'] = l_args['full_name']
+        if 'save_results' in r_args:
+            md['save_results'] = r_args['save_results']
+            
+        for lines in self.load_batch(infiles, **l_args):
+            
+            # Result names: the file, or <file>_y<column> if a file holds many curves
+            names = [ infile if name==Filename(infile).get_filebase() else os.path.join(os.path.dirname(infile), name+Filename(infile).get_ext()) for name, infile in zip(lines.names, lines.infiles) ]
+            
+            for protocol in protocols:
+                
+                output_dir_current = self.access_dir(output_dir, protocol.name)
+                
+                if force:
+                    todo = list(range(len(lines)))
+                else:
+                    todo = [ i for i, name in enumerate(lines.names) if not protocol.output_exists(name, output_dir_current) ]
+                if verbosity>=2:
+                    print('Running {} for {} curves'.format(protocol.name, len(todo)))
+                if len(todo)<1:
+                    continue
+                    
+                try:
+                    if hasattr(protocol, 'run_batch'):
+                        results_list = protocol.run_batch(lines.subset(todo), output_dir_current, **r_args)
+                        self.store_results_batch(results_list, output_dir, [names[i] for i in todo], protocol, infiles=[lines.infiles[i] for i in todo], **md)
+                        
+                    else:
+                        for i in todo:
+                            results = protocol.run(lines.line(i), output_dir_current, **r_args)
+                            self.store_results(results, output_dir, names[i], protocol, infile=lines.infiles[i], **md)
+                            
+                except Exception as exception:
+                    if SUPPRESS_EXCEPTIONS or ignore_errors:
+                        # Ignore errors, so that execution doesn't get stuck on a single bad batch
+                        if verbosity>=1:
+                            print('  ERROR ({}) with {} for {} curves.'.format(exception.__class__.__name__, protocol.name, len(todo)))
+                    else:
+                        raise
+        
 
 class plot(Protocol):
     
@@ -163,4 +269,32 @@ class structure(Protocol):
         return results
     
     
+    @run_default
+    def run_batch(self, lines, output_dir, **run_args):
+        '''Analyzes many curves (DataLinesStructured) at once, returning the
+        list of results (one per curve, the same as for run). No plots are
+        made.'''
+        
+        if run_args['blur'] is not None:
+            lines.smooth(run_args['blur'])
+            
+        parts = []
+        parts.append( lines.stats(prepend='stats_') )
+        lines.normalize()
+        parts.append( [self.prepend_keys(results, 'sort_') for results in lines.analyze_sort(**run_args)] )
+        parts.append( lines.stats(prepend='stats_normed_') )
+        parts.append( [self.prepend_keys(results, 'std_') for results in lines.analyze_std(**run_args)] )
+        parts.append( [self.prepend_keys(results, 'fft_') for results in lines.analyze_fft(**run_args)] )
+        parts.append( lines.fft_stats(prepend='fft_stats_') )
+        
+        results_list = []
+        for curve_results in zip(*parts):
+            results = {}
+            for new_results in curve_results:
+                results.update(new_results)
+            results_list.append(results)
+        
+        return results_list
+    
+    
     
@@ -22,29 +22,201 @@
 
 
 #import sys
+import collections
 import numpy as np
 import matplotlib as mpl
+import matplotlib.colors # Needed for the custom colormaps (below)
 from SciAnalysis.settings import *
 if MATPLOTLIB_BACKEND is not None:
     mpl.use(MATPLOTLIB_BACKEND)
 mpl.rcParams['mathtext.fontset'] = 'cm'
-import pylab as plt
-
-from scipy import signal # For gaussian smoothing
-from scipy import ndimage # For resize, etc.
-from scipy import stats # For skew
-#from scipy.optimize import leastsq
-#import scipy.special
 
 import PIL # Python Image Library (for opening PNG, etc.)
 from PIL import Image
 
 from SciAnalysis import tools
+from SciAnalysis import Trace # Attributes plot/save time to the active RunTrace
+
+# Heavy modules are only imported on first use (see tools.LazyModule), so that
+# importing SciAnalysis (e.g. in each joblib worker) stays fast.
+plt = tools.LazyModule('pylab')
+signal = tools.LazyModule('scipy.signal') # For gaussian smoothing
+ndimage = tools.LazyModule('scipy.ndimage') # For resize, etc.
+stats = tools.LazyModule('scipy.stats') # For skew
+#from scipy.optimize import leastsq
+#import scipy.special
  
  
 
 
 
+# Copy-on-write
+################################################################################
+# Data objects can be copied (e.g. by protocols that should not disturb the
+# data for downstream analysis) without duplicating their arrays, using
+# copy(shared=True): the copy and the original then refer to the same arrays,
+# which are marked read-only (in both objects). The data modification methods
+# replace arrays (self.data = ...) rather than modifying them in-place, so the
+# copy and the original remain independent; code that modifies an array
+# in-place must first call writeable_array (which copies it if necessary).
+# An in-place write that skips this raises an error (rather than silently
+# changing the other object).
+
+def writeable_array(array):
+    '''Returns the array, or a (writeable) copy of it if it is read-only
+    (e.g. because it is shared with a copy-on-write copy).'''
+    if isinstance(array, np.ndarray) and not array.flags.writeable:
+        return array.copy()
+    return array
+
+
+def _shared_arrays(obj):
+    '''Returns a deepcopy memo that maps each (non-object) array reachable from
+    obj (through attributes, lists, tuples, sets and dicts) to itself; the
+    arrays are marked read-only.'''
+
+    import types
+    memo = {}
+    visited = set()
+    stack = [obj]
+    while len(stack)>0:
+        item = stack.pop()
+        if id(item) in visited:
+            continue
+        visited.add(id(item))
+
+        if isinstance(item, np.ndarray):
+            if item.dtype!=object:
+                item.flags.writeable = False
+                memo[id(item)] = item
+        elif isinstance(item, dict):
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif hasattr(item, '__dict__') and not isinstance(item, (type, types.ModuleType, types.FunctionType, types.MethodType)):
+            stack.extend(vars(item).values())
+
+    return memo
+
+
+def copy_on_write(obj):
+    '''Returns a copy of obj which is deep (all attributes are copied),
+    except that arrays are shared rather than duplicated. The shared arrays
+    become read-only, in both obj and the copy.'''
+    import copy
+    return copy.deepcopy(obj, _shared_arrays(obj))
+
+
+
+
+# Coordinate maps
+################################################################################
+# The maps of the distance and angle of each pixel from the origin (d_map,
+# angle_map) are needed by most 2D reductions (circular averages, angular
+# linecuts, Fourier filters), often several times for the same image (or for
+# many images of the same size). They are cached, keyed by the image shape,
+# origin and scale. Cached maps are read-only.
+# Each entry holds two float64 maps (16 bytes/pixel), so only a few are kept;
+# the cache can be adjusted using set_coordinate_maps_cache (or the
+# 'coordinate_maps_cache' run_arg of a Processor).
+
+COORDINATE_MAPS_CACHE_SIZE = 2 # Number of (shape, origin, scale) entries kept
+COORDINATE_MAPS_MAX_PIXELS = 2**24 # Maps for larger images are not cached
+_coordinate_maps_cache = collections.OrderedDict()
+
+class CoordinateMaps(object):
+    '''The distance (in units) and angle (degrees; 0 is vertical, +90 is
+    right) of each pixel from the origin, for an image of the given shape and
+    scale. The maps (and the radial bins used by circular_average) are
+    computed on first use.'''
+
+    def __init__(self, shape, x0, y0, x_scale=1.0, y_scale=1.0):
+        self.shape = shape
+        self.x0, self.y0 = x0, y0
+        self.x_scale, self.y_scale = x_scale, y_scale
+        self._d = None
+        self._angle = None
+        self._radial = None
+
+    def _xy(self):
+        dim_y, dim_x = self.shape
+        x = (np.arange(dim_x) - self.x0)*self.x_scale
+        y = (np.arange(dim_y) - self.y0)*self.y_scale
+        return np.meshgrid(x,y)
+
+    @property
+    def d(self):
+        if self._d is None:
+            X, Y = self._xy()
+            self._d = np.sqrt(X**2 + Y**2)
+            self._d.flags.writeable = False
+        return self._d
+
+    @property
+    def angle(self):
+        if self._angle is None:
+            X, Y = self._xy()
+            # Note intentional inversion of the usual (x,y) convention.
+            # This is so that 0 degrees is vertical.
+            self._angle = np.degrees(np.arctan2(X, Y))
+            self._angle.flags.writeable = False
+        return self._angle
+
+    def radial_bins(self):
+        '''Returns the (integer) radial bin of each pixel (ravelled), the
+        indices of the non-empty bins, the number of pixels in each bin, and
+        the average distance of the pixels in each bin. Only the (small)
+        per-bin arrays are kept; the per-pixel bins are recomputed.'''
+        R = self.d.ravel()
+        scale = (self.x_scale + self.y_scale)/2.0
+        Rd = (R/scale + 0.5).astype(int) # Simplify the R pixel-distances to closest integers
+        if self._radial is None:
+            num_per_R = np.bincount(Rd)
+            idx = np.where(num_per_R!=0) # R-distances that actually have data
+            r_vals = np.bincount(Rd, weights=R)[idx]/num_per_R[idx]
+            self._radial = idx, num_per_R, r_vals
+        return (Rd,) + self._radial
+
+
+def set_coordinate_maps_cache(size=None, max_pixels=None):
+    '''Sets the number of CoordinateMaps kept in the cache (0 disables the
+    cache), and/or the image size (pixels) above which they are not cached.'''
+
+    global COORDINATE_MAPS_CACHE_SIZE, COORDINATE_MAPS_MAX_PIXELS
+    if size is not None:
+        COORDINATE_MAPS_CACHE_SIZE = max(int(size), 0)
+    if max_pixels is not None:
+        COORDINATE_MAPS_MAX_PIXELS = int(max_pixels)
+
+    while len(_coordinate_maps_cache)>COORDINATE_MAPS_CACHE_SIZE:
+        _coordinate_maps_cache.popitem(last=False)
+
+
+def coordinate_maps(shape, origin, x_scale=1.0, y_scale=1.0):
+    '''Returns the (cached) CoordinateMaps for an image shape, origin and
+    scale. An origin of None (for x or y) means the image center.'''
+
+    dim_y, dim_x = shape
+    x0 = dim_x/2. if origin[0] is None else origin[0]
+    y0 = dim_y/2. if origin[1] is None else origin[1]
+    key = (tuple(shape), float(x0), float(y0), float(x_scale), float(y_scale))
+
+    if COORDINATE_MAPS_CACHE_SIZE<1 or dim_y*dim_x > COORDINATE_MAPS_MAX_PIXELS:
+        return CoordinateMaps(*key)
+
+    # Least-recently used entries are dropped first
+    maps = _coordinate_maps_cache.pop(key, None)
+    if maps is None:
+        maps = CoordinateMaps(*key)
+    _coordinate_maps_cache[key] = maps
+    while len(_coordinate_maps_cache)>COORDINATE_MAPS_CACHE_SIZE:
+        _coordinate_maps_cache.popitem(last=False)
+
+    return maps
+
+
+
+
 # DataLine
 ################################################################################    
 class DataLine(object):
@@ -152,6 +324,7 @@ class DataLine(object):
     # Data export
     ########################################
     
+    @Trace.timed('save')
     def save_data(self, outfile):
         
         if self.x_err is None and self.y_err is None:
@@ -384,6 +557,7 @@ class DataLine(object):
     # Plotting
     ########################################
     
+    @Trace.timed('plot')
     def plot(self, save=None, show=False, plot_range=[None,None,None,None], plot_buffers=[0.2,0.05,0.2,0.05], **kwargs):
         '''Plots the data.
         
@@ -710,6 +884,7 @@ class DataLineAngle(DataLine):
     # Plotting
     ########################################
 
+    @Trace.timed('plot')
     def plot_polar(self, save=None, show=False, plot_buffers=[0.1,0.1,0.1,0.1], **kwargs):
         '''Plots the scattering data.
         
@@ -805,6 +980,7 @@ class DataLineAngle(DataLine):
         
         
         
+    @Trace.timed('plot')
     def plot_graininess(self, save=None, show=False, plot_range=[None,None,None,None], plot_buffers=[0.12,0.05,0.12,0.05], **kwargs):
         self._plot_graininess(save=save, show=show, plot_range=plot_range, plot_buffers=plot_buffers, **kwargs)
 
@@ -1137,6 +1313,7 @@ class DataLinesStacked(DataLines):
     '''Holds multiple lines, so that they can be plotted with stacked graphs.'''
     
     
+    @Trace.timed('plot')
     def plot(self, save=None, show=False, plot_range=[None,None,None,None], plot_buffers=[0.25,0.05,0.12,0.05], **kwargs):
         '''Plots the scattering data.
         
@@ -1361,6 +1538,7 @@ class Data2D(object):
         
     # Data export
     ########################################
+    @Trace.timed('save')
     def save_data(self, outfile):
         '''
         Save image (2D matrix data) as .npz 
@@ -1430,23 +1608,7 @@ class Data2D(object):
         if origin==None:
             origin = self.origin
         
-        dim_y,dim_x = self.data.shape
-        
-        if origin[0] is None:
-            x0 = dim_x/2.
-        else:
-            x0 = origin[0]
-        if origin[1] is None:
-            y0 = dim_y/2.
-        else:
-            y0 = origin[1]
-            
-        x = np.arange(dim_x) - x0
-        y = np.arange(dim_y) - y0
-        X,Y = np.meshgrid(x,y)
-        R = np.sqrt(X**2 + Y**2)
-        
-        return R
+        return coordinate_maps(self.data.shape, origin).d
 
         
     def d_map(self, origin=None):
@@ -1455,23 +1617,7 @@ class Data2D(object):
         if origin==None:
             origin = self.origin
         
-        dim_y,dim_x = self.data.shape
-        
-        if origin[0] is None:
-            x0 = dim_x/2.
-        else:
-            x0 = origin[0]
-        if origin[1] is None:
-            y0 = dim_y/2.
-        else:
-            y0 = origin[1]
-            
-        x = (np.arange(dim_x) - x0)*self.x_scale
-        y = (np.arange(dim_y) - y0)*self.y_scale
-        X,Y = np.meshgrid(x,y)
-        R = np.sqrt(X**2 + Y**2)
-        
-        return R
+        return coordinate_maps(self.data.shape, origin, self.x_scale, self.y_scale).d
     
     
     def angle_map(self, origin=None):
@@ -1481,26 +1627,7 @@ class Data2D(object):
         if origin==None:
             origin = self.origin
         
-        dim_y,dim_x = self.data.shape
-        
-        if origin[0] is None:
-            x0 = dim_x/2.
-        else:
-            x0 = origin[0]
-        if origin[1] is None:
-            y0 = dim_y/2.
-        else:
-            y0 = origin[1]
-            
-        x = (np.arange(dim_x) - x0)*self.x_scale
-        y = (np.arange(dim_y) - y0)*self.y_scale
-        X,Y = np.meshgrid(x,y)
-        #M = np.degrees(np.arctan2(Y, X))
-        # Note intentional inversion of the usual (x,y) convention.
-        # This is so that 0 degrees is vertical.
-        M = np.degrees(np.arctan2(X, Y))
-        
-        return M
+        return coordinate_maps(self.data.shape, origin, self.x_scale, self.y_scale).angle
     
     
     def image_area(self):
@@ -1607,14 +1734,20 @@ class Data2D(object):
         self.data = realspace
         
         
-    def fourier_filter(self, q, dq):
+    def fourier_filter(self, q, dq, data_fft=None):
+        '''Keeps only the Fourier components near q (within a Gaussian of
+        width dq). If the FFT of this data (from self.fft()) has already been
+        computed, it can be supplied as data_fft (it is not modified).'''
         
-        data_fft = self.fft()
+        if data_fft is None:
+            data_fft = self.fft()
+        else:
+            data_fft = data_fft.copy()
         
         distance_map = data_fft.d_map()
         attenuation = np.exp( -1.0*np.square( distance_map-q )/np.square(dq) )
         
-        data_fft.data *= attenuation
+        data_fft.data = data_fft.data*attenuation
         data_fft.recenter()
         
         realspace = np.real( np.fft.ifftn( data_fft.data ) ) # Inverse FT
@@ -1684,28 +1817,18 @@ class Data2D(object):
     def circular_average(self, absolute_value=False, x_label='r', x_rlabel='$r$', y_label='I', y_rlabel=r'$\langle I \rangle \, (\mathrm{counts/pixel})$', **kwargs):
         '''Returns a 1D curve that is a circular average of the 2D data.'''
         
-        mask = np.ones(self.data.shape)
-        dim_y, dim_x = self.data.shape
-        x0, y0 = self.origin
-        
         # .ravel() is used to convert the 2D grids into 1D arrays.
         # This is not strictly necessary, but improves speed somewhat.
         
         data = self.data.ravel()
         if absolute_value:
             data = np.abs(data)
-        pixel_list = np.where(mask.ravel()==1) # Non-masked pixels
-        
-        # Generate map of distances-from-origin
-        R = self.d_map().ravel()
-        scale = (self.x_scale + self.y_scale)/2.0
-        Rd = (R/scale + 0.5).astype(int) # Simplify the R pixel-distances to closest integers
         
-        num_per_R = np.bincount(Rd[pixel_list])
-        idx = np.where(num_per_R!=0) # R-distances that actually have data
+        # Map of distances-from-origin, simplified to closest integers (the
+        # binning is cached for the image shape, origin and scale)
+        Rd, idx, num_per_R, r_vals = coordinate_maps(self.data.shape, self.origin, self.x_scale, self.y_scale).radial_bins()
         
-        r_vals = np.bincount( Rd[pixel_list], weights=R[pixel_list] )[idx]/num_per_R[idx]
-        I_vals = np.bincount( Rd[pixel_list], weights=data[pixel_list] )[idx]/num_per_R[idx]
+        I_vals = np.bincount( Rd, weights=data )[idx]/num_per_R[idx]
         
         line = DataLine( x=r_vals, y=I_vals, x_label=x_label, y_label=y_label, x_rlabel=x_rlabel, y_rlabel=y_rlabel )
         
@@ -1751,10 +1874,6 @@ class Data2D(object):
     ########################################  
     def linecut_angle(self, d_center, d_spread, absolute_value=False, x_label='angle', x_rlabel='$\chi \, (^{\circ})$', y_label='I', y_rlabel=r'$I (\chi) \, (\mathrm{counts/pixel})$', **kwargs):
         
-        mask = np.ones(self.data.shape)
-        dim_y, dim_x = self.data.shape
-        x0, y0 = self.origin
-        
         # .ravel() is used to convert the 2D grids into 1D arrays.
         # This is not strictly necessary, but improves speed somewhat.
         
@@ -1764,7 +1883,7 @@ class Data2D(object):
         
         
         R = self.d_map().ravel()
-        pixel_list = np.where( (np.abs(R-d_center)<d_spread) & (mask.ravel()==1) )
+        pixel_list = np.where( np.abs(R-d_center)<d_spread )
             
             
         if 'show_region' in kwargs and kwargs['show_region']:
@@ -1824,6 +1943,7 @@ class Data2D(object):
         self.z_display = z_display
         
         
+    @Trace.timed('plot')
     def plot_image(self, save, ztrim=[0.01, 0.01], **plot_args):
         '''Generates a false-color image of the 2D data.'''
 
@@ -1844,6 +1964,7 @@ class Data2D(object):
         img.save(save)
         
     
+    @Trace.timed('plot')
     def plot(self, save=None, show=False, ztrim=[0.01, 0.01], plot_buffers=[0.15,0.05,0.15,0.05], **kwargs):
         '''Plots the data.
         
@@ -2061,6 +2182,7 @@ class Data2D(object):
                 plt.rcParams[param] = value
 
 
+    @Trace.timed('plot')
     def plot3D(self, save=None, show=False, ztrim=[0.01, 0.01], plot_buffers=[0.15,0.05,0.15,0.05], elev=30, azim=30, **kwargs):
         self._plot3D(save=save, show=show, ztrim=ztrim, plot_buffers=plot_buffers, elev=elev, azim=azim, **kwargs)
         
@@ -2307,7 +2429,12 @@ class Data2D(object):
         
     # Object
     ########################################
-    def copy(self):
+    def copy(self, shared=False):
+        '''Returns a (deep) copy of this object. With shared=True, the arrays
+        (e.g. self.data) are shared with the copy rather than duplicated, and
+        become read-only in both objects (see copy_on_write).'''
+        if shared:
+            return copy_on_write(self)
         import copy
         return copy.deepcopy(self)
         
@@ -2331,6 +2458,7 @@ class Data2DFourier(Data2D):
         
         
         
+    @Trace.timed('plot')
     def plot(self, save=None, show=False, ztrim=[0.05, 0.001], figsize=10.0, plot_buffers=[0.18,0.04,0.18,0.04], blur=None, **kwargs):
         '''Plots the scattering data.
         
@@ -2353,6 +2481,7 @@ class Data2DFourier(Data2D):
         self.data = Fourier_data
         
         
+    @Trace.timed('plot')
     def plot_components(self, save=None, show=False, ztrim=[0.05, 0.001], figsize=10.0, plot_buffers=[0.18,0.04,0.18,0.04], blur=None, **kwargs):
         
         Fourier_data = self.data
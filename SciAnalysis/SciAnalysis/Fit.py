@@ -11,7 +11,29 @@
 '''
 
 ################################################################################
-#  A variety of 1D curves are defined, intended for fitting data
+#  A variety of 1D curves are defined, intended for fitting data.
+#
+# Each curve is a Model, built once (see get_model) and reused for every fit:
+#  - func(x, p) evaluates the curve for the array p of parameter values (in
+#    the order of the parameters), vectorized over x (and over the components
+#    of multi-component curves).
+#  - jacobian(x, p) returns the analytic derivatives of the curve with respect
+#    to each parameter (shape (num_params, len(x))), which is used by the
+#    Levenberg-Marquardt fit instead of finite differences.
+#  - guess(x, y) returns the parameters (names, initial values and bounds),
+#    which may depend on the data.
+# The fit itself is done by lmfit, such that results (params, chisqr, nfree,
+# etc.) are the same as for a direct call to lmfit.minimize.
+#
+# Since the models are defined at module level, they can be sent to worker
+# processes; fit_batch fits many curves with the same model using a pool of
+# processes.
+#
+# Typical usage:
+#   model = get_model('peaks', num_curves=6)
+#   lm_result = model.fit(line.x, line.y)
+#   fit_y = model.eval(lm_result.params, line.x)
+#   results = fit_batch(model, [(x1, y1), (x2, y2), ...], processes=8)
 ################################################################################
 # Known Bugs:
 #  N/A
@@ -19,3 +41,438 @@
 # TODO:
 #  Search for "TODO" below.
 ################################################################################
+
+
+import functools
+import multiprocessing
+
+import numpy as np
+
+from . import tools
+
+lmfit = tools.LazyModule('lmfit')
+special = tools.LazyModule('scipy.special')
+
+
+
+# Model
+################################################################################
+class Model(object):
+    '''A curve that can be fit to (x,y) data.'''
+
+    def __init__(self, name, func, guess, jacobian=None, **options):
+        '''Defines the model.
+
+        Parameters
+        ----------
+        name : str
+        func : function
+            func(x, p, **options) returns the curve for parameter values p.
+        guess : function
+            guess(x, y, **options) returns the parameters, as a list of
+            (name, hints) where hints is a dict of arguments for
+            lmfit.Parameters.add (value, min, max, vary).
+        jacobian : function (optional)
+            jacobian(x, p, **options) returns the derivatives of the curve
+            with respect to each of the parameters.
+        options : dict
+            Additional (fixed) arguments for the functions (e.g. num_curves).
+        '''
+
+        self.name = name
+        self.func = func
+        self.guess = guess
+        self.jacobian = jacobian
+        self.options = options
+
+
+    def make_params(self, x, y, **hints):
+        '''Returns the (lmfit) Parameters, with the initial values and bounds
+        guessed from the data. The guesses for specific parameters can be
+        modified by providing hints (e.g. x_center={'value':0.5}).'''
+
+        params = lmfit.Parameters()
+        for name, param_hints in self.guess(x, y, **self.options):
+            param_hints = dict(param_hints, **hints.get(name, {}))
+            params.add(name, **param_hints)
+
+        return params
+
+
+    def values(self, params):
+        '''The parameter values (in order) as an array.'''
+        return np.fromiter( (param.value for param in params.values()), dtype=float, count=len(params) )
+
+
+    def eval(self, params, x):
+        '''Returns the curve for the given parameters (lmfit Parameters, or
+        array of values).'''
+        p = self.values(params) if isinstance(params, dict) else np.asarray(params, dtype=float)
+        return self.func(np.asarray(x, dtype=float), p, **self.options)
+
+
+    def residual(self, params, x, data):
+        return self.func(x, self.values(params), **self.options) - data
+
+
+    def _jacobian(self, params, x, data):
+        jac = self.jacobian(x, self.values(params), **self.options)
+        vary = [ param.vary for param in params.values() ]
+        return jac[vary]
+
+
+    def fit(self, x, y, params=None, **hints):
+        '''Fits the model to the data, returning the lmfit MinimizerResult.'''
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if params is None:
+            params = self.make_params(x, y, **hints)
+
+        fit_kws = {}
+        if self.jacobian is not None:
+            fit_kws = { 'Dfun': self._jacobian, 'col_deriv': 1 }
+
+        return lmfit.minimize(self.residual, params, args=(x, y), **fit_kws)
+
+
+    def __repr__(self):
+        options = ''.join( ', {}={}'.format(k, v) for k, v in sorted(self.options.items()) )
+        return 'Model({}{})'.format(self.name, options)
+
+
+    # End class Model(object)
+    ########################################
+
+
+
+# Batch fitting
+################################################################################
+class FitResult(object):
+    '''Outcome of a fit: the parts of lmfit's MinimizerResult that are needed
+    to report the fit (and that can be sent between processes).'''
+
+    def __init__(self, result):
+        self.params = result.params
+        self.chisqr = result.chisqr
+        self.redchi = result.redchi
+        self.nfree = result.nfree
+        self.nfev = result.nfev
+        self.success = result.success
+        self.message = result.message
+
+
+def _fit_task(task):
+    model, x, y, hints = task
+    try:
+        return FitResult(model.fit(x, y, **hints))
+    except (ValueError, FloatingPointError, ZeroDivisionError, np.linalg.LinAlgError):
+        return None
+
+
+def fit_batch(model, curves, processes=None, chunksize=8, **hints):
+    '''Fits the same model to each of the curves (list of (x, y) pairs).
+    Returns a list of FitResult (None for curves where the fit failed).
+
+    Parameters
+    ----------
+    processes : int or None
+        Number of worker processes (None uses all CPUs); with 1, the fits are
+        done in this process.
+    chunksize : int
+        Number of curves sent to a worker at a time.
+    '''
+
+    tasks = [ (model, x, y, hints) for x, y in curves ]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(tasks))
+    if processes<=1:
+        return [ _fit_task(task) for task in tasks ]
+
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(_fit_task, tasks, chunksize=chunksize)
+
+
+
+# Curves
+################################################################################
+
+def _x_range(x):
+    return np.min(x), np.max(x)
+
+
+def _components(p, num_curves):
+    '''Splits the values for repeated components (each with 3 parameters) into
+    arrays of shape (num_curves, 1), which broadcast against x.'''
+    return p[1:1+3*num_curves].reshape(num_curves, 3).T[:,:,np.newaxis]
+
+
+# Sum of Gaussians with a constant background
+def _peaks(x, p, num_curves):
+    prefactor, x_center, sigma = _components(p, num_curves)
+    return p[0] + np.sum( prefactor*np.exp( -np.square(x-x_center)/(2*(sigma**2)) ), axis=0 )
+
+def _peaks_jacobian(x, p, num_curves):
+    prefactor, x_center, sigma = _components(p, num_curves)
+    dx = x-x_center
+    g = np.exp( -np.square(dx)/(2*(sigma**2)) )
+    jac = np.empty( (len(p), len(x)) )
+    jac[0] = 1
+    jac[1::3] = g
+    jac[2::3] = prefactor*g*dx/(sigma**2)
+    jac[3::3] = prefactor*g*np.square(dx)/(sigma**3)
+    return jac
+
+def _peaks_guess(x, y, num_curves):
+    xmin, xmax = _x_range(x)
+    xspan = xmax - xmin
+    params = [ ('b', {'value':np.average(y)}) ]
+    for i in range(num_curves):
+        params += [
+            ('prefactor{:d}'.format(i+1), {'value':np.max(y)}),
+            ('x_center{:d}'.format(i+1), {'value':xmin + xspan*(1.*i/num_curves)}),
+            ('sigma{:d}'.format(i+1), {'value':xspan/num_curves, 'min':0}),
+            ]
+    return params
+
+
+# Sum of sines (the constant 'b' is not part of the curve)
+def _sines(x, p, num_curves):
+    prefactor, x_center, period = _components(p, num_curves)
+    return np.sum( prefactor*np.sin( 2.0*np.pi*(x-x_center)/period ), axis=0 )
+
+def _sines_jacobian(x, p, num_curves):
+    prefactor, x_center, period = _components(p, num_curves)
+    phase = 2.0*np.pi*(x-x_center)/period
+    c = prefactor*np.cos(phase)
+    jac = np.empty( (len(p), len(x)) )
+    jac[0] = 0
+    jac[1::3] = np.sin(phase)
+    jac[2::3] = -c*2.0*np.pi/period
+    jac[3::3] = -c*phase/period
+    return jac
+
+def _sines_guess(x, y, num_curves):
+    xmin, xmax = _x_range(x)
+    xspan = xmax - xmin
+    params = [ ('b', {'value':np.average(y)}) ]
+    for i in range(num_curves):
+        params += [
+            ('prefactor{:d}'.format(i+1), {'value':np.max(y)*0.5}),
+            ('x_center{:d}'.format(i+1), {'value':xmin + xspan*(1.*i/num_curves)}),
+            ('period{:d}'.format(i+1), {'value':0.5/(i+1), 'min':0.05, 'max':2}),
+            ]
+    return params
+
+
+# Eta orientation function
+def _eta(x, p):
+    prefactor, x_center, eta, symmetry, baseline = p
+    denom = ((1+eta)**2) - 4*eta*np.square(np.cos( (symmetry/2.0)*(x-x_center)*(2.0*np.pi) ))
+    return prefactor*( 1 - (eta**2) )/denom + baseline
+
+def _eta_jacobian(x, p):
+    prefactor, x_center, eta, symmetry, baseline = p
+    phase = np.pi*symmetry*(x-x_center)
+    cos2 = np.square(np.cos(phase))
+    denom = ((1+eta)**2) - 4*eta*cos2
+    numer = 1 - (eta**2)
+    d_phase = -prefactor*numer*4*eta*np.sin(2*phase)/np.square(denom)
+    return np.array( [
+        numer/denom,
+        d_phase*(-np.pi*symmetry),
+        prefactor*( -2*eta*denom - numer*(2*(1+eta) - 4*cos2) )/np.square(denom),
+        d_phase*np.pi*(x-x_center),
+        np.ones_like(x),
+        ] )
+
+def _eta_guess(x, y):
+    xmin, xmax = _x_range(x)
+    return [
+        ('prefactor', {'value':1.0, 'min':0}),
+        ('x_center', {'value':0.5, 'min':xmin, 'max':xmax}),
+        ('eta', {'value':0.4, 'min':0, 'max':1}),
+        ('symmetry', {'value':4, 'min':0.5, 'max':20}),
+        ('baseline', {'value':np.min(y), 'vary':False}),
+        ]
+
+
+# Gaussian
+def _gauss(x, p):
+    prefactor, x_center, sigma = p
+    return prefactor*np.exp( -np.square(x-x_center)/(2*(sigma**2)) )
+
+def _gauss_jacobian(x, p):
+    prefactor, x_center, sigma = p
+    dx = x-x_center
+    g = np.exp( -np.square(dx)/(2*(sigma**2)) )
+    return np.array( [ g, prefactor*g*dx/(sigma**2), prefactor*g*np.square(dx)/(sigma**3) ] )
+
+def _gauss_guess(x, y):
+    return [
+        ('prefactor', {'value':1.0, 'min':0}),
+        ('x_center', {'value':0.0, 'min':-4, 'max':+4}),
+        ('sigma', {'value':1.0, 'min':0}),
+        ]
+
+
+# Log-normal
+def _lognormal(x, p):
+    prefactor, x_zero, mu, sigma = p
+    x = np.maximum( x-x_zero, 1e-20 )
+    return prefactor*np.exp( -np.square( np.log(x) - mu )/(2*(sigma**2)) )
+
+def _lognormal_jacobian(x, p):
+    prefactor, x_zero, mu, sigma = p
+    xs = x-x_zero
+    clipped = xs<=1e-20
+    xs = np.maximum(xs, 1e-20)
+    dl = np.log(xs) - mu
+    g = np.exp( -np.square(dl)/(2*(sigma**2)) )
+    d_mu = prefactor*g*dl/(sigma**2)
+    return np.array( [ g, np.where(clipped, 0, d_mu/xs), d_mu, prefactor*g*np.square(dl)/(sigma**3) ] )
+
+def _lognormal_guess(x, y):
+    return [
+        ('prefactor', {'value':1.0, 'min':0}),
+        ('x_zero', {'value':-1.5, 'min':-4, 'max':+4}),
+        ('mu', {'value':0.0, 'min':0}),
+        ('sigma', {'value':0.5, 'min':0}),
+        ]
+
+
+# Error function (integral of Gaussian)
+def _erf(x, p):
+    prefactor, x_center, x_scale, baseline = p
+    return prefactor*special.erf( (x-x_center)/x_scale ) + baseline
+
+def _erf_jacobian(x, p):
+    prefactor, x_center, x_scale, baseline = p
+    u = (x-x_center)/x_scale
+    d_u = prefactor*(2/np.sqrt(np.pi))*np.exp(-np.square(u))
+    return np.array( [ special.erf(u), -d_u/x_scale, -d_u*u/x_scale, np.ones_like(x) ] )
+
+def _erf_guess(x, y):
+    return [
+        ('prefactor', {'value':0.5, 'min':0, 'max':2.0}),
+        ('x_center', {'value':0.0, 'min':-4, 'max':+4}),
+        ('x_scale', {'value':1.0, 'min':0, 'max':8.0}),
+        ('baseline', {'value':0.5, 'min':0, 'max':1}),
+        ]
+
+
+# Inverse error function
+def _erfinv(x, p):
+    x = np.clip(x, 0.001, 0.999) # Avoid infinities (asymptotes) at endpoints
+    return p[0]*special.erfinv( -(x*2-1) )
+
+def _erfinv_jacobian(x, p):
+    x = np.clip(x, 0.001, 0.999)
+    return special.erfinv( -(x*2-1) )[np.newaxis,:]
+
+def _erfinv_guess(x, y):
+    return [ ('prefactor', {'value':1.4, 'min':0}) ]
+
+
+# Negative logarithm
+# Note that x_scale and baseline are degenerate (only baseline +
+# prefactor*log(x_scale) is determined by the data), so their individual
+# values depend on the path taken by the minimizer.
+def _nlog(x, p):
+    prefactor, x_scale, baseline = p
+    x = np.clip(x, 0.001, 1.0)
+    return prefactor*-1.0*np.log(x/x_scale) + baseline
+
+def _nlog_jacobian(x, p):
+    prefactor, x_scale, baseline = p
+    x = np.clip(x, 0.001, 1.0)
+    return np.array( [ -np.log(x/x_scale), np.full(x.shape, prefactor/x_scale), np.ones_like(x) ] )
+
+def _nlog_guess(x, y):
+    return [
+        ('prefactor', {'value':1.0, 'min':0}),
+        ('x_scale', {'value':1.0, 'min':0}),
+        ('baseline', {'value':np.min(y)}),
+        ]
+
+
+# Exponential decay
+# For curves that are not convex, the best fit is a straight line, which is
+# approached as x_scale goes to infinity (with prefactor ~ -baseline growing
+# along with it). x_scale is bounded so that these fits end at a reproducible
+# point (x_scale=1e3, i.e. a straight line over the clipped x range) rather
+# than wherever the minimizer happens to stop.
+def _expdecay(x, p):
+    prefactor, x_scale, baseline = p
+    x = np.clip(x, 0.001, 1.0)
+    return prefactor*np.exp(-x/x_scale) + baseline
+
+def _expdecay_jacobian(x, p):
+    prefactor, x_scale, baseline = p
+    x = np.clip(x, 0.001, 1.0)
+    e = np.exp(-x/x_scale)
+    return np.array( [ e, prefactor*e*x/(x_scale**2), np.ones_like(x) ] )
+
+def _expdecay_guess(x, y):
+    return [
+        ('prefactor', {'value':3.0-np.min(y), 'min':0}),
+        ('x_scale', {'value':0.5, 'min':0, 'max':1e3}),
+        ('baseline', {'value':np.min(y), 'max':np.max(y)}),
+        ]
+
+
+# Line
+def _linear(x, p):
+    return p[0]*x + p[1]
+
+def _linear_jacobian(x, p):
+    return np.array( [ x, np.ones_like(x) ] )
+
+def _linear_guess(x, y):
+    return [ ('m', {'value':-3.0}), ('b', {'value':x[0]}) ]
+
+
+# Step function (constant within each of num_curves zones)
+def _zones_masks(x, num_curves):
+    xspan = 0.5*(np.max(x) - np.min(x))/num_curves
+    xpos = (np.arange(num_curves)*2+1)*xspan
+    return np.abs(x-xpos[:,np.newaxis])<=xspan
+
+def _zones(x, p, num_curves):
+    return np.dot(p, _zones_masks(x, num_curves))
+
+def _zones_jacobian(x, p, num_curves):
+    return _zones_masks(x, num_curves).astype(float)
+
+def _zones_guess(x, y, num_curves):
+    return [ ('prefactor{:d}'.format(i+1), {'value':0.0}) for i in range(num_curves) ]
+
+
+
+MODELS = {
+    'peaks' : (_peaks, _peaks_guess, _peaks_jacobian),
+    'sines' : (_sines, _sines_guess, _sines_jacobian),
+    'eta' : (_eta, _eta_guess, _eta_jacobian),
+    'gauss' : (_gauss, _gauss_guess, _gauss_jacobian),
+    'lognormal' : (_lognormal, _lognormal_guess, _lognormal_jacobian),
+    'erf' : (_erf, _erf_guess, _erf_jacobian),
+    'erfinv' : (_erfinv, _erfinv_guess, _erfinv_jacobian),
+    'nlog' : (_nlog, _nlog_guess, _nlog_jacobian),
+    'expdecay' : (_expdecay, _expdecay_guess, _expdecay_jacobian),
+    'linear' : (_linear, _linear_guess, _linear_jacobian),
+    'zones' : (_zones, _zones_guess, _zones_jacobian),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _get_model(name, options):
+    func, guess, jacobian = MODELS[name]
+    return Model(name, func, guess, jacobian=jacobian, **dict(options))
+
+
+def get_model(name, **options):
+    '''Returns the (shared) Model of the given name (see MODELS), e.g.
+    get_model('sines', num_curves=3).'''
+    return _get_model(name, tuple(sorted(options.items())))
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.ImAnalysis.Correlation` - Orientational correlation functions
+================================================
+.. module:: SciAnalysis.ImAnalysis.Correlation
+   :synopsis: Computes orientational correlation functions g(r) of angle maps
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  Given a map of local orientation angles theta (e.g. of the grains in a
+# micrograph), the orientational correlation function is:
+#   g(r) = < cos( n*(theta(p) - theta(p+d)) ) >    over pairs with |d| = r
+# where n is the symmetry of the pattern.
+#
+# Since cos(n*(a-b)) = Re[ z(a) * conj(z(b)) ] with z = exp(i*n*theta), the sum
+# over all pairs separated by d is a cross-correlation, which is computed for
+# all d at once using FFTs (zero-padded, so that there is no wrap-around). The
+# number of pairs at each d (for the normalization) is likewise the
+# cross-correlation of the masks. The 2D result is then radially binned using
+# np.bincount.
+#
+# For images too large for the FFTs, orientation_correlation_sampled estimates
+# the same g(r) from randomly-selected pairs of pixels.
+#
+# Typical usage:
+#   r, g, count = orientation_correlation(angles, symmetry=6, mask=mask)
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import numpy as np
+
+
+
+# Pair weights
+################################################################################
+
+def _weights(angles, mask=None, edge_exclusion=0, step=1):
+    '''Returns the weights of the pixels used as targets (all valid pixels)
+    and as anchors (valid pixels on a grid with the given step, excluding a
+    border of edge_exclusion pixels).'''
+
+    h, w = angles.shape
+
+    target = np.isfinite(angles)
+    if mask is not None:
+        target &= (mask==1)
+
+    anchor = np.zeros((h, w), dtype=bool)
+    ex = edge_exclusion
+    anchor[ex:h-ex:step, ex:w-ex:step] = True
+    anchor &= target
+
+    return anchor, target
+
+
+def _radial_bins(h, w):
+    '''Returns the (rounded) radial distance for each displacement (dy, dx)
+    in the range -(h-1)..(h-1), -(w-1)..(w-1).'''
+
+    dy = np.arange(-(h-1), h)
+    dx = np.arange(-(w-1), w)
+
+    return np.rint( np.sqrt( np.square(dy[:,None]) + np.square(dx[None,:]) ) ).astype(int)
+
+
+
+# Correlation functions
+################################################################################
+
+def orientation_correlation(angles, symmetry=6, mask=None, edge_exclusion=0, step=1):
+    '''Computes the orientational correlation function of an angle map.
+
+    Parameters
+    ----------
+    angles : 2D array
+        Orientation angles (radians). Non-finite values are ignored.
+    symmetry : int
+        Symmetry of the pattern (the correlation is cos(symmetry*dtheta)).
+    mask : 2D array (optional)
+        Only pixels where mask==1 are considered.
+    edge_exclusion : int
+        Pixels within this distance of the image edge are not used as
+        anchors (they are still used as the partner of a pair).
+    step : int
+        Only every step-th pixel (in x and y) is used as an anchor.
+
+    Returns
+    -------
+    r : 1D array of int
+        Distances (pixels) for which there is at least one pair.
+    g : 1D array
+        Correlation values g(r).
+    count : 1D array
+        Number of pairs contributing to each g(r).
+    '''
+
+    h, w = angles.shape
+    anchor, target = _weights(angles, mask=mask, edge_exclusion=edge_exclusion, step=step)
+
+    z = np.exp( 1j*symmetry*np.where(target, angles, 0) )
+
+    # Zero-pad so that the circular correlation does not wrap around
+    from scipy import fft
+    shape = fft.next_fast_len(2*h-1), fft.next_fast_len(2*w-1)
+
+    # Sum over anchors p of: z(p)*conj(z(p+d)) and 1 (for pixel pairs that are both valid)
+    Fa = fft.fft2( np.where(anchor, z, 0), s=shape, workers=-1 )
+    Ft = fft.fft2( np.where(target, z, 0), s=shape, workers=-1 )
+    accumulator = fft.ifft2( Fa*np.conj(Ft), workers=-1 ).real
+    del Fa, Ft
+
+    Fa = fft.rfft2( anchor.astype(float), s=shape, workers=-1 )
+    Ft = fft.rfft2( target.astype(float), s=shape, workers=-1 )
+    count_accumulator = fft.irfft2( np.conj(Fa)*Ft, s=shape, workers=-1 )
+    del Fa, Ft
+
+    # Reorder as displacements d = (p+d) - p, from -(h-1) to +(h-1)
+    iy = np.arange(-(h-1), h)%shape[0]
+    ix = np.arange(-(w-1), w)%shape[1]
+    accumulator = accumulator[np.ix_(-iy%shape[0], -ix%shape[1])]
+    count_accumulator = np.rint( count_accumulator[np.ix_(iy, ix)] )
+
+    # Radial binning
+    r_dist = _radial_bins(h, w).ravel()
+    valid = count_accumulator.ravel()>0
+    g_sum = np.bincount(r_dist[valid], weights=accumulator.ravel()[valid])
+    count = np.bincount(r_dist[valid], weights=count_accumulator.ravel()[valid])
+
+    r = np.nonzero(count>0)[0]
+
+    return r, g_sum[r]/count[r], count[r]
+
+
+def orientation_correlation_sampled(angles, symmetry=6, mask=None, edge_exclusion=0, step=1, num_pairs=10**7, r_max=None, chunk_size=10**6, seed=None):
+    '''Estimates the orientational correlation function of an angle map from
+    randomly-selected pairs of pixels (for images where the FFTs of
+    orientation_correlation would be too expensive). Anchors are selected
+    from the same pixels as for orientation_correlation, and partners are
+    selected at uniformly-distributed displacements (within r_max), so that
+    the estimate of each g(r) weights the pairs in the same way.
+
+    Returns r, g, count (as for orientation_correlation).
+    '''
+
+    h, w = angles.shape
+    anchor, target = _weights(angles, mask=mask, edge_exclusion=edge_exclusion, step=step)
+    anchor_y, anchor_x = np.nonzero(anchor)
+    if len(anchor_y)<1:
+        return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+
+    if r_max is None:
+        r_max = int(np.ceil(np.sqrt(h*h + w*w)))
+    dy_max, dx_max = min(int(r_max), h-1), min(int(r_max), w-1)
+
+    rng = np.random.default_rng(seed)
+    num_bins = int(np.ceil(np.sqrt(dy_max**2 + dx_max**2))) + 2
+    g_sum = np.zeros(num_bins)
+    count = np.zeros(num_bins)
+
+    remaining = int(num_pairs)
+    while remaining>0:
+        n = min(remaining, chunk_size)
+        remaining -= n
+
+        k = rng.integers(0, len(anchor_y), size=n)
+        y1, x1 = anchor_y[k], anchor_x[k]
+        y2 = y1 + rng.integers(-dy_max, dy_max+1, size=n)
+        x2 = x1 + rng.integers(-dx_max, dx_max+1, size=n)
+
+        keep = (y2>=0) & (y2<h) & (x2>=0) & (x2<w)
+        y1, x1, y2, x2 = y1[keep], x1[keep], y2[keep], x2[keep]
+        keep = target[y2, x2]
+        y1, x1, y2, x2 = y1[keep], x1[keep], y2[keep], x2[keep]
+
+        r = np.rint( np.sqrt( np.square(y2-y1) + np.square(x2-x1) ) ).astype(int)
+        keep = r<=r_max
+        r = r[keep]
+        values = np.cos( symmetry*( angles[y1[keep], x1[keep]] - angles[y2[keep], x2[keep]] ) )
+
+        g_sum += np.bincount(r, weights=values, minlength=num_bins)
+        count += np.bincount(r, minlength=num_bins)
+
+    r = np.nonzero(count>0)[0]
+
+    return r, g_sum[r]/count[r], count[r]
@@ -27,12 +27,7 @@ import re # Regular expressions
 
 import numpy as np
 
-import matplotlib as mpl
 from ..settings import *
-if MATPLOTLIB_BACKEND is not None:
-    mpl.use(MATPLOTLIB_BACKEND)
-mpl.rcParams['mathtext.fontset'] = 'cm'
-import pylab as plt
 
 #from scipy.optimize import leastsq
 #import scipy.special
@@ -40,7 +35,7 @@ import pylab as plt
 import PIL # Python Image Library (for opening PNG, etc.)    
 
 from .. import tools
-from ..Data import *
+from ..Data import * # Also provides mpl and (lazily-loaded) plt
 
 
 
@@ -106,6 +101,7 @@ class Data2DImage(Data2D):
         
     def threshold_pixels(self, threshold, new_value=0.0):
         
+        self.data = writeable_array(self.data)
         self.data[self.data>threshold] = new_value
         
         
@@ -226,6 +222,7 @@ class Data2DImageRGB(Data2DImage):
         del img2
         
         
+    @Trace.timed('plot')
     def plot_image(self, save=None, show=False, size=10, ztrim=[0.01, 0.01], **plot_args):
         '''Generates a false-color image of the 2D data.'''
         
@@ -0,0 +1,284 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.ImAnalysis.Flakes.Features` - Per-flake features
+================================================
+.. module:: SciAnalysis.ImAnalysis.Flakes.Features
+   :synopsis: Color statistics and regions of all the flakes in a label map
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  find_flakes analyzes each flake (labeled region) of an image. Rather than
+# selecting each flake's pixels from the full image (image_labelmap==index),
+# FlakeFeatures computes the color statistics (means, standard deviations and
+# gray-level histograms) of all the flakes at once, using np.bincount over the
+# label map. The 'inner' region of each flake (the flake eroded by a kernel)
+# is likewise found for all flakes at once: a pixel is inside flake L if every
+# pixel of the kernel (centered on it) is part of L.
+#
+# Geometric quantities (perimeter, contour) are computed on a crop around each
+# flake's bounding box (with a 1-pixel border), which gives the same results as
+# for the full-size mask.
+#
+# The color planes used (gray, HSV) are computed together by color_planes,
+# directly from the 8-bit RGB values, as float32 (half the memory traffic of
+# float64, which matters for 20 Mpix microscope images).
+#
+# Typical usage:
+#   im_rgb, im_gray, im_hsv = color_planes(image)
+#   features = FlakeFeatures(image_labelmap, im_maps, num_flakes)
+#   region, (y0, x0) = features.region(index)
+#   features.color_fea[index], features.inner_color_fea[index]
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import numpy as np
+
+from ... import tools
+
+ndimage = tools.LazyModule('scipy.ndimage')
+
+
+
+# Color planes
+################################################################################
+
+GRAY_WEIGHTS = (0.2989, 0.5870, 0.1140)
+
+
+def color_planes(image):
+    '''Converts an image (PIL) into the color planes used for flake finding, in
+    one pass over the 8-bit RGB values. Returns:
+      im_rgb : (h,w,3) uint8 array
+      im_gray : (h,w) float32 array; values in range [0..255] (identical to
+                PIL convert('L') with GRAY_WEIGHTS)
+      im_hsv : (h,w,3) float32 array; values in range [0..1] (equivalent to
+               skimage.color.rgb2hsv, which is consistent with Matlab)'''
+
+    image = image.convert('RGB')
+    im_rgb = np.asarray(image)
+    im_gray = np.asarray(image.convert('L', GRAY_WEIGHTS+(0,)), dtype=np.float32)
+
+    # Integer arithmetic on the channels; each HSV plane is contiguous in
+    # memory (im_hsv is a channel-last view)
+    r, g, b = im_rgb.transpose(2,0,1).astype(np.int16)
+    v = np.maximum(np.maximum(r, g), b)
+    delta = v - np.minimum(np.minimum(r, g), b)
+    nonzero = delta>0
+
+    # Hue is relative to the channel with the maximum value (in case of ties,
+    # blue takes precedence over green, and green over red; as in rgb2hsv):
+    # hue = num/(6*delta), with num in [0, 6*delta)
+    blue_max, green_max = (b==v), (g==v)
+    num = np.where(blue_max, r-g+4*delta, np.where(green_max, b-r+2*delta, g-b))
+    num += 6*delta*(num<0)
+
+    planes = np.zeros((3,)+r.shape, dtype=np.float32)
+    np.divide(num, 6*delta, out=planes[0], where=nonzero)
+    np.divide(delta, v, out=planes[1], where=nonzero)
+    np.multiply(v, np.float32(1/255), out=planes[2])
+
+    im_hsv = np.moveaxis(planes, 0, 2)
+
+    return im_rgb, im_gray, im_hsv
+
+
+
+# Label maps
+################################################################################
+
+def relabel_flakes(image_labelmap, keep, dtype=float):
+    '''Returns a label map where the flakes with labels keep+1 are renumbered
+    (in the given order) as 1, 2, 3, ...; all other pixels are set to 0.'''
+
+    labels = np.asarray(image_labelmap).astype(np.intp, copy=False)
+    keep = np.asarray(keep, dtype=np.intp)
+
+    lut = np.zeros(int(labels.max())+1, dtype=dtype)
+    lut[keep+1] = np.arange(1, len(keep)+1)
+
+    return lut[labels]
+
+
+def _label_mean_std(labels, n, channel, counts):
+    '''Returns the mean and (population) standard deviation of the channel
+    values for each label.'''
+
+    mean = np.bincount(labels, weights=channel, minlength=n)/counts
+    dev = channel - mean[labels]
+    std = np.sqrt( np.bincount(labels, weights=dev*dev, minlength=n)/counts )
+
+    return mean, std
+
+
+def _label_entropy(labels, n, values, counts):
+    '''Returns the entropy (bits) of the histogram of the (uint8) values for
+    each label.'''
+
+    hist = np.bincount(labels*256 + values, minlength=n*256).reshape(n, 256)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        plogp = np.where(hist>0, hist*np.log2(np.maximum(hist, 1)), 0).sum(axis=1)
+        return np.log2(counts) - plogp/counts
+
+
+
+# FlakeFeatures
+################################################################################
+class FlakeFeatures(object):
+    '''Statistics of all the flakes (labels 1..num_flakes) in a label map.
+    Per-flake arrays are indexed by label (index 0 is the background).'''
+
+    COLOR_FEATURE_NAMES = [
+        'g contrast',
+        'v contrast',
+        'gray',
+        'gray std',
+        'H',
+        'S',
+        'V',
+        'H std',
+        'S std',
+        'V std',
+        'R',
+        'G',
+        'B',
+        'R std',
+        'G std',
+        'B std',
+        'entropy'
+        ]
+
+
+    def __init__(self, image_labelmap, im_maps, num_flakes, kernel=None):
+        '''Computes the statistics.
+
+        Parameters
+        ----------
+        image_labelmap : 2D array
+            Flakes are labeled 1..num_flakes; the background is 0.
+        im_maps : tuple
+            (im_gray, im_hsv, im_rgb, bk_gray, bk_hsv), as in find_flakes; if
+            bk_gray is None, contrasts are computed against the background
+            (label 0) pixels rather than against the background image.
+        num_flakes : int
+        kernel : 2D array (optional)
+            Structuring element used to define the inner region (default 5x5).
+        '''
+
+        self.labels = np.asarray(image_labelmap).astype(np.intp, copy=False)
+        self.shape = self.labels.shape
+        self.num_flakes = int(num_flakes)
+        n = self.num_flakes + 1
+
+        if kernel is None:
+            kernel = np.ones((5,5), np.uint8)
+
+        labels = self.labels.ravel()
+        self.slices = [None] + ndimage.find_objects(self.labels, max_label=self.num_flakes)
+        self.counts = np.bincount(labels, minlength=n)
+
+        h, w = self.shape
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y_sum = np.bincount(labels, weights=np.repeat(np.arange(h, dtype=float), w), minlength=n)
+            x_sum = np.bincount(labels, weights=np.tile(np.arange(w, dtype=float), h), minlength=n)
+            self.center_of_mass = np.stack([y_sum/self.counts, x_sum/self.counts], axis=1)
+
+        # Inner region: pixels where the whole kernel lies within the same flake
+        # (as for cv2.erode, pixels beyond the image edge do not erode)
+        footprint = np.asarray(kernel)>0
+        inner = (ndimage.minimum_filter(self.labels, footprint=footprint, mode='nearest')==self.labels)
+        inner &= (ndimage.maximum_filter(self.labels, footprint=footprint, mode='nearest')==self.labels)
+        inner_labels = np.where(inner, self.labels, 0).ravel()
+        self.inner_counts = np.bincount(inner_labels, minlength=n)
+        self.inner_counts[0] = 0
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.color_fea = self._color_features(labels, n, self.counts, im_maps)
+            self.inner_color_fea = self._color_features(inner_labels, n, self.inner_counts, im_maps, background=self.color_fea)
+
+        self.inner_color_fea[self.inner_counts==0] = 0
+
+        self._scratch = None
+        self._scratch_slice = None
+
+
+    def _color_features(self, labels, n, counts, im_maps, background=None):
+        '''Returns the (n, 17) array of color features (see COLOR_FEATURE_NAMES).
+        Contrasts are relative to the background image (if provided), or else
+        to the background pixels (label 0), whose means are taken from the
+        'background' features (if provided).'''
+
+        im_gray, im_hsv, im_rgb, bk_gray, bk_hsv = im_maps
+
+        gray = np.asarray(im_gray, dtype=float).ravel()
+        gray_mean, gray_std = _label_mean_std(labels, n, gray, counts)
+        hsv = [ _label_mean_std(labels, n, im_hsv[:,:,i].ravel(), counts) for i in range(3) ]
+        rgb = [ _label_mean_std(labels, n, im_rgb[:,:,i].ravel(), counts) for i in range(3) ]
+        v_mean = hsv[2][0]
+
+        if bk_gray is not None:
+            g_ref = np.bincount(labels, weights=np.asarray(bk_gray, dtype=float).ravel(), minlength=n)/counts
+            v_ref = np.bincount(labels, weights=bk_hsv[:,:,2].ravel(), minlength=n)/counts
+        elif background is not None:
+            g_ref, v_ref = background[0,2], background[0,6]
+        else:
+            g_ref, v_ref = gray_mean[0], v_mean[0]
+
+        gray_entropy = _label_entropy(labels, n, gray.astype(np.uint8), counts)
+
+        columns = [gray_mean-g_ref, v_mean-v_ref, gray_mean, gray_std] + \
+                    [mean for mean, std in hsv] + [std for mean, std in hsv] + \
+                    [mean for mean, std in rgb] + [std for mean, std in rgb] + \
+                    [gray_entropy]
+
+        return np.stack(columns, axis=1)
+
+
+    # Regions
+    ########################################
+
+    def bbox(self, index):
+        '''Bounding box [y1, y2, x1, x2] of the flake.'''
+        sy, sx = self.slices[index]
+        return [sy.start, sy.stop, sx.start, sx.stop]
+
+
+    def region(self, index, pad=1):
+        '''Returns the mask (uint8) of the flake, cropped to its bounding box
+        extended by pad pixels (within the image), and the (y0, x0) position
+        of the crop within the image.'''
+
+        h, w = self.shape
+        y1, y2, x1, x2 = self.bbox(index)
+        y0, x0 = max(y1-pad, 0), max(x1-pad, 0)
+        crop = self.labels[y0:min(y2+pad, h), x0:min(x2+pad, w)]
+
+        return (crop==index).astype(np.uint8), (y0, x0)
+
+
+    def full_region(self, index):
+        '''Returns the full-size mask (uint8) of the flake. The same array is
+        reused (and overwritten) on the next call.'''
+
+        if self._scratch is None:
+            self._scratch = np.zeros(self.shape, dtype=np.uint8)
+        elif self._scratch_slice is not None:
+            self._scratch[self._scratch_slice] = 0
+
+        self._scratch_slice = self.slices[index]
+        self._scratch[self._scratch_slice] = (self.labels[self._scratch_slice]==index)
+
+        return self._scratch
+
+
+    # End class FlakeFeatures(object)
+    ########################################
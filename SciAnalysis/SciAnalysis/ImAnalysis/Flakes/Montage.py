@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.ImAnalysis.Flakes.Montage` - Montages of flake images
+================================================
+.. module:: SciAnalysis.ImAnalysis.Flakes.Montage
+   :synopsis: Batched cropping and PIL rendering of flake thumbnails
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  Cluster reports show many flakes (a thumbnail of the region around each
+# flake, with overlays and labels). Rather than re-loading the source image
+# for every flake, and plotting each flake into its own matplotlib axes:
+#  - FlakeThumbnails groups the flakes by source image, decodes each image
+#    once, and crops (array slicing) and resizes all of that image's flakes.
+#    The thumbnails are kept in memory (JPEG-compressed), so that large
+#    numbers of flakes can be prepared in a single pass over the images.
+#  - FlakeMontage composes a grid of thumbnails (with the overlays and text
+#    labels drawn using PIL) into a single image.
+#
+# Typical usage:
+#   thumbnails = FlakeThumbnails(size=256, bbox_pad=0.5)
+#   thumbnails.add(flakes) # Reads each source image once
+#   montage = FlakeMontage(thumbnails, overlays=3).render(flakes, distances, nrows=3, ncols=7)
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import os
+import io
+import numpy as np
+
+import PIL
+from PIL import ImageDraw, ImageFont
+
+
+
+# Cropping
+################################################################################
+
+def flake_box(flake, shape, bbox_pad=0.5):
+    '''Returns the region (y1, y2, x1, x2) around the flake that is shown: a
+    square box centered on the flake's bounding box, padded by the fraction
+    bbox_pad (and clipped to the image of the given shape).'''
+
+    h, w = shape[:2]
+    y1, y2, x1, x2 = flake['bbox']
+    box_size = (1+bbox_pad)*max( abs(x2-x1), abs(y2-y1) )
+    x1p = int(np.clip((x1+x2)*0.5 - box_size/2, 0, w))
+    x2p = int(np.clip((x1+x2)*0.5 + box_size/2, 0, w))
+    y1p = int(np.clip((y1+y2)*0.5 - box_size/2, 0, h))
+    y2p = int(np.clip((y1+y2)*0.5 + box_size/2, 0, h))
+
+    return y1p, y2p, x1p, x2p
+
+
+def contrast_lut(average, image_contrast=(0, 1), image_contrast_trim=None):
+    '''Returns the lookup table (uint8) that rescales intensities, equivalent
+    to skimage.exposure.rescale_intensity with the in_range computed from
+    image_contrast (and image_contrast_trim, relative to the average value).'''
+
+    im_contrast = image_contrast
+    if image_contrast_trim is not None:
+        amt = np.clip(image_contrast_trim, 0, 0.95)
+        avg = average/255
+        im_contrast = ( avg*amt , 1.0-(1.0-avg)*amt )
+    imin, imax = im_contrast[0]*255, im_contrast[1]*255
+
+    values = np.clip( (np.arange(256) - imin)/(imax - imin), 0, 1 )
+
+    return (values*255).astype(np.uint8)
+
+
+def _flake_key(flake):
+    return ( str(flake['infile']).replace('\\', '/'), int(flake['index']) )
+
+
+
+# FlakeThumbnails
+################################################################################
+class FlakeThumbnails(object):
+    '''Thumbnails (crops around flakes, with the contrast adjusted, resized so
+    that the larger side is size pixels). Thumbnails are created in batches
+    (add), which read each source image only once.'''
+
+    def __init__(self, size=256, bbox_pad=0.5, image_contrast=(0, 1), image_contrast_trim=None, quality=95):
+
+        self.size = int(size)
+        self.bbox_pad = bbox_pad
+        self.image_contrast = image_contrast
+        self.image_contrast_trim = image_contrast_trim
+        self.quality = quality
+
+        self._thumbnails = {} # (infile, index) : (JPEG bytes, box, factor)
+
+
+    def __len__(self):
+        return len(self._thumbnails)
+
+
+    def add(self, flakes):
+        '''Creates the thumbnails of the flakes (that are not yet available).'''
+
+        groups = {}
+        for flake in flakes:
+            key = _flake_key(flake)
+            if key not in self._thumbnails:
+                groups.setdefault(key[0], {})[key[1]] = flake
+
+        for infile, group in groups.items():
+            with PIL.Image.open(infile) as image:
+                img = np.asarray(image.convert('RGB'))
+            lut = contrast_lut(np.average(img), self.image_contrast, self.image_contrast_trim)
+
+            for index, flake in group.items():
+                box = y1p, y2p, x1p, x2p = flake_box(flake, img.shape, self.bbox_pad)
+                crop = lut[img[y1p:y2p, x1p:x2p]]
+
+                h, w = crop.shape[:2]
+                factor = self.size/max(h, w, 1)
+                thumbnail = PIL.Image.fromarray(crop)
+                thumbnail = thumbnail.resize( (max(int(round(w*factor)), 1), max(int(round(h*factor)), 1)), resample=PIL.Image.BILINEAR )
+
+                buf = io.BytesIO()
+                thumbnail.save(buf, format='JPEG', quality=self.quality)
+                self._thumbnails[(infile, index)] = (buf.getvalue(), box, factor)
+
+
+    def get(self, flake):
+        '''Returns the thumbnail (PIL image) of the flake, the region (y1, y2,
+        x1, x2) of the source image it shows, and its scaling factor.'''
+
+        key = _flake_key(flake)
+        if key not in self._thumbnails:
+            self.add([flake])
+        data, box, factor = self._thumbnails[key]
+
+        return PIL.Image.open(io.BytesIO(data)).convert('RGB'), box, factor
+
+
+    # End class FlakeThumbnails(object)
+    ########################################
+
+
+
+# FlakeMontage
+################################################################################
+class FlakeMontage(object):
+    '''Renders grids of flake thumbnails (with overlays and labels). The
+    overlays level follows the plotting in cluster._plot_flake_image.'''
+
+    def __init__(self, thumbnails, overlays=3, background=(255,255,255), font_size=None):
+
+        self.thumbnails = thumbnails
+        self.overlays = overlays
+        self.background = background
+
+        size = thumbnails.size
+        font_size = max(int(size/14), 6) if font_size is None else font_size
+        try:
+            self.font = ImageFont.load_default(size=font_size)
+            self.font_small = ImageFont.load_default(size=max(int(font_size*0.75), 5))
+        except TypeError:
+            # Older PIL (fixed-size bitmap font)
+            self.font = self.font_small = ImageFont.load_default()
+
+
+    def render(self, flakes, distances, nrows, ncols):
+        '''Returns the montage (uint8 RGB array) of the flakes, arranged in a
+        grid (row by row); unused cells are left blank.'''
+
+        s = self.thumbnails.size
+        canvas = PIL.Image.new('RGB', (ncols*s, nrows*s), self.background)
+        for i in range( min(len(flakes), nrows*ncols) ):
+            irow, icol = divmod(i, ncols)
+            canvas.paste(self.tile(flakes[i], distances[i]), (icol*s, irow*s))
+
+        return np.asarray(canvas)
+
+
+    def tile(self, flake, distance=None):
+        '''Returns the image (PIL) of one cell of the montage.'''
+
+        s = self.thumbnails.size
+        thumbnail, (y1p, y2p, x1p, x2p), factor = self.thumbnails.get(flake)
+        tw, th = thumbnail.size
+        ox, oy = (s-tw)//2, (s-th)//2
+
+        tile = PIL.Image.new('RGBA', (s, s), self.background+(255,))
+        tile.paste(thumbnail, (ox, oy))
+
+        def xy(x, y):
+            return ( ox + (x-x1p)*factor, oy + (y-y1p)*factor )
+
+        # Overlays (semi-transparent)
+        overlay = PIL.Image.new('RGBA', (s, s), (0,0,0,0))
+        draw = ImageDraw.Draw(overlay)
+        yc, xc = flake['center_of_mass']
+        size = flake['radius_pixels']
+
+        if self.overlays>=1:
+            c = np.asarray(flake['contour'])
+            if len(c)>1:
+                points = [ xy(x, y) for x, y in c ]
+                draw.line(points + points[:1], fill=(255,0,0,90), width=1)
+        if self.overlays>=7:
+            c = np.asarray(flake['convex_hull'])
+            if len(c)>1:
+                points = [ xy(x, y) for y, x in c ]
+                draw.line(points + points[:1], fill=(0,128,0,128), width=1)
+        if self.overlays>=5:
+            y1, y2, x1, x2 = flake['bbox']
+            draw.rectangle( [xy(x1, y1), xy(x2, y2)], outline=(255,165,0,128), width=2 )
+        if self.overlays>=3:
+            # Cross hair
+            draw.line( [xy(xc-size/2, yc), xy(xc+size/2, yc)], fill=(255,0,0,77), width=1 )
+            draw.line( [xy(xc, yc-size/2), xy(xc, yc+size/2)], fill=(255,0,0,77), width=1 )
+        if self.overlays>=5:
+            # Circle denoting size
+            draw.ellipse( [xy(xc-size, yc-size), xy(xc+size, yc+size)], outline=(255,0,0,77), width=1 )
+
+        tile = PIL.Image.alpha_composite(tile, overlay).convert('RGB')
+
+
+        # Labels
+        draw = ImageDraw.Draw(tile)
+        pad = 2
+        text = '{}\nflake{:03d}\n({}, {})'.format(os.path.basename(str(flake['infile'])), int(flake['index']), int(xc), int(yc))
+        draw.multiline_text((pad, pad), text, fill=(255,255,255), font=self.font_small)
+
+        self._text_bottom(draw, 'left', '{:.1f} um'.format(flake['radius_um']), (255,0,0), self.font)
+        if distance is not None:
+            self._text_bottom(draw, 'center', '{:.1f}'.format(distance), (255,255,255), self.font_small)
+        self._text_bottom(draw, 'right', '{:.3f}'.format(flake['flake_contrast']), (255,165,0), self.font)
+
+        return tile
+
+
+    def _text_bottom(self, draw, align, text, fill, font):
+
+        s, pad = self.thumbnails.size, 2
+        left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+        if align=='left':
+            x = pad
+        elif align=='right':
+            x = s - pad - right
+        else:
+            x = (s - right)/2
+        draw.text((x, s - pad - bottom), text, fill=fill, font=font)
+
+
+    # End class FlakeMontage(object)
+    ########################################
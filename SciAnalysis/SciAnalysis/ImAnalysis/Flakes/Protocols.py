@@ -10,14 +10,15 @@ import pickle
 from PIL import Image
 import matplotlib.patches as patches
 
-from scipy import ndimage
-from scipy.stats import entropy
 from scipy.spatial.distance import cdist
 import skimage
 import skimage.exposure
 import skimage.measure as measure
 import cv2
 
+from .Features import *
+from .Store import *
+
 
 
 
@@ -70,6 +71,7 @@ class find_flakes(thumbnails):
                         'resize' : 1.0 ,
                         'bbox_expanded' : 0.1 ,
                         'overlays' : 4 , # Larger number adds more annotations
+                        'flake_store' : None , # Columnar store (in output_dir) of the flakes of all images, e.g. 'flakes.h5' (serial runs only)
                         }
         self.run_args.update(kwargs)
         
@@ -88,6 +90,8 @@ class find_flakes(thumbnails):
             
         self.MatSegUtils = MatSegUtils
         
+        self._background = None # Cached color planes of the background image
+        
 
     @run_default
     def run(self, data, output_dir, **run_args):
@@ -102,13 +106,8 @@ class find_flakes(thumbnails):
         if run_args['verbosity']>=5:
             print('  Loading image')
         
-        image = Image.open(data.infile).convert('RGB')
-        im_rgb = np.array(image).astype('float')
-        im_gray = np.array(image.convert('L', (0.2989, 0.5870, 0.1140, 0))).astype('float') # vals in range [0..255]
-        # im_hsv = np.array(image.convert('HSV')).astype('float') # vals in range [0..255]
-        # Alternate HSV conversion (consistent with Matlab)
-        im_hsv = skimage.color.rgb2hsv(im_rgb)
-        im_hsv[:,:,2] = im_hsv[:,:,2]/255.0 # vals in range [0..1]
+        with Image.open(data.infile) as image:
+            im_rgb, im_gray, im_hsv = color_planes(image) # gray in range [0..255]; HSV in range [0..1]
 
         h, w, c = im_rgb.shape
         if run_args['verbosity']>=5:
@@ -116,13 +115,8 @@ class find_flakes(thumbnails):
 
         
         if run_args['background']:
-            background_image = Image.open(run_args['background']).convert('RGB')
-            bk_rgb = np.array(background_image).astype('float')
-            bk_gray = np.array( background_image.convert('L', (0.2989, 0.5870, 0.1140, 0)) ).astype('float')
-            # bk_hsv = np.array(background_image.convert('HSV')).astype('float')
-            # Alternate HSV conversion (consistent with Matlab)
-            bk_hsv = skimage.color.rgb2hsv(bk_rgb)
-            bk_hsv[:,:,2] = bk_hsv[:,:,2]/255.0
+            background = self.load_background(run_args['background'])
+            bk_gray, bk_hsv = background['gray'], background['hsv']
             
             im_maps = im_gray, im_hsv, im_rgb, bk_gray, bk_hsv
             
@@ -140,7 +134,7 @@ class find_flakes(thumbnails):
         
         #res_map, image_labelmap, flake_centroids, flake_sizes, num_flakes = self.MatSegUtils.perform_robustfit_multichannel(im_hsv, im_gray, run_args['image_threshold'], run_args['size_threshold'])
 
-        res_map, image_labelmap, flake_centroids, flake_sizes, num_flakes = self.perform_background_threshold(im_hsv, im_gray, background_image, **run_args)
+        res_map, image_labelmap, flake_centroids, flake_sizes, num_flakes = self.perform_background_threshold(im_hsv, im_gray, bk_hsv, bk_gray, **run_args)
         
         
         
@@ -150,7 +144,10 @@ class find_flakes(thumbnails):
         if run_args['background']:
             if run_args['verbosity']>=4:
                 print('  Segmenting background')
-            _, _, bk_flake_centroids, _, n = self.MatSegUtils.perform_robustfit(bk_gray, 10, 0)
+            if 'centroids' not in background:
+                _, _, background['centroids'], _, _ = self.MatSegUtils.perform_robustfit(bk_gray.astype(float), 10, 0)
+            bk_flake_centroids = background['centroids']
+            n = len(bk_flake_centroids)
             
             if n>0:
                 # Remove regions in background
@@ -166,12 +163,7 @@ class find_flakes(thumbnails):
                     print('    {} background objects; {} flakes remain'.format(n, num_flakes))
                 
                 # Reprocess label map
-                new_image_labels = np.zeros(image_labelmap.shape)
-                cnt = 0
-                for idx in to_keep:
-                    cnt += 1
-                    new_image_labels[image_labelmap==idx+1] = cnt
-                image_labelmap = new_image_labels            
+                image_labelmap = relabel_flakes(image_labelmap, to_keep)
             
         results['num_flakes'] = num_flakes
 
@@ -222,11 +214,12 @@ class find_flakes(thumbnails):
         
         flakes = []
         kernel = np.ones((5,5), np.uint8)
+        features = FlakeFeatures(image_labelmap, im_maps, num_flakes, kernel=kernel)
         for i in range(num_flakes):
             if run_args['verbosity']>=5:
                 print('    Flake {}/{} ({:.1f}%)'.format(i+1, num_flakes, 100.*i/num_flakes))
                 
-            flake_i = self.flake_analysis(image_labelmap, im_maps, index=i+1, kernel=kernel, **run_args)
+            flake_i = self.flake_analysis(features, index=i+1, **run_args)
 
             flake_i['name'] = data.name
             flake_i['infile'] = data.infile
@@ -263,63 +256,65 @@ class find_flakes(thumbnails):
         outfile = self.get_outfile(data.name, output_dir, ext='.pkl')
         with open(outfile, 'wb') as fout:
             pickle.dump(to_save, fout)
+            
+        # Append the flakes to the store for the whole set of images
+        if run_args['flake_store'] and FlakeStore.available():
+            store = FlakeStore(os.path.join(output_dir, run_args['flake_store']))
+            store.append(flakes, name=data.name, infile=data.infile)
         
         return results
 
 
 
-    def perform_background_threshold(self, im_hsv, im_gray, bk_rgb, **run_args):
+    def load_background(self, infile):
+        '''Returns the color planes (gray and HSV, see color_planes) of the
+        background image. The conversion is done once, and reused for all the
+        images that are analyzed (unless the background file changes).'''
+        
+        key = ( os.path.abspath(infile), os.path.getmtime(infile) )
+        if self._background is None or self._background['key']!=key:
+            with Image.open(infile) as image:
+                _, bk_gray, bk_hsv = color_planes(image)
+            self._background = { 'key': key, 'gray': bk_gray, 'hsv': bk_hsv }
+            
+        return self._background
+
+
+    def perform_background_threshold(self, im_hsv, im_gray, bk_hsv, bk_gray, **run_args):
         
         #res_map, image_labelmap, flake_centroids, flake_sizes, num_flakes = self.MatSegUtils.perform_robustfit_multichannel(im_hsv, im_gray, run_args['image_threshold'], run_args['size_threshold'])
         
-        # Use gray, hue, saturation
-        im_ghs = np.concatenate([np.expand_dims(im_gray/255,2), im_hsv[:,:,:2]], axis=2) # vals in range [0..1]
+        # Residual over gray, hue, saturation (vals in range [0..1])
+        h, w = im_gray.shape
+        c = 3
+        res_map = np.abs(im_gray-bk_gray)
+        res_map *= 1/255
         
+        # Hue channel is special due to the cyclic nature of its definition (where 0 and 1 are same number)
+        r = np.abs(im_hsv[:,:,0]-bk_hsv[:,:,0])
+        res_map += np.minimum(r, 1-r)
         
-        bk_gray = np.array( bk_rgb.convert('L', (0.2989, 0.5870, 0.1140, 0)) ).astype('float') # vals in range [0..255]
-        bk_rgb = np.array(bk_rgb).astype('float')
-        bk_hsv = skimage.color.rgb2hsv(bk_rgb)
-        bk_hsv[:,:,2] = bk_hsv[:,:,2]/255.0 # vals in range [0..1]
-        bk_ghs = np.concatenate([np.expand_dims(bk_gray/255,2), bk_hsv[:,:,:2]], axis=2) # vals in range [0..1]
-
-
-        h, w, c = im_ghs.shape
-        res_map = np.zeros([h,w])
-        for ic in range(c):
-            im_c = im_ghs[:,:,ic]
-            #val_stats(im_c, name=ic)
-            bk_c = bk_ghs[:,:,ic]
-
-            if ic==1:
-                # Hue channel is special due to the cyclic nature of its definition (where 0 and 1 are same number)
-                r = np.min( [np.abs(im_c-bk_c) , 1-np.abs(im_c-bk_c)], axis=0 )
-                res_map +=  r
-            else:
-                res_map +=  np.abs(im_c-bk_c)
+        r = np.abs(im_hsv[:,:,1]-bk_hsv[:,:,1], out=r)
+        res_map += r
             
         thresh = c*run_args['image_threshold']/255
         outlier_map = res_map>thresh
         outlier_map = outlier_map.astype(np.uint8)
         
         # connected component detection
-        nCC, image_labelmap, _, flake_centroids = cv2.connectedComponentsWithStats(outlier_map)
+        nCC, image_labelmap, flake_stats, flake_centroids = cv2.connectedComponentsWithStats(outlier_map)
         # flake_centroid: [m, 2] array, indicates row, column of the centroid
         flake_centroids = np.flip(flake_centroids, 1)
         flake_centroids = flake_centroids[1:].astype('int')
 
-        _, flake_sizes = np.unique(image_labelmap, return_counts=True)
+        flake_sizes = flake_stats[:, cv2.CC_STAT_AREA].astype(np.intp)
         # remove the background size
         flake_sizes = flake_sizes[1:]
         if run_args['size_threshold'] > 0:
             # remove small connect component
             large_flakes = flake_sizes > run_args['size_threshold']
             large_flake_idxs = np.nonzero(large_flakes)[0]
-            new_image_labels = np.zeros([h, w])
-            cnt = 0
-            for idx in large_flake_idxs:
-                cnt += 1
-                new_image_labels[image_labelmap==idx+1] = cnt
-            image_labelmap = new_image_labels
+            image_labelmap = relabel_flakes(image_labelmap, large_flake_idxs)
             num_flakes = large_flakes.sum()
             flake_centroids = flake_centroids[large_flake_idxs]
             flake_sizes = flake_sizes[large_flake_idxs]
@@ -422,30 +417,29 @@ class find_flakes(thumbnails):
     
     
 
-    def flake_analysis(self, image_labelmap, im_maps, index, kernel, **run_args):
+    def flake_analysis(self, features, index, **run_args):
+        '''Computes the features of one flake, given the FlakeFeatures of the
+        image. Geometric quantities are computed on a crop around the flake.'''
         
-        h, w = image_labelmap.shape
-        im_gray, im_hsv, im_rgb, bk_gray, bk_hsv = im_maps
+        h, w = features.shape
 
         
         flake_i = {}
         
-        flake_region = (image_labelmap==index).astype(np.uint8)
+        # Flake mask cropped to its bounding box (with a 1-pixel border)
+        flake_region, (y0, x0) = features.region(index, pad=1)
         flake_i['index'] = index
-        flake_i['size_pixels'] = np.sum(flake_region)
-        flake_i['center_of_mass'] = ndimage.measurements.center_of_mass(flake_region)
+        flake_i['size_pixels'] = features.counts[index]
+        flake_i['center_of_mass'] = tuple(features.center_of_mass[index])
         flake_i['perimeter_pixels'] = measure.perimeter(flake_region)
         
         
         # Bounding box [y1, y2, x1, x2]
-        f_mask_r, f_mask_c = np.nonzero(flake_region)
-        f_mask_r_min = min(f_mask_r)
-        f_mask_r_max = max(f_mask_r)
+        flake_i['bbox'] = features.bbox(index)
+        f_mask_r_min, f_mask_r_max = flake_i['bbox'][0], flake_i['bbox'][1]-1
         f_mask_height = f_mask_r_max - f_mask_r_min
-        f_mask_c_min = min(f_mask_c)
-        f_mask_c_max = max(f_mask_c)
+        f_mask_c_min, f_mask_c_max = flake_i['bbox'][2], flake_i['bbox'][3]-1
         f_mask_width = f_mask_c_max - f_mask_c_min
-        flake_i['bbox'] = [f_mask_r_min, f_mask_r_max+1, f_mask_c_min, f_mask_c_max+1]
         
         # Expanded bounding box
         expand = run_args['bbox_expanded']
@@ -466,7 +460,7 @@ class find_flakes(thumbnails):
         
         # Flake contour (call signature depends on cv2 version)
         #_, flake_contour, _ = cv2.findContours(flake_region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-        flake_contour, _ = cv2.findContours(flake_region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        flake_contour, _ = cv2.findContours(flake_region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(x0, y0))
         flake_i['contour'] = np.squeeze(flake_contour[0], 1)
         flake_i['contour_perimeter_pixels'] = self.total_length(flake_i['contour'])
         flake_i['contour_size_pixels'] = self.polygon_area(flake_i['contour'])
@@ -482,78 +476,18 @@ class find_flakes(thumbnails):
         contours_center_dis = cdist(np.expand_dims(flake_i['center_of_mass'],0), flake_contour)
         flake_shape_contour_hist = np.histogram(contours_center_dis, bins=15)[0]
         flake_shape_contour_hist = flake_shape_contour_hist / flake_shape_contour_hist.sum()
-        flake_shape_fracdim = self.MatSegUtils.fractal_dimension(flake_region)
+        # The box-counting depends on the image size, so uses the full-size mask
+        flake_shape_fracdim = self.MatSegUtils.fractal_dimension(features.full_region(index))
         flake_i['flake_shape_fea'] = np.array([flake_shape_len_area_ratio] + list(flake_shape_contour_hist) + [flake_shape_fracdim])
         
         flake_i['flake_shape_fea_names'] = ['P/A'] + ['hist {}'.format(i) for i in range(15)] + ['fractal dimension']
 
 
-        # Calculate color features of the flake
-        if run_args['background']:
-            flake_i['flake_contrast'] = (im_gray[flake_region>0].mean() - bk_gray[flake_region>0].mean())/255.0
-        else:
-            background_region = (image_labelmap==0)
-            flake_i['flake_contrast'] = (im_gray[flake_region>0].mean() - im_gray[background_region].mean())/255.0
+        # Color features of the flake, and of its inner (eroded) region
+        flake_i['flake_contrast'] = features.color_fea[index, 0]/255.0
+        flake_i['flake_color_fea'] = np.concatenate([features.color_fea[index], features.inner_color_fea[index]])
         
-        inner_region = cv2.erode(flake_region, kernel, iterations=1)
-
-        if run_args['background']:
-            flake_color_fea = [im_gray[flake_region>0].mean() - bk_gray[flake_region>0].mean(), 
-                            im_hsv[flake_region>0, 2].mean() - bk_hsv[flake_region>0, 2].mean()] + \
-                            [im_gray[flake_region>0].mean(), im_gray[flake_region>0].std()] + \
-                            list(im_hsv[flake_region>0].mean(0)) + list(im_hsv[flake_region>0].std(0)) + \
-                            list(im_rgb[flake_region>0].mean(0)) + list(im_rgb[flake_region>0].std(0))
-        else:
-            flake_color_fea = [im_gray[flake_region>0].mean() - im_gray[background_region].mean(), 
-                            im_hsv[flake_region>0, 2].mean() - im_hsv[background_region, 2].mean()] + \
-                            [im_gray[flake_region>0].mean(), im_gray[flake_region>0].std()] + \
-                            list(im_hsv[flake_region>0].mean(0)) + list(im_hsv[flake_region>0].std(0)) + \
-                            list(im_rgb[flake_region>0].mean(0)) + list(im_rgb[flake_region>0].std(0))
-            
-        # flake_color_entropy = entropy(im_gray[flake_region>0].astype('uint8'), disk(5))
-        flake_color_entropy = cv2.calcHist([im_gray[flake_region>0].astype('uint8')],[0],None,[256],[0,256])
-        flake_color_entropy = entropy(flake_color_entropy, base=2)
-        flake_inner_color_fea = [0] * 16
-        flake_inner_color_entropy = 0
-        if inner_region.sum() > 0:
-            if run_args['background']:
-                flake_inner_color_fea = [im_gray[inner_region>0].mean() - bk_gray[inner_region>0].mean(), 
-                            im_hsv[inner_region>0, 2].mean() - bk_hsv[inner_region>0, 2].mean()] + \
-                            [im_gray[inner_region>0].mean(), im_gray[inner_region>0].std()] + \
-                            list(im_hsv[inner_region>0].mean(0)) + list(im_hsv[inner_region>0].std(0)) + \
-                            list(im_rgb[inner_region>0].mean(0)) + list(im_rgb[inner_region>0].std(0))
-            else:
-                flake_inner_color_fea = [im_gray[inner_region>0].mean() - im_gray[background_region].mean(), 
-                            im_hsv[inner_region>0, 2].mean() - im_hsv[background_region, 2].mean()] + \
-                            [im_gray[inner_region>0].mean(), im_gray[inner_region>0].std()] + \
-                            list(im_hsv[inner_region>0].mean(0)) + list(im_hsv[inner_region>0].std(0)) + \
-                            list(im_rgb[inner_region>0].mean(0)) + list(im_rgb[inner_region>0].std(0))
-
-            # flake_inner_color_entropy = entropy(im_gray[inner_region>0].astype('uint8'), disk(5))
-            flake_inner_color_entropy = cv2.calcHist([im_gray[inner_region>0].astype('uint8')],[0],None,[256],[0,256])
-            flake_inner_color_entropy = entropy(flake_inner_color_entropy, base=2)
-        flake_i['flake_color_fea'] = np.array(flake_color_fea + [flake_color_entropy] + flake_inner_color_fea + [flake_inner_color_entropy])
-        
-        
-        feature_names_color = [
-            'g contrast',
-            'v contrast',
-            'gray',
-            'gray std',
-            'H',
-            'S',
-            'V',
-            'H std',
-            'S std',
-            'V std',
-            'R',
-            'G',
-            'B',
-            'R std',
-            'G std',
-            'B std',
-            'entropy'
-            ]
+        feature_names_color = features.COLOR_FEATURE_NAMES
         feature_names_color = feature_names_color + ['{}_inner'.format(f) for f in feature_names_color]
         flake_i['flake_color_fea_names'] = feature_names_color
 
@@ -583,10 +517,6 @@ class find_flakes(thumbnails):
             
     def colored_objects(self, labeled_array, outfile, **run_args):
         # Colored image
-        im = PIL.Image.fromarray( np.uint8(labeled_array) )
-        im = im.convert('RGB')
-        pix = im.load()
-        
         color_list = [ (1,0,0), (0,1,0), (0,0,1), (1,1,0), (1,0,1),(0,1,1),(1,1,1),]
         color_list2 = [ (0.7*c[0], 0.7*c[1], 0.7*c[2]) for c in color_list ]
         color_list3 = [ (0.5*c[0], 1.0*c[1], 1.0*c[2]) for c in color_list ]
@@ -600,16 +530,8 @@ class find_flakes(thumbnails):
         color_list11 = [ (0.5*c[0], 0.7*c[1], 1.0*c[2]) for c in color_list ]
         color_list = color_list + color_list2 + color_list3 + color_list4 + color_list5 + color_list6 + color_list7 + color_list8 + color_list9 + color_list10 + color_list11
         
-        h, w = labeled_array.shape
-        for ix in range(w):
-            for iy in range(h):
-                object_index = labeled_array[iy,ix]
-                if object_index==0:
-                    c = (0, 0, 0)
-                else:
-                    c = color_list[ int(object_index%len(color_list)) ]
-                    c = ( int(c[0]*255), int(c[1]*255), int(c[2]*255) )
-                pix[ix,iy] = c            
+        lut = label_lut(color_list, np.max(labeled_array))
+        im = PIL.Image.fromarray( render_labels(labeled_array, lut) )
         
         im.save(outfile)        
 
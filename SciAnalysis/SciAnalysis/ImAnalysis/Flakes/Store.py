@@ -0,0 +1,308 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.ImAnalysis.Flakes.Store` - Columnar store of flake features
+================================================
+.. module:: SciAnalysis.ImAnalysis.Flakes.Store
+   :synopsis: Append-only HDF5 table of the flakes found in a set of images
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  find_flakes saves the flakes of each image into a pickle file. Aggregating a
+# large survey (e.g. for clustering) then means unpickling one file per image,
+# and building feature arrays one flake at a time. Instead, find_flakes can
+# also append the flakes of each image to a single HDF5 file (the FlakeStore;
+# enabled with run_args flake_store='flakes.h5'), where every quantity is a
+# column:
+#   /flakes/<key>           one row per flake (numbers, or fixed-length vectors,
+#                           such as the feature vectors)
+#   /flakes/image           row (in /images) of the flake's image
+#   /images/name, infile    one row per image
+#   /images/valid           False for images that were later re-analyzed
+#   /ragged/<key>/points    variable-length per-flake arrays (contours), stored
+#   /ragged/<key>/start     as concatenated points, with the start and length
+#   /ragged/<key>/length    of each flake's points
+# Lists of strings (e.g. the feature names) are saved as attributes of /flakes.
+#
+# Reading returns a FlakeTable, which holds the columns as arrays (read in one
+# pass), but can also be used like the list of flake dicts that the pickles
+# provide (flakes[i], len(flakes), flakes[indices]). The (large) ragged arrays
+# are only read for the flakes that are accessed.
+#
+# Typical usage:
+#   FlakeStore(outfile).append(flakes, name=data.name, infile=data.infile)
+#   flakes = FlakeStore(outfile).read(names=names)
+#   features = flakes.column('flake_color_fea')
+################################################################################
+# Known Bugs:
+#  - The store is not safe for simultaneous writes (e.g. from parallel
+#    find_flakes processes); it is therefore disabled by default in
+#    find_flakes, and should only be enabled for serial runs.
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import os
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+
+# Keys that describe the image (rather than the flake)
+IMAGE_KEYS = ['name', 'infile']
+# Keys stored as integers (other numbers are stored as floats)
+INTEGER_KEYS = ['index']
+
+
+def _kind(value):
+    '''Classifies a flake value as: 'names' (list of strings), 'ragged'
+    (variable-length array), 'column' (number or vector) or None (not
+    stored).'''
+
+    if isinstance(value, str):
+        return None
+    if isinstance(value, (list, tuple)) and len(value)>0 and all(isinstance(v, str) for v in value):
+        return 'names'
+    value = np.asarray(value)
+    if value.dtype.kind not in 'biuf':
+        return None
+    if value.ndim==2:
+        return 'ragged'
+    if value.ndim<=1:
+        return 'column'
+    return None
+
+
+
+# FlakeStore
+################################################################################
+class FlakeStore(object):
+    '''Append-only HDF5 table of flakes (see module documentation).'''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+
+    @staticmethod
+    def available():
+        return h5py is not None
+
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+
+    def append(self, flakes, name, infile=None):
+        '''Appends the flakes (list of dicts, as generated by find_flakes) of
+        one image. If the image (name) is already in the store, its previous
+        flakes are marked as invalid.'''
+
+        with h5py.File(self.filename, 'a') as fout:
+
+            images = fout.require_group('images')
+            if 'name' not in images:
+                string = h5py.string_dtype()
+                images.create_dataset('name', shape=(0,), maxshape=(None,), dtype=string, chunks=(256,))
+                images.create_dataset('infile', shape=(0,), maxshape=(None,), dtype=string, chunks=(256,))
+                images.create_dataset('valid', shape=(0,), maxshape=(None,), dtype=bool, chunks=(256,))
+
+            # Invalidate previous analysis of the same image
+            names = images['name'].asstr()[...]
+            previous = np.nonzero(names==name)[0]
+            if len(previous)>0:
+                images['valid'][previous] = False
+
+            image = len(names)
+            self._append(images['name'], [name])
+            self._append(images['infile'], ['' if infile is None else infile])
+            self._append(images['valid'], [True])
+
+            if len(flakes)<1:
+                return
+
+            table = fout.require_group('flakes')
+            ragged = fout.require_group('ragged')
+            for key, value in flakes[0].items():
+                if key in IMAGE_KEYS:
+                    continue
+
+                kind = _kind(value)
+                if kind=='names':
+                    if key not in table.attrs:
+                        table.attrs[key] = list(value)
+
+                elif kind=='column':
+                    values = np.asarray([flake[key] for flake in flakes])
+                    if key not in table:
+                        dtype = np.int64 if key in INTEGER_KEYS else (bool if values.dtype.kind=='b' else np.float64)
+                        table.create_dataset(key, shape=(0,)+values.shape[1:], maxshape=(None,)+values.shape[1:], dtype=dtype, chunks=True)
+                    self._append(table[key], values)
+
+                elif kind=='ragged':
+                    arrays = [np.asarray(flake[key]) for flake in flakes]
+                    lengths = np.asarray([len(a) for a in arrays], dtype=np.int64)
+                    points = np.concatenate(arrays, axis=0)
+                    if key not in ragged:
+                        group = ragged.create_group(key)
+                        group.create_dataset('points', shape=(0,)+points.shape[1:], maxshape=(None,)+points.shape[1:], dtype=points.dtype, chunks=True)
+                        group.create_dataset('start', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=True)
+                        group.create_dataset('length', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=True)
+                    group = ragged[key]
+                    start = len(group['points'])
+                    self._append(group['points'], points)
+                    self._append(group['start'], start + np.cumsum(lengths) - lengths)
+                    self._append(group['length'], lengths)
+
+            if 'image' not in table:
+                table.create_dataset('image', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=True)
+            self._append(table['image'], np.full(len(flakes), image, dtype=np.int64))
+
+
+    def _append(self, dataset, values):
+        n = len(dataset)
+        dataset.resize(n+len(values), axis=0)
+        dataset[n:] = values
+
+
+    def read(self, names=None):
+        '''Returns a FlakeTable of the (valid) flakes, optionally restricted
+        to the given image names (in which case the flakes are ordered by
+        image, in the order given). Returns None if any of the names is
+        missing from the store.'''
+
+        with h5py.File(self.filename, 'r') as fin:
+
+            images = fin['images']
+            image_names = images['name'].asstr()[...]
+            image_infiles = images['infile'].asstr()[...]
+            valid = images['valid'][...]
+
+            # Position (in the output) of each image; -1 excludes it
+            position = np.where(valid, np.arange(len(valid)), -1)
+            if names is not None:
+                lookup = dict( (name, i) for i, name in enumerate(image_names) if valid[i] )
+                if any(name not in lookup for name in names):
+                    return None
+                position = -np.ones(len(valid), dtype=np.int64)
+                position[[lookup[name] for name in names]] = np.arange(len(names))
+
+            if 'flakes' not in fin:
+                return FlakeTable({}, image_names, image_infiles)
+
+            table = fin['flakes']
+            image = table['image'][...]
+            rows = np.nonzero(position[image]>=0)[0]
+            rows = rows[np.argsort(position[image[rows]], kind='stable')]
+
+            columns = {}
+            for key, dataset in table.items():
+                columns[key] = dataset[...][rows]
+            attrs = dict( (key, list(value)) for key, value in table.attrs.items() )
+
+            ragged = {}
+            if 'ragged' in fin:
+                for key, group in fin['ragged'].items():
+                    ragged[key] = ( group['start'][...][rows], group['length'][...][rows] )
+
+        return FlakeTable(columns, image_names, image_infiles, attrs=attrs, ragged=ragged, filename=self.filename)
+
+
+    # End class FlakeStore(object)
+    ########################################
+
+
+
+# FlakeTable
+################################################################################
+class FlakeTable(object):
+    '''Columns of per-flake values. Can be indexed like a list of flakes:
+    flakes[i] returns the dict for flake i, while flakes[indices] (array or
+    slice) returns a FlakeTable with the selected flakes.'''
+
+    def __init__(self, columns, image_names, image_infiles, attrs=None, ragged=None, filename=None):
+
+        self.columns = columns
+        self.image_names = np.asarray(image_names)
+        self.image_infiles = np.asarray(image_infiles)
+        self.attrs = {} if attrs is None else attrs
+        self.ragged = {} if ragged is None else ragged
+        self.filename = filename
+        self._file = None
+
+
+    def __len__(self):
+        if 'image' not in self.columns:
+            return 0
+        return len(self.columns['image'])
+
+
+    def __contains__(self, key):
+        return key in self.columns or key in self.attrs or key in self.ragged or key in IMAGE_KEYS
+
+
+    def column(self, key):
+        '''Returns the values of the given key for all the flakes (as an array).'''
+        if key=='name':
+            return self.image_names[self.columns['image']]
+        if key=='infile':
+            return self.image_infiles[self.columns['image']]
+        return self.columns[key]
+
+
+    def __getitem__(self, index):
+
+        if isinstance(index, (int, np.integer)):
+            return self.flake(index)
+
+        columns = dict( (key, values[index]) for key, values in self.columns.items() )
+        ragged = dict( (key, (start[index], length[index])) for key, (start, length) in self.ragged.items() )
+        table = FlakeTable(columns, self.image_names, self.image_infiles, attrs=self.attrs, ragged=ragged, filename=self.filename)
+        table._file = self._file
+
+        return table
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.flake(i)
+
+
+    def flake(self, i):
+        '''Returns the dict for flake i (as saved by find_flakes).'''
+
+        flake = dict( (key, values[i]) for key, values in self.columns.items() if key!='image' )
+        flake['name'] = self.image_names[self.columns['image'][i]]
+        flake['infile'] = self.image_infiles[self.columns['image'][i]]
+        flake.update(self.attrs)
+        for key in self.ragged:
+            flake[key] = self.ragged_values(key, i)
+
+        return flake
+
+
+    def ragged_values(self, key, i):
+        '''Returns the (variable-length) array of the given key for flake i.'''
+
+        if self._file is None:
+            self._file = h5py.File(self.filename, 'r')
+        start, length = self.ragged[key]
+        return self._file['ragged'][key]['points'][start[i]:start[i]+length[i]]
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+    # End class FlakeTable(object)
+    ########################################
@@ -3,13 +3,17 @@
 # vi: ts=4 sw=4
 
 import pickle
+import warnings
 from ..Protocols import *
+from .Store import *
+from .Montage import *
 
 
 from scipy.spatial.distance import cdist
 from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans, MeanShift, estimate_bandwidth, AffinityPropagation, SpectralClustering # Clustering methods
+from sklearn.cluster import KMeans, MiniBatchKMeans, MeanShift, estimate_bandwidth, AffinityPropagation, SpectralClustering # Clustering methods
 from sklearn.decomposition import PCA
+from sklearn.exceptions import ConvergenceWarning
 
 import skimage
 
@@ -29,13 +33,19 @@ class cluster(ProtocolMultiple):
                         'verbosity' : 3,
                         'num_jobs' : None,
                         'num_clusters' : 20,
-                        'cluster_method' : 'kmeans', # 'affinity', 'kmeans', 'meanshift'
+                        'cluster_method' : 'kmeans', # 'affinity', 'kmeans', 'minibatch', 'meanshift', 'spectral'
+                        'max_samples' : 20000, # Maximum number of flakes used to fit 'affinity' and 'spectral' (memory scales as N^2); other flakes are assigned to the nearest cluster
+                        'bandwidth_samples' : 10000, # Number of flakes used to estimate the 'meanshift' bandwidth
+                        'batch_size' : 4096, # Batch size for 'minibatch' (incremental) clustering
+                        'renderer' : 'montage', # 'montage' (PIL, batched) or 'matplotlib' (one axes per flake)
+                        'thumbnail_size' : 256, # Size (pixels) of flake images in montages
                         'features' : 'all', # 'shape', 'color', 'all'
                         'feature_normed_range' : [-2, +2], # range for plotting the normed features
                         'bbox_pad' : 0.5,
                         'image_contrast' : (0, 1),
                         'image_contrast_trim' : None,
                         'overlays' : 3,
+                        'flake_store' : 'flakes.h5', # Columnar store written by find_flakes (alongside the .pkl files)
                         }
         self.run_args.update(kwargs)
         
@@ -71,6 +81,11 @@ class cluster(ProtocolMultiple):
         
         
     def load_flakes(self, datas, **run_args):
+        
+        flakes = self.load_flake_store(datas, **run_args)
+        if flakes is not None:
+            return flakes
+        
         flakes = []
         for data in datas:
             with open(data.infile, 'rb') as fin:
@@ -88,6 +103,39 @@ class cluster(ProtocolMultiple):
         return flakes
     
     
+    def load_flake_store(self, datas, **run_args):
+        '''Loads the flakes (as a FlakeTable) from the columnar store written by
+        find_flakes. Returns None if there is no store, or if it doesn't
+        include all the images.'''
+        
+        if 'flake_store' not in run_args or not run_args['flake_store'] or len(datas)<1 or not FlakeStore.available():
+            return None
+        
+        store = FlakeStore(os.path.join(os.path.dirname(datas[0].infile), run_args['flake_store']))
+        if not store.exists():
+            return None
+        
+        flakes = store.read(names=[data.name for data in datas])
+        if flakes is not None and run_args['verbosity']>=5:
+            print('      {:,d} flakes loaded from {}'.format(len(flakes), store.filename))
+            
+        return flakes
+    
+    
+    def flake_column(self, flakes, key):
+        '''Returns the values of key for all the flakes, as an array.'''
+        if isinstance(flakes, FlakeTable):
+            return flakes.column(key)
+        return np.asarray([flake[key] for flake in flakes])
+    
+    
+    def flake_subset(self, flakes, indices):
+        '''Returns the flakes selected by indices.'''
+        if isinstance(flakes, FlakeTable):
+            return flakes[indices]
+        return np.asarray(flakes)[indices]
+    
+    
     def load_flakes_parallel(self, datas, **run_args):
         # Parallelize loading
         # Doesn't seem to actually run faster (likely I/O limited)
@@ -107,7 +155,7 @@ class cluster(ProtocolMultiple):
     def load_features(self, flakes, **run_args):
         
         if run_args['features']=='all':
-            features = [ np.concatenate([flake['flake_color_fea'], flake['flake_shape_fea']]) for flake in flakes ]
+            features = np.concatenate([self.flake_column(flakes, 'flake_color_fea'), self.flake_column(flakes, 'flake_shape_fea')], axis=1)
             
             if 'flake_color_fea_names' in flakes[0]:
                 self.feature_names_color = flakes[0]['flake_color_fea_names']
@@ -117,7 +165,7 @@ class cluster(ProtocolMultiple):
             self.feature_names = self.feature_names_color + self.feature_names_shape
             
         else:
-            features = [ flake['flake_{}_fea'.format(run_args['features'])] for flake in flakes ]
+            features = self.flake_column(flakes, 'flake_{}_fea'.format(run_args['features']))
             
             if run_args['features']=='color':
                 if 'flake_color_fea_names' in flakes[0]:
@@ -185,8 +233,17 @@ class cluster(ProtocolMultiple):
         
         # Clustering
         ########################################
-        rescale = StandardScaler()
-        features = rescale.fit_transform(features_orig)
+        state = None
+        if run_args['cluster_method']=='minibatch':
+            # Incremental clustering: the rescaling and clusters are saved between runs
+            state = self.load_cluster_state(basename, output_dir, num_features=features_orig.shape[1], **run_args)
+            
+        if state is None:
+            rescale = StandardScaler()
+            features = rescale.fit_transform(features_orig)
+        else:
+            rescale = state['rescale']
+            features = rescale.transform(features_orig)
         
         if run_args['verbosity']>=4:
             print("  Clustering {:,d} flakes using '{}'".format(len(flakes), run_args['cluster_method']))
@@ -194,19 +251,46 @@ class cluster(ProtocolMultiple):
         start = time.time()
         
         n_jobs = run_args['num_jobs'] if 'num_jobs' in run_args else -1
+        sample = self.sample_indices(len(features), run_args['max_samples'] if 'max_samples' in run_args else None)
         
         if run_args['cluster_method']=='kmeans':
-            cluster_result = KMeans(n_clusters=run_args['num_clusters'], random_state=0, n_jobs=n_jobs).fit(features)
+            cluster_result = KMeans(n_clusters=run_args['num_clusters'], random_state=0, n_init=10).fit(features)
+            
+        elif run_args['cluster_method']=='minibatch':
+            state = self.cluster_incremental(self.flake_column(flakes, 'name'), features_orig, state=state, rescale=rescale, **run_args)
+            self.save_cluster_state(state, basename, output_dir, **run_args)
+            if hasattr(state['model'], 'cluster_centers_'):
+                cluster_result = state['model']
+                cluster_result.labels_ = cluster_result.predict(features)
+            else:
+                # Not enough flakes (yet) to initialize the incremental clustering
+                num_clusters = min(run_args['num_clusters'], len(features))
+                if run_args['verbosity']>=2:
+                    print('  WARNING: only {:,d} flakes for {:d} clusters; using kmeans (with {:d} clusters) for now.'.format(len(features), run_args['num_clusters'], num_clusters))
+                cluster_result = KMeans(n_clusters=num_clusters, random_state=0, n_init=10).fit(features)
             
         elif run_args['cluster_method']=='meanshift':
-            bandwidth = estimate_bandwidth(features, quantile=0.1)#, n_samples=int(features.shape[0]/10))
+            n_samples = run_args['bandwidth_samples'] if 'bandwidth_samples' in run_args else None
+            if n_samples is not None and n_samples>=len(features):
+                n_samples = None
+            bandwidth = estimate_bandwidth(features, quantile=0.1, n_samples=n_samples, random_state=0)
             cluster_result = MeanShift(bandwidth=bandwidth, bin_seeding=True, n_jobs=n_jobs).fit(features)
             
         elif run_args['cluster_method']=='affinity':
-            cluster_result = AffinityPropagation().fit(features)
+            cluster_result = self.affinity_propagation(features[sample], **run_args)
+            if cluster_result is None:
+                cluster_result = KMeans(n_clusters=run_args['num_clusters'], random_state=0, n_init=10).fit(features)
+            elif len(sample)<len(features):
+                cluster_result.labels_ = cluster_result.predict(features)
 
         elif run_args['cluster_method']=='spectral':
-            cluster_result = SpectralClustering(n_clusters=run_args['num_clusters'], n_jobs=n_jobs).fit(features)
+            cluster_result = SpectralClustering(n_clusters=run_args['num_clusters'], n_jobs=n_jobs).fit(features[sample])
+            # Cluster centers (not computed by SpectralClustering) are the average of the flakes in each cluster
+            labels = np.unique(cluster_result.labels_, return_inverse=True)[1] # Renumbered, in case a label is unused
+            cluster_result.labels_ = labels
+            cluster_result.cluster_centers_ = np.asarray([ np.mean(features[sample][labels==i], axis=0) for i in range(np.max(labels)+1) ])
+            if len(sample)<len(features):
+                cluster_result.labels_ = np.argmin(cdist(features, cluster_result.cluster_centers_), axis=1)
             
         else:
             print("ERROR: clustering method '{}' not recognized.".format(run_args['cluster_method']))
@@ -218,7 +302,17 @@ class cluster(ProtocolMultiple):
             
         # Assignments are unsorted by default
         assignment = cluster_result.labels_
-        results['num_clusters'] = len(np.unique(assignment))
+        # When flakes are assigned to clusters fitted to a subset, a cluster may
+        # be empty; empty clusters are dropped and the rest renumbered (the
+        # fitted model, which may be the incremental state, is left as-is)
+        cluster_centers = cluster_result.cluster_centers_
+        occupied = np.bincount(assignment, minlength=len(cluster_centers))>0
+        if not np.all(occupied):
+            if run_args['verbosity']>=2:
+                print('  WARNING: dropping {:d} empty clusters.'.format(np.sum(~occupied)))
+            assignment = (np.cumsum(occupied)-1)[assignment]
+            cluster_centers = cluster_centers[occupied]
+        results['num_clusters'] = len(cluster_centers)
         clustering['assignment'] = assignment # Label ids for each flake, saying what cluster it belongs to [unsorted indexing]
 
         if run_args['verbosity']>=4:
@@ -226,7 +320,7 @@ class cluster(ProtocolMultiple):
             
             
         # Sort clusters into a sensible order
-        consider_features = np.asarray([flake['flake_color_fea'][:2] for flake in flakes]) # Grayscale and V contrast
+        consider_features = self.flake_column(flakes, 'flake_color_fea')[:,:2] # Grayscale and V contrast
         
         # The average for each cluster gives the position for the center of that cluster (in the feature space)
         central_features = np.zeros([results['num_clusters'], consider_features.shape[1]])
@@ -236,7 +330,7 @@ class cluster(ProtocolMultiple):
         clustering['sort_indices'] = np.argsort(np.abs(central_features).sum(1))
         clustering['unsort2sort'] = np.unique(clustering['sort_indices'], return_index=True)[1]
         
-        clustering['cluster_centers'] = cluster_result.cluster_centers_[clustering['sort_indices']] # in (normed) feature space coordinates [sorted indexing]
+        clustering['cluster_centers'] = cluster_centers[clustering['sort_indices']] # in (normed) feature space coordinates [sorted indexing]
         clustering['cluster_centers_orig'] = rescale.inverse_transform(clustering['cluster_centers']) # in (original) feature space coordinates [sorted indexing]
         clustering['cluster_center_distances'] = cdist(clustering['cluster_centers'], clustering['cluster_centers']) # in (normed) feature space coordinates [sorted indexing]
 
@@ -304,6 +398,122 @@ class cluster(ProtocolMultiple):
 
     
 
+    def affinity_propagation(self, features_rescaled, **run_args):
+        '''Fits AffinityPropagation to the (rescaled) features. If it does not converge
+        (in which case it returns no clusters), it is re-run with stronger
+        damping; returns None if it still does not converge.'''
+        
+        for damping, max_iter in [(0.5, 200), (0.9, 1000)]:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', ConvergenceWarning)
+                cluster_result = AffinityPropagation(damping=damping, max_iter=max_iter, random_state=0).fit(features_rescaled)
+            if len(cluster_result.cluster_centers_)>0 and cluster_result.n_iter_<max_iter:
+                return cluster_result
+            
+        if run_args['verbosity']>=2:
+            print('  WARNING: affinity propagation did not converge; using kmeans ({:d} clusters) instead.'.format(run_args['num_clusters']))
+            
+        return None
+    
+    
+    def sample_indices(self, num, max_samples=None, seed=0):
+        '''Returns the (sorted) indices of a random subset of at most max_samples
+        of num items (or all of them).'''
+        if max_samples is None or num<=max_samples:
+            return np.arange(num)
+        rng = np.random.default_rng(seed)
+        return np.sort(rng.choice(num, size=int(max_samples), replace=False))
+    
+    
+    def cluster_incremental(self, names, features_orig, state=None, rescale=None, **run_args):
+        '''Updates the incremental (minibatch k-means) clustering with the flakes
+        whose image (names) has not yet been included, and returns the
+        updated state. For a new state, the rescaling (StandardScaler) is
+        fitted to the given flakes; it is then kept fixed, so that the cluster
+        centers remain valid as more images are added.'''
+        
+        if state is None:
+            if rescale is None:
+                rescale = StandardScaler().fit(features_orig)
+            model = MiniBatchKMeans(n_clusters=run_args['num_clusters'], random_state=0, batch_size=run_args['batch_size'], n_init=3)
+            state = { 'rescale': rescale, 'model': model, 'names': set(), 'num_flakes': 0, 'features': run_args['features'] }
+            
+        names = np.asarray(names)
+        new_images = sorted(set(names) - state['names'])
+        new = np.nonzero(np.isin(names, new_images))[0]
+        
+        if len(new)>0:
+            if run_args['verbosity']>=5:
+                print('    Adding {:,d} flakes from {:,d} new images to the clustering'.format(len(new), len(new_images)))
+            
+            # Batches are drawn in random order (rather than image-by-image)
+            rng = np.random.default_rng(state['num_flakes'])
+            new = rng.permutation(new)
+            features = state['rescale'].transform(features_orig[new])
+            
+            # The first batch initializes the clusters, so must have at least
+            # num_clusters flakes; until then, the flakes are held in the state
+            if not hasattr(state['model'], 'cluster_centers_'):
+                if 'pending' in state:
+                    features = np.concatenate([state['pending'], features])
+                if len(features)<run_args['num_clusters']:
+                    state['pending'] = features
+                    features = features[:0]
+                else:
+                    state.pop('pending', None)
+            batch_size = max(run_args['batch_size'], run_args['num_clusters'])
+            for i in range(0, len(features), batch_size):
+                state['model'].partial_fit(features[i:i+batch_size])
+            
+            state['names'].update(new_images)
+            state['num_flakes'] += len(new)
+            
+        return state
+    
+    
+    def load_cluster_state(self, basename, output_dir, num_features=None, **run_args):
+        '''Loads the saved incremental clustering state (or returns None if there
+        isn't one, or if it is incompatible with the current settings).'''
+        
+        savefile = self.get_outfile(basename, output_dir, ext='-state.pkl')
+        if not os.path.exists(savefile):
+            return None
+        
+        with open(savefile, 'rb') as fin:
+            state = pickle.load(fin)
+            
+        model = state['model']
+        if model.n_clusters!=run_args['num_clusters'] or state['features']!=run_args['features'] or (num_features is not None and state['rescale'].n_features_in_!=num_features):
+            if run_args['verbosity']>=3:
+                print('  Saved clustering state ({}) does not match the current settings; starting a new clustering.'.format(savefile))
+            return None
+        
+        return state
+    
+    
+    def save_cluster_state(self, state, basename, output_dir, **run_args):
+        
+        savefile = self.get_outfile(basename, output_dir, ext='-state.pkl')
+        with open(savefile, 'wb') as fout:
+            pickle.dump(state, fout)
+            
+            
+    def assign_flakes(self, flakes, basename, output_dir, **run_args):
+        '''Assigns flakes (e.g. from newly-acquired images) to the clusters of
+        the saved incremental clustering, without updating it. Returns the
+        cluster index [unsorted indexing] of each flake, or None if there is no
+        saved state.'''
+        
+        run_args = dict(self.run_args, **run_args)
+        features_orig = self.load_features(flakes, **run_args)
+        state = self.load_cluster_state(basename, output_dir, num_features=features_orig.shape[1], **run_args)
+        if state is None or not hasattr(state['model'], 'cluster_centers_'):
+            return None
+        
+        return state['model'].predict(state['rescale'].transform(features_orig))
+        
+    
+
     def plot_pca(self, outfile, coordinates, assignment, cluster_colors, **run_args):
         
         flake_colors = [cluster_colors[index] for index in assignment]
@@ -430,6 +640,16 @@ class cluster(ProtocolMultiple):
         plt.rcParams['axes.labelsize'] = 20
         plt.rcParams['lines.markersize'] = 5
         
+        if self._use_montage(**run_args):
+            # Prepare the thumbnails of all the flakes that will be shown (reading each image once)
+            self._thumbnails = None
+            shown = []
+            for i, feature_vector in enumerate(cluster_centers):
+                cluster_i = np.nonzero(assignment==sort_indices[i])[0]
+                order, distances = self._sort_by_distance(flake_features[cluster_i], feature_vector)
+                shown.append( cluster_i[order[self._shown_indices(len(order), **run_args)]] )
+            self.prepare_thumbnails(self.flake_subset(flakes, np.concatenate(shown+[np.zeros(0, dtype=int)])), **run_args)
+        
         #for i, feature_vector in enumerate(cluster_centers[:1]): # for testing
         for i, feature_vector in enumerate(cluster_centers):
             
@@ -440,7 +660,7 @@ class cluster(ProtocolMultiple):
             i_before_sort = sort_indices[i] # [unsorted indexing]
             
             cluster_i = np.nonzero(assignment==i_before_sort)[0] # indices [in unsorted indexing] of all flakes matching this cluster
-            flakes_cluster = np.asarray(flakes)[cluster_i] # flakes matching this cluster
+            flakes_cluster = self.flake_subset(flakes, cluster_i) # flakes matching this cluster
             features_cluster = flake_features[cluster_i] # feature vectors matching this cluster
             
             
@@ -458,15 +678,16 @@ class cluster(ProtocolMultiple):
         num_flakes = len(flakes_cluster)
 
         # Sort flakes by their distance from the cluster centroid (which is located at position "feature_vector")
-        distances = cdist(features_cluster, [feature_vector], metric='euclidean')[:,0]
-        sort_indices = np.argsort(distances)
+        sort_indices, distances = self._sort_by_distance(features_cluster, feature_vector)
         flakes_cluster = flakes_cluster[sort_indices]
         features_cluster = features_cluster[sort_indices]
-        distances = distances[sort_indices]
 
         if run_args['verbosity']>=5:
             print('    image for cluster {} ({:,d} flakes)'.format(cluster_name, num_flakes))
             
+        if self._use_montage(**run_args):
+            self.prepare_thumbnails(flakes_cluster[self._shown_indices(num_flakes, **run_args)], **run_args)
+            
             
         # Output a summary (central, generic, peripheral)
         ########################################
@@ -540,6 +761,90 @@ class cluster(ProtocolMultiple):
                 plt.close(self.fig.number)
 
 
+    def _sort_by_distance(self, features_cluster, feature_vector):
+        '''Returns the order of the flakes by distance from the cluster centroid
+        (feature_vector), and the sorted distances.'''
+        distances = cdist(features_cluster, [feature_vector], metric='euclidean')[:,0]
+        sort_indices = np.argsort(distances)
+        return sort_indices, distances[sort_indices]
+    
+    
+    def _cluster_main_blocks(self, num_flakes):
+        '''The blocks of flakes (label, first index, nrows, ncols) shown in the
+        summary image of a cluster (with flakes sorted by distance).'''
+        
+        # Central flakes
+        nrows, ncols = 3, 7
+        blocks = [ ('central', 0, nrows, ncols) ]
+        idx = nrows*ncols
+        
+        # Generic flakes
+        if idx<num_flakes:
+            idx = max( int( np.clip( num_flakes/2, idx, num_flakes-nrows*ncols ) ), idx )
+            blocks.append( ('generic', idx, nrows, ncols) )
+            idx += nrows*ncols
+            
+        # Peripheral flakes
+        if idx<num_flakes:
+            nrows, ncols = 2, 7
+            idx = max( num_flakes-nrows*ncols, idx )
+            blocks.append( ('peripheral', idx, nrows, ncols) )
+            
+        return blocks
+    
+    
+    def _shown_indices(self, num_flakes, **run_args):
+        '''Indices (of the sorted flakes of a cluster) that will be plotted.'''
+        if 'output_all' in run_args and run_args['output_all']:
+            return np.arange(num_flakes)
+        shown = [ np.arange(idx, min(idx+nrows*ncols, num_flakes)) for label, idx, nrows, ncols in self._cluster_main_blocks(num_flakes) ]
+        return np.concatenate(shown)
+    
+    
+    def _use_montage(self, **run_args):
+        return 'renderer' not in run_args or run_args['renderer']=='montage'
+    
+    
+    def prepare_thumbnails(self, flakes, **run_args):
+        '''Creates the thumbnails (for the montage renderer) of the given flakes.'''
+        
+        size = run_args['thumbnail_size'] if 'thumbnail_size' in run_args else 256
+        settings = (size, run_args['bbox_pad'], tuple(run_args['image_contrast']), run_args['image_contrast_trim'])
+        if getattr(self, '_thumbnails', None) is None or self._thumbnails_settings!=settings:
+            self._thumbnails = FlakeThumbnails(size=size, bbox_pad=run_args['bbox_pad'], image_contrast=run_args['image_contrast'], image_contrast_trim=run_args['image_contrast_trim'])
+            self._thumbnails_settings = settings
+            
+        num = len(self._thumbnails)
+        self._thumbnails.add(flakes)
+        if run_args['verbosity']>=5:
+            print('    {:,d} flake thumbnails prepared'.format(len(self._thumbnails)-num))
+    
+    
+    def _plot_flake_block(self, idx, flakes_cluster, distances, left, top, w, nrows, ncols, **run_args):
+        '''Plots a grid of flakes (starting from index idx), with the top-left
+        corner at (left, top) in figure coordinates, and cells of size w.'''
+        
+        if self._use_montage(**run_args):
+            end = min(idx+nrows*ncols, len(flakes_cluster))
+            if end<=idx:
+                return
+            self.prepare_thumbnails(flakes_cluster[idx:end], **run_args)
+            montage = FlakeMontage(self._thumbnails, overlays=run_args['overlays'])
+            image = montage.render(flakes_cluster[idx:end], distances[idx:end], nrows, ncols)
+            
+            self.ax = self.fig.add_axes( [left, top-nrows*w, ncols*w, nrows*w] )
+            self.ax.imshow(image, interpolation='none')
+            self.ax.axis('off')
+            return
+        
+        for irow in range(nrows):
+            for icol in range(ncols):
+                ax_pos = [left+icol*w, top-(irow+1)*w, w, w]
+                if idx<len(flakes_cluster):
+                    self._plot_flake_image(ax_pos, flakes_cluster[idx], distances[idx], **run_args)
+                idx += 1
+    
+    
     def _plot_cluster_page(self, idx, flakes_cluster, distances, fea_w, fea_h, plot_buffers, nrows, ncols, **run_args):
         
         # The total area we have available for plotting flakes
@@ -550,12 +855,8 @@ class cluster(ProtocolMultiple):
         
         w = fig_width/ncols
         ystart = bottom_buf+fig_height
-        for irow in range(nrows):
-            for icol in range(ncols):
-                ax_pos = [left_buf+icol*w, ystart-(irow+1)*w, w, w]
-                if idx<len(flakes_cluster):
-                    self._plot_flake_image(ax_pos, flakes_cluster[idx], distances[idx], **run_args)
-                idx += 1        
+        self._plot_flake_block(idx, flakes_cluster, distances, left_buf, ystart, w, nrows, ncols, **run_args)
+        
         
     def _plot_cluster_main(self, flakes_cluster, distances, fea_w, fea_h, plot_buffers, **run_args):
         
@@ -566,47 +867,15 @@ class cluster(ProtocolMultiple):
         fig_height = 1.0-top_buf-bottom_buf
         #self.ax = self.fig.add_axes( [left_buf, bottom_buf, fig_width, fig_height] )
         
-        
-        # Central flakes
-        nrows, ncols = 3, 7
-        w = fig_width/ncols
-        idx = 0
+        # Central, generic, and peripheral flakes
         ystart = bottom_buf+fig_height
-        plt.figtext(left_buf, ystart, 'central', size=8, verticalalignment='bottom', horizontalalignment='left')
-        for irow in range(nrows):
-            for icol in range(ncols):
-                ax_pos = [left_buf+icol*w, ystart-(irow+1)*w, w, w]
-                if idx<len(flakes_cluster):
-                    self._plot_flake_image(ax_pos, flakes_cluster[idx], distances[idx], **run_args)
-                idx += 1
-
-        # Generic flakes
-        if idx<len(flakes_cluster):
-            ystart = ystart-nrows*w - 0.015
-            #nrows, ncols = 2, 6
-            w = fig_width/ncols
-            idx = max( int( np.clip( len(flakes_cluster)/2, idx, len(flakes_cluster)-nrows*ncols ) ), idx )
-            plt.figtext(left_buf, ystart, 'generic', size=8, verticalalignment='bottom', horizontalalignment='left')
-            for irow in range(nrows):
-                for icol in range(ncols):
-                    ax_pos = [left_buf+icol*w, ystart-(irow+1)*w, w, w]
-                    if idx<len(flakes_cluster):
-                        self._plot_flake_image(ax_pos, flakes_cluster[idx], distances[idx], **run_args)
-                    idx += 1
-        
-        # Peripheral flakes
-        if idx<len(flakes_cluster):
-            ystart = ystart-nrows*w - 0.015
-            nrows, ncols = 2, 7
+        for iblock, (label, idx, nrows, ncols) in enumerate(self._cluster_main_blocks(len(flakes_cluster))):
+            if iblock>0:
+                ystart = ystart-nrows_previous*w - 0.015
             w = fig_width/ncols
-            idx = max( len(flakes_cluster)-nrows*ncols, idx )
-            plt.figtext(left_buf, ystart, 'peripheral', size=8, verticalalignment='bottom', horizontalalignment='left')
-            for irow in range(nrows):
-                for icol in range(ncols):
-                    ax_pos = [left_buf+icol*w, ystart-(irow+1)*w, w, w]
-                    if idx<len(flakes_cluster):
-                        self._plot_flake_image(ax_pos, flakes_cluster[idx], distances[idx], **run_args)
-                    idx += 1
+            plt.figtext(left_buf, ystart, label, size=8, verticalalignment='bottom', horizontalalignment='left')
+            self._plot_flake_block(idx, flakes_cluster, distances, left_buf, ystart, w, nrows, ncols, **run_args)
+            nrows_previous = nrows
         
 
     def _plot_cluster_sidebar(self, feature_vector, feature_vector_orig, features_cluster, distributions, dist_bin_edges, fea_w, fea_h, **run_args):
@@ -775,6 +1044,9 @@ class select_flakes(cluster):
                         'image_contrast' : (0, 1),
                         'image_contrast_trim' : None,
                         'overlays' : 3,
+                        'renderer' : 'montage', # 'montage' (PIL, batched) or 'matplotlib' (one axes per flake)
+                        'thumbnail_size' : 256, # Size (pixels) of flake images in montages
+                        'flake_store' : 'flakes.h5', # Columnar store written by find_flakes (alongside the .pkl files)
                         }
         self.run_args.update(kwargs)
     
@@ -873,7 +1145,7 @@ class select_flakes(cluster):
         if feature_name in flakes[0]:
             if run_args['verbosity']>=5:
                 print("      Extracting {} from flakes".format(feature_name))
-            return np.asarray( [ f[feature_name] for f in flakes ] )
+            return self.flake_column(flakes, feature_name)
             
         # Default: lookup in self.feature_names
         i = self.feature_names.index(feature_name)
@@ -901,7 +1173,7 @@ class select_flakes(cluster):
                 
         idx = np.where(np.all(conditions, axis=0))[0]
         
-        flakes = np.asarray(flakes)[idx]
+        flakes = self.flake_subset(flakes, idx)
 
         if run_args['verbosity']>=3 and len(flakes)<1:
             print("WARNING: Selection criteria too restrictive. (No flakes meet criteria.)")
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.ImAnalysis.Neighbors` - Neighbour networks of particles
+================================================
+.. module:: SciAnalysis.ImAnalysis.Neighbors
+   :synopsis: Neighbour lists, bond lengths and bond angles for particle positions
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  Given the (x,y) positions of particles (e.g. the centers-of-mass of dots in
+# a micrograph), the Neighbors class finds all the 'bonds' between neighbouring
+# particles at once, using a spatial index (scipy.spatial.cKDTree) instead of
+# computing the distances from each particle to all others.
+#
+# Neighbours can be defined using:
+#  method='cutoff'   : all particles closer than a cutoff distance
+#  method='delaunay' : the Delaunay triangulation (i.e. particles that share a
+#                      Voronoi cell edge); optionally restricted to bonds
+#                      shorter than the cutoff
+#
+# Image boundaries are handled using:
+#  boundary='open'     : particles near the edges simply have fewer neighbours
+#  boundary='periodic' : the image is treated as periodic (requires shape)
+#  boundary='exclude'  : particles whose neighbourhood is truncated by the image
+#                        edge are marked as not 'interior' (so that statistics
+#                        can be restricted to interior particles)
+#
+# Typical usage:
+#   neighbors = Neighbors(x_positions, y_positions, cutoff=20, shape=data.data.shape)
+#   neighbors.counts # Number of neighbours of each particle
+#   neighbors.length, neighbors.angle # Bond lengths and angles
+#   neighbors.average_angle(symmetry=6) # Local (6-fold) orientation of each particle
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import numpy as np
+
+from .. import tools
+
+spatial = tools.LazyModule('scipy.spatial')
+
+
+
+# Neighbors
+################################################################################
+class Neighbors(object):
+    '''The network of bonds between neighbouring particles. Each bond is listed
+    in both directions; i.e. bond k goes from particle i[k] to particle j[k],
+    with displacement (dx[k], dy[k]), length[k] and angle[k] (radians, from
+    the x axis).'''
+
+    def __init__(self, x_positions, y_positions, cutoff=None, method='cutoff', boundary='open', shape=None):
+        '''Finds the neighbours of each particle.
+
+        Parameters
+        ----------
+        x_positions, y_positions : 1D arrays
+            Particle positions (pixels). Particles with non-finite positions
+            are ignored (they have no neighbours).
+        cutoff : float
+            Neighbour cutoff distance (pixels); only bonds strictly shorter
+            than this are kept. Required for method='cutoff'.
+        method : 'cutoff' or 'delaunay'
+        boundary : 'open', 'periodic' or 'exclude'
+        shape : (h, w)
+            Size of the image (needed for boundary='periodic' or 'exclude').
+        '''
+
+        self.x = np.asarray(x_positions, dtype=float)
+        self.y = np.asarray(y_positions, dtype=float)
+        self.num_particles = len(self.x)
+        self.cutoff = cutoff
+        self.method = method
+        self.boundary = boundary
+        self.shape = shape
+
+        if method not in ['cutoff', 'delaunay']:
+            raise ValueError("method must be 'cutoff' or 'delaunay' (got {})".format(method))
+        if boundary not in ['open', 'periodic', 'exclude']:
+            raise ValueError("boundary must be 'open', 'periodic' or 'exclude' (got {})".format(boundary))
+        if boundary in ['periodic', 'exclude'] and shape is None:
+            raise ValueError("boundary='{}' requires the image shape".format(boundary))
+        if method=='cutoff' and cutoff is None:
+            raise ValueError("method='cutoff' requires a cutoff distance")
+        if method=='delaunay' and boundary=='periodic':
+            raise ValueError("method='delaunay' does not support periodic boundaries")
+
+        valid = np.nonzero( np.isfinite(self.x) & np.isfinite(self.y) )[0]
+
+        if method=='cutoff':
+            i, j = self._pairs_cutoff(valid)
+        else:
+            i, j = self._pairs_delaunay(valid)
+
+        # List each bond in both directions
+        self.i = np.concatenate( (i, j) )
+        self.j = np.concatenate( (j, i) )
+
+        self.dx = self.x[self.j] - self.x[self.i]
+        self.dy = self.y[self.j] - self.y[self.i]
+        if boundary=='periodic':
+            # Minimum-image convention
+            h, w = shape
+            self.dx -= w*np.round(self.dx/w)
+            self.dy -= h*np.round(self.dy/h)
+        self.length = np.sqrt( np.square(self.dx) + np.square(self.dy) )
+        self.angle = np.arctan2(self.dy, self.dx)
+
+        if cutoff is not None:
+            # Bonds must be strictly shorter than the cutoff
+            keep = self.length<cutoff
+            for name in ['i', 'j', 'dx', 'dy', 'length', 'angle']:
+                setattr(self, name, getattr(self, name)[keep])
+
+        self.counts = np.bincount(self.i, minlength=self.num_particles)
+
+        self.interior = np.zeros(self.num_particles, dtype=bool)
+        self.interior[valid] = True
+        if boundary=='exclude':
+            self.interior &= self._interior()
+
+
+    def _pairs_cutoff(self, valid):
+
+        points = np.column_stack( (self.x[valid], self.y[valid]) )
+        if self.boundary=='periodic':
+            h, w = self.shape
+            points = np.mod(points, [w, h])
+            tree = spatial.cKDTree(points, boxsize=[w, h])
+        else:
+            tree = spatial.cKDTree(points)
+
+        pairs = tree.query_pairs(self.cutoff, output_type='ndarray')
+        if len(pairs)<1:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        return valid[pairs[:,0]], valid[pairs[:,1]]
+
+
+    def _pairs_delaunay(self, valid):
+
+        if len(valid)<3:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        triangulation = spatial.Delaunay( np.column_stack( (self.x[valid], self.y[valid]) ) )
+        simplices = triangulation.simplices
+        edges = np.concatenate( (simplices[:,[0,1]], simplices[:,[1,2]], simplices[:,[2,0]]) )
+        edges = np.unique( np.sort(edges, axis=1), axis=0 )
+
+        self._hull = valid[ np.unique(triangulation.convex_hull) ]
+
+        return valid[edges[:,0]], valid[edges[:,1]]
+
+
+    def _interior(self):
+        '''Particles whose neighbourhood is not truncated by the image edges.'''
+
+        if self.method=='delaunay':
+            # Particles on the convex hull have unbounded Voronoi cells
+            interior = np.ones(self.num_particles, dtype=bool)
+            interior[getattr(self, '_hull', [])] = False
+            if self.cutoff is None:
+                return interior
+        else:
+            interior = np.ones(self.num_particles, dtype=bool)
+
+        h, w = self.shape
+        with np.errstate(invalid='ignore'):
+            interior &= (self.x>=self.cutoff) & (self.x<=w-1-self.cutoff) & (self.y>=self.cutoff) & (self.y<=h-1-self.cutoff)
+
+        return interior
+
+
+    # Per-particle quantities
+    ########################################
+
+    def neighbor_lists(self):
+        '''Returns a list (one entry per particle) of arrays of the indices of
+        the neighbouring particles.'''
+
+        order = np.argsort(self.i, kind='stable')
+        return np.split( self.j[order], np.cumsum(self.counts)[:-1] )
+
+
+    def bond_order(self, symmetry=6):
+        '''Returns the (complex) bond-orientational order parameter of each
+        particle: psi = < exp(i*symmetry*angle) > over its bonds (zero for
+        particles without neighbours).'''
+
+        phase = np.exp(1j*symmetry*self.angle)
+        total = np.bincount(self.i, weights=phase.real, minlength=self.num_particles) + 1j*np.bincount(self.i, weights=phase.imag, minlength=self.num_particles)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.counts>0, total/self.counts, 0)
+
+
+    def average_angle(self, symmetry=6):
+        '''Returns the average bond angle (radians, in the range 0 to
+        2*pi/symmetry) of each particle, accounting for the symmetry (i.e.
+        the bond angles are averaged as exp(i*symmetry*angle)); nan for
+        particles without neighbours.'''
+
+        angle_max_rad = 2.0*np.pi/symmetry
+        angles = ( np.angle(self.bond_order(symmetry))/symmetry )%angle_max_rad
+        return np.where(self.counts>0, angles, np.nan)
+
+
+    def bond_length_average(self):
+        '''Returns the average bond length of each particle (nan for particles
+        without neighbours).'''
+
+        total = np.bincount(self.i, weights=self.length, minlength=self.num_particles)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return total/self.counts
+
+
+    # End class Neighbors(object)
+    ########################################
@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.ImAnalysis.Orientation` - Local orientation (structure tensor)
+================================================
+.. module:: SciAnalysis.ImAnalysis.Orientation
+   :synopsis: Tiled, multi-scale structure-tensor orientation maps
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  The local orientation of (e.g. line/stripe) patterns is computed from the
+# image gradients (dx, dy), using the structure tensor:
+#   numerator = 2*dx*dy
+#   denominator = dx^2 - dy^2
+#   angle = 0.5*arctan2( <numerator>, <denominator> )
+# where <...> denotes smoothing (Gaussian blur, possibly several passes).
+#
+# Rather than computing each of these as a full-size image (which, for large
+# micrographs, means many full-size temporaries), the image is processed in
+# tiles. Each tile is extended by a 'halo' large enough that the (pre-blur,
+# gradient and smoothing) filters give the same result as for the full image;
+# only the interior of each tile is kept. Tiles are processed in parallel
+# threads, and several smoothing scales can be computed from the same
+# gradients.
+#
+# Typical usage:
+#   angles = structure_tensor_orientation(data.data, pre_blur=2.0, sigmas=[3.0], num_passes=3)[0]
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import os
+import numpy as np
+
+from .. import tools
+
+ndimage = tools.LazyModule('scipy.ndimage')
+
+
+
+# Structure tensor
+################################################################################
+
+def _filter_radius(sigma, truncate=4.0):
+    '''Radius (pixels) of the kernel of ndimage.gaussian_filter.'''
+    if sigma is None or sigma<=0:
+        return 0
+    return int(truncate*float(sigma) + 0.5)
+
+
+def _tile_orientation(image, y0, y1, x0, x1, halo, pre_blur, sigmas, num_passes, dtype, components=None):
+    '''Computes the orientation maps for image[y0:y1, x0:x1]; returns a list
+    of arrays (one per smoothing scale).'''
+
+    h, w = image.shape
+    Y0, Y1 = max(y0-halo, 0), min(y1+halo, h)
+    X0, X1 = max(x0-halo, 0), min(x1+halo, w)
+
+    # Include one more row/column (where available) for the forward differences
+    block = image[Y0:min(Y1+1, h), X0:min(X1+1, w)]
+    if pre_blur is not None and pre_blur>0:
+        block = ndimage.gaussian_filter(block, pre_blur)
+    block = block.astype(dtype, copy=False)
+
+    # Forward differences; zero along the last row/column of the full image
+    dx = np.zeros((Y1-Y0, X1-X0), dtype=dtype)
+    dy = np.zeros((Y1-Y0, X1-X0), dtype=dtype)
+    diff = np.diff(block[:Y1-Y0], axis=1)
+    dx[:, :diff.shape[1]] = diff
+    diff = np.diff(block[:, :X1-X0], axis=0)
+    dy[:diff.shape[0], :] = diff
+    del block, diff
+
+    numerator = dx*dy
+    numerator *= 2.0
+    denominator = np.square(dx)
+    denominator -= np.square(dy)
+
+    interior = (slice(y0-Y0, y1-Y0), slice(x0-X0, x1-X0))
+    if components is not None:
+        components['dif_x'][y0:y1, x0:x1] = dx[interior]
+        components['dif_y'][y0:y1, x0:x1] = dy[interior]
+    del dx, dy
+
+    angles = []
+    for i, sigma in enumerate(sigmas):
+        num, den = numerator, denominator
+        if sigma is not None and sigma>0:
+            for ipass in range(num_passes):
+                num = ndimage.gaussian_filter(num, sigma)
+                den = ndimage.gaussian_filter(den, sigma)
+
+        if components is not None and i==0:
+            components['numerator'][y0:y1, x0:x1] = num[interior]
+            components['denominator'][y0:y1, x0:x1] = den[interior]
+
+        angles.append( 0.5*np.arctan2(num[interior], den[interior]) )
+
+    return angles
+
+
+def structure_tensor_orientation(image, pre_blur=None, sigmas=[None], num_passes=1, tile_size=1024, num_threads=None, dtype=np.float64, components=False):
+    '''Computes local orientation angle maps of an image.
+
+    Parameters
+    ----------
+    image : 2D array
+    pre_blur : float (optional)
+        Gaussian blur (pixels) applied to the image before the gradients.
+    sigmas : list of float
+        Smoothing scales (pixels) of the structure tensor; one angle map is
+        returned for each (None means no smoothing).
+    num_passes : int
+        Number of times the smoothing is applied.
+    tile_size : int
+        Size (pixels) of the tiles; bounds the temporary memory.
+    num_threads : int
+        Number of tiles processed in parallel (default: number of CPUs).
+    dtype : numpy dtype
+        Precision of the calculation (e.g. np.float32 halves the memory).
+    components : bool
+        If True, also returns a dict of the full-size gradients (dif_x,
+        dif_y) and smoothed tensor components (numerator, denominator) for
+        the first scale (e.g. for display).
+
+    Returns
+    -------
+    angles : list of 2D arrays
+        Angles (radians, from -pi/2 to +pi/2), one per scale.
+    '''
+
+    if np.isscalar(sigmas) or sigmas is None:
+        sigmas = [sigmas]
+    image = np.asarray(image)
+    if not np.issubdtype(image.dtype, np.floating):
+        image = image.astype(dtype)
+
+    h, w = image.shape
+    radius = max([_filter_radius(sigma) for sigma in sigmas])
+    halo = _filter_radius(pre_blur) + 1 + radius*max(int(num_passes), 1)
+
+    angles = [np.empty((h, w), dtype=dtype) for sigma in sigmas]
+    if components:
+        components = dict( (name, np.empty((h, w), dtype=dtype)) for name in ['dif_x', 'dif_y', 'numerator', 'denominator'] )
+    else:
+        components = None
+
+    tile_size = max(int(tile_size), 1)
+    tiles = [ (y0, min(y0+tile_size, h), x0, min(x0+tile_size, w)) for y0 in range(0, h, tile_size) for x0 in range(0, w, tile_size) ]
+
+    def process(tile):
+        y0, y1, x0, x1 = tile
+        for angle_map, result in zip(angles, _tile_orientation(image, y0, y1, x0, x1, halo, pre_blur, sigmas, num_passes, dtype, components=components)):
+            angle_map[y0:y1, x0:x1] = result
+
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    if num_threads>1 and len(tiles)>1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(num_threads, len(tiles))) as executor:
+            list(executor.map(process, tiles))
+    else:
+        for tile in tiles:
+            process(tile)
+
+    if components is not None:
+        return angles, components
+    return angles
@@ -22,16 +22,22 @@
 
 import os
 from .Data import *
+from .Regions import *
+from .Neighbors import *
+from .Correlation import *
+from .Windows import *
+from .Orientation import *
+from .Skeleton import *
+from .Tiles import *
 from ..tools import *
 
-import copy
 
 
 class ProcessorIm(Processor):
 
     
-    def load(self, infile, **kwargs):
-
+    def load_param_file(self, infile, **kwargs):
+        
         if 'load_param_file' in kwargs and kwargs['load_param_file']:
             # Load information about the image from the corresponding parameter file
             # For the Hitachi SEM, this is a txt file with the same name
@@ -44,7 +50,13 @@ class ProcessorIm(Processor):
                     m = match_re.match(line)
                     if m:
                         kwargs['scale'] = float(m.groups()[0])
-            
+                        
+        return kwargs
+        
+    
+    def load(self, infile, **kwargs):
+
+        kwargs = self.load_param_file(infile, **kwargs)
 
         data = Data2DImage(infile, **kwargs)
         data.infile = infile
@@ -55,6 +67,97 @@ class ProcessorIm(Processor):
 
         
         return data
+    
+    
+    def load_tiled(self, infile, tile_size=4096, halo=64, **kwargs):
+        
+        kwargs = self.load_param_file(infile, **kwargs)
+        for key in ['load_param_file', 'crop_edges']:
+            kwargs.pop(key, None)
+        
+        return TiledImage(infile, tile_size=tile_size, halo=halo, **kwargs)
+    
+    
+    def run_tiled(self, infiles=None, protocols=None, output_dir=None, tile_size=4096, halo=64, force=False, ignore_errors=False, sort=False, load_args={}, run_args={}, verbosity=3, **kwargs):
+        '''Process the specified files using the specified protocols, reading
+        each image as a grid of tiles (of tile_size pixels, overlapping by halo
+        pixels), such that images larger than the available memory can be
+        analyzed.
+        
+        Protocols that define a run_tiled method (e.g. particles) analyze the
+        tiles themselves, and stitch the results for the full image. Protocols
+        that declare their tile_results (e.g. fft) are run on each tile
+        (without the halo), and those results are merged (see run_tiles).
+        Other protocols are skipped.'''
+        
+        l_args = self.load_args.copy()
+        l_args.update(load_args)
+        r_args = self.run_args.copy()
+        r_args.update(run_args)
+        self.apply_settings(r_args)
+        
+        if infiles is None:
+            infiles = self.infiles
+        if sort:
+            infiles.sort()
+                
+        if protocols is None:
+            protocols = self.protocols
+        for protocol in protocols:
+            protocol._processor = self # Allow a protocol to access global connections
+            
+        if output_dir is None:
+            output_dir = self.output_dir
+            
+            
+        trace = self.trace
+        with Trace.activate(trace):
+            for infile in infiles:
+            
+                try:
+                    with Trace.step(trace, infile, 'load'):
+                        tiled = self.load_tiled(infile, tile_size=tile_size, halo=halo, **l_args)
+            
+                    for protocol in protocols:
+                    
+                        output_dir_current = self.access_dir(output_dir, protocol.name)
+                    
+                        if not force and protocol.output_exists(tiled.name, output_dir_current):
+                            # Data already exists
+                            if verbosity>=2:
+                                print(' Skipping {} for {}'.format(protocol.name, tiled.name))
+                                
+                        elif not hasattr(protocol, 'run_tiled') and not getattr(protocol, 'tile_results', None):
+                            if verbosity>=1:
+                                print(' Skipping {} for {} (it cannot be run on tiles)'.format(protocol.name, tiled.name))
+                        
+                        else:
+                            if verbosity>=2:
+                                print('Running {} for {} ({} tiles)'.format(protocol.name, tiled.name, len(tiled.tiles())))
+                        
+                            with Trace.step(trace, infile, protocol.name):
+                                if hasattr(protocol, 'run_tiled'):
+                                    results = protocol.run_tiled(tiled, output_dir_current, **r_args)
+                                else:
+                                    results = run_tiles(protocol, tiled, output_dir_current, **r_args)
+                            
+                                md = {}
+                                md['infile'] = tiled.infile
+                                if 'full_name' in l_args:
+                                    md['full_name'] = l_args['full_name']
+                                if 'save_results' in r_args:
+                                    md['save_results'] = r_args['save_results']
+                                
+                                self.store_results(results, output_dir, infile, protocol, **md)
+                        
+
+                except Exception as exception:
+                    if SUPPRESS_EXCEPTIONS or ignore_errors:
+                        # Ignore errors, so that execution doesn't get stuck on a single bad file
+                        if verbosity>=1:
+                            print('  ERROR ({}) with file {}.'.format(exception.__class__.__name__, infile))
+                    else:
+                        raise
         
         
         
@@ -103,7 +206,7 @@ class shell(Protocol):
         make_dir(output_dir)
         
         results = {}
-        data = copy.deepcopy(data)
+        data = data.copy(shared=True)
         
         if run_args['crop'] is not None:
             data.crop(run_args['crop'])
@@ -262,7 +365,7 @@ class thumbnails(Protocol):
         
         if run_args['preserve_data']:
             # Avoid changing the data (which would disrupt downstream analysis of this data object)
-            data = copy.deepcopy(data)
+            data = data.copy(shared=True)
         
         if run_args['crop'] is not None:
             data.crop(run_args['crop'])
@@ -306,7 +409,7 @@ class thumb_view(thumbnails):
         
         if run_args['preserve_data']:
             # Avoid changing the data (which would disrupt downstream analysis of this data object)
-            data = copy.deepcopy(data)
+            data = data.copy(shared=True)
         
         # Crop out the correct region
         height, width = data.data.shape
@@ -347,6 +450,8 @@ class thumb_view(thumbnails):
     
 class fft(Protocol, mask):
     
+    tile_results = { 'q0': 'average', 'd0': 'average', 'sigma_q0': 'average' } # Results that can be merged when run on tiles (see run_tiles)
+    
     def __init__(self, name='fft', **kwargs):
         
         self.name = self.__class__.__name__ if name is None else name
@@ -387,7 +492,7 @@ class fft(Protocol, mask):
         
         
         if run_args['mask'] is not None:
-            data = copy.deepcopy(data)
+            data = data.copy(shared=True)
             avg = np.average(data.data)
             data.data = np.where(run_args['mask']==1, data.data, avg)
                 
@@ -431,8 +536,12 @@ class fft(Protocol, mask):
             data_fft.plot_components(save=outfile, plot_range=[-q_max,+q_max,-q_max,+q_max], blur=run_args['blur'])
             
             
+        # Amplitude of the FFT (for the 1D curve and the orientation analysis)
+        data_fft_abs = data_fft.copy()
+        data_fft_abs.data = np.abs(data_fft.data)
+        
         # 1D curve
-        line = data_fft.circular_average()
+        line = data_fft_abs.circular_average(absolute_value=False)
         line.x_rlabel = '$q \, (\mathrm{nm}^{-1})$'
         outfile = self.get_outfile('fft_1d', output_dir, ext='.dat', ir=False)
         line.save_data(outfile)
@@ -477,13 +586,13 @@ class fft(Protocol, mask):
         # Orientation analysis at q0
         q0 = results['q0']['value']
         q_spread = results['sigma_q0']['value']*3.0
-        new_results = self.orientation_q0(data_fft, q0, q_spread, output_dir, **run_args)
+        new_results = self.orientation_q0(data_fft_abs, q0, q_spread, output_dir, **run_args)
         results.update(new_results)
         
         
-        # Fourier-filtered image at q0
+        # Fourier-filtered image at q0 (re-using the FFT)
         q_spread = results['sigma_q0']['value']*5.0
-        self.fourier_filter(data, q0, q_spread, output_dir, **run_args)            
+        self.fourier_filter(data, q0, q_spread, output_dir, data_fft=data_fft, **run_args)            
             
             
         
@@ -839,9 +948,10 @@ class fft(Protocol, mask):
         return angle
     
         
-    def fourier_filter(self, data, q_center, q_spread, output_dir, **run_args):
+    def fourier_filter(self, data, q_center, q_spread, output_dir, data_fft=None, **run_args):
         
-        data.fourier_filter(q_center, q_spread)
+        data = data.copy(shared=True)
+        data.fourier_filter(q_center, q_spread, data_fft=data_fft)
         
         
         data.maximize_intensity_spread()
@@ -886,7 +996,7 @@ class local_d0(Protocol, preprocess):
         make_dir(output_dir)
 
         results = {}
-        data = copy.deepcopy(data)
+        data = data.copy(shared=True)
         
         if run_args['verbosity']>=5:
             im = PIL.Image.fromarray( np.uint8(data.data) )
@@ -923,51 +1033,38 @@ class local_d0(Protocol, preprocess):
         sub_region_step = int(sub_region_size*run_args['sub_region_step_rel'])
         h, w = data.data.shape
         
-        sub_image = Data2D()
-        sub_image.x_scale, sub_image.y_scale = data.x_scale, data.y_scale
-        
-        
+        # FFT all the sub-regions in batches (see Windows.py)
+        windows = WindowFFT(data.data, sub_region_size, sub_region_step, x_scale=data.x_scale, y_scale=data.y_scale, blur=run_args['blur'])
         
-        for ix in range(sub_region_size, w-sub_region_size, sub_region_step):
+        for indices in windows.batches():
             if run_args['verbosity']>=3:
-                print('  ix {:d}/{:d} = {:.1f}%'.format(ix, w, 100.*ix/w))
-            for iy in range(sub_region_size, h-sub_region_size, sub_region_step):
-                
-                sub_image.data = data.data[iy-sub_region_size:iy+sub_region_size , ix-sub_region_size:ix+sub_region_size]
-                y_num, x_num = sub_image.data.shape
+                print('  window {:d}/{:d} = {:.1f}%'.format(indices[0], windows.num_windows, 100.*indices[0]/windows.num_windows))
+            
+            Zabs = windows.amplitude( windows.transform(indices) )
+            q_vals, I_vals = windows.circular_average(Zabs)
+            
+            for i, index in enumerate(indices):
+                ix, iy = windows.x[index], windows.y[index]
                 
-                if x_num>=sub_region_size*2 and y_num>=sub_region_size*2: # Full sub_images only
-                    
-                    if run_args['verbosity']>=5:
-                        print('    sub_region ({:d}, {:d}) of size {:d}×{:d}'.format(ix, iy, x_num, y_num))
-
-
-                    data_fft = sub_image.fft(update_origin=True)
-                    
-                    Re, Im = np.real(data_fft.data), np.imag(data_fft.data)
-                    data_fft.data = np.abs(data_fft.data)
-                    
-                    if run_args['blur'] is not None:
-                        data_fft.data = ndimage.filters.gaussian_filter(data_fft.data, run_args['blur'])
-                        Re = ndimage.filters.gaussian_filter(Re, run_args['blur'])
-                        Im = ndimage.filters.gaussian_filter(Im, run_args['blur'])
-                        
-                        
-                    if run_args['verbosity']>=6:
-                        outfile = self.get_outfile('sub_image_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
-                        sub_image.plot_image(save=outfile, cmap=mpl.cm.bone, ztrim=[0,0])
-                        
-                        outfile = self.get_outfile('sub_FFT_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
-                        data_fft.plot(save=outfile, plot_range=plot_range, ztrim=[0.25, 0.001], dpi=50)
-                        
-                    
-                    outfile_extra = '_ix{:03d}iy{:03d}'.format(ix,iy)
-                    q0local = self.analyze_q0(data_fft, q0i=q0, dqi=dq, outfile_extra=outfile_extra, output_dir=output_dir, **run_args)
-                    d0local = 2*np.pi/q0local
+                if run_args['verbosity']>=6:
+                    sub_image = Data2D()
+                    sub_image.data = windows.windows([index])[0]
+                    sub_image.x_scale, sub_image.y_scale = data.x_scale, data.y_scale
+                    outfile = self.get_outfile('sub_image_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
+                    sub_image.plot_image(save=outfile, cmap=mpl.cm.bone, ztrim=[0,0])
                     
-                    d0_x.append(ix)
-                    d0_y.append(iy)
-                    d0s.append(d0local)
+                    data_fft = windows.data_fft(Zabs[i])
+                    outfile = self.get_outfile('sub_FFT_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
+                    data_fft.plot(save=outfile, plot_range=plot_range, ztrim=[0.25, 0.001], dpi=50)
+                
+                line = DataLine(x=q_vals, y=I_vals[i], x_label='q', y_label='I', x_rlabel=r'$q \, (\mathrm{nm}^{-1})$', y_rlabel=r'$\langle I \rangle \, (\mathrm{counts/pixel})$')
+                outfile_extra = '_ix{:03d}iy{:03d}'.format(ix,iy)
+                q0local = self.analyze_q0_line(line, q0i=q0, dqi=dq, outfile_extra=outfile_extra, output_dir=output_dir, **run_args)
+                d0local = 2*np.pi/q0local
+                
+                d0_x.append(ix)
+                d0_y.append(iy)
+                d0s.append(d0local)
                     
                     
         d0s = np.asarray(d0s)
@@ -1008,6 +1105,12 @@ class local_d0(Protocol, preprocess):
         line = data_fft.circular_average()
         line.x_rlabel = '$q \, (\mathrm{nm}^{-1})$'
         
+        return self.analyze_q0_line(line, q0i, dqi, outfile_extra=outfile_extra, output_dir=output_dir, **run_args)
+        
+        
+    def analyze_q0_line(self, line, q0i, dqi, outfile_extra='', output_dir='./', **run_args):
+        '''Fits the peak (near q0i) in the circularly-averaged FFT.'''
+        
         sub_line = line.sub_range(q0i-dqi,q0i+dqi)
         lm_result, fit_line, fit_line_extended = self.fit_peak(sub_line, **run_args)
         q0 = lm_result.params['x_center'].value
@@ -1116,7 +1219,7 @@ class local_avg_realspace(Protocol, preprocess):
         make_dir(output_dir)
 
         results = {}
-        data = copy.deepcopy(data)
+        data = data.copy(shared=True)
         
         
         if run_args['verbosity']>=5:
@@ -1153,89 +1256,91 @@ class local_avg_realspace(Protocol, preprocess):
         
         sub_region_size = run_args['sub_region_size']
         sub_region_step = int(sub_region_size*run_args['sub_region_step_rel'])
-        h, w = data.data.shape
         
-        for ix in range(sub_region_size, w-sub_region_size, sub_region_step):
-            for iy in range(sub_region_size, h-sub_region_size, sub_region_step):
-                        
-                sub_image = Data2D()
-                sub_image.data = data.data[iy-sub_region_size:iy+sub_region_size , ix-sub_region_size:ix+sub_region_size]
-                sub_image.x_scale, sub_image.y_scale = data.x_scale, data.y_scale
-                y_num, x_num = sub_image.data.shape
+        # FFT all the sub-regions in batches (see Windows.py)
+        windows = WindowFFT(data.data, sub_region_size, sub_region_step, x_scale=data.x_scale, y_scale=data.y_scale, blur=run_args['blur'])
+        
+        sub_image = Data2D()
+        sub_image.x_scale, sub_image.y_scale = data.x_scale, data.y_scale
+        data_fft = windows.data_fft(None)
+        
+        for indices in windows.batches():
+            
+            F = windows.transform(indices)
+            Zabs_all = windows.amplitude(F)
+            Re_all, Im_all = windows.real_imag(F)
+            del F
+            angle_vals, angle_ints = windows.linecut_angle(Zabs_all, d_center=q0, d_spread=dq)
+            
+            for i, index in enumerate(indices):
+                ix, iy = windows.x[index], windows.y[index]
                 
-                #if x_num>0 and y_num>0: # Images of size greater than 0
-                if x_num>=sub_region_size*2 and y_num>=sub_region_size*2: # Full sub_images only
-                    if run_args['verbosity']>=4:
-                        print('    sub_region ({:d}, {:d}) of size {:d}×{:d}'.format(ix, iy, x_num, y_num))
-                    
-                    data_fft = sub_image.fft(update_origin=True)
-                    
-                    Re, Im = np.real(data_fft.data), np.imag(data_fft.data)
-                    data_fft.data = np.abs(data_fft.data)
+                sub_image.data = windows.windows([index])[0]
+                data_fft.data = Zabs_all[i]
+                
+                if run_args['verbosity']>=4:
+                    y_num, x_num = sub_image.data.shape
+                    print('    sub_region ({:d}, {:d}) of size {:d}×{:d}'.format(ix, iy, x_num, y_num))
                     
-                    if run_args['blur'] is not None:
-                        data_fft.data = ndimage.filters.gaussian_filter(data_fft.data, run_args['blur'])
-                        Re = ndimage.filters.gaussian_filter(Re, run_args['blur'])
-                        Im = ndimage.filters.gaussian_filter(Im, run_args['blur'])
-                        
-                        
-                    if run_args['verbosity']>=5:
-                        outfile = self.get_outfile('sub_image_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
-                        sub_image.plot_image(save=outfile, cmap=mpl.cm.bone, ztrim=[0,0])
-                        
-                        outfile = self.get_outfile('sub_FFT_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
-                        data_fft.plot(save=outfile, plot_range=plot_range, ztrim=[0.25, 0.0005], dpi=50)
+                if run_args['verbosity']>=5:
+                    outfile = self.get_outfile('sub_image_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
+                    sub_image.plot_image(save=outfile, cmap=mpl.cm.bone, ztrim=[0,0])
                     
-                    line = data_fft.linecut_angle(d_center=q0, d_spread=dq, absolute_value=True)
+                    outfile = self.get_outfile('sub_FFT_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
+                    data_fft.plot(save=outfile, plot_range=plot_range, ztrim=[0.25, 0.0005], dpi=50)
+                
+                line = DataLineAngle(x=angle_vals, y=angle_ints[i], x_label='angle', y_label='I', x_rlabel=r'$\chi \, (^{\circ})$', y_rlabel=r'$I (\chi) \, (\mathrm{counts/pixel})$')
+                
+                if run_args['verbosity']>=5:
+                    outfile = self.get_outfile('sub_angle_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
+                    line.plot(save=outfile, plot_range=[-180,+180,None,None])
+                    outfile = self.get_outfile('sub_angle_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.dat', ir=False)
+                    line.save_data(outfile)                        
+
+                if run_args['verbosity']>=10:
+                    # Show where the linecut is being applied
+                    data_fft_c = windows.data_fft(Zabs_all[i])
+                    data_fft_c.x_scale, data_fft_c.y_scale = 1, 1 # Hack because currently show_region assumes no coordinates have been applied
+                    data_fft_c.origin = [0,0]
+                    y_num, x_num = data_fft_c.data.shape
+                    ws = 30
+                    plot_range_c = [(x_num-ws)/2,(x_num+ws)/2,(y_num-ws)/2,(y_num+ws)/2]
+                    data_fft_c.plot(save=False, plot_range=plot_range_c, dpi=50, show_region=True, show=True)
                     
-                    if run_args['verbosity']>=5:
-                        outfile = self.get_outfile('sub_angle_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
-                        line.plot(save=outfile, plot_range=[-180,+180,None,None])
-                        outfile = self.get_outfile('sub_angle_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.dat', ir=False)
-                        line.save_data(outfile)                        
-
-                    if run_args['verbosity']>=10:
-                        # Show where the linecut is being applied
-                        data_fft.x_scale, data_fft.y_scale = 1, 1 # Hack because currently show_region assumes no coordinates have been applied
-                        data_fft.origin = [0,0]
-                        #plot_range = [None,None,None,None]
-                        y_num, x_num = data_fft.data.shape
-                        ws = 30
-                        plot_range_c = [(x_num-ws)/2,(x_num+ws)/2,(y_num-ws)/2,(y_num+ws)/2]
-                        data_fft.plot(save=False, plot_range=plot_range_c, dpi=50, show_region=True, show=True)
-                        
-                        
-                    # Rotate the FFT to align the maximum
-                    xm, ym = line.target_y_max()
-                    Zabs = ndimage.interpolation.rotate(data_fft.data, -xm, reshape=False)
-                    Re = ndimage.interpolation.rotate(Re, -xm, reshape=False)
-                    Im = ndimage.interpolation.rotate(Im, -xm, reshape=False)
-                    realspace = ndimage.interpolation.rotate(sub_image.data, -xm, reshape=False)
                     
+                # Rotate the FFT to align the maximum
+                # (|FFT| is centrosymmetric, so the maximum has a tied partner 180° away;
+                # always pick the first one, so that all the windows are aligned the same way)
+                i_max = np.nonzero(angle_ints[i]>=np.max(angle_ints[i])*(1-1e-9))[0][0]
+                xm = angle_vals[i_max]
+                Zabs = ndimage.interpolation.rotate(Zabs_all[i], -xm, reshape=False)
+                Re = ndimage.interpolation.rotate(Re_all[i], -xm, reshape=False)
+                Im = ndimage.interpolation.rotate(Im_all[i], -xm, reshape=False)
+                realspace = ndimage.interpolation.rotate(sub_image.data, -xm, reshape=False)
+                
 
-                    if run_args['verbosity']>=5:
-                        outfile = self.get_outfile('rot_FFT_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
-                        Z = data_fft.data
-                        data_fft.data = Zabs
-                        data_fft.plot(save=outfile, plot_range=plot_range, ztrim=[0.25, 0.0005], dpi=50)
-                        line2 = data_fft.linecut_angle(d_center=q0, d_spread=dq, absolute_value=True)
-                        outfile = self.get_outfile('rot_angle_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
-                        line2.plot(save=outfile, plot_range=[-180,+180,None,None])
-                        data_fft.data = Z
-
-
-                    # Accumulate the rotated data
-                    if Z_accumluation is None:
-                        Z_accumluation = Zabs
-                        Re_accumluation = Re
-                        Im_accumluation = Im
-                        realspace_accumulation = realspace
-                    else:
-                        Z_accumluation += Zabs
-                        Re_accumluation += Re
-                        Im_accumluation += Im
-                        realspace_accumulation += realspace
-                    num_images += 1
+                if run_args['verbosity']>=5:
+                    outfile = self.get_outfile('rot_FFT_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
+                    data_fft.data = Zabs
+                    data_fft.plot(save=outfile, plot_range=plot_range, ztrim=[0.25, 0.0005], dpi=50)
+                    line2 = data_fft.linecut_angle(d_center=q0, d_spread=dq, absolute_value=True)
+                    outfile = self.get_outfile('rot_angle_ix{:03d}iy{:03d}'.format(ix,iy), output_dir, ext='.jpg', ir=False)
+                    line2.plot(save=outfile, plot_range=[-180,+180,None,None])
+                    data_fft.data = Zabs_all[i]
+
+
+                # Accumulate the rotated data
+                if Z_accumluation is None:
+                    Z_accumluation = Zabs
+                    Re_accumluation = Re
+                    Im_accumluation = Im
+                    realspace_accumulation = realspace
+                else:
+                    Z_accumluation += Zabs
+                    Re_accumluation += Re
+                    Im_accumluation += Im
+                    realspace_accumulation += realspace
+                num_images += 1
             
             
             
@@ -1381,6 +1486,21 @@ class particles(Protocol, preprocess):
 
 
 
+    def _structure(self, **run_args):
+        
+        if 'diagonal_detection' in run_args and run_args['diagonal_detection']:
+            #s = [[1,1,1],
+            #    [1,1,1],
+            #    [1,1,1]]
+            s = ndimage.generate_binary_structure(2,2)
+        else:
+            s = [[0,1,0],
+                [1,1,1],
+                [0,1,0]]
+            
+        return s
+
+
     def _find_objects(self, data, output_dir, results, **run_args):
         # results, labeled_array = self._find_objects(data, output_dir, results, **run_args)
 
@@ -1412,40 +1532,13 @@ class particles(Protocol, preprocess):
             
             
         # Identify particles positions
-        if 'diagonal_detection' in run_args and run_args['diagonal_detection']:
-            #s = [[1,1,1],
-            #    [1,1,1],
-            #    [1,1,1]]
-            s = ndimage.generate_binary_structure(2,2)
-        else:
-            s = [[0,1,0],
-                [1,1,1],
-                [0,1,0]]
-        
+        s = self._structure(**run_args)
         labeled_array, num_features = ndimage.measurements.label(data.data, structure=s)
         results['num_particles'] = num_features
 
         # Remove objects not meeting size criteria
-        for i in range(np.max(labeled_array)+1):
-            particle = (labeled_array==i).astype(np.uint8)
-            area_pix = np.sum(particle)
-            area_nm2 = area_pix*data.x_scale*data.y_scale # nm^2
-            radius_nm = np.sqrt(area_nm2/np.pi) # nm
-
-            # Select only desired particles
-            exclude = False
-            if 'area_min' in run_args and area_nm2<run_args['area_min']:
-                exclude = True
-            if 'area_max' in run_args and area_nm2>run_args['area_max']:
-                exclude = True
-            if 'radius_min' in run_args and radius_nm<run_args['radius_min']:
-                exclude = True
-            if 'radius_max' in run_args and radius_nm>run_args['radius_max']:
-                exclude = True
-            
-            if exclude:
-                idx = np.where(labeled_array==i)
-                labeled_array[idx] = 0
+        regions = RegionProperties(labeled_array, num_labels=num_features, x_scale=data.x_scale, y_scale=data.y_scale)
+        labeled_array = regions.relabel(regions.select(**run_args))
             
         data.data = ( labeled_array>0 )*255
 
@@ -1458,6 +1551,39 @@ class particles(Protocol, preprocess):
         return results, labeled_array
     
 
+    def _size_statistics(self, bins, x_scale, y_scale, results, **run_args):
+        # results, particle_sizes, particle_radii = self._size_statistics(bins, x_scale, y_scale, results, **run_args)
+        # where bins are the particle sizes (pixels)
+        
+        # Convert to physical sizes
+        particle_sizes = bins*x_scale*y_scale # nm^2
+        
+        if 'area_min' in run_args:
+            particle_sizes = particle_sizes[particle_sizes>run_args['area_min']]
+        if 'area_max' in run_args:
+            particle_sizes = particle_sizes[particle_sizes<run_args['area_max']]
+        
+        
+        particle_radii = np.sqrt(particle_sizes/np.pi) # nm
+        
+        if 'radius_min' in run_args:
+            particle_radii = particle_radii[particle_radii>run_args['radius_min']]
+        if 'radius_max' in run_args:
+            particle_radii = particle_radii[particle_radii<run_args['radius_max']]
+
+        particle_sizes = np.pi*np.square(particle_radii)
+        
+        results['area_average'] = np.average(particle_sizes)
+        results['area_std'] = np.std(particle_sizes)
+        results['area_median'] = np.median(particle_sizes)
+        
+        results['radius_average'] = np.average(particle_radii)
+        results['radius_std'] = np.std(particle_radii)
+        results['radius_median'] = np.median(particle_radii)
+        
+        return results, particle_sizes, particle_radii
+        
+
     @run_default
     def run(self, data, output_dir, **run_args):
         
@@ -1465,7 +1591,7 @@ class particles(Protocol, preprocess):
         make_dir(output_dir)
         
         results = {}
-        data = copy.deepcopy(data)
+        data = data.copy(shared=True)
         
         results, labeled_array = self._find_objects(data, output_dir, results, **run_args)
 
@@ -1473,20 +1599,8 @@ class particles(Protocol, preprocess):
         if run_args['verbosity']>=3:
             # Colored image
             
-            im = PIL.Image.fromarray( np.uint8(data.data*255.0) )
-            im = im.convert('RGB')
-            pix = im.load()
-            
-            h, w = data.data.shape
-            for ix in range(w):
-                for iy in range(h):
-                    object_index = labeled_array[iy,ix]
-                    if object_index==0:
-                        c = (0, 0, 0)
-                    else:
-                        c = color_list[ object_index%len(color_list) ]
-                        c = ( int(c[0]*255), int(c[1]*255), int(c[2]*255) )
-                    pix[ix,iy] = c            
+            lut = label_lut(color_list, np.max(labeled_array))
+            im = PIL.Image.fromarray( render_labels(labeled_array, lut) )
             
             
             outfile = self.get_outfile('colored', output_dir, ext='.png', ir=True)
@@ -1496,26 +1610,17 @@ class particles(Protocol, preprocess):
         if run_args['verbosity']>=4:
             # Boundary image
             
-            im = PIL.Image.fromarray( np.uint8(data.data*255.0) )
-            im = im.convert('RGB')
-            pix = im.load()
-            
-            c = ( 1*255, 0*255, 0*255 )
-            h, w = data.data.shape
-            for ix in range(w-1):
-                for iy in range(h-1):
-                    
-                    num_zeros = np.bincount( labeled_array[iy:iy+2,ix:ix+2].flatten() )[0]
-                    if not (num_zeros==0 or num_zeros==4):
-                        pix[ix,iy] = c            
+            im = np.array( PIL.Image.fromarray( np.uint8(data.data*255.0) ).convert('RGB') )
+            im[label_boundaries(labeled_array)] = ( 1*255, 0*255, 0*255 )
             
 
             outfile = self.get_outfile('boundaries', output_dir, ext='.png', ir=True)
-            im.save(outfile)
+            PIL.Image.fromarray(im).save(outfile)
             
         
         # Statistics on particles that have been found
-        bins = np.bincount(labeled_array.flatten('C'))
+        regions = RegionProperties(labeled_array, x_scale=data.x_scale, y_scale=data.y_scale)
+        bins = regions.area
         h, w = data.data.shape
         total_pixels = w*h
         background_pixels = bins[0]
@@ -1533,108 +1638,71 @@ class particles(Protocol, preprocess):
         # Remove the 'surrounding field' (index 0)
         bins = bins[1:]
         
-        # Convert to physical sizes
-        particle_sizes = bins*data.x_scale*data.y_scale # nm^2
-        
-        if 'area_min' in run_args:
-            particle_sizes = particle_sizes[particle_sizes>run_args['area_min']]
-        if 'area_max' in run_args:
-            particle_sizes = particle_sizes[particle_sizes<run_args['area_max']]
-        
-        
-        particle_radii = np.sqrt(particle_sizes/np.pi) # nm
-        
-        if 'radius_min' in run_args:
-            particle_radii = particle_radii[particle_radii>run_args['radius_min']]
-        if 'radius_max' in run_args:
-            particle_radii = particle_radii[particle_radii<run_args['radius_max']]
-
-        particle_sizes = np.pi*np.square(particle_radii)
-        
-        results['area_average'] = np.average(particle_sizes)
-        results['area_std'] = np.std(particle_sizes)
-        results['area_median'] = np.median(particle_sizes)
-        
-        results['radius_average'] = np.average(particle_radii)
-        results['radius_std'] = np.std(particle_radii)
-        results['radius_median'] = np.median(particle_radii)
+        results, particle_sizes, particle_radii = self._size_statistics(bins, data.x_scale, data.y_scale, results, **run_args)
         
         
         # Compute additional properties of of each particle
+        # (each particle is analyzed within its bounding box)
         import skimage.measure as measure
         analyzed_image = np.zeros((h,w,3))
         PrAs = []
         eccentricities = []
-        for i in range(np.max(labeled_array)+1):
+        analyze_particle = regions.select(**run_args)
+        areas_nm2, radii_nm = regions.area_nm2, regions.radius_nm
+        for i in regions.labels(): # Ignores the background object (index 0)
             
-            if i>0: # Ignore the background object (index 0)
-                
-                # Extract just this particle
-                #particle = np.where(labeled_array==i, 1, 0)
-                particle = (labeled_array==i).astype(np.uint8)
-                area_pix = np.sum(particle)
-                area_nm2 = area_pix*data.x_scale*data.y_scale # nm^2
-                radius_nm = np.sqrt(area_nm2/np.pi) # nm
-
-                # Select only desired particles
-                analyze = True
-                if 'area_min' in run_args and area_nm2<run_args['area_min']:
-                    analyze = False
-                if 'area_max' in run_args and area_nm2>run_args['area_max']:
-                    analyze = False
-                if 'radius_min' in run_args and radius_nm<run_args['radius_min']:
-                    analyze = False
-                if 'radius_max' in run_args and radius_nm>run_args['radius_max']:
-                    analyze = False
-
-
-                h, w = labeled_array.shape
-                
+            # Extract just this particle
+            particle, (y0, x0) = regions.crop(i)
+            area_pix = regions.area[i]
+            area_nm2 = areas_nm2[i] # nm^2
+            radius_nm = radii_nm[i] # nm
 
-                if analyze:
-                        
-                    scale = (data.x_scale + data.y_scale)*0.5
-                    perimeter_pix = measure.perimeter(particle)
-                    perimeter_nm = perimeter_pix*scale
-                    PrA = perimeter_nm*radius_nm/area_nm2
-                    PrAs.append(PrA)
-                
-                    # Fit the particle to an ellipse
-                    contour = measure.find_contours(particle, 0.5)[0]
-                    ellipse = measure.EllipseModel()
-                    ellipse.estimate(contour)
+            # Select only desired particles
+            if analyze_particle[i]:
                     
-                    if ellipse.params is None:
-                        if run_args['verbosity']>=1:
-                            print("WARNING: params is None for particle {:d}".format(i))
+                scale = (data.x_scale + data.y_scale)*0.5
+                perimeter_pix = measure.perimeter(particle)
+                perimeter_nm = perimeter_pix*scale
+                PrA = perimeter_nm*radius_nm/area_nm2
+                PrAs.append(PrA)
+            
+                # Fit the particle to an ellipse
+                contour = measure.find_contours(particle, 0.5)[0] + [y0, x0]
+                ellipse = measure.EllipseModel()
+                ellipse.estimate(contour)
+                
+                if ellipse.params is None:
+                    if run_args['verbosity']>=1:
+                        print("WARNING: params is None for particle {:d}".format(i))
+                else:
+                    xc, yc, a, b, theta = ellipse.params
+                    if a>=b:
+                        eccentricity = np.sqrt(1 - b**2/a**2)
                     else:
-                        xc, yc, a, b, theta = ellipse.params
-                        if a>=b:
-                            eccentricity = np.sqrt(1 - b**2/a**2)
-                        else:
-                            eccentricity = np.sqrt(1 - a**2/b**2)
-                        eccentricities.append(eccentricity)
-
-                        if run_args['verbosity']>=4:
-                            print('    Particle {} ({} pixels)'.format(i, area_pix))
-                            print('      A = {:.1f} nm^2; r = {:.1f} nm'.format(area_nm2, radius_nm))
-                            print('      P = {:.1f} nm; P/A = {:.2g} 1/nm; Pr/A = {:.2f}'.format(perimeter_nm, perimeter_nm/area_nm2, PrA))
-                            print('      e = {:.2f}'.format(eccentricity))
-
-                        if run_args['verbosity']>=5:
-                            analyzed_image += np.stack( (particle*255, particle*255, particle*255), axis=-1 )
-                            xy = ellipse.predict_xy( np.linspace(0, 2*np.pi, 90) )
-                            for y, x in xy:
-                                if x>=0 and y>=0 and x<w and y<h:
-                                    analyzed_image[int(y),int(x)] = [255, 0, 0]
-                        
-                        if run_args['verbosity']>=10:
-                            # Output image of each particle separately (mostly for debugging)
-                            outfile = self.get_outfile('particle{}'.format(i), output_dir, ext='.png', ir=False)
-                            #import scipy.misc
-                            #scipy.misc.toimage(particle*255).save(outfile) # Deprecated
-                            particle_image = particle*255
-                            Image.fromarray(particle_image.astype(np.uint8)).save(outfile)
+                        eccentricity = np.sqrt(1 - a**2/b**2)
+                    eccentricities.append(eccentricity)
+
+                    if run_args['verbosity']>=4:
+                        print('    Particle {} ({} pixels)'.format(i, area_pix))
+                        print('      A = {:.1f} nm^2; r = {:.1f} nm'.format(area_nm2, radius_nm))
+                        print('      P = {:.1f} nm; P/A = {:.2g} 1/nm; Pr/A = {:.2f}'.format(perimeter_nm, perimeter_nm/area_nm2, PrA))
+                        print('      e = {:.2f}'.format(eccentricity))
+
+                    if run_args['verbosity']>=5:
+                        ph, pw = particle.shape
+                        analyzed_image[y0:y0+ph, x0:x0+pw] += particle[:,:,np.newaxis]*255
+                        xy = ellipse.predict_xy( np.linspace(0, 2*np.pi, 90) )
+                        for y, x in xy:
+                            if x>=0 and y>=0 and x<w and y<h:
+                                analyzed_image[int(y),int(x)] = [255, 0, 0]
+                    
+                    if run_args['verbosity']>=10:
+                        # Output image of each particle separately (mostly for debugging)
+                        outfile = self.get_outfile('particle{}'.format(i), output_dir, ext='.png', ir=False)
+                        #import scipy.misc
+                        #scipy.misc.toimage(particle*255).save(outfile) # Deprecated
+                        particle_image = (labeled_array==i)*255
+                        Image.fromarray(particle_image.astype(np.uint8)).save(outfile)
 
 
         results['PrA_average'] = np.average(PrAs)
@@ -1783,6 +1851,69 @@ class particles(Protocol, preprocess):
         
         return results
         
+        
+    @run_default
+    def run_tiled(self, tiled, output_dir, **run_args):
+        '''Finds the particles in a (large) image that is read as tiles (see
+        ProcessorIm.run_tiled). Each tile is pre-processed and thresholded
+        (including its halo, so that filters behave as for the full image);
+        particles are then labelled and stitched across the tile borders.
+        The particle statistics (number, coverage, sizes) are computed for the
+        full image; the per-particle shape analysis (PrA, eccentricity) is
+        not performed.'''
+        
+        if type(self).run is not particles.run or type(self)._find_objects is not particles._find_objects:
+            # Variants that modify the analysis are run tile-by-tile (if they
+            # declare their tile_results)
+            return run_tiles(self, tiled, output_dir, **run_args)
+        
+        output_dir = os.path.join(output_dir, tiled.name)
+        make_dir(output_dir)
+        
+        results = {}
+        
+        outfile = self.get_outfile('labels', output_dir, ext='.npy')
+        labels = TiledLabels(tiled.shape, structure=self._structure(**run_args), outfile=outfile)
+        
+        for tile in tiled.tiles():
+            data = tiled.data(tile)
+            data = self.preprocess(data, **run_args)
+            data.threshold(run_args['threshold'], run_args['invert'])
+            labels.add(tile, data.data[tile.interior]>0)
+            
+        regions = labels.regions(x_scale=tiled.x_scale, y_scale=tiled.y_scale)
+        results['num_particles'] = regions.num_labels
+        results['num_tiles'] = len(tiled.tiles())
+        
+        # Remove objects not meeting size criteria
+        keep = regions.select(**run_args)
+        labels.relabel( np.where(keep, np.arange(len(keep)), 0) )
+        
+        h, w = tiled.shape
+        coverage = np.sum(regions.area[keep])*1./(h*w*1.)
+        results['coverage'] = coverage
+        if run_args['verbosity']>=4:
+            print('    {} particles'.format(results['num_particles']))
+            print('    Particle coverage: {:.1f}%'.format(coverage*100.))
+            
+        bins = regions.area[keep]
+        results, particle_sizes, particle_radii = self._size_statistics(bins, tiled.x_scale, tiled.y_scale, results, **run_args)
+        
+        
+        if run_args['verbosity']>=3:
+            # Colored image (reduced to at most ~2000 pixels)
+            step = max(1, int(np.ceil(max(h, w)/2000.)))
+            labeled_array = np.asarray(labels.labeled_array[::step, ::step])
+            
+            lut = label_lut(color_list, regions.num_labels)
+            im = PIL.Image.fromarray( render_labels(labeled_array, lut) )
+            
+            outfile = self.get_outfile('colored', output_dir, ext='.png', ir=True)
+            im.save(outfile)
+            
+            
+        return results
+        
 
 
 
@@ -1866,7 +1997,7 @@ class skeletonize(particles):
         
         results = {}
         orig_img = data.data
-        data = copy.deepcopy(data)
+        data = data.copy(shared=True)
         
         results, labeled_array = self._find_objects(data, output_dir, results, **run_args)
         
@@ -1877,29 +2008,19 @@ class skeletonize(particles):
 
     def _skeletonize(self, data, output_dir, results, labeled_array, **run_args):
         
+        regions = RegionProperties(labeled_array, x_scale=data.x_scale, y_scale=data.y_scale)
+        
         if run_args['verbosity']>=4:
             # Colored image
-            im = PIL.Image.fromarray( np.uint8(data.data*255.0) )
-            im = im.convert('RGB')
-            pix = im.load()
-            
-            h, w = data.data.shape
-            for ix in range(w):
-                for iy in range(h):
-                    object_index = labeled_array[iy,ix]
-                    if object_index==0:
-                        c = (0, 0, 0)
-                    else:
-                        c = color_list[ object_index%len(color_list) ]
-                        c = ( int(c[0]*255), int(c[1]*255), int(c[2]*255) )
-                    pix[ix,iy] = c            
+            lut = label_lut(color_list, np.max(labeled_array))
+            im = PIL.Image.fromarray( render_labels(labeled_array, lut) )
             
             
             outfile = self.get_outfile('colored', output_dir, ext='.png', ir=True)
             im.save(outfile)
 
         # Statistics on particles that have been found
-        bins = np.bincount(labeled_array.flatten('C'))
+        bins = regions.area
         h, w = data.data.shape
         total_pixels = w*h
         background_pixels = bins[0]
@@ -1968,20 +2089,8 @@ class skeletonize(particles):
 
         if run_args['verbosity']>=5:
             # Colored image
-            im = PIL.Image.fromarray( np.uint8(data.data*255.0) )
-            im = im.convert('RGB')
-            pix = im.load()
-            
-            h, w = data.data.shape
-            for ix in range(w):
-                for iy in range(h):
-                    object_index = labeled_array[iy,ix]
-                    if object_index==0:
-                        c = (0, 0, 0)
-                    else:
-                        c = color_list[ object_index%len(color_list) ]
-                        c = ( int(c[0]*255), int(c[1]*255), int(c[2]*255) )
-                    pix[ix,iy] = c            
+            lut = label_lut(color_list, np.max(labeled_array))
+            im = PIL.Image.fromarray( render_labels(labeled_array, lut) )
             
             outfile = self.get_outfile('colored', output_dir, ext='.png', ir=True)
             im.save(outfile)
@@ -2015,7 +2124,7 @@ class skeleton_lines(skeletonize):
         
         results = {}
         orig_img = data.data
-        data = copy.deepcopy(data)
+        data = data.copy(shared=True)
         
         results, labeled_array = self._find_objects(data, output_dir, results, **run_args)
         
@@ -2029,25 +2138,26 @@ class skeleton_lines(skeletonize):
     def _skeletonize_lines(self, data, output_dir, results, skeleton, orig_img, **run_args):
 
 
-        # Neighbor image
-        def filter_function(values):
-            return values.sum()
-        footprint = np.array([[1,1,1],
-                            [1,0,1],
-                            [1,1,1]])
-        
-        neighbors = ndimage.generic_filter(skeleton, filter_function, footprint=footprint, mode='constant')
-        neighbors *= skeleton
+        # Graph of the skeleton (line ends, junctions, segments); see Skeleton.py
+        graph = SkeletonGraph(skeleton, x_scale=data.x_scale, y_scale=data.y_scale)
+        neighbors = graph.neighbors
         
         # Count certain kinds of defects
-        results['line_ends_count'] = len(neighbors[neighbors==1])
+        results['line_ends_count'] = int(np.sum(graph.endpoints))
         results['line_ends_density'] = results['line_ends_count']/data.image_area()
         
-        junctions = np.where(neighbors>=3, 1, 0)
-        s = ndimage.generate_binary_structure(2,2) # Detect along diagonals
-        labeled_junctions, num_junctions = ndimage.measurements.label(junctions, structure=s)
+        junctions = graph.junction_pixels.astype(int)
+        num_junctions = graph.num_junctions
         results['junctions_count'] = num_junctions
         results['junctions_density'] = results['junctions_count']/data.image_area()
+        
+        # Line segments (between junctions)
+        lengths = graph.segment_length[1:]
+        results['segments_count'] = graph.num_segments
+        if graph.num_segments>0:
+            results['segment_length_average'] = np.average(lengths)
+            results['segment_length_median'] = np.median(lengths)
+            results['segment_tortuosity_median'] = np.nanmedian(graph.segment_tortuosity[1:]) if np.any(np.isfinite(graph.segment_tortuosity[1:])) else np.nan
 
         if run_args['verbosity']>=3:
             print('    {:d} line ends ({:.3g}/nm^2 = {:.2g}/μm^2)'.format(results['line_ends_count'], results['line_ends_density'], results['line_ends_density']*1e6))
@@ -2088,8 +2198,7 @@ class skeleton_lines(skeletonize):
                 draw.ellipse((x-r, y-r, x+r, y+r), outline=(255,0,0,0), fill=None)
                 
             # Mark junctions
-            import scipy
-            com = scipy.ndimage.measurements.center_of_mass(junctions, labels=labeled_junctions, index=range(1,num_junctions+1))
+            com = graph.junction_positions()
             for y, x in com:
                 draw.ellipse((x-r, y-r, x+r, y+r), outline=(0,0,255,0), fill=None)
             
@@ -2142,7 +2251,7 @@ class skeleton_angles(skeleton_lines):
         
         results = {}
         orig_img = data.data
-        data = copy.deepcopy(data)
+        data = data.copy(shared=True)
         
         results, labeled_array = self._find_objects(data, output_dir, results, **run_args)
         
@@ -2168,79 +2277,10 @@ class skeleton_angles(skeleton_lines):
         # Compute the local "bending" angle of skeleton lines
         # out to a "lookout" distance of l.
         l = run_args['lookout_distance_pix']
-        s = 2*l+1 # Size of window
-        
-        # We define a "footprint" for the window that will search at any given point.
-        # For instance, a footprint that searches 2 pixels away from the target point is a 5x5 matrix:
-        #footprint = [ [1, 1, 1, 1, 1] ,
-        #              [1, 0, 0, 0, 1] ,
-        #              [1, 0, 0, 0, 1] ,
-        #              [1, 0, 0, 0, 1] ,
-        #              [1, 1, 1, 1, 1] ]
-        footprint = np.ones((s,s)) # Set all values (including edges) to 1.0
-        footprint[1:-1,1:-1] = 0 # Set inner (non-edge) values to 0.0
-
-        # We pre-compute angles for the footprint, which has indices like:
-        #  0  1  2  3  4
-        #  5  -  -  -  6
-        #  7  -  -  -  8
-        #  9  -  -  - 10
-        # 11 12 13 14 15
-        #delta_x = [-2, -1, +0, +1, +2,    -2, +2, -2, +2, -2, +2,    -2, -1, +0, +1, +2]
-        #delta_y = [+2, +2, +2, +2, +2,    +1, +1, +0, +0, -1, -1,    -2, -2, -2, -2, -2]
-        grid = np.indices((s,s))
-        delta_x = grid[1]-l
-        delta_x = delta_x[footprint==1]
-        delta_y = (grid[0]-l)*-1
-        delta_y = delta_y[footprint==1]
-        angle_lookup = np.degrees(np.arctan2(delta_y, delta_x))
-        
-        def filter_function(values):
-            '''Calculates the local bending angle at this pixel.'''
-            idx = np.where(values>0)[0]
-            n = len(idx)
-            if n<=1:
-                return 0
-            elif n==2:
-                angle0 = angle_lookup[idx[0]]
-                angle1 = angle_lookup[idx[1]]
-                angle_diff = abs(angle1-angle0)
-                angle_diff = min(angle_diff, 360-angle_diff)
-                bend = 180-angle_diff
-                return bend
-            elif n==3:
-                angle0 = angle_lookup[idx[0]]
-                angle1 = angle_lookup[idx[1]]
-                angle2 = angle_lookup[idx[2]]
-                angle_diff01 = abs(angle1-angle0)
-                angle_diff01 = min(angle_diff01, 360-angle_diff01)
-                angle_diff12 = abs(angle2-angle1)
-                angle_diff12 = min(angle_diff12, 360-angle_diff12)
-                angle_diff20 = abs(angle0-angle2)
-                angle_diff20 = min(angle_diff20, 360-angle_diff20)
-                angles = sorted([angle_diff01, angle_diff12, angle_diff20])[:n-1]
-                bends = 180-np.asarray(angles)
-                return np.average(bends)
-            
-            else:
-                # This block works for all n, but the above code might be slightly more efficient
-                # (and is retained to document how this method works)
-                angles = []
-                for i in range(n):
-                    angle_i = angle_lookup[idx[i]]
-                    for j in range(i+1, n):
-                        angle_j = angle_lookup[idx[j]]
-                        diff = abs(angle_i-angle_j)
-                        diff = min(diff, 360-diff)
-                        angles.append(diff)
-                angles = sorted(angles)[:n-1] # Exclude the largest outer angle
-                bends = 180-np.asarray(angles)
-                return np.average(bends)
-                
         
-        # Apply the local "angle calculator" to every pixel in the image.
-        angles = ndimage.generic_filter(skeleton, filter_function, footprint=footprint, mode='constant', output=np.float)
-        angles *= skeleton # Set to zero any non-skeleton pixels
+        # Apply the local "angle calculator" to every skeleton pixel (see SkeletonGraph.bending_angles).
+        graph = SkeletonGraph(skeleton, x_scale=data.x_scale, y_scale=data.y_scale)
+        angles = graph.bending_angles(lookout=l) # Zero for non-skeleton pixels
         if run_args['verbosity']>=6:
             print_array(angles, 'angles')
             
@@ -2329,6 +2369,8 @@ class grain_size_hex(Protocol, preprocess, mask):
                         'correlation_edge_exclusion' : 10,
                         'correlation_step_size_points' : 5,
                         'trim_r_curve' : 0.8, # 1.0 doesn't trim anything; 0.8 trims the last 20% of the g(r)-curve
+                        'NN_method' : 'cutoff', # 'cutoff' or 'delaunay' (Delaunay/Voronoi coordination)
+                        'NN_boundary' : 'open', # 'open', 'periodic', or 'exclude' (particles near edges)
                         'preprocess' : 'default',
                         }
         self.run_args.update(kwargs)
@@ -2385,7 +2427,7 @@ class grain_size_hex(Protocol, preprocess, mask):
         orig_data = data.data.copy()
         
         results = {}
-        data = copy.deepcopy(data)
+        data = data.copy(shared=True)
         
         if run_args['verbosity']>=5:
             im = PIL.Image.fromarray( np.uint8(data.data) )
@@ -2428,13 +2470,9 @@ class grain_size_hex(Protocol, preprocess, mask):
         num_objects = num_features
         
         # Remove objects outside of size cutoffs
-        bins = np.bincount(labeled_array.flatten('C'))
-        bins = bins[1:] # Remove the 'surrounding field' (index 0)
         if 'area_min' in run_args:
-            cutoff = run_args['area_min']/(data.x_scale*data.y_scale) # pix^2
-            idx = np.where(bins<cutoff)[0]
-            for object_index in idx:
-                labeled_array[labeled_array==(object_index+1)] = 0
+            regions = RegionProperties(labeled_array, num_labels=num_features, x_scale=data.x_scale, y_scale=data.y_scale)
+            labeled_array = regions.relabel(regions.select(area_min=run_args['area_min']))
                 
             #num_objects -= len(idx)
             
@@ -2452,20 +2490,10 @@ class grain_size_hex(Protocol, preprocess, mask):
             
 
         # Determine (x,y) position of each particle (center-of-mass of each particle)
-        x_positions = np.zeros( (num_features) )
-        y_positions = np.zeros( (num_features) )
-        counts = np.zeros( (num_features) )
-        for ix in range( len(labeled_array[0]) ):
-            for iy in range( len(labeled_array) ):
-                if labeled_array[iy,ix]!=0:
-                    object_index = labeled_array[iy,ix] - 1
-                    
-                    x_positions[object_index] +=  1.0*ix
-                    y_positions[object_index] +=  1.0*iy
-                    counts[object_index] +=  1.0  
-                    
-        x_positions /= counts
-        y_positions /= counts
+        regions = RegionProperties(labeled_array, num_labels=num_features)
+        x_positions = regions.centroid_x[1:]
+        y_positions = regions.centroid_y[1:]
+        counts = regions.area[1:].astype(float)
 
 
 
@@ -2479,7 +2507,7 @@ class grain_size_hex(Protocol, preprocess, mask):
             
         if 'NN_cutoff_distance_pix' not in run_args:
             run_args['NN_cutoff_distance_pix'] = run_args['NN_cutoff_distance_nm']/( (data.x_scale + data.y_scale)*0.5 )
-        NN_counts, angles, new_results = self.nearest_neighbor_count(x_positions, y_positions, counts, **run_args)
+        NN_counts, angles, interior, new_results = self.nearest_neighbor_count(x_positions, y_positions, counts, image_shape=data.data.shape, **run_args)
         results.update(new_results)
 
 
@@ -2492,11 +2520,14 @@ class grain_size_hex(Protocol, preprocess, mask):
         d = L0/(np.sqrt(3.0)/2.0)
         edge_defects = 2*w*data.x_scale/d # top/bottom edge
         edge_defects += 2*2*h*data.y_scale/L0 # left/right edge
+        if 'NN_boundary' in run_args and run_args['NN_boundary'] in ['periodic', 'exclude']:
+            # Edges are either absent (periodic) or excluded from the counts
+            edge_defects = 0
         
         sym = run_args['symmetry']
-        less = len(np.nonzero(NN_counts<sym)[0])
-        equal = len(np.nonzero(NN_counts==sym)[0])
-        more = len(np.nonzero(NN_counts>sym)[0])
+        less = len(np.nonzero(NN_counts[interior]<sym)[0])
+        equal = len(np.nonzero(NN_counts[interior]==sym)[0])
+        more = len(np.nonzero(NN_counts[interior]>sym)[0])
         
         results['fraction_matching_symmetry'] = equal/(less+equal+more - edge_defects)
         results['number_defects'] = int(max( ( (less + more) - edge_defects ), 0 ))
@@ -2514,20 +2545,8 @@ class grain_size_hex(Protocol, preprocess, mask):
         if run_args['verbosity']>=5:
             # Colored image
             
-            im = PIL.Image.fromarray( np.uint8(data.data*255.0) )
-            im = im.convert('RGB')
-            pix = im.load()
-            
-            h, w = data.data.shape
-            for ix in range(w):
-                for iy in range(h):
-                    object_index = labeled_array[iy,ix]
-                    if object_index==0:
-                        c = (0, 0, 0)
-                    else:
-                        c = color_list[ object_index%len(color_list) ]
-                        c = ( int(c[0]*255), int(c[1]*255), int(c[2]*255) )
-                    pix[ix,iy] = c            
+            lut = label_lut(color_list, np.max(labeled_array))
+            im = PIL.Image.fromarray( render_labels(labeled_array, lut) )
             
             
             outfile = self.get_outfile('colored', output_dir, ext='.png', ir=True)
@@ -2537,72 +2556,35 @@ class grain_size_hex(Protocol, preprocess, mask):
         if run_args['verbosity']>=5:
             # Boundary image
             
-            im = PIL.Image.fromarray( np.uint8(data.data*255.0) )
-            im = im.convert('RGB')
-            pix = im.load()
-            
-            c = ( 1*255, 0*255, 0*255 )
-            h, w = data.data.shape
-            for ix in range(w-1):
-                for iy in range(h-1):
-                    
-                    num_zeros = np.bincount( labeled_array[iy:iy+2,ix:ix+2].flatten() )[0]
-                    if not (num_zeros==0 or num_zeros==4):
-                        pix[ix,iy] = c            
+            im = np.array( PIL.Image.fromarray( np.uint8(data.data*255.0) ).convert('RGB') )
+            im[label_boundaries(labeled_array)] = ( 1*255, 0*255, 0*255 )
             
             # Put a dot at center-of-mass (COM) of each object
-            c = ( 0*255, 1*255, 0*255 )
-            for object_index in range(len(counts)):
-                #if counts[object_index]>0:
-                ix = int(x_positions[object_index])
-                iy = int(y_positions[object_index])
-                pix[ix,iy] = c
+            valid = counts>0
+            im[ y_positions[valid].astype(int), x_positions[valid].astype(int) ] = ( 0*255, 1*255, 0*255 )
 
             outfile = self.get_outfile('boundaries', output_dir, ext='.png', ir=True)
-            im.save(outfile)
+            PIL.Image.fromarray(im).save(outfile)
 
         if run_args['verbosity']>=3:
             # Color-coded image of nearest-neighbour (NN) count
-            
-            im = PIL.Image.fromarray( np.uint8(data.data*255.0) )
-            im = im.convert('RGB')
-            pix = im.load()
-            
-            for ix in range( len(labeled_array[0]) ):
-                for iy in range( len(labeled_array) ):
-                    object_index = labeled_array[iy,ix] - 1
-                    
-                    if object_index<0:
-                        c = (0, 0, 0 )
-                    else:
-                        NN_count = NN_counts[object_index]
-                        
-                        if NN_count==0:
-                            c = (20, 20, 20) # Dark grey
-                        elif NN_count==1:
-                            c = (40, 40, 40) # Dark grey
-                        elif NN_count==2:
-                            c = (60, 60, 60) # Dark grey
-                        elif NN_count==3:
-                            c = (0, 0, 150)
-                        elif NN_count==4:
-                            c = (0, 0, 200)
-                        elif NN_count==5:
-                            c = (0, 255, 255)
-                        elif NN_count==6:
-                            c = (0, 255, 0) # Green
-                        elif NN_count==7:
-                            c = (255, 255, 0)
-                        elif NN_count==8:
-                            c = (100, 0, 0) # Dark red
-                        elif NN_count==9:
-                            c = (150, 0, 0) # Dark red
-                        elif NN_count==10:
-                            c = (200, 0, 0) # Dark red
-                        else:
-                            c = (255, 0, 0 ) # Red
-                        
-                    pix[ix,iy] = c
+            NN_colors = np.asarray([
+                (20, 20, 20), # 0 (dark grey)
+                (40, 40, 40), # 1 (dark grey)
+                (60, 60, 60), # 2 (dark grey)
+                (0, 0, 150), # 3
+                (0, 0, 200), # 4
+                (0, 255, 255), # 5
+                (0, 255, 0), # 6 (green)
+                (255, 255, 0), # 7
+                (100, 0, 0), # 8 (dark red)
+                (150, 0, 0), # 9 (dark red)
+                (200, 0, 0), # 10 (dark red)
+                (255, 0, 0), # >10 (red)
+                ], dtype=np.uint8)
+            lut = np.zeros( (len(NN_counts)+1, 3), dtype=np.uint8 ) # Background (index 0) is black
+            lut[1:] = NN_colors[ np.clip(np.asarray(NN_counts, dtype=int), 0, len(NN_colors)-1) ]
+            im = PIL.Image.fromarray( render_labels(labeled_array, lut) )
                     
             outfile = self.get_outfile('NN_count', output_dir, ext='.png', ir=True)
             im.save(outfile)
@@ -2613,9 +2595,10 @@ class grain_size_hex(Protocol, preprocess, mask):
 
         # Compute angle map
         from scipy.interpolate import griddata
-        positions = np.column_stack((x_positions,y_positions))
+        has_angle = np.isfinite(angles) # Particles without neighbours have no bond angle
+        positions = np.column_stack((x_positions[has_angle],y_positions[has_angle]))
         grid_x, grid_y = np.mgrid[ 0:len(labeled_array) , 0:len(labeled_array[0]) ]
-        angle_map = griddata(positions, angles, (grid_y, grid_x), method='nearest') # Avoids artifacts
+        angle_map = griddata(positions, angles[has_angle], (grid_y, grid_x), method='nearest') # Avoids artifacts
 
         if run_args['verbosity']>=3:
             # False-color map of angles
@@ -2645,7 +2628,7 @@ class grain_size_hex(Protocol, preprocess, mask):
             
         # Angle histogram
         # TODO: Fix the angle histograms.
-        hist, bin_edges = np.histogram(angles, bins=100, range=[0,angle_max_rad])
+        hist, bin_edges = np.histogram(angles[has_angle], bins=100, range=[0,angle_max_rad])
         bin_edges += bin_edges[1]-bin_edges[0]
         new_results = self.orientation_fit(np.degrees(bin_edges[:-1]), hist, output_dir, result_prepend='NN_', **run_args)
         results.update(new_results)            
@@ -2818,46 +2801,29 @@ class grain_size_hex(Protocol, preprocess, mask):
         
 
 
-    def nearest_neighbor_count(self, x_positions, y_positions, counts, **run_args):
+    def nearest_neighbor_count(self, x_positions, y_positions, counts, image_shape=None, **run_args):
         
         results = {}
         
         cutoff_pix = run_args['NN_cutoff_distance_pix']
         sym = run_args['symmetry']
-        angle_max_deg = 360.0/sym # 60.0deg for 6-fold
-        angle_max_rad = np.radians(angle_max_deg)
         
-        num_features = len(counts)
+        # Find all the neighbour pairs at once (see Neighbors.py)
+        method = run_args['NN_method'] if 'NN_method' in run_args else 'cutoff'
+        boundary = run_args['NN_boundary'] if 'NN_boundary' in run_args else 'open'
+        neighbors = Neighbors(x_positions, y_positions, cutoff=cutoff_pix, method=method, boundary=boundary, shape=image_shape)
         
-        NN_counts = np.zeros(num_features)
-        angles = np.zeros(num_features)
+        NN_counts = neighbors.counts.astype(float)
+        angles = neighbors.average_angle(sym)
         
-        for object_index in range(num_features):
-            
-            xpos = x_positions[object_index]
-            ypos = y_positions[object_index]
-            
-            # Find nearby particles
-            distances = np.sqrt( np.square( x_positions-xpos ) + np.square( y_positions-ypos ) )
-            idx = np.where( distances<cutoff_pix )[0]
-            idx = idx[ np.where( idx!=object_index )[0] ] # Excludes the particle itself
-            
-            NN_counts[object_index] = len(idx)
-            
-            cur_angles = ( np.arctan2( y_positions[idx]-ypos , x_positions[idx]-xpos ) )%angle_max_rad
-            
-            
-            #angles[object_index] = np.sum(cur_angles)/NN_counts[object_index] # This naive average is wrong!
-            angles[object_index] = ( self.average_angle( cur_angles*sym )/sym )%angle_max_rad
-            
-            if angles[object_index] <np.radians(0.0) or angles[object_index]>angle_max_rad:
-                print( 'err', angles[object_index] )
-                
-                
-                
-        less = len(np.nonzero(NN_counts<sym)[0])
-        equal = len(np.nonzero(NN_counts==sym)[0])
-        more = len(np.nonzero(NN_counts>sym)[0])
+        # Particles near the image edges are excluded from the statistics for boundary='exclude'
+        interior = neighbors.interior if boundary=='exclude' else np.ones(len(NN_counts), dtype=bool)
+        
+        
+        NN_counts_interior = NN_counts[interior]
+        less = len(np.nonzero(NN_counts_interior<sym)[0])
+        equal = len(np.nonzero(NN_counts_interior==sym)[0])
+        more = len(np.nonzero(NN_counts_interior>sym)[0])
         if run_args['verbosity']>=2:
             print("        <%d NN: %d (%.1f%%)" % ( sym, less, less*100.0/(less+equal+more) ) )
             print("        =%d NN: %d (%.1f%%)" % ( sym, equal, equal*100.0/(less+equal+more) ) )
@@ -2871,7 +2837,7 @@ class grain_size_hex(Protocol, preprocess, mask):
         results['NN_more%d_fraction'%(sym)] = more*1.0/(less+equal+more)
         
         
-        return NN_counts, angles, results
+        return NN_counts, angles, interior, results
 
 
     def average_angle(self, list_of_angles):
@@ -3075,72 +3041,19 @@ class grain_size_hex(Protocol, preprocess, mask):
         symmetry = run_args['symmetry']
         scale = run_args['scale'] # nm/pixel
         
-        h, w = angles.shape
-        
-        accumulator = np.zeros( (h*2,w*2) ) # Sum of correlation values
-        count_accumulator = np.zeros( (h*2,w*2) ) # Keep track of counts (for normalization)
-        one_field = np.ones( (h,w) )
+        mask = run_args['mask'] if 'mask' in run_args else None
         
-        if 'mask' not in run_args or run_args['mask'] is None:
-            # Normal analysis
-            for ix in range(ex, w-ex, step):
-                if run_args['verbosity']>=3:
-                    print( '        Correlation analysis {:.1f}%'.format (100.*ix/w))
-                for iy in range(ex, h-ex, step):
-                    deltatheta = angles[iy,ix] - angles
-                    orderparameter = np.cos(symmetry*deltatheta)
-                    
-                    accumulator[h-iy:-iy, w-ix:-ix] += orderparameter
-                    count_accumulator[h-iy:-iy, w-ix:-ix] += one_field
-                    
+        # Correlate all pairs (anchors on a grid with the given step) at once (see Correlation.py)
+        if 'correlation_method' in run_args and run_args['correlation_method']=='sampled':
+            # Random-sampling estimate (for very large images)
+            num_pairs = run_args['correlation_num_pairs'] if 'correlation_num_pairs' in run_args else 10**7
+            r_list, g_of_r, count_list = orientation_correlation_sampled(angles, symmetry=symmetry, mask=mask, edge_exclusion=ex, step=step, num_pairs=num_pairs)
         else:
-            # Analysis that ignores pixels excluded by the mask
-            mask = run_args['mask']
-            for ix in range(ex, w-ex, step):
-                if run_args['verbosity']>=3:
-                    print( '        Correlation analysis {:.1f}%'.format (100.*ix/w))
-                for iy in range(ex, h-ex, step):
-                    if mask[iy,ix]==1:
-                        deltatheta = angles[iy,ix] - angles
-                        orderparameter = np.cos(symmetry*deltatheta)
-                        
-                        accumulator[h-iy:-iy, w-ix:-ix] += orderparameter*mask
-                        count_accumulator[h-iy:-iy, w-ix:-ix] += one_field*mask
-
-        # Compute array of distances associated with the accumulator
-        r_dist = np.zeros( (h*2,w*2) )
-        ix_list = np.asarray( range(0, w*2) )
-        for iy in range(0, h*2):
-            r_dist[iy,:] = np.round( np.sqrt( (ix_list-w)**2 + (iy-h)**2 ) )
-
-        
+            r_list, g_of_r, count_list = orientation_correlation(angles, symmetry=symmetry, mask=mask, edge_exclusion=ex, step=step)
         
-        # Create a g(r) curve by summing up the values in the accumulator
-        # TODO: This section could be improved by using various numpy functions
-        # (where, bincount, etc.)
-        r_list = range( 0, int(np.max(r_dist)) )
-        g_of_r = np.zeros( (len(r_list)) )
-        count_list = np.zeros( (len(r_list)) )
-        
-        for iy in range(0, h*2):
-            for ix in range(0, w*2):
-                
-                if count_accumulator[iy,ix]>0:
-                    r = int( r_dist[iy,ix] )
-                    g_of_r[r] += accumulator[iy,ix]
-                    count_list[r] += count_accumulator[iy,ix]
-        
-        
-        r_list_final = []
-        r_nm_list_final = []
-        g_of_r_final = []
-        for r in range(len(r_list)):
-            if count_list[r]>0 and not np.isnan(g_of_r[r]):
-                
-                # Convert from pixels to nm
-                r_list_final.append( r_list[r] )
-                r_nm_list_final.append( scale*r_list[r] )
-                g_of_r_final.append( g_of_r[r]/count_list[r] )
+        # Convert from pixels to nm
+        r_nm_list_final = scale*r_list
+        g_of_r_final = g_of_r
                 
                 
         line = DataLine(x=r_nm_list_final, y=g_of_r_final)
@@ -3322,79 +3235,66 @@ class grain_size_hex(Protocol, preprocess, mask):
     def orientation_angle_map(self, data, output_dir, **run_args):
         
         if 'blur' in run_args and run_args['blur'] is not None:
-            data.blur(run_args['blur'])
+            blur_pix = run_args['blur']
         elif 'q0' in run_args:
             blur_nm = (2*np.pi/run_args['q0'])*run_args['blur_size_rel_d0']
             blur_pix = blur_nm/data.x_scale
-            data.blur(blur_pix)
+        else:
+            blur_pix = None
 
         if run_args['verbosity']>=5:
+            if blur_pix is not None:
+                data.blur(blur_pix)
+                blur_pix = None # Already applied
             data.set_z_display( [None, None, 'gamma', 1.0] )
             outfile = self.get_outfile('blurred', output_dir, ext='.jpg', ir=True)
             data.plot_image(save=outfile, ztrim=[0,0], cmap=run_args['cmap'])
             
         
-        h, w = data.data.shape
-        
-        # Differentiate image in x and y directions
-        dif_x = np.diff( data.data, axis=1 )
-        line = np.zeros((h,1))
-        dif_x = np.concatenate( (dif_x, line) , axis=1 )
-        
-        dif_y = np.diff( data.data, axis=0 )
-        line = np.zeros((1,w))
-        dif_y = np.concatenate( (dif_y, line) , axis=0 )
-        
-        numerator = 2.0*np.multiply( dif_x, dif_y )
-        denominator = np.power(dif_x,2) - np.power(dif_y,2)
-        
-
-        if run_args['verbosity']>=4:
-            display = Data2D()
-            display.data = dif_x
-            display.set_z_display( [None, None, 'linear', 1.0] )
-            outfile = self.get_outfile('dif_x', output_dir, ext='.jpg', ir=True)
-            dmax = max( np.abs(np.max(display.data)), np.abs(np.min(display.data)) )
-            display.plot_image(save=outfile, zmin=-dmax, zmax=dmax, cmap=mpl.cm.seismic)
-
-            display = Data2D()
-            display.data = dif_y
-            display.set_z_display( [None, None, 'linear', 1.0] )
-            outfile = self.get_outfile('dif_y', output_dir, ext='.jpg', ir=True)
-            dmax = max( np.abs(np.max(display.data)), np.abs(np.min(display.data)) )
-            display.plot_image(save=outfile, zmin=-dmax, zmax=dmax, cmap=mpl.cm.seismic)
-
+        # Smoothing of the structure tensor (the orientation image)
+        sigmas = [None]
+        if 'blur_orientation_image' in run_args and run_args['blur_orientation_image']:
+            if 'orientation_scales_rel' in run_args:
+                # Multi-scale: an orientation map for each blur size (relative to d0)
+                sizes_rel = run_args['orientation_scales_rel']
+            else:
+                sizes_rel = [run_args['blur_orientation_image_size_rel']]
+            sigmas = [ (2*np.pi/run_args['q0'])*size_rel/data.x_scale for size_rel in sizes_rel ]
+        num_passes = run_args['blur_orientation_image_num_passes'] if 'blur_orientation_image_num_passes' in run_args else 1
         
+        # Gradients, tensor products and smoothing are computed tile-by-tile (see Orientation.py)
+        tile_size = run_args['orientation_tile_size'] if 'orientation_tile_size' in run_args else 1024
+        result = structure_tensor_orientation(data.data, pre_blur=blur_pix, sigmas=sigmas, num_passes=num_passes, tile_size=tile_size, components=(run_args['verbosity']>=4))
         
-        if 'blur_orientation_image' in run_args and run_args['blur_orientation_image']:
-            
-            blur_nm = (2*np.pi/run_args['q0'])*run_args['blur_orientation_image_size_rel']
-            blur_pix = blur_nm/data.x_scale
-            
-            for i in range(run_args['blur_orientation_image_num_passes']):
-                numerator = ndimage.filters.gaussian_filter( numerator, blur_pix )
-                denominator = ndimage.filters.gaussian_filter( denominator, blur_pix )
-            
-
         if run_args['verbosity']>=4:
-            display = Data2D()
-            display.data = numerator
-            display.set_z_display( [None, None, 'linear', 1.0] )
-            outfile = self.get_outfile('numerator', output_dir, ext='.jpg', ir=True)
-            display.plot_image(save=outfile, cmap=mpl.cm.gnuplot2)
-
-            display = Data2D()
-            display.data = denominator
-            display.set_z_display( [None, None, 'linear', 1.0] )
-            outfile = self.get_outfile('denominator', output_dir, ext='.jpg', ir=True)
-            display.plot_image(save=outfile, cmap=mpl.cm.gnuplot2)
-            
-            
+            angle_maps, components = result
+            
+            for name in ['dif_x', 'dif_y']:
+                display = Data2D()
+                display.data = components[name]
+                display.set_z_display( [None, None, 'linear', 1.0] )
+                outfile = self.get_outfile(name, output_dir, ext='.jpg', ir=True)
+                dmax = max( np.abs(np.max(display.data)), np.abs(np.min(display.data)) )
+                display.plot_image(save=outfile, zmin=-dmax, zmax=dmax, cmap=mpl.cm.seismic)
+
+            for name in ['numerator', 'denominator']:
+                display = Data2D()
+                display.data = components[name]
+                display.set_z_display( [None, None, 'linear', 1.0] )
+                outfile = self.get_outfile(name, output_dir, ext='.jpg', ir=True)
+                display.plot_image(save=outfile, cmap=mpl.cm.gnuplot2)
+                
+        else:
+            angle_maps = result
             
-        angles = 0.5*np.arctan2(numerator, denominator)
         # angles are in radians, from -pi/2 to +pi/2
+        if len(angle_maps)>1:
+            # Multi-scale: save the maps for all the scales
+            for size_rel, angle_map in zip(sizes_rel, angle_maps):
+                outfile = self.get_outfile('angles_scale{:.3f}'.format(size_rel), output_dir, ext='.npy', ir=False)
+                np.save(outfile, angle_map)
         
-        return angles
+        return angle_maps[0]
 
 
     
@@ -3439,7 +3339,7 @@ class grain_size(grain_size_hex):
         
         
         results = {}
-        data = copy.deepcopy(data)
+        data = data.copy(shared=True)
         
         #orig_data = data.data.copy()
 
@@ -3556,7 +3456,7 @@ class defects_lines(grain_size_hex):
         orig_data = data.data.copy()
         
         results = {}
-        data = copy.deepcopy(data)
+        data = data.copy(shared=True)
         
         if run_args['verbosity']>=5:
             im = PIL.Image.fromarray( np.uint8(data.data) )
@@ -3599,13 +3499,9 @@ class defects_lines(grain_size_hex):
         num_objects = num_features
         
         # Remove objects outside of size cutoffs
-        bins = np.bincount(labeled_array.flatten('C'))
-        bins = bins[1:] # Remove the 'surrounding field' (index 0)
         if 'area_min' in run_args:
-            cutoff = run_args['area_min']/(data.x_scale*data.y_scale) # pix^2
-            idx = np.where(bins<cutoff)[0]
-            for object_index in idx:
-                labeled_array[labeled_array==(object_index+1)] = 0
+            regions = RegionProperties(labeled_array, num_labels=num_features, x_scale=data.x_scale, y_scale=data.y_scale)
+            labeled_array = regions.relabel(regions.select(area_min=run_args['area_min']))
                 
             #num_objects -= len(idx)
             
@@ -3623,20 +3519,10 @@ class defects_lines(grain_size_hex):
             
 
         # Determine (x,y) position of each particle (center-of-mass of each particle)
-        x_positions = np.zeros( (num_features) )
-        y_positions = np.zeros( (num_features) )
-        counts = np.zeros( (num_features) )
-        for ix in range( len(labeled_array[0]) ):
-            for iy in range( len(labeled_array) ):
-                if labeled_array[iy,ix]!=0:
-                    object_index = labeled_array[iy,ix] - 1
-                    
-                    x_positions[object_index] +=  1.0*ix
-                    y_positions[object_index] +=  1.0*iy
-                    counts[object_index] +=  1.0  
-                    
-        x_positions /= counts
-        y_positions /= counts
+        regions = RegionProperties(labeled_array, num_labels=num_features)
+        x_positions = regions.centroid_x[1:]
+        y_positions = regions.centroid_y[1:]
+        counts = regions.area[1:].astype(float)
 
 
 
@@ -3669,20 +3555,8 @@ class defects_lines(grain_size_hex):
         if run_args['verbosity']>=5:
             # Colored image
             
-            im = PIL.Image.fromarray( np.uint8(data.data*255.0) )
-            im = im.convert('RGB')
-            pix = im.load()
-            
-            h, w = data.data.shape
-            for ix in range(w):
-                for iy in range(h):
-                    object_index = labeled_array[iy,ix]
-                    if object_index==0:
-                        c = (0, 0, 0)
-                    else:
-                        c = color_list[ object_index%len(color_list) ]
-                        c = ( int(c[0]*255), int(c[1]*255), int(c[2]*255) )
-                    pix[ix,iy] = c            
+            lut = label_lut(color_list, np.max(labeled_array))
+            im = PIL.Image.fromarray( render_labels(labeled_array, lut) )
             
             
             outfile = self.get_outfile('colored', output_dir, ext='.png', ir=True)
@@ -3692,29 +3566,15 @@ class defects_lines(grain_size_hex):
         if run_args['verbosity']>=5:
             # Boundary image
             
-            im = PIL.Image.fromarray( np.uint8(data.data*255.0) )
-            im = im.convert('RGB')
-            pix = im.load()
-            
-            c = ( 1*255, 0*255, 0*255 )
-            h, w = data.data.shape
-            for ix in range(w-1):
-                for iy in range(h-1):
-                    
-                    num_zeros = np.bincount( labeled_array[iy:iy+2,ix:ix+2].flatten() )[0]
-                    if not (num_zeros==0 or num_zeros==4):
-                        pix[ix,iy] = c            
+            im = np.array( PIL.Image.fromarray( np.uint8(data.data*255.0) ).convert('RGB') )
+            im[label_boundaries(labeled_array)] = ( 1*255, 0*255, 0*255 )
             
             # Put a dot at center-of-mass (COM) of each object
-            c = ( 0*255, 1*255, 0*255 )
-            for object_index in range(len(counts)):
-                #if counts[object_index]>0:
-                ix = int(x_positions[object_index])
-                iy = int(y_positions[object_index])
-                pix[ix,iy] = c
+            valid = counts>0
+            im[ y_positions[valid].astype(int), x_positions[valid].astype(int) ] = ( 0*255, 1*255, 0*255 )
 
             outfile = self.get_outfile('boundaries', output_dir, ext='.png', ir=True)
-            im.save(outfile)
+            PIL.Image.fromarray(im).save(outfile)
 
 
 
@@ -3821,7 +3681,7 @@ class dots_vs_lines(particles):
         make_dir(output_dir)
         
         results = {}
-        data = copy.deepcopy(data)
+        data = data.copy(shared=True)
         
         results, labeled_array = self._find_objects(data, output_dir, results, **run_args)
 
@@ -3847,40 +3707,25 @@ class dots_vs_lines(particles):
         if run_args['verbosity']>=5:
             print('        Cutoff {:.2f} nm ({:.1f} pixels); surface area {:.1f} pixels'.format(run_args['dot_size_cutoff_nm'], cutoff_pix, cutoff_area))
         
-        particle_areas = np.bincount( labeled_array.flatten() )
+        particle_areas = RegionProperties(labeled_array).area
 
-        if run_args['verbosity']>=6:
-            # Color-coded image of object types
-            im = PIL.Image.fromarray( np.uint8(data.data*255.0) )
-            im = im.convert('RGB')
-            pix = im.load()
-            
-            
         # Sort labelled objects into the two size categories
         start_time = time.time()
         
-        particles_sized = particle_areas[labeled_array] # Image where each pixel has the corresponding size of that object (we obtain this by returning the particle_areas as a lookup table and labeled_array for the object indices)
-        
-        labeled_array_categories = np.where( (particles_sized<cutoff_area) & (labeled_array>0), 1, 0 ) # Small particles
-        labeled_array_categories += np.where( (particles_sized>=cutoff_area) & (labeled_array>0), 2, 0 ) # Big particles
+        # Lookup table (label --> category), applied to the whole image at once
+        category_lut = np.where( particle_areas<cutoff_area, 1, 2 ) # Small (1) or big (2) particles
+        category_lut[0] = 0 # Background
+        labeled_array_categories = category_lut[labeled_array]
         
         if run_args['verbosity']>=5:
             # Create a color-coded image of the objects
-            color_background = [0, 0, 0] # Black
-            color_small = [255, 0, 0 ] # Red
-            color_big = [0, 255, 0] # Green
-            
-            red = np.where( (particles_sized<cutoff_area) & (labeled_array>0), color_small[0], color_background[0] )
-            red = np.where( (particles_sized>=cutoff_area) & (labeled_array>0), color_big[0], red )
-            
-            green = np.where( (particles_sized<cutoff_area) & (labeled_array>0), color_small[1], color_background[0] )
-            green = np.where( (particles_sized>=cutoff_area) & (labeled_array>0), color_big[1], green )
-            
-            blue = np.where( (particles_sized<cutoff_area) & (labeled_array>0), color_small[2], color_background[0] )
-            blue = np.where( (particles_sized>=cutoff_area) & (labeled_array>0), color_big[2], blue )
-            image_data = np.dstack( (red, green, blue) )
+            category_colors = np.asarray([
+                [0, 0, 0], # Black (background)
+                [255, 0, 0], # Red (small particles)
+                [0, 255, 0], # Green (big particles)
+                ], dtype=np.uint8)
             
-            image = PIL.Image.fromarray( np.uint8(image_data) )
+            image = PIL.Image.fromarray( render_labels(labeled_array_categories, category_colors) )
             outfile = self.get_outfile('coded', output_dir, ext='.png', ir=True)
             image.save(outfile)
             
@@ -3935,37 +3780,21 @@ class dots_vs_lines(particles):
         if run_args['verbosity']>=5:
             print('        Cutoff {:.2f} nm ({:.1f} pixels); surface area {:.1f} pixels'.format(run_args['dot_size_cutoff_nm'], cutoff_pix, cutoff_area))
         
-        particle_areas = np.bincount( labeled_array.flatten() )
+        particle_areas = RegionProperties(labeled_array).area
 
-        if run_args['verbosity']>=6:
-            # Color-coded image of object types
-            im = PIL.Image.fromarray( np.uint8(data.data*255.0) )
-            im = im.convert('RGB')
-            pix = im.load()
-            
         # Sort labelled objects into the two size categories
         start_time = time.time()
-        for ix in range( len(labeled_array[0]) ):
-            for iy in range( len(labeled_array) ):
-                object_index = labeled_array[iy,ix]
-
-                if object_index==0:
-                    labeled_array[iy,ix] = 0
-                elif particle_areas[object_index]<cutoff_area:
-                    labeled_array[iy,ix] = 1
-                else:
-                    labeled_array[iy,ix] = 2
-
-                if run_args['verbosity']>=6:
-                    if object_index==0:
-                        c = (0, 0, 0) # Black (no particles)
-                    elif particle_areas[object_index]<cutoff_area:
-                        c = (255, 0, 0) # Red (small particles)
-                    else:
-                        c = (0, 255, 0 ) # Green (big particles)
-                    pix[ix,iy] = c
+        category_lut = np.where( particle_areas<cutoff_area, 1, 2 ) # Small (1) or big (2) particles
+        category_lut[0] = 0 # Background
+        labeled_array = category_lut[labeled_array]
                     
         if run_args['verbosity']>=6:
+            category_colors = np.asarray([
+                [0, 0, 0], # Black (no particles)
+                [255, 0, 0], # Red (small particles)
+                [0, 255, 0], # Green (big particles)
+                ], dtype=np.uint8)
+            im = PIL.Image.fromarray( render_labels(labeled_array, category_colors) )
             outfile = self.get_outfile('coded', output_dir, ext='.png', ir=True)
             im.save(outfile)
 
@@ -4022,21 +3851,12 @@ class dots_vs_lines(particles):
         
         if run_args['verbosity']>=1:
             # Create black-and-white image
-            im = PIL.Image.fromarray( np.uint8(data.data*255.0) )
-            im = im.convert('RGB')
-            pix = im.load()
-            
-            for ix in range(w):
-                for iy in range(h):
-                    object_index = labeled_array[iy,ix]
-                    
-                    if labeled_array[iy,ix]==0:
-                        c = (255, 0, 0) # Red (error)
-                    elif labeled_array[iy,ix]==1:
-                        c = (0, 0, 0) # Black (small particles)
-                    else:
-                        c = (255, 255, 255 ) # White (big particles)
-                    pix[ix,iy] = c
+            region_colors = np.asarray([
+                (255, 0, 0), # Red (error)
+                (0, 0, 0), # Black (small particles)
+                (255, 255, 255), # White (big particles)
+                ], dtype=np.uint8)
+            im = PIL.Image.fromarray( render_labels(np.clip(labeled_array, 0, 2), region_colors) )
                     
             outfile = self.get_outfile('dots_vs_lines', output_dir, ext='.png', ir=False)
             im.save(outfile)
@@ -0,0 +1,318 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.ImAnalysis.Regions` - Properties of labelled regions
+================================================
+.. module:: SciAnalysis.ImAnalysis.Regions
+   :synopsis: Computes properties of all labelled objects in an image at once
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  Protocols that identify objects (particles, grains, skeleton lines, etc.)
+# label an image (e.g. using ndimage.label) and then need some properties of
+# each object. Looping over labels and evaluating (labeled_array==i) against
+# the full image costs O(labels*pixels). Instead, RegionProperties computes
+# the properties of all the labels together, using np.bincount (with weights)
+# over the pixels, and ndimage.find_objects for the bounding boxes; this scales
+# linearly with image size.
+#
+# Typical usage:
+#   regions = RegionProperties(labeled_array, x_scale=data.x_scale, y_scale=data.y_scale)
+#   keep = regions.select(area_min=100) # nm^2
+#   labeled_array = regions.relabel(keep)
+#   regions.centroid_x[1:], regions.centroid_y[1:]
+#   mask, (y0, x0) = regions.crop(i) # Local (bounding-box) image of object i
+#
+# Labelled images are rendered (e.g. for 'colored' debugging outputs) using a
+# label-to-RGB lookup table, so that the whole image is colorized with a single
+# array gather:
+#   lut = label_lut(color_list, np.max(labeled_array))
+#   im = PIL.Image.fromarray( render_labels(labeled_array, lut) )
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import numpy as np
+
+from .. import tools
+
+ndimage = tools.LazyModule('scipy.ndimage')
+
+
+
+# RegionProperties
+################################################################################
+class RegionProperties(object):
+    '''Properties of all the regions (objects) in a labelled image. The
+    property arrays are indexed by label; index 0 is the background.
+    Positions and lengths are in pixels; area_nm2 and radius_nm use the
+    supplied x_scale and y_scale (nm/pixel).'''
+
+    def __init__(self, labeled_array, intensity=None, num_labels=None, x_scale=1.0, y_scale=1.0, chunk_size=2**20):
+        '''Computes the region properties.
+
+        Parameters
+        ----------
+        labeled_array : 2D array of int
+            Object labels (0 is background), e.g. from ndimage.label.
+        intensity : 2D array (optional)
+            Image from which to compute per-region intensity statistics.
+        num_labels : int (optional)
+            Number of labels (the maximum label is used by default).
+        chunk_size : int
+            Pixels are processed in strips of (approximately) this many pixels,
+            which bounds the temporary memory used.
+        '''
+
+        self.labeled_array = labeled_array
+        self.x_scale = x_scale
+        self.y_scale = y_scale
+
+        self.num_labels = int(np.max(labeled_array)) if num_labels is None else int(num_labels)
+        n = self.num_labels + 1
+
+        h, w = labeled_array.shape
+        self.area = np.zeros(n, dtype=int)
+        sums = np.zeros((5, n)) # x, y, xx, yy, xy
+        if intensity is not None:
+            isums = np.zeros((2, n)) # I, I^2
+
+        # Accumulate moments over strips of rows
+        rows = max(1, chunk_size//max(w, 1))
+        x = np.arange(w, dtype=float)
+        for y0 in range(0, h, rows):
+            labels = labeled_array[y0:y0+rows].ravel()
+            nrows = len(labels)//w
+            X = np.tile(x, nrows)
+            Y = np.repeat(np.arange(y0, y0+nrows, dtype=float), w)
+
+            self.area += np.bincount(labels, minlength=n)
+            sums[0] += np.bincount(labels, weights=X, minlength=n)
+            sums[1] += np.bincount(labels, weights=Y, minlength=n)
+            sums[2] += np.bincount(labels, weights=X*X, minlength=n)
+            sums[3] += np.bincount(labels, weights=Y*Y, minlength=n)
+            sums[4] += np.bincount(labels, weights=X*Y, minlength=n)
+
+            if intensity is not None:
+                values = np.asarray(intensity[y0:y0+rows], dtype=float).ravel()
+                isums[0] += np.bincount(labels, weights=values, minlength=n)
+                isums[1] += np.bincount(labels, weights=values*values, minlength=n)
+
+        self._set_moments(sums)
+
+        if intensity is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.intensity_total = isums[0]
+                self.intensity_mean = isums[0]/self.area
+                self.intensity_std = np.sqrt(np.maximum(isums[1]/self.area - np.square(self.intensity_mean), 0))
+
+            index = np.arange(n)
+            self.intensity_min = np.asarray(ndimage.minimum(intensity, labels=labeled_array, index=index))
+            self.intensity_max = np.asarray(ndimage.maximum(intensity, labels=labeled_array, index=index))
+
+        self._slices = None
+
+
+    @classmethod
+    def from_moments(cls, area, sums, labeled_array=None, x_scale=1.0, y_scale=1.0):
+        '''Creates the region properties from already-accumulated moments
+        (e.g. merged from several tiles of an image), rather than from the
+        labeled array.
+
+        Parameters
+        ----------
+        area : 1D array of int
+            Number of pixels of each label (index 0 is the background).
+        sums : (5, n) array
+            Sums of x, y, x*x, y*y and x*y (pixels) over each label.
+        labeled_array : 2D array of int (optional)
+            Needed only for the bounding boxes and crops.
+        '''
+
+        self = cls.__new__(cls)
+        self.labeled_array = labeled_array
+        self.x_scale = x_scale
+        self.y_scale = y_scale
+        self.num_labels = len(area) - 1
+        self.area = np.asarray(area, dtype=int)
+        self._set_moments(np.asarray(sums, dtype=float))
+        self._slices = None
+
+        return self
+
+
+    def _set_moments(self, sums):
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.centroid_x = sums[0]/self.area
+            self.centroid_y = sums[1]/self.area
+
+            # Central second moments (covariance)
+            self.mu20 = sums[2]/self.area - np.square(self.centroid_x)
+            self.mu02 = sums[3]/self.area - np.square(self.centroid_y)
+            self.mu11 = sums[4]/self.area - self.centroid_x*self.centroid_y
+
+
+    # Derived properties
+    ########################################
+
+    @property
+    def radius(self):
+        '''Radius (pixels) of a circle with the same area as the region.'''
+        return np.sqrt(self.area/np.pi)
+
+    @property
+    def area_nm2(self):
+        return self.area*self.x_scale*self.y_scale
+
+    @property
+    def radius_nm(self):
+        return np.sqrt(self.area_nm2/np.pi)
+
+    def _eigenvalues(self):
+        mean = 0.5*(self.mu20 + self.mu02)
+        diff = np.sqrt(np.square(0.5*(self.mu20 - self.mu02)) + np.square(self.mu11))
+        return mean + diff, np.maximum(mean - diff, 0)
+
+    @property
+    def major_axis_length(self):
+        '''Length (pixels) of the major axis of the ellipse with the same
+        second moments as the region.'''
+        return 4*np.sqrt(self._eigenvalues()[0])
+
+    @property
+    def minor_axis_length(self):
+        return 4*np.sqrt(self._eigenvalues()[1])
+
+    @property
+    def eccentricity(self):
+        '''Eccentricity (0 for circular, approaching 1 for elongated) of the
+        ellipse with the same second moments as the region.'''
+        l1, l2 = self._eigenvalues()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(l1>0, np.sqrt(1 - l2/l1), 0.0)
+
+    @property
+    def orientation(self):
+        '''Angle (radians, in the range -pi/2 to +pi/2) of the major axis
+        relative to the x axis (image coordinates; i.e. y pointing down).'''
+        return 0.5*np.arctan2(2*self.mu11, self.mu20 - self.mu02)
+
+    @property
+    def slices(self):
+        '''Bounding-box slices for each label (index 0 is None).'''
+        if self._slices is None:
+            self._slices = [None] + ndimage.find_objects(self.labeled_array, max_label=self.num_labels)
+        return self._slices
+
+    @property
+    def bbox(self):
+        '''Bounding boxes as an (n,4) array of (y_min, x_min, y_max, x_max),
+        with the max values exclusive; -1 for labels that are absent.'''
+        bbox = -np.ones((self.num_labels+1, 4), dtype=int)
+        for i, sl in enumerate(self.slices):
+            if sl is not None:
+                bbox[i] = sl[0].start, sl[1].start, sl[0].stop, sl[1].stop
+        return bbox
+
+
+    # Selection
+    ########################################
+
+    def labels(self):
+        '''Returns the (non-background) labels which are present in the image.'''
+        return np.nonzero(self.area[1:])[0] + 1
+
+
+    def select(self, area_min=None, area_max=None, radius_min=None, radius_max=None, **kwargs):
+        '''Returns a boolean array (indexed by label) of the regions meeting the
+        given size criteria (in nm^2 and nm). The background (index 0) is never
+        selected.'''
+
+        area, radius = self.area_nm2, self.radius_nm
+        keep = np.ones(self.num_labels+1, dtype=bool)
+        if area_min is not None:
+            keep &= area>=area_min
+        if area_max is not None:
+            keep &= area<=area_max
+        if radius_min is not None:
+            keep &= radius>=radius_min
+        if radius_max is not None:
+            keep &= radius<=radius_max
+        keep[0] = False
+
+        return keep
+
+
+    def relabel(self, keep, labeled_array=None):
+        '''Returns a copy of the labeled array where the regions not in keep
+        are set to background (0). The remaining labels are unchanged.'''
+
+        if labeled_array is None:
+            labeled_array = self.labeled_array
+        lut = np.where(keep, np.arange(len(keep)), 0).astype(labeled_array.dtype)
+
+        return lut[ labeled_array.astype(np.intp, copy=False) ]
+
+
+    def crop(self, label, pad=1):
+        '''Returns the binary image (uint8) of the given region, cropped to its
+        bounding box (plus pad pixels on each side, within the image), and the
+        (y, x) offset of the crop within the full image.'''
+
+        sl = self.slices[label]
+        h, w = self.labeled_array.shape
+        y0, y1 = max(sl[0].start-pad, 0), min(sl[0].stop+pad, h)
+        x0, x1 = max(sl[1].start-pad, 0), min(sl[1].stop+pad, w)
+        mask = (self.labeled_array[y0:y1, x0:x1]==label).astype(np.uint8)
+
+        return mask, (y0, x0)
+
+
+    # End class RegionProperties(object)
+    ########################################
+
+
+
+# Rendering
+################################################################################
+
+def label_lut(colors, num_labels, background=(0, 0, 0)):
+    '''Returns a (num_labels+1, 3) uint8 lookup table, where label i>0 is
+    assigned colors[i%len(colors)] (RGB values from 0 to 1), and label 0 is
+    assigned the background color (RGB values from 0 to 255).'''
+
+    palette = ( np.asarray(colors, dtype=float)*255 ).astype(np.uint8)
+    lut = palette[ np.arange(int(num_labels)+1)%len(palette) ]
+    lut[0] = background
+
+    return lut
+
+
+def render_labels(labeled_array, lut):
+    '''Colorizes the labeled image using the lookup table (e.g. from
+    label_lut); returns an (h,w,3) uint8 RGB array.'''
+    return lut[ labeled_array.astype(np.intp, copy=False) ]
+
+
+def label_boundaries(labeled_array):
+    '''Returns a boolean image which is True along the boundaries between
+    objects and the background. That is, pixel (iy,ix) is on a boundary if
+    the 2x2 block labeled_array[iy:iy+2,ix:ix+2] contains both background
+    and object pixels.'''
+
+    background = (labeled_array==0).astype(np.uint8)
+    num_zeros = background[:-1,:-1] + background[1:,:-1] + background[:-1,1:] + background[1:,1:]
+
+    boundaries = np.zeros(labeled_array.shape, dtype=bool)
+    boundaries[:-1,:-1] = (num_zeros>0) & (num_zeros<4)
+
+    return boundaries
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.ImAnalysis.Skeleton` - Graph of a skeletonized image
+================================================
+.. module:: SciAnalysis.ImAnalysis.Skeleton
+   :synopsis: Junctions, endpoints and segments of skeleton lines
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  A skeleton (1-pixel-wide lines, e.g. from skimage.morphology.skeletonize)
+# is converted into a graph:
+#  - endpoints: skeleton pixels with exactly 1 (8-connected) neighbour
+#  - junctions: clusters of skeleton pixels with 3 or more neighbours
+#  - segments: the connected pieces of skeleton between junctions
+#
+# The 8 neighbours of every pixel are encoded (in one pass over the image) as
+# an 8-bit code; neighbour counts etc. then come from lookup tables over the
+# codes, rather than from per-pixel filter functions. Segment properties
+# (length, orientation, tortuosity, bending) are accumulated for all segments
+# at once using np.bincount, so the cost scales with the number of pixels.
+#
+# The local "bending angle" at each skeleton pixel depends only on which
+# pixels (on a ring at the 'lookout' distance) are part of the skeleton; the
+# bend is computed once for each distinct ring pattern, and then mapped back
+# to all the pixels.
+#
+# Typical usage:
+#   graph = SkeletonGraph(skeleton, x_scale=data.x_scale, y_scale=data.y_scale)
+#   graph.num_junctions, graph.endpoints, graph.segment_length
+#   bends = graph.bending_angles(lookout=6)
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import numpy as np
+
+from .. import tools
+
+ndimage = tools.LazyModule('scipy.ndimage')
+
+
+
+# Neighbourhood codes
+################################################################################
+
+# Offsets (dy, dx) of the 8 neighbours; neighbour k sets bit k of the code
+NEIGHBOR_OFFSETS = [ (-1,-1), (-1,0), (-1,+1), (0,-1), (0,+1), (+1,-1), (+1,0), (+1,+1) ]
+
+# Number of neighbours for each code
+NEIGHBOR_COUNT_LUT = np.array( [ bin(code).count('1') for code in range(256) ], dtype=np.uint8 )
+
+
+def _shifted(padded, dy, dx):
+    '''Returns the (unpadded) view of padded shifted by (dy, dx).'''
+    h, w = padded.shape
+    return padded[1+dy:h-1+dy, 1+dx:w-1+dx]
+
+
+def neighbor_codes(skeleton):
+    '''Returns the 8-bit code (uint8) of the skeleton neighbours of each pixel.'''
+
+    padded = np.pad( (np.asarray(skeleton)>0).astype(np.uint8), 1, mode='constant' )
+    codes = np.zeros(np.shape(skeleton), dtype=np.uint8)
+    for k, (dy, dx) in enumerate(NEIGHBOR_OFFSETS):
+        codes |= _shifted(padded, dy, dx) << k
+
+    return codes
+
+
+def _bend_angle(idx, angle_lookup):
+    '''The local bending angle (degrees) for a pixel, given the indices (idx) of
+    the ring (lookout) positions that are part of the skeleton: 180 minus the
+    angles between the ring pixels, averaged over the n-1 smallest angles.'''
+
+    n = len(idx)
+    if n<=1:
+        return 0
+
+    angles = []
+    for i in range(n):
+        angle_i = angle_lookup[idx[i]]
+        for j in range(i+1, n):
+            angle_j = angle_lookup[idx[j]]
+            diff = abs(angle_i-angle_j)
+            diff = min(diff, 360-diff)
+            angles.append(diff)
+    angles = sorted(angles)[:n-1] # Exclude the largest outer angle
+    bends = 180-np.asarray(angles)
+
+    return np.average(bends)
+
+
+
+# SkeletonGraph
+################################################################################
+class SkeletonGraph(object):
+    '''The graph (endpoints, junctions, segments) of a skeleton image. Segment
+    arrays are indexed by segment label (index 0 is unused); lengths are in
+    the units of x_scale and y_scale (e.g. nm), orientations in degrees
+    (0 to 180, counter-clockwise from the +x axis, with y pointing up).'''
+
+    def __init__(self, skeleton, x_scale=1.0, y_scale=1.0):
+
+        self.skeleton = np.asarray(skeleton)>0
+        self.x_scale, self.y_scale = x_scale, y_scale
+        self.codes = neighbor_codes(self.skeleton)*self.skeleton
+
+        # Number of neighbours of each skeleton pixel (0 elsewhere)
+        self.neighbors = NEIGHBOR_COUNT_LUT[self.codes].astype(int)
+
+        self.endpoints = (self.neighbors==1)
+        self.junction_pixels = (self.neighbors>=3)
+
+        s = ndimage.generate_binary_structure(2,2) # 8-connected
+        self.labeled_junctions, self.num_junctions = ndimage.label(self.junction_pixels, structure=s)
+        self.labeled_segments, self.num_segments = ndimage.label(self.skeleton & ~self.junction_pixels, structure=s)
+
+        self._segment_properties()
+
+
+    def _segment_properties(self):
+
+        labels = self.labeled_segments
+        n = self.num_segments + 1
+        h, w = labels.shape
+
+        y, x = np.nonzero(labels)
+        lab = labels[y, x]
+        self.segment_pixels = np.bincount(lab, minlength=n)
+
+        # Bonds between pixels within the same segment; diagonal bonds are only
+        # counted where there is no axial path (i.e. the corner pixels are not
+        # part of the segment), so that steps are not counted twice
+        padded = np.pad(labels, 1, mode='constant')
+        bond_counts = np.zeros(labels.shape, dtype=int)
+        length = np.zeros(n)
+        for (dy, dx) in [ (0,+1), (+1,0), (+1,+1), (+1,-1) ]:
+            other = _shifted(padded, dy, dx)
+            bonded = (labels>0) & (other==labels)
+            if dy!=0 and dx!=0:
+                corner1 = _shifted(padded, dy, 0)
+                corner2 = _shifted(padded, 0, dx)
+                bonded &= (corner1!=labels) & (corner2!=labels)
+            step = np.sqrt( (dx*self.x_scale)**2 + (dy*self.y_scale)**2 )
+            length += step*np.bincount(labels[bonded], minlength=n)
+
+            # Count the bonds of each pixel (at both ends)
+            bond_counts += bonded
+            padded_bonded = np.pad(bonded, 1, mode='constant')
+            bond_counts += _shifted(padded_bonded, -dy, -dx)
+
+        self.segment_length = length
+
+        # Orientation from the second moments (y pointing up)
+        X, Y = x*self.x_scale, -y*self.y_scale
+        with np.errstate(divide='ignore', invalid='ignore'):
+            num = self.segment_pixels
+            cx = np.bincount(lab, weights=X, minlength=n)/num
+            cy = np.bincount(lab, weights=Y, minlength=n)/num
+            mu20 = np.bincount(lab, weights=X*X, minlength=n)/num - cx*cx
+            mu02 = np.bincount(lab, weights=Y*Y, minlength=n)/num - cy*cy
+            mu11 = np.bincount(lab, weights=X*Y, minlength=n)/num - cx*cy
+        self.segment_centroid_x, self.segment_centroid_y = cx, cy
+        self.segment_orientation = np.degrees( 0.5*np.arctan2(2*mu11, mu20-mu02) )%180
+
+        # Ends of each segment (pixels with at most one bond within the segment);
+        # the chord is the distance between the first and last end pixels
+        ends = (labels>0) & (bond_counts<=1)
+        ey, ex = np.nonzero(ends)
+        elab = labels[ey, ex]
+        order = np.argsort(elab, kind='stable')
+        ey, ex, elab = ey[order], ex[order], elab[order]
+        first = np.full(n, -1)
+        last = np.full(n, -1)
+        first[elab[::-1]] = np.arange(len(elab))[::-1]
+        last[elab] = np.arange(len(elab))
+        has_ends = (first>=0) & (last>first)
+        chord = np.zeros(n)
+        i0, i1 = first[has_ends], last[has_ends]
+        chord[has_ends] = np.sqrt( ((ex[i1]-ex[i0])*self.x_scale)**2 + ((ey[i1]-ey[i0])*self.y_scale)**2 )
+        self.segment_chord = chord
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Closed loops (no ends) and single pixels have undefined tortuosity
+            self.segment_tortuosity = np.where(chord>0, length/chord, np.nan)
+
+
+    # Lines
+    ########################################
+
+    def endpoint_positions(self):
+        '''Returns the (y, x) pixel positions of the line ends, as an (n,2) array.'''
+        return np.argwhere(self.endpoints)
+
+
+    def junction_positions(self):
+        '''Returns the (y, x) centers-of-mass of the junctions, as a list.'''
+        return ndimage.center_of_mass(self.junction_pixels, labels=self.labeled_junctions, index=range(1, self.num_junctions+1))
+
+
+    # Bending
+    ########################################
+
+    def bending_angles(self, lookout=6):
+        '''Returns an image of the local bending angle (degrees) of the skeleton
+        lines (0 off the skeleton). At each skeleton pixel, the skeleton
+        pixels on the ring (square) at the lookout distance are assumed to be
+        the extensions of the line(s) through this pixel; the bending is
+        computed from the angles between them.'''
+
+        l = int(lookout)
+        s = 2*l+1 # Size of window
+        footprint = np.ones((s,s), dtype=bool)
+        footprint[1:-1,1:-1] = False
+
+        # Ring positions in row-major order (as for ndimage.generic_filter)
+        ring_y, ring_x = np.nonzero(footprint)
+        ring_y, ring_x = ring_y-l, ring_x-l
+        angle_lookup = np.degrees(np.arctan2(-ring_y, ring_x)) # y pointing up
+
+        y, x = np.nonzero(self.skeleton)
+        padded = np.pad(self.skeleton, l, mode='constant')
+        ring = padded[ y[:,None]+l+ring_y[None,:], x[:,None]+l+ring_x[None,:] ]
+
+        # Evaluate the bend once for each distinct ring pattern
+        patterns, inverse = np.unique(np.packbits(ring, axis=1), axis=0, return_inverse=True)
+        patterns = np.unpackbits(patterns, axis=1, count=len(ring_y)).astype(bool)
+        bends = np.array( [ _bend_angle(np.nonzero(pattern)[0], angle_lookup) for pattern in patterns ], dtype=float )
+
+        angles = np.zeros(self.skeleton.shape)
+        angles[y, x] = bends[np.ravel(inverse)]
+
+        return angles
+
+
+    def segment_bending(self, angles):
+        '''Returns the average bending angle (given the image from
+        bending_angles) of each segment (a measure of its curvature).'''
+
+        labels = self.labeled_segments
+        n = self.num_segments + 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.bincount(labels.ravel(), weights=angles.ravel(), minlength=n)/self.segment_pixels
+
+
+    # End class SkeletonGraph(object)
+    ########################################
@@ -0,0 +1,482 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.ImAnalysis.Tiles` - Tiled (out-of-core) image processing
+================================================
+.. module:: SciAnalysis.ImAnalysis.Tiles
+   :synopsis: Reads large images as tiles, and stitches the per-tile results
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  Very large images (e.g. stitched SEM/AFM mosaics of 20k x 20k pixels) are
+# processed as a grid of tiles, so that only one tile (and the temporaries of
+# its analysis) need to be in memory at once.
+#
+# TiledImage opens the image without reading the pixels:
+#  - .npy files are memory-mapped
+#  - TIFF files are memory-mapped (uncompressed) or read by tile (compressed,
+#    tiled TIFFs; requires zarr) using tifffile (if it is installed)
+#  - other formats fall back to PIL (which decodes the image once, but only
+#    converts the requested regions to 32-bit pixels)
+# Each tile is extended by a 'halo' (overlap with the neighbouring tiles), so
+# that filters near the tile borders see the same neighbourhood as they would
+# in the full image; only the interior of each tile is kept.
+#
+# TiledLabels stitches per-tile labellings (e.g. of thresholded particles)
+# into a single labelling of the full image. The labels of each tile are
+# offset to be unique; labels touching across tile borders are recorded as
+# connected, and merged (as the connected components of the graph of such
+# pairs) at the end. Region moments (area, centroid, second moments) are
+# accumulated per tile and merged in the same way. The full labeled array
+# can be stored as a memory-mapped .npy file.
+#
+# Typical usage:
+#   tiled = TiledImage('mosaic.tif', tile_size=4096, halo=64, scale=2.0)
+#   labels = TiledLabels(tiled.shape, structure=s, outfile='labels.npy')
+#   for tile in tiled.tiles():
+#       data = tiled.data(tile) # Data2DImage including the halo
+#       ...
+#       labels.add(tile, data.data[tile.interior]>0)
+#   regions = labels.regions(x_scale=tiled.x_scale, y_scale=tiled.y_scale)
+#
+# Protocols without their own tiled analysis can be run on each tile (without
+# the halo) using run_tiles, provided that they declare which of their results
+# remain valid when computed on tiles, and how to merge them, e.g.:
+#   tile_results = { 'q0': 'average', 'num_grains': 'sum' }
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import numpy as np
+
+import PIL.Image
+
+from .. import tools
+from .Data import Data2DImage
+from .Regions import RegionProperties
+
+ndimage = tools.LazyModule('scipy.ndimage')
+sparse = tools.LazyModule('scipy.sparse')
+csgraph = tools.LazyModule('scipy.sparse.csgraph')
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+
+# Image sources
+################################################################################
+
+def _to_intensity(block):
+    '''Converts pixels to 32-bit integer intensities (as for PIL's
+    convert('I'), which maps RGB to luminance).'''
+
+    block = np.asarray(block)
+    if block.ndim==3:
+        rgb = block[:,:,:3].astype(np.int64)
+        return ( (rgb[:,:,0]*19595 + rgb[:,:,1]*38470 + rgb[:,:,2]*7471 + 0x8000) >> 16 ).astype(np.int32)
+    if np.issubdtype(block.dtype, np.integer) or block.dtype==bool:
+        return block.astype(np.int32)
+    return block
+
+
+class _PILSource(object):
+    '''Reads regions of an image file using PIL.'''
+
+    def __init__(self, infile):
+
+        # Large mosaics would otherwise be refused as 'decompression bombs'
+        max_pixels = PIL.Image.MAX_IMAGE_PIXELS
+        PIL.Image.MAX_IMAGE_PIXELS = None
+        try:
+            self.image = PIL.Image.open(infile)
+        finally:
+            PIL.Image.MAX_IMAGE_PIXELS = max_pixels
+        w, h = self.image.size
+        self.shape = (h, w)
+
+    def __getitem__(self, key):
+        sy, sx = key
+        box = (sx.start, sy.start, sx.stop, sy.stop)
+        return np.asarray(self.image.crop(box).convert('I'))
+
+
+def open_image(infile):
+    '''Returns an array-like object (supporting shape and 2D slicing) for the
+    image, without reading all the pixels into memory (where possible).'''
+
+    ext = tools.Filename(infile).get_ext()[1:].lower()
+
+    if ext=='npy':
+        return np.load(infile, mmap_mode='r')
+
+    if ext in ['tif', 'tiff'] and tifffile is not None:
+        try:
+            return tifffile.memmap(infile, mode='r')
+        except ValueError:
+            # Compressed (or otherwise not contiguous) data
+            pass
+        try:
+            import zarr
+            return zarr.open(tifffile.imread(infile, aszarr=True), mode='r')
+        except ImportError:
+            pass
+
+    return _PILSource(infile)
+
+
+
+# TiledImage
+################################################################################
+class Tile(object):
+    '''A region of the image: the interior [y0:y1, x0:x1] plus the halo, which
+    together span [Y0:Y1, X0:X1].'''
+
+    def __init__(self, y0, y1, x0, x1, halo, shape):
+        h, w = shape
+        self.y0, self.y1, self.x0, self.x1 = y0, y1, x0, x1
+        self.Y0, self.Y1 = max(y0-halo, 0), min(y1+halo, h)
+        self.X0, self.X1 = max(x0-halo, 0), min(x1+halo, w)
+
+    @property
+    def interior(self):
+        '''Slices of the interior, relative to the (halo-extended) tile.'''
+        return ( slice(self.y0-self.Y0, self.y1-self.Y0), slice(self.x0-self.X0, self.x1-self.X0) )
+
+    @property
+    def shape(self):
+        return (self.y1-self.y0, self.x1-self.x0)
+
+    @property
+    def name(self):
+        return 'y{:05d}_x{:05d}'.format(self.y0, self.x0)
+
+    def __repr__(self):
+        return 'Tile([{}:{}, {}:{}])'.format(self.y0, self.y1, self.x0, self.x1)
+
+
+class TiledImage(object):
+    '''A (large) image that is read tile-by-tile.'''
+
+    def __init__(self, infile, tile_size=4096, halo=0, name=None, scale=None, **kwargs):
+        '''Opens the image (without reading the pixels).
+
+        Parameters
+        ----------
+        infile : str
+            Image file (.npy, .tif or any format PIL can read).
+        tile_size : int
+            Size (pixels) of the tile interiors.
+        halo : int
+            Overlap (pixels) added around each tile.
+        scale : float (optional)
+            Size of a pixel (e.g. nm/pixel).
+        '''
+
+        self.infile = infile
+        self.name = tools.Filename(infile).get_filebase() if name is None else name
+        self.tile_size = max(int(tile_size), 1)
+        self.halo = max(int(halo), 0)
+        self.x_scale = self.y_scale = 1.0 if scale is None else scale
+        self._kwargs = kwargs
+
+        self.source = open_image(infile)
+        self.shape = tuple(self.source.shape[:2])
+
+
+    def tiles(self):
+        '''Returns the list of tiles (in row-major order).'''
+        h, w = self.shape
+        t = self.tile_size
+        return [ Tile(y0, min(y0+t, h), x0, min(x0+t, w), self.halo, self.shape) for y0 in range(0, h, t) for x0 in range(0, w, t) ]
+
+
+    def read(self, tile, halo=True):
+        '''Returns the pixels of the tile (including the halo, by default).'''
+        if halo:
+            block = self.source[tile.Y0:tile.Y1, tile.X0:tile.X1]
+        else:
+            block = self.source[tile.y0:tile.y1, tile.x0:tile.x1]
+        return _to_intensity(block)
+
+
+    def data(self, tile, halo=True):
+        '''Returns the tile as a Data2DImage (named after the image and the
+        tile position).'''
+
+        data = Data2DImage(name='{}_{}'.format(self.name, tile.name), **self._kwargs)
+        data.data = self.read(tile, halo=halo)
+        data.x_scale, data.y_scale = self.x_scale, self.y_scale
+        data.infile = self.infile
+
+        return data
+
+
+    # End class TiledImage(object)
+    ########################################
+
+
+
+# TiledLabels
+################################################################################
+class TiledLabels(object):
+    '''Labelling of a full image, assembled from binary masks of its tiles.
+    Objects that touch across tile borders (according to the connectivity
+    structure) are merged into a single label.'''
+
+    def __init__(self, shape, structure=None, outfile=None, dtype=np.int32):
+        '''Prepares the (empty) labelling.
+
+        Parameters
+        ----------
+        shape : (h, w)
+            Size of the full image.
+        structure : 3x3 array (optional)
+            Connectivity (as for ndimage.label); 4-connected by default.
+        outfile : str (optional)
+            If given, the labeled array is stored as a memory-mapped .npy file.
+        '''
+
+        self.shape = tuple(shape)
+        if structure is None:
+            structure = ndimage.generate_binary_structure(2,1)
+        self.structure = np.asarray(structure, dtype=bool)
+
+        if outfile is not None:
+            self.labeled_array = np.lib.format.open_memmap(outfile, mode='w+', dtype=dtype, shape=self.shape)
+        else:
+            self.labeled_array = np.zeros(self.shape, dtype=dtype)
+
+        self.num_labels = 0
+        self._area = [np.zeros(1, dtype=int)]
+        self._sums = [np.zeros((5, 1))]
+        self._pairs = []
+
+
+    def add(self, tile, mask):
+        '''Labels the (binary) mask of the tile's interior, and records its
+        connections to the tiles that have already been added.'''
+
+        labels, num = ndimage.label(mask, structure=self.structure)
+        labels = labels.astype(self.labeled_array.dtype, copy=False)
+        labels[labels>0] += self.num_labels
+
+        # Moments (in full-image coordinates)
+        idx = np.nonzero(labels)
+        lab = labels[idx] - self.num_labels
+        X = idx[1] + float(tile.x0)
+        Y = idx[0] + float(tile.y0)
+        n = num + 1
+        self._area.append( np.bincount(lab, minlength=n)[1:] )
+        self._sums.append( np.array([ np.bincount(lab, weights=weights, minlength=n)[1:] for weights in [X, Y, X*X, Y*Y, X*Y] ]).reshape(5, num) )
+
+        self._connect(tile, labels)
+
+        self.labeled_array[tile.y0:tile.y1, tile.x0:tile.x1] = labels
+        self.num_labels += num
+
+
+    def _connect(self, tile, labels):
+        '''Records the pairs of (provisional) labels that touch across the
+        tile's border.'''
+
+        h, w = self.shape
+        th, tw = tile.shape
+        y0, y1, x0, x1 = tile.y0, tile.y1, tile.x0, tile.x1
+        stored = self.labeled_array
+
+        # The one-pixel border around the tile (0 outside the image, or where
+        # no tile has been added yet)
+        border = np.zeros((th+2, tw+2), dtype=labels.dtype)
+        Xa, Xb = max(x0-1, 0), min(x1+1, w)
+        if y0>0:
+            border[0, 1+Xa-x0:1+Xb-x0] = stored[y0-1, Xa:Xb]
+        if y1<h:
+            border[-1, 1+Xa-x0:1+Xb-x0] = stored[y1, Xa:Xb]
+        if x0>0:
+            border[1:-1, 0] = stored[y0:y1, x0-1]
+        if x1<w:
+            border[1:-1, -1] = stored[y0:y1, x1]
+
+        pairs = []
+        for dy, dx in zip(*np.nonzero(self.structure)):
+            dy, dx = dy-1, dx-1
+            if dy==0 and dx==0:
+                continue
+            other = border[1+dy:1+dy+th, 1+dx:1+dx+tw]
+            touching = (labels>0) & (other>0)
+            if np.any(touching):
+                pairs.append( np.column_stack( (labels[touching], other[touching]) ) )
+
+        if len(pairs)>0:
+            self._pairs.append( np.unique(np.concatenate(pairs), axis=0) )
+
+
+    def relabel(self, lut, rows=1024):
+        '''Applies the lookup table (old label to new label) to the labeled
+        array, in strips of rows.'''
+
+        lut = np.asarray(lut).astype(self.labeled_array.dtype)
+        for y0 in range(0, self.shape[0], rows):
+            self.labeled_array[y0:y0+rows] = lut[ np.asarray(self.labeled_array[y0:y0+rows]).astype(np.intp) ]
+
+
+    def regions(self, x_scale=1.0, y_scale=1.0):
+        '''Merges the labels that touch across tile borders (so that the labels
+        become consecutive, from 1), and returns the RegionProperties of the
+        merged regions.'''
+
+        n = self.num_labels + 1
+        area = np.concatenate(self._area)
+        sums = np.concatenate(self._sums, axis=1)
+
+        if len(self._pairs)>0:
+            pairs = np.concatenate(self._pairs)
+            graph = sparse.coo_matrix( (np.ones(len(pairs)), (pairs[:,0], pairs[:,1])), shape=(n, n) )
+            # Components are numbered in order of their lowest label (the
+            # background, label 0, remains 0)
+            num_components, lut = csgraph.connected_components(graph, directed=False)
+
+            area = np.bincount(lut, weights=area, minlength=num_components).astype(int)
+            sums = np.array([ np.bincount(lut, weights=row, minlength=num_components) for row in sums ])
+            self.relabel(lut)
+
+            self.num_labels = num_components - 1
+            self._area, self._sums, self._pairs = [area], [sums], []
+
+        # Background
+        area = area.copy()
+        area[0] = self.shape[0]*self.shape[1] - np.sum(area[1:])
+
+        return RegionProperties.from_moments(area, sums, labeled_array=self.labeled_array, x_scale=x_scale, y_scale=y_scale)
+
+
+    # End class TiledLabels(object)
+    ########################################
+
+
+
+# Results
+################################################################################
+
+def run_tiles(protocol, tiled, output_dir, **run_args):
+    '''Runs the protocol separately on each tile (without the halo) of the
+    image, and returns the merged results. The outputs for each tile are
+    named after the image and the tile position. Only protocols that declare
+    their tile_results (the results that can be merged across tiles, see
+    merge_tile_results) can be run this way. Tiles for which the protocol
+    fails are skipped (and counted as 'tiles_failed', such that sums then
+    only cover the remaining tiles); an exception is only raised if all the
+    tiles fail.'''
+
+    merge = getattr(protocol, 'tile_results', None)
+    if not merge:
+        raise ValueError("Protocol {} cannot be run on tiles (it does not declare its tile_results).".format(protocol.name))
+
+    verbosity = run_args['verbosity'] if 'verbosity' in run_args else 3
+
+    results_list, weights = [], []
+    tiles = tiled.tiles()
+    tiles_failed = 0
+    for tile in tiles:
+        data = tiled.data(tile, halo=False)
+        try:
+            results = protocol.run(data, output_dir, **run_args)
+        except Exception as exception:
+            tiles_failed += 1
+            if tiles_failed==len(tiles):
+                raise
+            if verbosity>=1:
+                print('  ERROR ({}) with {} for tile {}.'.format(exception.__class__.__name__, protocol.name, data.name))
+            continue
+
+        results_list.append(results)
+        weights.append( tile.shape[0]*tile.shape[1] )
+
+    merged = merge_tile_results(results_list, merge, weights=weights)
+    merged['tiles_failed'] = tiles_failed
+
+    return merged
+
+
+def _tile_value(value):
+    '''Returns (value, error) for a numeric (scalar) result, which can also
+    be a dict with 'value' and 'error', as for fit parameters. Returns None
+    for other results, and for fits without an error estimate (i.e. that did
+    not converge).'''
+
+    numeric = lambda v: isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, (bool, np.bool_))
+
+    if numeric(value):
+        return (value, None) if np.isfinite(value) else None
+    if isinstance(value, dict) and 'value' in value and numeric(value['value']):
+        error = value.get('error', None)
+        if not numeric(error) or not np.isfinite(error) or not np.isfinite(value['value']):
+            return None
+        return value['value'], error
+
+    return None
+
+
+def merge_tile_results(results_list, merge, weights=None):
+    '''Merges the results (dicts) of running a protocol on each tile into a
+    single dict. Only the keys given in merge are merged, either as a 'sum'
+    (e.g. counts) or as an 'average' (weighted, e.g. by the tile areas).
+    Results of the form {'value': v, 'error': e} (e.g. fit parameters) are
+    merged in the same way, with the errors combined in quadrature; tiles
+    where the fit did not converge (no error estimate) are left out of
+    averages, and make sums invalid (nan).'''
+
+    if weights is None:
+        weights = np.ones(len(results_list))
+    weights = np.asarray(weights, dtype=float)
+
+    merged = {}
+    for key, method in merge.items():
+        if method not in ['sum', 'average']:
+            raise ValueError("tile_results for {} must be 'sum' or 'average' (got {}).".format(key, method))
+
+        present = [ results[key] for results in results_list if key in results ]
+        if len(present)<1:
+            continue
+        pairs = [ _tile_value(results.get(key, None)) for results in results_list ]
+        valid = np.asarray([ pair is not None for pair in pairs ])
+        values = np.asarray([ pair[0] if pair is not None else np.nan for pair in pairs ], dtype=float)
+        errors = np.asarray([ pair[1] if pair is not None and pair[1] is not None else 0.0 for pair in pairs ], dtype=float)
+
+        if method=='sum':
+            w = np.ones(len(values))
+            if np.all(valid):
+                value = np.sum(values)
+                if all( isinstance(pair[0], (int, np.integer)) for pair in pairs ):
+                    value = int(value)
+                error = np.sqrt(np.sum(np.square(errors)))
+            else:
+                value, error = np.nan, None
+        else:
+            w = weights
+            if np.any(valid) and np.sum(w[valid])>0:
+                value = np.average(values[valid], weights=w[valid])
+                error = np.sqrt(np.sum(np.square(w[valid]*errors[valid])))/np.sum(w[valid])
+            else:
+                value, error = np.nan, None
+
+        if isinstance(present[0], dict):
+            # Keep the other fields (units, symbol, ...) of the result
+            merged[key] = dict(present[0], value=value, error=error)
+        else:
+            merged[key] = value
+
+    merged['num_tiles'] = len(results_list)
+
+    return merged
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.ImAnalysis.Windows` - Local (windowed) Fourier analysis
+================================================
+.. module:: SciAnalysis.ImAnalysis.Windows
+   :synopsis: Batched FFTs of strided sub-regions (windows) of an image
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  Protocols that map local structure (e.g. the local periodicity d0) split the
+# image into a grid of overlapping square sub-regions (windows), and compute
+# the FFT of each. Rather than building a Data2D for each window, WindowFFT
+# extracts the windows as a strided view of the image, and transforms them in
+# batches (a stack of windows per FFT call). Since all the windows have the
+# same shape, reductions (circular averages, angular linecuts) are computed for
+# the whole batch with a single (sparse) binning operator, which is computed
+# once. Any blur of the FFTs is likewise applied to a whole batch at once.
+#
+# The windows are centered at (ix, iy) for:
+#   ix in range(size, w-size, step), iy in range(size, h-size, step)
+# and cover data[iy-size:iy+size, ix-size:ix+size] (ordered with ix as the
+# outer loop, as in the protocols' original loops).
+#
+# Typical usage:
+#   windows = WindowFFT(data.data, size=75, step=37, x_scale=data.x_scale, y_scale=data.y_scale, blur=0.5)
+#   for indices in windows.batches():
+#       F = windows.transform(indices)
+#       q, I = windows.circular_average( windows.amplitude(F) )
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import numpy as np
+
+from .. import tools
+from ..Data import Data2DFourier
+
+ndimage = tools.LazyModule('scipy.ndimage')
+sparse = tools.LazyModule('scipy.sparse')
+fft = tools.LazyModule('scipy.fft')
+
+
+
+# WindowFFT
+################################################################################
+class WindowFFT(object):
+    '''FFTs of a grid of square (2*size x 2*size) windows of an image. The
+    FFTs are centered (like Data2D.fft with update_origin=True) and have
+    q-scales (per pixel) of q_x_scale and q_y_scale.'''
+
+    def __init__(self, image, size, step, x_scale=1.0, y_scale=1.0, blur=None, batch_size=128, workers=-1):
+        '''Defines the windows.
+
+        Parameters
+        ----------
+        image : 2D array
+        size : int
+            Half-width (pixels) of the windows.
+        step : int
+            Spacing (pixels) between window centers.
+        x_scale, y_scale : float
+            Real-space scale (e.g. nm/pixel) of the image.
+        blur : float (optional)
+            Size (pixels) of the Gaussian blur applied to the FFTs.
+        batch_size : int
+            Number of windows per FFT call (bounds memory use).
+        workers : int
+            Number of threads for the FFTs (-1 for all cores).
+        '''
+
+        self.image = np.asarray(image)
+        self.size = int(size)
+        self.step = max(int(step), 1)
+        self.blur = blur
+        self.batch_size = batch_size
+        self.workers = workers
+
+        h, w = self.image.shape
+        s = self.size
+        x_centers = np.arange(s, w-s, self.step)
+        y_centers = np.arange(s, h-s, self.step)
+        ix, iy = np.meshgrid(x_centers, y_centers, indexing='ij')
+        self.x, self.y = ix.ravel(), iy.ravel()
+        self.num_windows = len(self.x)
+
+        self.shape = (2*s, 2*s)
+        if self.num_windows>0:
+            self._view = np.lib.stride_tricks.sliding_window_view(self.image, self.shape)
+
+        # Fourier-space coordinates (same conventions as Data2D.fft, d_map, angle_map)
+        self.origin = [s, s]
+        self.q_x_scale = 2*np.pi/(x_scale*self.shape[1])
+        self.q_y_scale = 2*np.pi/(y_scale*self.shape[0])
+
+        self._radial = None
+        self._angular = {}
+
+
+    def batches(self):
+        '''Yields the window indices in batches.'''
+        for i in range(0, self.num_windows, self.batch_size):
+            yield np.arange(i, min(i+self.batch_size, self.num_windows))
+
+
+    def windows(self, indices):
+        '''Returns the (real-space) windows as an (n, 2*size, 2*size) array.'''
+        s = self.size
+        return self._view[self.y[indices]-s, self.x[indices]-s]
+
+
+    # Transforms
+    ########################################
+
+    def transform(self, indices):
+        '''Returns the centered FFTs of the windows, as an (n, 2*size, 2*size)
+        complex array.'''
+        F = fft.fft2(self.windows(indices), axes=(-2,-1), workers=self.workers)
+        # Data2D.recenter is equivalent to ifftshift
+        return np.fft.ifftshift(F, axes=(-2,-1))
+
+
+    def _blur(self, A):
+        if self.blur is None:
+            return A
+        return ndimage.gaussian_filter(A, sigma=(0, self.blur, self.blur))
+
+    def amplitude(self, F):
+        '''Returns the (blurred) amplitude of the FFTs.'''
+        return self._blur(np.abs(F))
+
+    def real_imag(self, F):
+        '''Returns the (blurred) real and imaginary parts of the FFTs.'''
+        return self._blur(np.ascontiguousarray(F.real)), self._blur(np.ascontiguousarray(F.imag))
+
+
+    # Reductions
+    ########################################
+
+    def _maps(self):
+        h, w = self.shape
+        x = (np.arange(w) - self.origin[0])*self.q_x_scale
+        y = (np.arange(h) - self.origin[1])*self.q_y_scale
+        X, Y = np.meshgrid(x, y)
+        Q = np.sqrt(X**2 + Y**2)
+        # 0 degrees is vertical (as in Data2D.angle_map)
+        CHI = np.degrees(np.arctan2(X, Y))
+
+        return Q.ravel(), CHI.ravel()
+
+
+    def _operator(self, bins, pixels, values):
+        '''Returns the (sparse) operator that averages the pixels within each
+        bin, and the average coordinate value of each bin.'''
+
+        num_per_bin = np.bincount(bins[pixels])
+        idx = np.nonzero(num_per_bin)[0]
+        lookup = -np.ones(len(num_per_bin), dtype=int)
+        lookup[idx] = np.arange(len(idx))
+
+        cols = lookup[bins[pixels]]
+        weights = 1.0/num_per_bin[bins[pixels]]
+        operator = sparse.csr_matrix( (weights, (pixels, cols)), shape=(len(bins), len(idx)) )
+
+        x_vals = np.bincount(bins[pixels], weights=values[pixels])[idx]/num_per_bin[idx]
+
+        return x_vals, operator
+
+
+    def circular_average(self, A):
+        '''Circularly averages each window (as in Data2D.circular_average).
+        Returns q (1D) and the averages (n, len(q)).'''
+
+        if self._radial is None:
+            Q, CHI = self._maps()
+            scale = (self.q_x_scale + self.q_y_scale)/2.0
+            Qd = (Q/scale + 0.5).astype(int)
+            self._radial = self._operator(Qd, np.arange(len(Qd)), Q)
+
+        q_vals, operator = self._radial
+
+        return q_vals, np.asarray( operator.T.dot( A.reshape(len(A), -1).T ) ).T
+
+
+    def linecut_angle(self, A, d_center, d_spread):
+        '''Angular linecut of each window through the annulus |q-d_center|<d_spread
+        (as in Data2D.linecut_angle). Returns chi (1D, degrees) and the
+        linecuts (n, len(chi)).'''
+
+        key = (d_center, d_spread)
+        if key not in self._angular:
+            Q, CHI = self._maps()
+            scale_x = np.abs(np.arctan(1.0/(d_center/self.q_x_scale)))
+            scale_y = np.abs(np.arctan(1.0/(d_center/self.q_y_scale)))
+            scale = np.degrees( min(scale_x, scale_y) ) # approximately 1-pixel
+            CHId = (CHI/scale + 0.5).astype(int)
+            CHId -= np.min(CHId)
+            pixels = np.nonzero( np.abs(Q-d_center)<d_spread )[0]
+            self._angular[key] = self._operator(CHId, pixels, CHI)
+
+        chi_vals, operator = self._angular[key]
+
+        return chi_vals, np.asarray( operator.T.dot( A.reshape(len(A), -1).T ) ).T
+
+
+    # Output
+    ########################################
+
+    def data_fft(self, values):
+        '''Returns a Data2DFourier for one window's FFT (e.g. for plotting).'''
+
+        data_fft = Data2DFourier()
+        data_fft.data = values
+        data_fft.origin = list(self.origin)
+        data_fft.x_scale, data_fft.y_scale = self.q_x_scale, self.q_y_scale
+        data_fft.x_label = 'qx'
+        data_fft.x_rlabel = r'$q_x \, (\mathrm{nm}^{-1})$'
+        data_fft.y_label = 'qy'
+        data_fft.y_rlabel = r'$q_y \, (\mathrm{nm}^{-1})$'
+
+        return data_fft
+
+
+    # End class WindowFFT(object)
+    ########################################
@@ -0,0 +1,293 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.PlotQueue` - Out-of-process plot rendering
+================================================
+.. module:: SciAnalysis.PlotQueue
+   :synopsis: Renders protocol plots in a separate pool of processes
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  Plotting (matplotlib) is often slower than the analysis itself. A PlotQueue
+# accepts lightweight plot specifications (the DataLine/Data2D object, which is
+# just arrays plus plot_args, together with the plot method and its arguments)
+# and renders them in a pool of worker processes. Each worker imports
+# matplotlib (with a non-interactive backend) once, and keeps it warm for all
+# subsequent plots. Figures are also reused: within a worker, plt.close()
+# clears the figure and keeps it, and the next plt.figure() returns it (resized)
+# instead of creating a new one.
+#
+# Typical usage:
+#   process = ProcessorXS(load_args=load_args, run_args=run_args)
+#   process.plot_queue = PlotQueue(processes=4)
+#   process.run(infiles, protocols, output_dir=output_dir)
+#
+# During live monitoring, plotting can be sampled (every=10 plots only every
+# 10th file) or deferred (defer=True holds plots until flush() is called).
+# Sampling follows a running count of the files processed (each of the
+# Processor run methods, including monitor_loop and run_parallel, advances
+# it), so that the same files are plotted whether run serially or in parallel.
+#
+# A copy of the PlotQueue (e.g. in the joblib workers of run_parallel) never
+# starts its own pool; the sampled plots are instead rendered directly by the
+# worker (which is already running in parallel). Likewise, no pool is started
+# within daemonic processes, which are not allowed to have children.
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import pickle
+import weakref
+import multiprocessing
+
+
+
+# Worker-side functions
+########################################
+
+def _reuse_figures(plt, modules, max_spare=4):
+    '''Replaces figure() and close() in the given (pyplot-like) modules, such
+    that closed figures are cleared and kept (up to max_spare), and handed out
+    again by the next call to figure() (without a num).'''
+
+    import matplotlib as mpl
+    from matplotlib._pylab_helpers import Gcf
+    figure, close = plt.figure, plt.close
+    spare = []
+
+    def reused_figure(num=None, figsize=None, facecolor=None, **kwargs):
+        if num is not None or len(kwargs)>0 or len(spare)<1:
+            return figure(num=num, figsize=figsize, facecolor=facecolor, **kwargs)
+
+        fig = figure(spare.pop().number) # Make it the current figure again
+        rc = mpl.rcParams
+        fig.set_size_inches(rc['figure.figsize'] if figsize is None else figsize, forward=False)
+        fig.set_facecolor(rc['figure.facecolor'] if facecolor is None else facecolor)
+        fig.subplotpars.update(**{ key: rc['figure.subplot.{}'.format(key)] for key in ['left', 'right', 'bottom', 'top', 'wspace', 'hspace'] })
+        return fig
+
+    def reused_close(fig=None):
+        if isinstance(fig, int) and Gcf.has_fignum(fig):
+            fig = Gcf.get_fig_manager(fig).canvas.figure
+        if isinstance(fig, mpl.figure.Figure) and fig not in spare and len(spare)<max_spare:
+            fig.clear()
+            spare.append(fig)
+        else:
+            close(fig)
+
+    for module in modules:
+        module.figure = reused_figure
+        module.close = reused_close
+
+
+def _init_worker(backend):
+    '''Runs once in each worker process.'''
+    import matplotlib as mpl
+    mpl.use(backend, force=True)
+    import matplotlib.pyplot as plt
+    plt.switch_backend(backend) # Needed if the parent had already selected a GUI backend
+    import pylab
+    _reuse_figures(plt, [plt, pylab])
+
+    # Import the data classes now, so that unpickling plot specifications
+    # (and building the font cache) only happens once per worker.
+    import SciAnalysis.Data
+
+
+def _render(payload):
+    '''Renders a single (pickled) plot specification.'''
+    obj, method, kwargs = pickle.loads(payload)
+    getattr(obj, method)(**kwargs)
+
+    return kwargs.get('save')
+
+
+def _shutdown(pool, deferred):
+    '''Renders the deferred plots, and shuts down the pool (when a PlotQueue is
+    closed, garbage-collected, or at exit).'''
+
+    if len(deferred)>0 and pool[0] is None:
+        pool[0] = PlotQueue._new_pool(*pool[1:])
+    if pool[0] is not None:
+        for payload in deferred:
+            pool[0].apply_async(_render, (payload,))
+        del deferred[:]
+        pool[0].close()
+        pool[0].join()
+        pool[0] = None
+
+
+
+# PlotQueue
+################################################################################
+class PlotQueue(object):
+    '''Queue of plots to be rendered by a pool of background processes.'''
+
+    def __init__(self, processes=2, every=1, defer=False, backend='Agg', verbosity=3):
+        '''Creates a new pool of plotting processes.
+
+        Parameters
+        ----------
+        processes : int
+            Number of plotting worker processes.
+        every : int
+            Only render plots for every N-th file (1 means plot everything).
+        defer : bool
+            Hold plots in memory until flush() is called (e.g. at the end of a
+            run, or when the beamline is idle).
+        backend : str
+            matplotlib backend used by the workers.
+        '''
+
+        self.processes = processes
+        self.every = max(1, int(every))
+        self.defer = defer
+        self.backend = backend
+        self.verbosity = verbosity
+
+        self.file_count = 0
+        self._deferred = []
+        self._pending = []
+        self._pool = [None, processes, backend] # The pool (created on first use) and its settings
+        self._copy = False # Set on copies sent to other processes
+
+        # Renders outstanding plots when the PlotQueue is garbage-collected, or
+        # at exit (without keeping the PlotQueue alive)
+        self._finalizer = weakref.finalize(self, _shutdown, self._pool, self._deferred)
+
+
+    def can_queue(self):
+        '''Returns False if plots cannot be sent to a pool from this process
+        (a copy of the PlotQueue, or within a daemonic process).'''
+        return not self._copy and not multiprocessing.current_process().daemon
+
+
+    @staticmethod
+    def _new_pool(processes, backend):
+        return multiprocessing.Pool(processes, initializer=_init_worker, initargs=(backend,))
+
+
+    def _get_pool(self):
+
+        if self._pool[0] is None:
+            self._pool[0] = self._new_pool(self.processes, self.backend)
+
+        return self._pool[0]
+
+
+    def next_file(self, index=None):
+        '''Indicates that processing has moved on to a new file (or to the
+        file with the given index, counting from 0, in the overall sequence of
+        files). This is used to decide whether plots are sampled (see
+        'every').'''
+        if index is None:
+            self.file_count += 1
+        else:
+            self.file_count = index+1
+
+
+    def sampled(self):
+        '''Returns True if plots for the current file should be generated.'''
+        return (self.file_count-1)%self.every==0
+
+
+    def submit(self, obj, save, method='plot', **kwargs):
+        '''Adds a plot to the queue. The supplied obj must provide the given
+        plot method (e.g. DataLine.plot, Data2D.plot). Returns False if the
+        plot could not be queued (e.g. the object cannot be pickled, or this
+        is a copy of the PlotQueue running in a worker), in which case the
+        caller should plot it directly.'''
+
+        if not self.sampled():
+            if self.verbosity>=5:
+                print('    PlotQueue: skipping plot {} (not sampled)'.format(save))
+            return True
+
+        if not self.can_queue():
+            return False
+
+        kwargs['save'] = save
+        try:
+            payload = pickle.dumps( (obj, method, kwargs), protocol=pickle.HIGHEST_PROTOCOL )
+        except (pickle.PicklingError, AttributeError, TypeError):
+            # E.g. classes defined locally inside a Protocol.run method
+            if self.verbosity>=4:
+                print('    PlotQueue: cannot queue {}; plotting directly'.format(obj.__class__.__name__))
+            return False
+
+        if self.defer:
+            self._deferred.append(payload)
+        else:
+            self._dispatch(payload)
+
+        return True
+
+
+    def _dispatch(self, payload):
+
+        self._pending = [p for p in self._pending if not p.ready()]
+        self._pending.append( self._get_pool().apply_async(_render, (payload,), error_callback=self._error) )
+
+
+    def _error(self, exception):
+        if self.verbosity>=1:
+            print('  ERROR ({}) in PlotQueue: {}'.format(exception.__class__.__name__, exception))
+
+
+    def flush(self):
+        '''Sends all deferred plots to the workers.'''
+        for payload in self._deferred:
+            self._dispatch(payload)
+        del self._deferred[:] # (The list is shared with the finalizer)
+
+
+    def wait(self):
+        '''Blocks until all submitted plots have been rendered.'''
+        self.flush()
+        for p in self._pending:
+            p.wait()
+        self._pending = []
+
+
+    def close(self):
+        '''Renders any outstanding plots and shuts down the worker pool.'''
+        if self._copy:
+            return
+        self.flush()
+        if self._pool[0] is not None:
+            self.wait()
+            self._pool[0].close()
+            self._pool[0].join()
+            self._pool[0] = None
+
+
+    def __getstate__(self):
+        # Worker pools cannot be pickled (e.g. when a Processor is sent to
+        # joblib workers). A copy never creates a pool of its own (which would
+        # be left running in each worker); it only samples.
+        state = self.__dict__.copy()
+        state['_deferred'] = []
+        state['_pending'] = []
+        state['_pool'] = [None, self.processes, self.backend]
+        state['_finalizer'] = None
+        state['_copy'] = True
+        return state
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    # End class PlotQueue(object)
+    ########################################
@@ -0,0 +1,498 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.Trace` - Run-time instrumentation of processing runs
+================================================
+.. module:: SciAnalysis.Trace
+   :synopsis: Records per-file, per-protocol timing, memory and I/O
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  A RunTrace records, for each file and each protocol run by a Processor:
+#   wall    : total time for the step
+#   load    : time spent loading the data
+#   compute : time spent in the protocol itself (wall - plot - save)
+#   plot    : time spent in plotting methods (DataLine.plot, Data2D.plot, ...)
+#   save    : time spent saving (store_results, save_data, HDF5 output)
+#   rss_MB : memory (resident set) at the end of the step
+#   peak_rss_MB : peak (high-water mark) memory during the step; only recorded
+#       (otherwise None) with RunTrace(peak_memory=True), which resets the
+#       high-water mark of the whole process at the start of each step (Linux
+#       /proc/self/clear_refs)
+#   process_peak_rss_MB : peak memory of the process, so far
+#   read_bytes, written_bytes : bytes read/written during the step
+#
+# Typical usage:
+#   process = ProcessorXS(load_args=load_args, run_args=run_args)
+#   process.trace = RunTrace()
+#   process.run(infiles, protocols, output_dir=output_dir)
+#   process.trace.summary()
+#   process.trace.save(output_dir) # trace.csv, trace.json, trace_summary.txt
+#
+# Profiling is opt-in: RunTrace(profile='cprofile') (or 'pyinstrument', if
+# installed) profiles each step, accumulating one profile per protocol. Use
+# profile_every=N to only profile every N-th file (to limit overhead). Files
+# are counted over the whole run; in Processor.run_parallel, the cProfile
+# profiles of the workers are merged back into the trace (pyinstrument
+# profiles are only recorded for serial runs).
+#
+# Plot/save time is attributed using the timed() decorator (applied to the
+# plotting and saving methods of the data classes). When a PlotQueue is used,
+# only the time to submit the plot is recorded (rendering happens elsewhere).
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import os
+import time
+import json
+import functools
+import threading
+import contextlib
+
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
+
+
+PHASES = ['load', 'compute', 'plot', 'save']
+FIELDS = ['infile', 'protocol', 'start', 'wall'] + PHASES + ['rss_MB', 'peak_rss_MB', 'process_peak_rss_MB', 'read_bytes', 'written_bytes', 'error']
+
+
+_local = threading.local() # Holds the RunTrace active in the current thread
+
+
+
+# Helpers
+########################################
+
+def active():
+    '''Returns the RunTrace active in this thread (or None).'''
+    return getattr(_local, 'trace', None)
+
+
+@contextlib.contextmanager
+def activate(trace):
+    '''Makes the trace active (within this thread), so that timed() methods
+    report to it. Does nothing if trace is None.'''
+    if trace is None:
+        yield
+        return
+
+    previous = active()
+    _local.trace = trace
+    try:
+        yield
+    finally:
+        _local.trace = previous
+
+
+def step(trace, infile, protocol):
+    '''Context manager recording one step (e.g. running a protocol on a file).
+    Does nothing if trace is None.'''
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.step(infile, protocol)
+
+
+def timed(phase):
+    '''Decorator which attributes the time spent in the function to the given
+    phase ('plot', 'save', ...) of the active trace step.'''
+    def decorator(function):
+        @functools.wraps(function)
+        def _timed(*args, **kwargs):
+            trace = active()
+            if trace is None:
+                return function(*args, **kwargs)
+            with trace.phase(phase):
+                return function(*args, **kwargs)
+        return _timed
+    return decorator
+
+
+def memory_usage():
+    '''Returns the current and peak resident memory (in MB), if available. The
+    peak is the high-water mark since the last reset_peak_memory() (or since
+    the start of the process).'''
+    rss, peak = None, None
+    try:
+        with open('/proc/self/status') as fin:
+            for line in fin:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])/1e3 # kB
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1])/1e3
+        return rss, peak
+    except (OSError, ValueError, IndexError):
+        pass
+
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak/1e6 if os.uname().sysname=='Darwin' else peak/1e3 # bytes on macOS, kB on Linux
+
+    return rss, peak
+
+
+def reset_peak_memory():
+    '''Resets the peak (high-water mark) resident memory to the current value,
+    so that the next memory_usage() returns the peak since now. Returns False
+    if this is not possible (only Linux supports it).'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as fout:
+            fout.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def io_counters():
+    '''Returns the total bytes read and written by this process, if available.'''
+    try:
+        counters = {}
+        with open('/proc/self/io') as fin:
+            for line in fin:
+                key, value = line.split(':')
+                counters[key] = int(value)
+        return counters['rchar'], counters['wchar']
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+
+
+def _add_stats(stats, other):
+    '''Returns the sum of two sets of cProfile statistics (pstats.Stats.stats
+    dicts).'''
+    import pstats
+    total = pstats.Stats()
+    for item in [stats, other]:
+        part = pstats.Stats()
+        part.stats = dict(item)
+        part.get_top_level_stats()
+        total.add(part)
+    return total.stats
+
+
+
+# RunTrace
+################################################################################
+class RunTrace(object):
+    '''Records timing, memory and I/O for each (file, protocol) step.'''
+
+    def __init__(self, profile=None, profile_every=1, peak_memory=False, verbosity=3):
+        '''Creates a new (empty) trace.
+
+        Parameters
+        ----------
+        profile : None, 'cprofile' or 'pyinstrument'
+            Profile each step (one accumulated profile per protocol).
+        profile_every : int
+            Only profile every N-th file.
+        peak_memory : bool
+            Record the peak memory of each step (this resets the peak memory
+            of the process, as reported by the OS, at each step).
+        '''
+
+        self.verbosity = verbosity
+        self.records = []
+        self._current = None
+        self._files = []
+        self._file_offset = 0 # Number of files before this one (for a fork)
+        self.peak_memory = peak_memory
+        self._process_peak = None # Peak memory (MB) of the process, across resets
+
+        self.profile_every = max(1, int(profile_every))
+        self.profile = profile
+        if profile=='pyinstrument':
+            try:
+                import pyinstrument
+            except ImportError:
+                if self.verbosity>=1:
+                    print('WARNING: pyinstrument is not installed; using cProfile instead.')
+                self.profile = 'cprofile'
+        elif profile not in [None, 'cprofile']:
+            raise ValueError("profile must be None, 'cprofile' or 'pyinstrument' (got {})".format(profile))
+        self.profilers = {}
+        self.profile_stats = {} # cProfile statistics merged from forks (by protocol)
+
+
+    @property
+    def num_files(self):
+        '''Number of files recorded (counting those before a fork).'''
+        return self._file_offset + len(self._files)
+
+
+    def fork(self, file_index=None):
+        '''Returns a new (empty) trace with the same settings (e.g. for use in
+        a parallel worker, whose first file is number file_index in the whole
+        run). The results are merged back using merge(fork.export()).'''
+        trace = self.__class__(profile=self.profile, profile_every=self.profile_every, peak_memory=self.peak_memory, verbosity=0)
+        trace._file_offset = self.num_files if file_index is None else file_index
+        return trace
+
+
+    def extend(self, records):
+        self.records.extend(records)
+        for record in records:
+            if record['infile'] not in self._files:
+                self._files.append(record['infile'])
+
+
+    def export(self):
+        '''Returns the records and the (cProfile) profile statistics, in a
+        form that can be sent between processes (see merge).'''
+
+        profiles = {}
+        if self.profile=='cprofile':
+            import pstats
+            profiles = { protocol: pstats.Stats(profiler).stats for protocol, profiler in self.profilers.items() }
+
+        return { 'records': self.records, 'profiles': profiles }
+
+
+    def merge(self, exported):
+        '''Adds the records and profiles of another trace (from its export).'''
+
+        self.extend(exported['records'])
+        for protocol, stats in exported['profiles'].items():
+            if protocol in self.profile_stats:
+                self.profile_stats[protocol].update(_add_stats(self.profile_stats[protocol], stats))
+            else:
+                self.profile_stats[protocol] = dict(stats)
+
+
+    @contextlib.contextmanager
+    def step(self, infile, protocol):
+        '''Records one step. Nested steps (e.g. Protocol.run inside of a
+        Processor step) are folded into the outer step.'''
+
+        if self._current is not None:
+            yield self._current
+            return
+
+        infile = str(infile)
+        if infile not in self._files:
+            self._files.append(infile)
+        number = self._file_offset + len(self._files) - 1 # Within the whole run
+        profiler = self._start_profiler(protocol) if number%self.profile_every==0 else None
+
+        record = dict.fromkeys(FIELDS)
+        record.update(infile=infile, protocol=protocol, start=time.time(), plot=0.0, save=0.0, load=0.0)
+        record['_phase'] = None
+        read_start, written_start = io_counters()
+        self._update_process_peak(memory_usage()[1])
+        reset = self.peak_memory and reset_peak_memory()
+        self._current = record
+        start = time.perf_counter()
+
+        try:
+            yield record
+        except Exception as exception:
+            record['error'] = exception.__class__.__name__
+            raise
+        finally:
+            record['wall'] = time.perf_counter() - start
+            self._current = None
+            if profiler is not None:
+                self._stop_profiler(profiler)
+
+            if protocol=='load':
+                record['load'] = record['wall']
+            record['compute'] = max(0.0, record['wall'] - record['load'] - record['plot'] - record['save'])
+            record['rss_MB'], peak = memory_usage()
+            self._update_process_peak(peak)
+            record['peak_rss_MB'] = peak if reset else None
+            record['process_peak_rss_MB'] = self._process_peak
+            read_end, written_end = io_counters()
+            if read_start is not None and read_end is not None:
+                record['read_bytes'] = read_end - read_start
+                record['written_bytes'] = written_end - written_start
+            del record['_phase']
+            self.records.append(record)
+
+
+    def _update_process_peak(self, peak):
+        if peak is not None:
+            self._process_peak = peak if self._process_peak is None else max(self._process_peak, peak)
+
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Attributes time to the given phase of the current step. Time spent in
+        nested phases (e.g. save_data called during a plot) counts toward the
+        outer phase only.'''
+
+        record = self._current
+        if record is None or record['_phase'] is not None:
+            yield
+            return
+
+        record['_phase'] = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record[name] = record.get(name, 0.0) + time.perf_counter() - start
+            record['_phase'] = None
+
+
+    # Profiling
+    ########################################
+
+    def _start_profiler(self, protocol):
+
+        if self.profile is None:
+            return None
+
+        if protocol not in self.profilers:
+            if self.profile=='pyinstrument':
+                from pyinstrument import Profiler
+                self.profilers[protocol] = Profiler()
+            else:
+                import cProfile
+                self.profilers[protocol] = cProfile.Profile()
+
+        profiler = self.profilers[protocol]
+        if self.profile=='pyinstrument':
+            profiler.start()
+        else:
+            profiler.enable()
+
+        return profiler
+
+
+    def _stop_profiler(self, profiler):
+
+        if self.profile=='pyinstrument':
+            profiler.stop()
+        else:
+            profiler.disable()
+
+
+    def save_profiles(self, output_dir):
+        '''Saves one profile per protocol (.prof for cProfile, which can be
+        inspected using pstats/snakeviz; .txt and .html for pyinstrument).'''
+
+        outfiles = []
+        if self.profile=='pyinstrument':
+            for protocol, profiler in self.profilers.items():
+                outfile = os.path.join(output_dir, 'profile_{}'.format(protocol))
+                with open(outfile+'.txt', 'w') as fout:
+                    fout.write(profiler.output_text(unicode=True))
+                with open(outfile+'.html', 'w') as fout:
+                    fout.write(profiler.output_html())
+                outfiles.append(outfile+'.html')
+
+        elif self.profile=='cprofile':
+            import pstats, marshal
+            stats = dict( (protocol, dict(stats)) for protocol, stats in self.profile_stats.items() )
+            for protocol, profiler in self.profilers.items():
+                own = pstats.Stats(profiler).stats
+                stats[protocol] = _add_stats(stats[protocol], own) if protocol in stats else own
+            for protocol, protocol_stats in stats.items():
+                outfile = os.path.join(output_dir, 'profile_{}.prof'.format(protocol))
+                with open(outfile, 'wb') as fout:
+                    marshal.dump(protocol_stats, fout) # As pstats.Stats.dump_stats
+                outfiles.append(outfile)
+
+        return outfiles
+
+
+    # Export
+    ########################################
+
+    def save_csv(self, outfile):
+        import csv
+        with open(outfile, 'w', newline='') as fout:
+            writer = csv.DictWriter(fout, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+
+    def save_json(self, outfile):
+        with open(outfile, 'w') as fout:
+            json.dump({'fields': FIELDS, 'records': self.records, 'summary': self.totals()}, fout, indent=1)
+
+
+    def save(self, output_dir, name='trace'):
+        '''Saves the trace (CSV and JSON), the summary report, and any
+        profiles into output_dir.'''
+
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        self.save_csv(os.path.join(output_dir, name+'.csv'))
+        self.save_json(os.path.join(output_dir, name+'.json'))
+        with open(os.path.join(output_dir, name+'_summary.txt'), 'w') as fout:
+            fout.write(self.report())
+        self.save_profiles(output_dir)
+
+
+    # Summary
+    ########################################
+
+    def totals(self):
+        '''Aggregates the records by protocol (in order of first appearance).'''
+
+        totals = {}
+        for record in self.records:
+            protocol = record['protocol']
+            if protocol not in totals:
+                totals[protocol] = dict.fromkeys(['wall'] + PHASES, 0.0)
+                totals[protocol].update(count=0, errors=0, peak_rss_MB=None, read_bytes=0, written_bytes=0)
+            total = totals[protocol]
+            total['count'] += 1
+            total['errors'] += 1 if record['error'] else 0
+            for key in ['wall'] + PHASES:
+                total[key] += record[key]
+            for key in ['read_bytes', 'written_bytes']:
+                total[key] += record[key] or 0
+            if record['peak_rss_MB'] is not None:
+                total['peak_rss_MB'] = max(total['peak_rss_MB'] or 0, record['peak_rss_MB'])
+
+        return totals
+
+
+    def report(self):
+        '''Returns a text table of where the time was spent, by protocol.'''
+
+        totals = self.totals()
+        run_total = sum(total['wall'] for total in totals.values())
+        files = len(set(record['infile'] for record in self.records))
+
+        lines = []
+        lines.append('RunTrace: {} steps for {} files took {:.2f}s'.format(len(self.records), files, run_total))
+        lines.append('{:24s} {:>5s} {:>9s} {:>6s} {:>9s} {:>8s} {:>8s} {:>8s} {:>8s} {:>9s} {:>9s} {:>9s}'.format('protocol', 'n', 'total(s)', '%', 'mean(s)', 'load', 'compute', 'plot', 'save', 'peak(MB)', 'read(MB)', 'write(MB)'))
+        for protocol, total in sorted(totals.items(), key=lambda item: -item[1]['wall']):
+            percent = 100.0*total['wall']/run_total if run_total>0 else 0.0
+            peak = '{:9.1f}'.format(total['peak_rss_MB']) if total['peak_rss_MB'] is not None else '{:>9s}'.format('-')
+            name = protocol if total['errors']==0 else '{} ({} err)'.format(protocol, total['errors'])
+            lines.append('{:24s} {:5d} {:9.3f} {:6.1f} {:9.4f} {:8.3f} {:8.3f} {:8.3f} {:8.3f} {} {:9.2f} {:9.2f}'.format(name, total['count'], total['wall'], percent, total['wall']/total['count'], total['load'], total['compute'], total['plot'], total['save'], peak, total['read_bytes']/1e6, total['written_bytes']/1e6))
+
+        return '\n'.join(lines) + '\n'
+
+
+    def summary(self):
+        '''Prints the summary report.'''
+        print(self.report())
+
+
+    def __getstate__(self):
+        # Profilers cannot be pickled (e.g. when a Processor is sent to joblib
+        # workers); workers record into a fork() of the trace.
+        state = self.__dict__.copy()
+        state['profilers'] = {}
+        state['_current'] = None
+        return state
+
+
+    # End class RunTrace(object)
+    ########################################
@@ -26,12 +26,7 @@
 import re # Regular expressions
 
 import numpy as np
-import matplotlib as mpl
 from SciAnalysis.settings import *
-if MATPLOTLIB_BACKEND is not None:
-    mpl.use(MATPLOTLIB_BACKEND)
-mpl.rcParams['mathtext.fontset'] = 'cm'
-import pylab as plt
 
 #from scipy.optimize import leastsq
 #import scipy.special
@@ -39,12 +34,10 @@ import pylab as plt
 import PIL # Python Image Library (for opening PNG, etc.)    
 
 from SciAnalysis import tools
-from SciAnalysis.Data import *
-try:
-    from .Eiger import *
-except ImportError:
-    # Eiger support is optional
-    pass
+from SciAnalysis.Data import * # Also provides mpl and (lazily-loaded) plt
+
+h5py = tools.LazyModule('h5py')
+# Eiger support is optional (requires pims); it is imported in load_eiger()
 
 
 
@@ -111,6 +104,7 @@ class Data2DScattering(Data2D):
             
     def load_eiger(self, infile, frame='all'):
         
+        from .Eiger import EigerImages
         self.detector_data = EigerImages(infile)
         
         self.measure_time = self.detector_data.exposuretime
@@ -216,6 +210,7 @@ class Data2DScattering(Data2D):
         
     def threshold_pixels(self, threshold, new_value=0.0):
         
+        self.data = writeable_array(self.data)
         self.data[self.data>threshold] = new_value
         
         
@@ -274,9 +269,11 @@ class Data2DScattering(Data2D):
         
         #self.data[idx] = 0
         if fill:
+            self.data = writeable_array(self.data)
             self.data[idx] = avg[idx]
             
         if mask:
+            self.mask.data = writeable_array(self.mask.data)
             self.mask.data[idx] = 0
 
                        
@@ -1104,6 +1101,7 @@ class Data2DScattering(Data2D):
     # Plotting
     ########################################
         
+    @Trace.timed('plot')
     def plot(self, save=None, show=False, ztrim=[0.01, 0.001], **kwargs):
         
         super(Data2DScattering, self).plot(save=save, show=show, ztrim=ztrim, **kwargs)
@@ -1194,6 +1192,7 @@ class Mask(object):
         if self.data is None:
             self.data = data
         else:
+            self.data = writeable_array(self.data)
             self.data *= data
         
         
@@ -1208,6 +1207,7 @@ class Mask(object):
         if self.data is None:
             self.data = data
         else:
+            self.data = writeable_array(self.data)
             self.data *= data
 
         
@@ -1598,6 +1598,7 @@ class Data2DReciprocal(Data2D):
         return self.x_axis, self.y_axis
 
 
+    @Trace.timed('plot')
     def plot(self, save=None, show=False, ztrim=[0.01, 0.01], size=10.0, plot_buffers=[0.25,0.05,0.25,0.05], **kwargs):
         '''Plots the data.
         
@@ -1679,6 +1680,7 @@ class Data2DQPhi(Data2D):
         return self.x_axis, self.y_axis
 
 
+    @Trace.timed('plot')
     def plot(self, save=None, show=False, ztrim=[0.01, 0.01], size=10.0, plot_buffers=[0.25,0.05,0.25,0.05], **kwargs):
         '''Plots the data.
         
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.XSAnalysis.FormFactor` - Form factors of simple shapes
+================================================
+.. module:: SciAnalysis.XSAnalysis.FormFactor
+   :synopsis: Vectorized (polydisperse) form factor intensities, with derivatives
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  Scattering intensity P(q) of simple particle shapes, intended to be used
+# within fits (e.g. fit_FormFactor_Sphere), where it is evaluated at every
+# iteration.
+#
+# Polydispersity is a Gaussian distribution of sizes (relative width sigma),
+# integrated by quadrature: the particle size at each node is R*(1+sigma*t),
+# and the amplitudes for all (q, size) pairs are computed at once (outer
+# product), followed by a weighted sum over the sizes. Orientational averages
+# (e.g. for cylinders) are likewise an extra axis of the array. The quadrature
+# nodes and weights depend only on the number of points, and are cached.
+#
+# With jacobian=True, the derivatives of the intensity with respect to each
+# size parameter (and the contrast delta_rho) are also returned, as an array
+# with one row per parameter (in the order of the function arguments), which
+# can be used by the Levenberg-Marquardt fit instead of finite differences.
+#
+# Typical usage:
+#   P = sphere_intensity(q, R=50.0, sigma=0.1)
+#   P, jac = sphere_intensity(q, R=50.0, sigma=0.1, jacobian=True) # jac[0] = dP/dR
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import functools
+
+import numpy as np
+
+from .. import tools
+
+special = tools.LazyModule('scipy.special')
+
+
+
+# Quadrature
+################################################################################
+
+@functools.lru_cache(maxsize=None)
+def gaussian_nodes(num_points=30, spread=3):
+    '''Returns the nodes t (in units of the standard deviation, evenly spaced
+    over +/-spread) and the (unnormalized) weights of the Gaussian size
+    distribution.'''
+
+    t = np.linspace(-spread, spread, num_points)
+    w = np.exp(-0.5*t*t)
+    t.flags.writeable = False
+    w.flags.writeable = False
+
+    return t, w
+
+
+@functools.lru_cache(maxsize=None)
+def orientation_nodes(num_points=40):
+    '''Returns the Gauss-Legendre nodes and weights for averaging over
+    orientations: mu = cos(alpha) in [0,1] (weights sum to 1).'''
+
+    x, w = np.polynomial.legendre.leggauss(num_points)
+    mu, w = 0.5*(x+1), 0.5*w
+    mu.flags.writeable = False
+    w.flags.writeable = False
+
+    return mu, w
+
+
+def _size_nodes(R, sigma, num_points, spread):
+    '''Sizes (R*(1+sigma*t)) and normalized weights of the (positive) nodes of
+    the size distribution; and the nodes t.'''
+
+    if sigma==0:
+        t, w = np.zeros(1), np.ones(1)
+    else:
+        t, w = gaussian_nodes(num_points, spread)
+        positive = (1+sigma*t)>0
+        t, w = t[positive], w[positive]
+
+    return R*(1+sigma*t), w/np.sum(w), t
+
+
+
+# Sphere
+################################################################################
+
+def sphere_amplitude(q, R, delta_rho=1.0, derivative=False):
+    '''Scattering amplitude F(q) of a sphere of radius R. With derivative=True,
+    also returns dF/dR.'''
+
+    x = np.asarray(q, dtype=float)*R
+    small = np.abs(x)<1e-2 # Series expansion (avoids round-off near x=0)
+    x2 = x*x
+    xs = np.where(small, 1.0, x)
+    sin_x, cos_x = np.sin(xs), np.cos(xs)
+
+    # Normalized amplitude: 3*(sin(x)-x*cos(x))/x^3 (1 at x=0)
+    shape = np.where(small, 1 - x2/10 + x2*x2/280, 3*(sin_x - xs*cos_x)/(xs*xs*xs))
+    F = delta_rho*(4.0/3.0)*np.pi*(R**3)*shape
+    if not derivative:
+        return F
+
+    sinc = np.where(small, 1 - x2/6, sin_x/xs)
+    dF = delta_rho*4*np.pi*(R**2)*sinc
+
+    return F, dF
+
+
+def sphere_intensity(q, R, sigma=0.0, delta_rho=1.0, num_points=30, spread=3, jacobian=False):
+    '''Form factor intensity P(q) (=<F^2>) of spheres with a Gaussian
+    distribution of radii (mean R, standard deviation sigma*R). With
+    jacobian=True, also returns the derivatives with respect to (R, sigma,
+    delta_rho).'''
+
+    q = np.asarray(q, dtype=float)
+    radii, w, t = _size_nodes(R, sigma, num_points, spread)
+
+    if not jacobian:
+        F = sphere_amplitude(q[...,np.newaxis], radii)
+        return (delta_rho**2)*np.dot(F*F, w)
+
+    F, dF = sphere_amplitude(q[...,np.newaxis], radii, derivative=True)
+    P1 = np.dot(F*F, w) # P for delta_rho=1
+    P = (delta_rho**2)*P1
+    FdF = 2*(delta_rho**2)*F*dF
+    jac = np.stack([
+        np.dot(FdF, w*(1+sigma*t)), # dP/dR
+        np.dot(FdF, w*R*t), # dP/dsigma
+        2*delta_rho*P1, # dP/ddelta_rho
+        ])
+
+    return P, jac
+
+
+
+# Cylinder
+################################################################################
+
+def cylinder_intensity(q, R, L, sigma=0.0, delta_rho=1.0, num_points=30, spread=3, num_orientations=40, jacobian=False):
+    '''Form factor intensity P(q) of randomly-oriented cylinders (radius R,
+    length L), with a Gaussian distribution of radii (mean R, standard
+    deviation sigma*R). With jacobian=True, also returns the derivatives with
+    respect to (R, L, sigma, delta_rho).'''
+
+    q = np.asarray(q, dtype=float)
+    radii, w, t = _size_nodes(R, sigma, num_points, spread)
+    mu, w_mu = orientation_nodes(num_orientations)
+
+    # Axes: (q, radius, orientation)
+    qs = q[:,np.newaxis,np.newaxis]
+    r = radii[np.newaxis,:,np.newaxis]
+    a = qs*r*np.sqrt(1-mu*mu)
+    b = qs*L*mu/2
+
+    a_safe = np.where(a==0, 1.0, a)
+    A = np.where(a==0, 1.0, 2*special.j1(a_safe)/a_safe)
+    B = np.sinc(b/np.pi)
+
+    F = np.pi*(r**2)*L*A*B # For delta_rho=1
+    weights = w[:,np.newaxis]*w_mu
+    P1 = np.einsum('ijk,jk->i', F*F, weights)
+    P = (delta_rho**2)*P1
+    if not jacobian:
+        return P
+
+    dA = np.where(a==0, 0.0, -2*special.jv(2, a_safe)/a_safe) # dA/da
+    b_safe = np.where(b==0, 1.0, b)
+    dB = np.where(b==0, 0.0, (np.cos(b_safe) - B)/b_safe) # dB/db
+    dF_dr = np.pi*L*( 2*r*A*B + (r**2)*dA*(a/r)*B )
+    dF_dL = np.pi*(r**2)*( A*B + L*A*dB*(b/L) )
+
+    FF = 2*(delta_rho**2)*F
+    jac = np.stack([
+        np.einsum('ijk,jk->i', FF*dF_dr, weights*(1+sigma*t)[:,np.newaxis]), # dP/dR
+        np.einsum('ijk,jk->i', FF*dF_dL, weights), # dP/dL
+        np.einsum('ijk,jk->i', FF*dF_dr, weights*(R*t)[:,np.newaxis]), # dP/dsigma
+        2*delta_rho*P1, # dP/ddelta_rho
+        ])
+
+    return P, jac
@@ -107,6 +107,7 @@ class sum_images(ProtocolMultiple):
         for data in datas:
             self.transform(data, **run_args)
         
+        datas[0].data = writeable_array(datas[0].data)
         for data in datas[1:]:
             datas[0].data += data.data
         
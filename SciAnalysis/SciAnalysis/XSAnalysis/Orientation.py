@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vi: ts=4 sw=4
+'''
+:mod:`SciAnalysis.XSAnalysis.Orientation` - Angular (chi) profiles
+================================================
+.. module:: SciAnalysis.XSAnalysis.Orientation
+   :synopsis: Initial parameters for the orientation fits of angular linecuts
+.. moduleauthor:: Dr. Kevin G. Yager <kyager@bnl.gov>
+                    Brookhaven National Laboratory
+'''
+
+################################################################################
+#  The orientation models fit to an angular linecut I(chi) (in linecut_angle_fit)
+# are periodic, and their parameters follow from the circular moments (Fourier
+# harmonics) of the profile:
+#   C_k = < I(chi) exp(-i*k*n*chi) >
+# where n is the symmetry (n=2 for the usual two-fold orientation). The phase of
+# C_1 gives the peak position, while the ratio |C_1|/C_0 measures the width:
+#  - eta function: I = A*(1-eta^2)/(1 - 2*eta*cos(n*dchi) + eta^2), which is
+#    the Poisson kernel, so that C_0 = A and |C_1|/C_0 = eta (exactly).
+#  - Maier-Saupe: I = A*exp(m*cos^2(dchi)) = A*exp(m/2)*exp((m/2)*cos(2*dchi)),
+#    a von Mises distribution, so that |C_1|/C_0 = I1(m/2)/I0(m/2).
+# An AngularProfile computes the harmonics (for all orders at once), along
+# with the maximum and the overall statistics, in one pass over the linecut;
+# the same profile is then used to start each of the fits, instead of
+# starting each fit from generic values.
+#
+# Typical usage:
+#   profile = AngularProfile(line.x, line.y)
+#   guess = profile.guess_eta(symmetry=2) # {'prefactor', 'x_center', 'eta'}
+################################################################################
+# Known Bugs:
+#  N/A
+################################################################################
+# TODO:
+#  Search for "TODO" below.
+################################################################################
+
+
+import numpy as np
+
+from .. import tools
+
+special = tools.LazyModule('scipy.special')
+
+
+
+# AngularProfile
+################################################################################
+class AngularProfile(object):
+    '''Moments and statistics of an angular linecut (x in degrees).'''
+
+    def __init__(self, x, y, symmetry=2, num_harmonics=2):
+
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.num_harmonics = num_harmonics
+
+        # Maximum (the point returned by DataLine.target_y_max)
+        idx = np.argmax(self.y)
+        self.x_peak, self.y_peak = self.x[idx], self.y[idx]
+
+        # Statistics
+        self.average = np.average(self.y)
+        self.std = np.std(self.y)
+
+        self._harmonics = {}
+        self.harmonics(symmetry)
+
+
+    def harmonics(self, symmetry=2):
+        '''Returns the harmonics C_k (k=0..num_harmonics) for the symmetry;
+        all orders are computed at once, as the product of y with a matrix of
+        phases.'''
+
+        if symmetry not in self._harmonics:
+            orders = symmetry*np.arange(self.num_harmonics+1)
+            phase = np.exp( -1j*np.outer(orders, np.radians(self.x)) )
+            self._harmonics[symmetry] = np.dot(phase, self.y)/max(len(self.y), 1)
+
+        return self._harmonics[symmetry]
+
+
+    def ratio(self, symmetry=2):
+        '''|C_1|/C_0: 0 for isotropic, approaching 1 for sharp peaks.'''
+
+        C = self.harmonics(symmetry)
+        if C[0].real<=0:
+            return 0.0
+        return float(np.clip(np.abs(C[1])/C[0].real, 0, 1))
+
+
+    def center(self, symmetry=2, near=None, bounds=None):
+        '''Peak position (from the phase of the first harmonic), taken as the
+        periodic copy nearest to near (default: the maximum), and clipped to
+        bounds (min, max).'''
+
+        C = self.harmonics(symmetry)
+        period = 360.0/symmetry
+        x_center = -np.degrees(np.angle(C[1]))/symmetry
+        near = self.x_peak if near is None else near
+        x_center += period*np.round((near-x_center)/period)
+
+        if bounds is not None:
+            x_center = np.clip(x_center, bounds[0], bounds[1])
+
+        return float(x_center)
+
+
+    def guess_eta(self, symmetry=2, near=None, bounds=None, eta_max=0.99):
+        '''Initial parameters for the eta orientation function (baseline 0).'''
+
+        return {
+            'prefactor' : max(float(self.harmonics(symmetry)[0].real), 0),
+            'x_center' : self.center(symmetry, near=near, bounds=bounds),
+            'eta' : min(self.ratio(symmetry), eta_max),
+            }
+
+
+    def guess_MaierSaupe(self, near=None, bounds=None, ratio_max=0.99):
+        '''Initial parameters for the Maier-Saupe orientation function
+        (baseline 0).'''
+
+        # Invert I1(k)/I0(k) = R (Best & Fisher approximation), with k = m/2
+        R = min(self.ratio(2), ratio_max)
+        if R<0.53:
+            kappa = 2*R + R**3 + 5*(R**5)/6
+        elif R<0.85:
+            kappa = -0.4 + 1.39*R + 0.43/(1-R)
+        else:
+            kappa = 1/(R**3 - 4*R**2 + 3*R)
+
+        # <I> = A*exp(k)*I0(k) = A*exp(2*k)*i0e(k)
+        C0 = max(float(self.harmonics(2)[0].real), 0)
+        prefactor = C0*np.exp(-2*kappa)/special.i0e(kappa)
+
+        return {
+            'prefactor' : float(prefactor),
+            'x_center' : self.center(2, near=near, bounds=bounds),
+            'm' : float(2*kappa),
+            }
+
+
+    # End class AngularProfile(object)
+    ########################################
@@ -23,8 +23,9 @@
 from SciAnalysis.XSAnalysis.Data import * #from .Data import *
 from SciAnalysis.tools import * #from ..tools import *
 #from SciAnalysis.IO_HDF import *
+from SciAnalysis.XSAnalysis import FormFactor
+from SciAnalysis.XSAnalysis import Orientation
 
-import copy
 
 class ProcessorXS(Processor):
 
@@ -65,6 +66,7 @@ class ProcessorXS(Processor):
 
 
         if data.mask is not None:
+            data.data = writeable_array(data.data)
             data.data *= data.mask.data
 
 
@@ -77,6 +79,7 @@ class ProcessorXS(Processor):
         
         if isinstance(kwargs['background'], (int, float)):
             # Constant background to be subtracted from whole image
+            data.data = writeable_array(data.data)
             data.data -= kwargs['background']
             
         elif isinstance(kwargs['background'], str):
@@ -118,6 +121,7 @@ class ProcessorXS(Processor):
             if verbosity>=5:
                 print("# Before: data MAX {:.3f}, MEAN {:.3f}".format(np.max(data.data), np.mean(data.data)))
 
+            data.data = writeable_array(data.data)
             data.data -= average_background_data
             
             if verbosity>=5:
@@ -126,6 +130,7 @@ class ProcessorXS(Processor):
             
         elif isinstance(kwargs['background'], (list, np.ndarray)):
             # Subtract supplied array as background
+            data.data = writeable_array(data.data)
             data.data -= kwargs['background']
             
         else:
@@ -238,7 +243,7 @@ class thumbnails(Protocol):
         
         if run_args['preserve_data']:
             # Avoid changing the data (which would disrupt downstream analysis of this data object)
-            data = copy.deepcopy(data)
+            data = data.copy()
             # TODO: This can raise errors (mpl or qt nodes may not copy cleanly).
         
         if run_args['crop'] is not None:
@@ -311,7 +316,7 @@ class circular_average(Protocol):
         if 'plots' in run_args['save_results']:
             self.label_filename(data, line, **run_args)
             outfile = self.get_outfile(data.name, output_dir)
-            line.plot(save=outfile, **run_args)
+            self.submit_plot(line, outfile, **run_args)
 
         if 'hdf5' in run_args['save_results']:
             self.save_DataLine_HDF5(line, data.name, output_dir, results=results)
@@ -433,7 +438,7 @@ class circular_average_q2I(Protocol):
         if 'plots' in run_args['save_results']:
             self.label_filename(data, line, **run_args)
             outfile = self.get_outfile(data.name, output_dir, ext='_q2I{}'.format(self.default_ext))
-            line.plot(save=outfile, **run_args)
+            self.submit_plot(line, outfile, **run_args)
         
         if 'txt' in run_args['save_results']:
             outfile = self.get_outfile(data.name, output_dir, ext='_q2I.dat')
@@ -457,6 +462,65 @@ class circular_average_q2I(Protocol):
         return os.path.isfile(outfile)
 
 
+class DataLines_fit_peaks(DataLines):
+    '''Plots a curve along with its fit_peaks fit (and annotations of the fit results).'''
+    
+    def _plot_extra(self, **plot_args):
+        
+        xi, xf, yi, yf = self.ax.axis()
+        
+        if 'fit_range' in self._run_args:
+            xstart, xend = self._run_args['fit_range']
+            line = self.lines[0].sub_range(xstart, xend)
+        else:
+            line = self.lines[0]
+        
+        yf = np.max(line.y)*1.5
+        self.ax.axis([xi, xf, yi, yf])
+
+        color = 'b'
+        font_size = self._run_args['font_size'] if 'font_size' in self._run_args else 18
+        v_spacing = (yf-yi)*0.065*(font_size/20)
+
+        s = '$\chi^2 = \, {:.4g}$'.format(self.results['fit_peaks_chi_squared'])
+        self.ax.text(xi, yi, s, size=font_size, color=color, verticalalignment='bottom', horizontalalignment='left')
+
+
+        
+        for i in range(self._run_args['num_curves']):
+            
+            self.ax.axvline(self.results['fit_peaks_x_center{}'.format(i+1)]['value'], linewidth=1, color=color, alpha=0.5)
+            
+            if i<=1:
+                yp = yf
+            else:
+                yp -= v_spacing*1.5
+            if i==0:
+                ha, xp = 'right', xf
+            else:
+                ha, xp = 'left', xi
+
+            s = '$p_{{ {:d} }} = \, {:.3g}$'.format(i+1, self.results['fit_peaks_prefactor{}'.format(i+1)]['value'])
+            self.ax.text(xp, yp, s, size=font_size, color=color, verticalalignment='top', horizontalalignment=ha)
+
+            yp -= v_spacing
+            s = '$q = \, {:.4f} \, \mathrm{{\AA}}^{{-1}}$'.format(self.results['fit_peaks_x_center{}'.format(i+1)]['value'])
+            self.ax.text(xp, yp, s, size=font_size, color=color, verticalalignment='top', horizontalalignment=ha)
+
+            yp -= v_spacing
+            s = r'$d \approx \, {:.1f} \, \mathrm{{nm}}$'.format(self.results['fit_peaks_d0{}'.format(i+1)]['value'])
+            self.ax.text(xp, yp, s, size=font_size, color=color, verticalalignment='top', horizontalalignment=ha)
+
+            yp -= v_spacing
+            s = '$\sigma = \, {:.4f} \, \mathrm{{\AA}}^{{-1}}$'.format(self.results['fit_peaks_sigma{}'.format(i+1)]['value'])
+            self.ax.text(xp, yp, s, size=font_size, color=color, verticalalignment='top', horizontalalignment=ha)
+            
+            yp -= v_spacing
+            s = r'$\xi \approx \, {:.1f} \, \mathrm{{nm}}$'.format(self.results['fit_peaks_grain_size{}'.format(i+1)]['value'])
+            self.ax.text(xp, yp, s, size=font_size, color=color, verticalalignment='top', horizontalalignment=ha)
+
+
+
 class fit_peaks(Protocol):
     
     def _fit(self, line, results, **run_args):
@@ -501,65 +565,7 @@ class fit_peaks(Protocol):
         
         
         # Plot and save data
-        class DataLines_current(DataLines):
-            
-            def _plot_extra(self, **plot_args):
-                
-                xi, xf, yi, yf = self.ax.axis()
-                
-                if 'fit_range' in self._run_args:
-                    xstart, xend = self._run_args['fit_range']
-                    line = self.lines[0].sub_range(xstart, xend)
-                else:
-                    line = self.lines[0]
-                
-                yf = np.max(line.y)*1.5
-                self.ax.axis([xi, xf, yi, yf])
-
-                color = 'b'
-                font_size = self._run_args['font_size'] if 'font_size' in self._run_args else 18
-                v_spacing = (yf-yi)*0.065*(font_size/20)
-
-                s = '$\chi^2 = \, {:.4g}$'.format(self.results['fit_peaks_chi_squared'])
-                self.ax.text(xi, yi, s, size=font_size, color=color, verticalalignment='bottom', horizontalalignment='left')
-
-
-                
-                for i in range(self._run_args['num_curves']):
-                    
-                    self.ax.axvline(self.results['fit_peaks_x_center{}'.format(i+1)]['value'], linewidth=1, color=color, alpha=0.5)
-                    
-                    if i<=1:
-                        yp = yf
-                    else:
-                        yp -= v_spacing*1.5
-                    if i==0:
-                        ha, xp = 'right', xf
-                    else:
-                        ha, xp = 'left', xi
-        
-                    s = '$p_{{ {:d} }} = \, {:.3g}$'.format(i+1, self.results['fit_peaks_prefactor{}'.format(i+1)]['value'])
-                    self.ax.text(xp, yp, s, size=font_size, color=color, verticalalignment='top', horizontalalignment=ha)
-
-                    yp -= v_spacing
-                    s = '$q = \, {:.4f} \, \mathrm{{\AA}}^{{-1}}$'.format(self.results['fit_peaks_x_center{}'.format(i+1)]['value'])
-                    self.ax.text(xp, yp, s, size=font_size, color=color, verticalalignment='top', horizontalalignment=ha)
-
-                    yp -= v_spacing
-                    s = r'$d \approx \, {:.1f} \, \mathrm{{nm}}$'.format(self.results['fit_peaks_d0{}'.format(i+1)]['value'])
-                    self.ax.text(xp, yp, s, size=font_size, color=color, verticalalignment='top', horizontalalignment=ha)
-
-                    yp -= v_spacing
-                    s = '$\sigma = \, {:.4f} \, \mathrm{{\AA}}^{{-1}}$'.format(self.results['fit_peaks_sigma{}'.format(i+1)]['value'])
-                    self.ax.text(xp, yp, s, size=font_size, color=color, verticalalignment='top', horizontalalignment=ha)
-                    
-                    yp -= v_spacing
-                    s = r'$\xi \approx \, {:.1f} \, \mathrm{{nm}}$'.format(self.results['fit_peaks_grain_size{}'.format(i+1)]['value'])
-                    self.ax.text(xp, yp, s, size=font_size, color=color, verticalalignment='top', horizontalalignment=ha)        
-                    
-        
-        
-        lines = DataLines_current([line, fit_line, fit_line_extended])
+        lines = DataLines_fit_peaks([line, fit_line, fit_line_extended])
         if 'num_curves' in run_args and run_args['num_curves']>1 and 'show_curves' in run_args and run_args['show_curves']:
             for curve in fit_line_curves:
                 lines.add_line(curve)
@@ -808,7 +814,7 @@ class fit_FormFactor_Sphere(Protocol):
         if 'plots' in run_args['save_results']:
             self.label_filename(data, lines, **run_args)
             outfile = self.get_outfile(data.name, output_dir, ext=self.default_ext)
-            lines.plot(save=outfile, **run_args)
+            self.submit_plot(lines, outfile, **run_args)
         
         
         if 'hdf5' in run_args['save_results']:
@@ -909,13 +915,32 @@ class fit_FormFactor_Sphere(Protocol):
             #return m - data
             return np.log(data/m)
         
+        def jacobian(params, x, data):
+            # Analytic derivatives of the residual (-dm/dp/m) for each varying parameter
+            
+            v = params.valuesdict()
+            P, P_jac = FormFactor.sphere_intensity(x, R=v['radius'], sigma=v['sigma'], delta_rho=v['delta_rho'], jacobian=True)
+            x_power = np.power(x, v['qpower'])
+            m = P + v['qpower_scale']*x_power + v['background']
+            
+            derivatives = {
+                'radius' : P_jac[0],
+                'sigma' : P_jac[1],
+                'delta_rho' : P_jac[2],
+                'qpower_scale' : x_power,
+                'qpower' : v['qpower_scale']*x_power*np.log(x),
+                'background' : np.ones_like(x),
+                }
+            
+            return np.asarray([ -derivatives[k]/m if k in derivatives else np.zeros_like(x) for k, param in params.items() if param.vary ])
+        
         params = lmfit.Parameters()
         
         for k, v in run_args['initial_guess'].items():
             v_min, v_max = run_args['limits'][k]
             params.add(k, value=v, min=v_min, max=v_max, vary=True)
 
-        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y))
+        lm_result = lmfit.minimize(func2minimize, params, args=(line.x, line.y), Dfun=jacobian, col_deriv=1)
 
         if run_args['verbosity']>=5:
             print('Fit results (lmfit):')
@@ -937,28 +962,17 @@ class fit_FormFactor_Sphere(Protocol):
 
     def sphere_form_factor(self, q, R, delta_rho=1):
         """Calculate the form factor (fq) of a sphere."""
-        from scipy.special import spherical_jn
-        volume = (4.0/3.0)*np.pi*(R**3)
-        qR = R*q
-        F =  delta_rho  * volume * 3 * spherical_jn(1, qR) / qR      
-        return F
+        return FormFactor.sphere_amplitude(q, R, delta_rho=delta_rho)
 
     def sphere_form_factor_intensity(self, q, R, delta_rho=1):
         """Calculate the form factor intensity (Pq=fq**2) of a sphere."""  
-        F =  self.sphere_form_factor(q=q, R=R, delta_rho=delta_rho)   
-        return np.abs(F)**2 
+        return FormFactor.sphere_intensity(q, R, delta_rho=delta_rho)
 
     def poly_sphere_form_factor_intensity(self, q, R, sigma, delta_rho=1):
         """Calculate the form factor intensity of a polydispersed distribution
-        of spheres.
+        of spheres (the same distribution as distribution_gaussian).
         Pq = sum( wi * fqi**2 )"""    
-        disx, disw, disdx = self.distribution_gaussian( R, sigma * R )
-        f1_ = np.zeros_like(q)
-        cts=0
-        for i, ri in enumerate(disx):
-            f1_ += self.sphere_form_factor_intensity(q, R=ri, delta_rho= delta_rho ) * disw[i] * disdx
-            cts += disw[i] *disdx  
-        return f1_/cts
+        return FormFactor.sphere_intensity(q, R, sigma=sigma, delta_rho=delta_rho)
     
     def distribution_gaussian(self, radius=1.0, sigma=0.01, num_points=30, spread=3, only_positive=True): 
         ''' Create a gaussian distribution'''    
@@ -1021,7 +1035,7 @@ class circular_average_q2I_fit(circular_average_q2I, fit_peaks):
         if 'plots' in run_args['save_results']:
             self.label_filename(data, lines, **run_args)
             outfile = self.get_outfile(data.name, output_dir, ext='_q2I{}'.format(self.default_ext))
-            lines.plot(save=outfile, **run_args)
+            self.submit_plot(lines, outfile, **run_args)
         
         
         if 'hdf5' in run_args['save_results']:
@@ -1073,7 +1087,7 @@ class sector_average(Protocol):
         if 'plots' in run_args['save_results']:
             self.label_filename(data, line, **run_args)
             outfile = self.get_outfile(data.name, output_dir)
-            line.plot(save=outfile, error_band=False, ecolor='0.75', capsize=2, elinewidth=1, **run_args)
+            self.submit_plot(line, outfile, error_band=False, ecolor='0.75', capsize=2, elinewidth=1, **run_args)
 
         if 'txt' in run_args['save_results']:
             outfile = self.get_outfile(data.name, output_dir, ext='.dat')
@@ -1160,7 +1174,7 @@ class sector_average_fit(sector_average, fit_peaks):
         if 'plots' in run_args['save_results']:
             self.label_filename(data, lines, **run_args)
             outfile = self.get_outfile(data.name, output_dir)
-            lines.plot(save=outfile, **run_args)        
+            self.submit_plot(lines, outfile, **run_args)
         
 
         return results
@@ -1252,7 +1266,7 @@ class linecut_angle(Protocol):
         if 'plots' in run_args['save_results']:
             self.label_filename(data, line, **run_args)
             outfile = self.get_outfile(data.name, output_dir)
-            line.plot(save=outfile, **run_args)
+            self.submit_plot(line, outfile, **run_args)
             
             #outfile = self.get_outfile(data.name, output_dir, ext='_polar.png')
             #line.plot_polar(save=outfile, **run_args)
@@ -1339,7 +1353,8 @@ class linecut_angle_graininess(linecut_angle):
             line.smooth(dbins)
         
         # Compute the standard deviation of the intensity variation along the ring
-        sigma_R = np.std(line.y)/np.average(line.y)
+        profile = Orientation.AngularProfile(line.x, line.y)
+        sigma_R = profile.std/profile.average
         
         # N_g = c_sigmaR * (sigma_R)^beta
         # c.f. Eq. (30) (page 5) of https://doi.org/10.1107/S1600576714020822  
@@ -1350,8 +1365,8 @@ class linecut_angle_graininess(linecut_angle):
         
         N_g = c_sigmaR*np.power( sigma_R, beta )
         
-        results['average'] = np.average(line.y)
-        results['sigma'] = np.std(line.y)
+        results['average'] = profile.average
+        results['sigma'] = profile.std
         results['sigma_R'] = sigma_R
         results['N_g'] = N_g
         
@@ -1440,7 +1455,7 @@ class linecut_qr(Protocol):
         if 'plots' in run_args['save_results']:
             self.label_filename(data, line, **run_args)
             outfile = self.get_outfile(data.name, output_dir)
-            line.plot(save=outfile, **run_args)
+            self.submit_plot(line, outfile, **run_args)
 
         if 'txt' in run_args['save_results']:
             outfile = self.get_outfile(data.name, output_dir, ext='.dat')
@@ -1483,7 +1498,7 @@ class linecut_qz(Protocol):
         if 'plots' in run_args['save_results']:
             self.label_filename(data, line, **run_args)
             outfile = self.get_outfile(data.name, output_dir)
-            line.plot(save=outfile, **run_args)
+            self.submit_plot(line, outfile, **run_args)
 
         if 'txt' in run_args['save_results']:
             outfile = self.get_outfile(data.name, output_dir, ext='.dat')
@@ -1527,7 +1542,7 @@ class linecut_q(Protocol):
         if 'plots' in run_args['save_results']:
             self.label_filename(data, line, **run_args)
             outfile = self.get_outfile(data.name, output_dir)
-            line.plot(save=outfile, **run_args)
+            self.submit_plot(line, outfile, **run_args)
 
         if 'txt' in run_args['save_results']:
             outfile = self.get_outfile(data.name, output_dir, ext='.dat')
@@ -1588,7 +1603,7 @@ class linecut_qr_fit(linecut_qr, fit_peaks):
         if 'plots' in run_args['save_results']:
             self.label_filename(data, lines, **run_args)
             outfile = self.get_outfile(data.name, output_dir)
-            lines.plot(save=outfile, **run_args)        
+            self.submit_plot(lines, outfile, **run_args)
         
         if 'hdf5' in run_args['save_results']:
             self.save_DataLine_HDF5(line, data.name, output_dir, results=results)          
@@ -2321,9 +2336,11 @@ class linecut_angle_fit(linecut_angle):
         lines.add_line(line)
         lines.copy_labels(line)
         angle = None
+        
+        # Moments of the linecut, used to start all the fits
+        profile = Orientation.AngularProfile(line.x, line.y)
             
-            
-        xt, yt = line.target_y(max(line.y))
+        xt, yt = profile.x_peak, profile.y_peak
         angle = xt
             
         if run_args['do_max']:
@@ -2359,7 +2376,7 @@ class linecut_angle_fit(linecut_angle):
             color_list = ['b', 'purple', 'r', 'green', 'orange',]
             for i, fit_name in enumerate(['fit_eta', 'fit_MaierSaupe', 'fit_eta_span']):
                 
-                lm_result, fit_line, fit_line_e = getattr(self, fit_name)(line, **run_args)
+                lm_result, fit_line, fit_line_e = getattr(self, fit_name)(line, profile=profile, **run_args)
                 fit_line_e.plot_args['color'] = color_list[i%len(color_list)]
                 lines.add_line(fit_line_e)
                 if fit_name=='fit_eta_span':
@@ -2414,7 +2431,10 @@ class linecut_angle_fit(linecut_angle):
         return results
     
     
-    def fit_eta(self, line, **run_args):
+    def fit_eta(self, line, profile=None, **run_args):
+        '''Fit the data with an "eta orientation" function. The initial
+        parameters are derived from the profile (Orientation.AngularProfile of
+        the line).'''
         
         import lmfit
         
@@ -2431,12 +2451,14 @@ class linecut_angle_fit(linecut_angle):
             return m - data
 
         
-        xpeak, ypeak = line.target_y(np.max(line.y))
+        if profile is None:
+            profile = Orientation.AngularProfile(line.x, line.y)
+        guess = profile.guess_eta(symmetry=2, bounds=(np.min(line.x), np.max(line.x)))
         
         params = lmfit.Parameters()
-        params.add('prefactor', value=ypeak*0.5, min=0)
-        params.add('x_center', value=xpeak, min=np.min(line.x), max=np.max(line.x), vary=True)
-        params.add('eta', value=0.4, min=0, max=1)
+        params.add('prefactor', value=guess['prefactor'], min=0)
+        params.add('x_center', value=guess['x_center'], min=np.min(line.x), max=np.max(line.x), vary=True)
+        params.add('eta', value=guess['eta'], min=0, max=1)
         params.add('symmetry', value=2, min=0.5, max=20, vary=False)
         params.add('baseline', value=0, min=0, max=np.max(line.y)+1e-10, vary=False)
         
@@ -2459,14 +2481,16 @@ class linecut_angle_fit(linecut_angle):
         return lm_result, fit_line, fit_line_extended
                     
                     
-    def fit_eta_span(self, line, span=30, **run_args):
+    def fit_eta_span(self, line, span=30, profile=None, **run_args):
         '''Fit the data with an "eta orientation" function, but over a limited span of angle.
         This guards against spurious fits for distributions that do not strictly match the
-        eta function.'''
+        eta function. The initial parameters are derived from the profile of the full line.'''
         
         import lmfit
         
-        xpeak, ypeak = line.target_y(np.max(line.y))
+        if profile is None:
+            profile = Orientation.AngularProfile(line.x, line.y)
+        xpeak = profile.x_peak
         if xpeak<0:
             xpeak += 180
         line_full = line
@@ -2499,10 +2523,12 @@ class linecut_angle_fit(linecut_angle):
             return m - data
         
         
+        guess = profile.guess_eta(symmetry=2, near=xpeak, bounds=(np.min(line.x), np.max(line.x)))
+        
         params = lmfit.Parameters()
-        params.add('prefactor', value=np.max(line.y)*0.5, min=0)
-        params.add('x_center', value=xpeak, min=np.min(line.x), max=np.max(line.x), vary=True)
-        params.add('eta', value=0.4, min=0, max=1)
+        params.add('prefactor', value=guess['prefactor'], min=0)
+        params.add('x_center', value=guess['x_center'], min=np.min(line.x), max=np.max(line.x), vary=True)
+        params.add('eta', value=guess['eta'], min=0, max=1)
         params.add('symmetry', value=2, min=0.5, max=20, vary=False)
         params.add('baseline', value=0, min=0, max=np.max(line.y)+1e-10, vary=False)
         
@@ -2525,7 +2551,10 @@ class linecut_angle_fit(linecut_angle):
         return lm_result, fit_line, fit_line_extended
     
            
-    def fit_MaierSaupe(self, line, **run_args):
+    def fit_MaierSaupe(self, line, profile=None, **run_args):
+        '''Fit the data with a Maier-Saupe orientation function. The initial
+        parameters are derived from the profile (Orientation.AngularProfile of
+        the line).'''
         
         import lmfit
         
@@ -2542,12 +2571,14 @@ class linecut_angle_fit(linecut_angle):
             return m - data
         
         
-        xpeak, ypeak = line.target_y(np.max(line.y))
+        if profile is None:
+            profile = Orientation.AngularProfile(line.x, line.y)
+        guess = profile.guess_MaierSaupe(bounds=(np.min(line.x), np.max(line.x)))
         
         params = lmfit.Parameters()
-        params.add('prefactor', value=ypeak*0.1, min=0)
-        params.add('x_center', value=xpeak, min=np.min(line.x), max=np.max(line.x))
-        params.add('m', value=2.0, min=0)
+        params.add('prefactor', value=guess['prefactor'], min=0)
+        params.add('x_center', value=guess['x_center'], min=np.min(line.x), max=np.max(line.x))
+        params.add('m', value=guess['m'], min=0)
         params.add('baseline', value=0, min=0, max=np.max(line.y)+1e-10, vary=False)
         
         
@@ -2863,7 +2894,7 @@ class q_image(Protocol):
         if 'plot_buffers' not in run_args:
             run_args['plot_buffers'] = [0.30,0.05,0.25,0.05]
         self.label_filename(data, q_data, **run_args)
-        q_data.plot(outfile, **run_args)
+        self.submit_plot(q_data, outfile, **run_args)
         
         #if 'save_data' in run_args and run_args['save_data']: # Deprecated
         if 'npz' in run_args['save_results']:
@@ -3650,6 +3681,7 @@ class _deprecated_sum_images(Protocol):
                     # Add this new image to the data...
                     newdata = run_args['processor'].load(infile, **run_args['load_args'])
                     newdata = self.transform(newdata, **run_args)
+                    data.data = writeable_array(data.data)
                     data.data += newdata.data
                 
             
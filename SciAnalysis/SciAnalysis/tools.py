@@ -26,6 +26,8 @@
 
 import os
 import time
+import importlib
+import types
 import numpy as np
 
 
@@ -34,6 +36,7 @@ import sqlite3, pickle # Used for storing/retrieving from database
 
 
 from SciAnalysis.settings import * #from .settings import *
+from SciAnalysis import Trace
 
 try:
     # 'Fancy' xml library
@@ -61,6 +64,51 @@ def timestamp(filepath):
     return filetimestamp
 
 
+class LazyModule(types.ModuleType):
+    '''Placeholder for a module that is only imported on first use.
+    This keeps start-up fast (e.g. for scripts, joblib workers, or CGI use)
+    when heavy dependencies (pyplot, scipy submodules, etc.) may not even be
+    needed. Usage:
+        plt = LazyModule('pylab')
+        plt.figure() # pylab is imported at this point
+    Optionally, a list of other LazyModule objects can be specified in
+    'requires'; these are loaded first (e.g. to configure matplotlib before
+    pyplot is imported). The 'on_load' function is called with the real
+    module once it has been imported.'''
+    
+    def __init__(self, name, requires=None, on_load=None):
+        super().__init__(name)
+        self.__dict__['_lazy_requires'] = [] if requires is None else requires
+        self.__dict__['_lazy_on_load'] = on_load
+        self.__dict__['_lazy_module'] = None
+        
+    def _lazy_load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            for required in self.__dict__['_lazy_requires']:
+                if isinstance(required, LazyModule):
+                    required._lazy_load()
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_lazy_module'] = module
+            if self.__dict__['_lazy_on_load'] is not None:
+                self.__dict__['_lazy_on_load'](module)
+        return module
+        
+    def __getattr__(self, attr):
+        # Only called for attributes not found on the placeholder itself
+        return getattr(self._lazy_load(), attr)
+    
+    def __setattr__(self, attr, value):
+        setattr(self._lazy_load(), attr, value)
+        
+    def __dir__(self):
+        return dir(self._lazy_load())
+    
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_lazy_module'] is not None else 'not loaded'
+        return "<LazyModule '{}' ({})>".format(self.__name__, state)
+
+
 # Printout helpers
 ########################################
 
@@ -223,6 +271,9 @@ class Processor(object):
         
         self.db_connection = None
         self.db_cursor = None
+        
+        self.plot_queue = None # Optional PlotQueue, for rendering plots out-of-process
+        self.trace = None # Optional Trace.RunTrace, for recording timing/memory of each step
 
 
     def __del__(self):
@@ -235,6 +286,17 @@ class Processor(object):
                 self.db_connection.close()
     
     
+    def apply_settings(self, run_args):
+        '''Applies the run_args that configure the data classes (rather than
+        a particular protocol):
+          coordinate_maps_cache : number of cached coordinate maps (see
+            Data.set_coordinate_maps_cache)'''
+        
+        if 'coordinate_maps_cache' in run_args:
+            from SciAnalysis.Data import set_coordinate_maps_cache
+            set_coordinate_maps_cache(run_args['coordinate_maps_cache'])
+        
+        
     def set_files(self, infiles):
         
         self.infiles = infiles
@@ -267,6 +329,7 @@ class Processor(object):
         l_args.update(load_args)
         r_args = self.run_args.copy()
         r_args.update(run_args)
+        self.apply_settings(r_args)
         
         if infiles is None:
             infiles = self.infiles
@@ -282,43 +345,50 @@ class Processor(object):
             output_dir = self.output_dir
             
             
-        for infile in infiles:
+        trace = self.trace
+        with Trace.activate(trace):
+            for infile in infiles:
             
-            try:
-                data = self.load(infile, **l_args)
+                if self.plot_queue is not None:
+                    self.plot_queue.next_file()
             
-                for protocol in protocols:
+                try:
+                    with Trace.step(trace, infile, 'load'):
+                        data = self.load(infile, **l_args)
+            
+                    for protocol in protocols:
                     
-                    output_dir_current = self.access_dir(output_dir, protocol.name)
+                        output_dir_current = self.access_dir(output_dir, protocol.name)
                     
-                    if not force and protocol.output_exists(data.name, output_dir_current):
-                        # Data already exists
-                        if verbosity>=2:
-                            print(' Skipping {} for {}'.format(protocol.name, data.name))
+                        if not force and protocol.output_exists(data.name, output_dir_current):
+                            # Data already exists
+                            if verbosity>=2:
+                                print(' Skipping {} for {}'.format(protocol.name, data.name))
                         
-                    else:
-                        if verbosity>=2:
-                            print('Running {} for {}'.format(protocol.name, data.name))
+                        else:
+                            if verbosity>=2:
+                                print('Running {} for {}'.format(protocol.name, data.name))
                         
-                        results = protocol.run(data, output_dir_current, **r_args)
-                        
-                        md = {}
-                        md['infile'] = data.infile
-                        if 'full_name' in l_args:
-                            md['full_name'] = l_args['full_name']
-                        if 'save_results' in r_args:
-                            md['save_results'] = r_args['save_results']
+                            with Trace.step(trace, infile, protocol.name):
+                                results = protocol.run(data, output_dir_current, **r_args)
                             
-                        self.store_results(results, output_dir, infile, protocol, **md)
+                                md = {}
+                                md['infile'] = data.infile
+                                if 'full_name' in l_args:
+                                    md['full_name'] = l_args['full_name']
+                                if 'save_results' in r_args:
+                                    md['save_results'] = r_args['save_results']
+                                
+                                self.store_results(results, output_dir, infile, protocol, **md)
                         
 
-            except Exception as exception:
-                if SUPPRESS_EXCEPTIONS or ignore_errors:
-                    # Ignore errors, so that execution doesn't get stuck on a single bad file
-                    if verbosity>=1:
-                        print('  ERROR ({}) with file {}.'.format(exception.__class__.__name__, infile))
-                else:
-                    raise
+                except Exception as exception:
+                    if SUPPRESS_EXCEPTIONS or ignore_errors:
+                        # Ignore errors, so that execution doesn't get stuck on a single bad file
+                        if verbosity>=1:
+                            print('  ERROR ({}) with file {}.'.format(exception.__class__.__name__, infile))
+                    else:
+                        raise
 
 
     def run_parallel(self, infiles=None, protocols=None, output_dir=None, force=False, ignore_errors=False, sort=False, load_args={}, run_args={}, verbosity=3, **kwargs):
@@ -345,48 +415,72 @@ class Processor(object):
         if output_dir is None:
             output_dir = self.output_dir
             
+        # Files are numbered (for plot sampling and profiling) as if they were
+        # run serially
+        start = 0 if self.plot_queue is None else self.plot_queue.file_count
+        trace_start = 0 if self.trace is None else self.trace.num_files
+            
         n_jobs = r_args['num_jobs'] if 'num_jobs' in r_args else 5
         with Parallel(n_jobs=n_jobs) as parallel:
-            ret = parallel( delayed(self.run_parallel_file)(infile, protocols, output_dir, force, ignore_errors, l_args, r_args, verbosity) for infile in infiles )
+            ret = parallel( delayed(self.run_parallel_file)(infile, protocols, output_dir, force, ignore_errors, l_args, r_args, verbosity, index=start+i, trace_index=trace_start+i) for i, infile in enumerate(infiles) )
+
+        if self.plot_queue is not None:
+            self.plot_queue.next_file(start+len(infiles)-1)
+
+        if self.trace is not None:
+            # Each worker records into its own trace; merge them
+            for exported in ret:
+                self.trace.merge(exported)
 
             
-    def run_parallel_file(self, infile, protocols, output_dir, force, ignore_errors, l_args, r_args, verbosity):
-            
-        try:
-            data = self.load(infile, **l_args)
+    def run_parallel_file(self, infile, protocols, output_dir, force, ignore_errors, l_args, r_args, verbosity, index=None, trace_index=None):
         
-            for protocol in protocols:
+        self.apply_settings(r_args) # Needed in each worker process
+        
+        if self.plot_queue is not None:
+            self.plot_queue.next_file(index)
+        
+        trace = None if self.trace is None else self.trace.fork(trace_index)
+        with Trace.activate(trace):
+            try:
+                with Trace.step(trace, infile, 'load'):
+                    data = self.load(infile, **l_args)
+            
+                for protocol in protocols:
                 
-                output_dir_current = self.access_dir(output_dir, protocol.name)
+                    output_dir_current = self.access_dir(output_dir, protocol.name)
                 
-                if not force and protocol.output_exists(data.name, output_dir_current):
-                    # Data already exists
-                    if verbosity>=2:
-                        print(' Skipping {} for {}'.format(protocol.name, data.name))
-                    
-                else:
-                    if verbosity>=2:
-                        print('Queueing {} for {}'.format(protocol.name, data.name))
+                    if not force and protocol.output_exists(data.name, output_dir_current):
+                        # Data already exists
+                        if verbosity>=2:
+                            print(' Skipping {} for {}'.format(protocol.name, data.name))
                     
-                    results = protocol.run(data, output_dir_current, **r_args)
+                    else:
+                        if verbosity>=2:
+                            print('Queueing {} for {}'.format(protocol.name, data.name))
                     
-                    md = {}
-                    md['infile'] = data.infile
-                    if 'full_name' in l_args:
-                        md['full_name'] = l_args['full_name']
-                    if 'save_results' in r_args:
-                        md['save_results'] = r_args['save_results']
-                    self.store_results(results, output_dir, infile, protocol, **md)
+                        with Trace.step(trace, infile, protocol.name):
+                            results = protocol.run(data, output_dir_current, **r_args)
+                        
+                            md = {}
+                            md['infile'] = data.infile
+                            if 'full_name' in l_args:
+                                md['full_name'] = l_args['full_name']
+                            if 'save_results' in r_args:
+                                md['save_results'] = r_args['save_results']
+                            self.store_results(results, output_dir, infile, protocol, **md)
                     
 
-        except Exception as exception:
-            if SUPPRESS_EXCEPTIONS or ignore_errors:
-                # Ignore errors, so that execution doesn't get stuck on a single bad file
-                if verbosity>=1:
-                    print('  ERROR ({}) with file {}.'.format(exception.__class__.__name__, infile))
-            else:
-                raise
+            except Exception as exception:
+                if SUPPRESS_EXCEPTIONS or ignore_errors:
+                    # Ignore errors, so that execution doesn't get stuck on a single bad file
+                    if verbosity>=1:
+                        print('  ERROR ({}) with file {}.'.format(exception.__class__.__name__, infile))
+                else:
+                    raise
             
+        if trace is not None:
+            return trace.export()
         return 'done'
 
 
@@ -399,6 +493,7 @@ class Processor(object):
         return data
         
     
+    @Trace.timed('save')
     def store_results(self, results, output_dir, name, protocol, **md):
         
         if 'save_results' not in md:
@@ -468,100 +563,160 @@ class Processor(object):
         if 'sql' in md['save_results']:
             # Save the results to an SQLite database
             
-            #outfile = os.path.join( output_dir, 'results.db' )
-            #if not os.path.isfile(outfile):
-            outfile = Path(output_dir, 'results.db')
-            if not outfile.is_file():
-                # Create database
-                self.db_connection = sqlite3.connect(str(outfile))
-                self.db_cursor = self.db_connection.cursor()
-                
-                # Create db structure
-                sql = '''-- analyses table (for each run of a Protocol)
-                CREATE TABLE IF NOT EXISTS analyses (
-                        analysis_id integer PRIMARY KEY,
-                        protocol text NOT NULL,
-                        infile text NOT NULL,
-                        filename text NOT NULL,
-                        infile_resolved text NOT NULL,
-                        start_timestamp timestamp NOT NULL,
-                        end_timestamp timestamp NOT NULL,
-                        runtime real NOT NULL,
-                        save_timestamp timestamp NOT NULL
-                );
-                '''
-                self.db_cursor.execute(sql)
-                sql = '''-- results table (for each result/value)
-                CREATE TABLE IF NOT EXISTS results (
-                        result_id integer PRIMARY KEY,
-                        analysis_id integer NOT NULL,
-                        protocol text NOT NULL,
-                        result_name text NOT NULL,
-                        value real,
-                        units text,
-                        error real,
-                        value_text text,
-                        value_blob blob
-                );
-                '''
-                self.db_cursor.execute(sql)
-                
-                
-            if self.db_connection is None:
-                # Connect to database
-                self.db_connection = sqlite3.connect(str(outfile), timeout=30)
-                self.db_cursor = self.db_connection.cursor()
+            self._connect_db(output_dir)
             
             # Store data in SQLite database
             
             # First store the analysis run
-            sql = '''-- Add a new analysis run
-            INSERT INTO analyses (protocol, infile, filename, infile_resolved, start_timestamp, end_timestamp, runtime, save_timestamp)
-            VALUES(?,?,?,?,?,?,?,CURRENT_TIMESTAMP);
+            analysis_id = self._insert_analysis(name, protocol)
+            
+            # Then store each result value
+            sql = '''-- Add a result
+            INSERT INTO results (analysis_id, protocol, result_name, value, units, error, value_text, value_blob) 
+            VALUES(?,?,?,?,?,?,?,?);
             '''
+            for insert_tuple in self._result_tuples(results, analysis_id, protocol):
+                self.db_cursor.execute(sql, insert_tuple)
+                
+                
+    @Trace.timed('save')
+    def store_results_batch(self, results_list, output_dir, names, protocol, infiles=None, **md):
+        '''Stores the results of a protocol for many inputs at once (e.g. as
+        returned by a protocol's run_batch). XML files are written as for
+        store_results (one per name), while all the SQL rows are inserted in
+        a single transaction. Note that writing the XML files is the slow
+        part for large batches; use save_results=['sql'] to skip it.'''
+        
+        if 'save_results' not in md:
+            md['save_results'] = ['xml', 'sql']
+        if infiles is None:
+            infiles = names
             
-            insert_tuple = (protocol.name, name, str(Path(name).stem), str(Path(name).resolve()), protocol.start_timestamp, protocol.end_timestamp, protocol.end_timestamp-protocol.start_timestamp )
+        if 'xml' in md['save_results']:
+            md_xml = md.copy()
+            md_xml['save_results'] = ['xml']
+            for results, name, infile in zip(results_list, names, infiles):
+                md_xml['infile'] = infile
+                self.store_results(results, output_dir, name, protocol, **md_xml)
+                
+        if 'sql' in md['save_results']:
+            self._connect_db(self.access_dir(output_dir, 'results'))
             
-            itry = 0
-            while True:
-                # If multiple SciAnalysis codes are running,
-                # you may get "database is locked" errors.
-                # So, we just keep trying until db is free.
-                try:
-                    self.db_cursor.execute(sql, insert_tuple)
-                except sqlite3.OperationalError as exc:
-                    print('  DB locked (attempt {:d}); retrying...'.format(itry+1))
-                    itry += 1
-                    time.sleep(2)
-                finally:
-                    break
+            rows = []
+            for results, name in zip(results_list, names):
+                analysis_id = self._insert_analysis(name, protocol)
+                rows.extend(self._result_tuples(results, analysis_id, protocol))
+                
+            sql = '''-- Add a result
+            INSERT INTO results (analysis_id, protocol, result_name, value, units, error, value_text, value_blob) 
+            VALUES(?,?,?,?,?,?,?,?);
+            '''
+            self.db_cursor.executemany(sql, rows)
+            self.db_connection.commit()
             
             
-            analysis_id = self.db_cursor.lastrowid
+    def _connect_db(self, output_dir):
+        '''Opens (creating if necessary) the SQLite database of results.'''
+        
+        #outfile = os.path.join( output_dir, 'results.db' )
+        #if not os.path.isfile(outfile):
+        outfile = Path(output_dir, 'results.db')
+        if not outfile.is_file():
+            # Create database
+            self.db_connection = sqlite3.connect(str(outfile))
+            self.db_cursor = self.db_connection.cursor()
             
-            # Then store each result value
-            for result_name, content in results.items():
-                insert_tuple = [analysis_id, protocol.name, result_name, None, None, None, None, None]
-                if isinstance(content, (int,float)):
-                    insert_tuple[3] = content
-                elif isinstance(content, str):
-                    insert_tuple[6] = content
-                elif isinstance(content, dict):
-                    if 'value' in content:
-                        insert_tuple[3] = content['value']
-                    if 'units' in content:
-                        insert_tuple[4] = content['units']
-                    if 'error' in content:
-                        insert_tuple[5] = content['error']
-                    insert_tuple[7] = pickle.dumps(content)
-                else:
-                    insert_tuple[7] = pickle.dumps(content)
-                
-                sql = '''-- Add a result
-                INSERT INTO results (analysis_id, protocol, result_name, value, units, error, value_text, value_blob) 
-                VALUES(?,?,?,?,?,?,?,?);
-                '''
+            # Create db structure
+            sql = '''-- analyses table (for each run of a Protocol)
+            CREATE TABLE IF NOT EXISTS analyses (
+                    analysis_id integer PRIMARY KEY,
+                    protocol text NOT NULL,
+                    infile text NOT NULL,
+                    filename text NOT NULL,
+                    infile_resolved text NOT NULL,
+                    start_timestamp timestamp NOT NULL,
+                    end_timestamp timestamp NOT NULL,
+                    runtime real NOT NULL,
+                    save_timestamp timestamp NOT NULL
+            );
+            '''
+            self.db_cursor.execute(sql)
+            sql = '''-- results table (for each result/value)
+            CREATE TABLE IF NOT EXISTS results (
+                    result_id integer PRIMARY KEY,
+                    analysis_id integer NOT NULL,
+                    protocol text NOT NULL,
+                    result_name text NOT NULL,
+                    value real,
+                    units text,
+                    error real,
+                    value_text text,
+                    value_blob blob
+            );
+            '''
+            self.db_cursor.execute(sql)
+            
+            
+        if self.db_connection is None:
+            # Connect to database
+            self.db_connection = sqlite3.connect(str(outfile), timeout=30)
+            self.db_cursor = self.db_connection.cursor()
+        
+        
+    def _insert_analysis(self, name, protocol):
+        '''Adds an analysis run to the database, returning its id.'''
+        
+        sql = '''-- Add a new analysis run
+        INSERT INTO analyses (protocol, infile, filename, infile_resolved, start_timestamp, end_timestamp, runtime, save_timestamp)
+        VALUES(?,?,?,?,?,?,?,CURRENT_TIMESTAMP);
+        '''
+        
+        insert_tuple = (protocol.name, name, str(Path(name).stem), str(Path(name).resolve()), protocol.start_timestamp, protocol.end_timestamp, protocol.end_timestamp-protocol.start_timestamp )
+        
+        itry = 0
+        while True:
+            # If multiple SciAnalysis codes are running,
+            # you may get "database is locked" errors.
+            # So, we just keep trying until db is free.
+            try:
                 self.db_cursor.execute(sql, insert_tuple)
+            except sqlite3.OperationalError as exc:
+                print('  DB locked (attempt {:d}); retrying...'.format(itry+1))
+                itry += 1
+                time.sleep(2)
+            finally:
+                break
+        
+        
+        analysis_id = self.db_cursor.lastrowid
+        
+        return analysis_id
+        
+        
+    def _result_tuples(self, results, analysis_id, protocol):
+        '''Returns the rows (for the results table) of each result value.'''
+        
+        rows = []
+        for result_name, content in results.items():
+            insert_tuple = [analysis_id, protocol.name, result_name, None, None, None, None, None]
+            if isinstance(content, (int,float)):
+                insert_tuple[3] = content
+            elif isinstance(content, str):
+                insert_tuple[6] = content
+            elif isinstance(content, dict):
+                if 'value' in content:
+                    insert_tuple[3] = content['value']
+                if 'units' in content:
+                    insert_tuple[4] = content['units']
+                if 'error' in content:
+                    insert_tuple[5] = content['error']
+                insert_tuple[7] = pickle.dumps(content)
+            else:
+                insert_tuple[7] = pickle.dumps(content)
+            
+            rows.append(insert_tuple)
+        
+        return rows
                 
                 
                 
@@ -600,6 +755,7 @@ class Processor(object):
         l_args.update(load_args)
         r_args = self.run_args.copy()
         r_args.update(run_args)
+        self.apply_settings(r_args)
         
         if infiles is None:
             infiles = self.infiles
@@ -617,6 +773,9 @@ class Processor(object):
             
         for infile in infiles:
             
+            if self.plot_queue is not None:
+                self.plot_queue.next_file()
+            
             try:
                 
                 data_name = Filename(infile).get_filebase()
@@ -631,18 +790,20 @@ class Processor(object):
                             print(' Skipping {} for {}'.format(protocol.name, data_name))
                         
                     else:
-                        data = self.load(infile, **l_args)
+                        with Trace.step(self.trace, infile, 'load'):
+                            data = self.load(infile, **l_args)
                         
                         if verbosity>=2:
                             print('Running {} for {}'.format(protocol.name, data.name))
                         
-                        results = protocol.run(data, output_dir_current, **r_args)
-                        
-                        md = {}
-                        md['infile'] = data.infile
-                        if 'full_name' in l_args:
-                            md['full_name'] = l_args['full_name']
-                        self.store_results(results, output_dir, infile, protocol, **md)
+                        with Trace.step(self.trace, infile, protocol.name), Trace.activate(self.trace):
+                            results = protocol.run(data, output_dir_current, **r_args)
+                            
+                            md = {}
+                            md['infile'] = data.infile
+                            if 'full_name' in l_args:
+                                md['full_name'] = l_args['full_name']
+                            self.store_results(results, output_dir, infile, protocol, **md)
 
 
             except (OSError, ValueError):
@@ -860,7 +1021,10 @@ def run_default(inner_function):
         self.ir = 1
         self.start_timestamp = time.time()
 
-        results = inner_function(self, data, output_dir, **run_args)
+        # Recorded as its own step only if a trace is active and the caller
+        # (e.g. Processor.run) is not already recording this step
+        with Trace.step(Trace.active(), getattr(data, 'name', None), self.name):
+            results = inner_function(self, data, output_dir, **run_args)
 
         self.end_timestamp = time.time()
 
@@ -948,6 +1112,7 @@ class Protocol(object):
         
         return outfile    
     
+    @Trace.timed('save')
     def save_Data2D_HDF5(self, data, label, output_dir, results=None, extra=None):
         '''Save analysis results to the HDF5 file 
         Input:
@@ -973,6 +1138,7 @@ class Protocol(object):
             }
         dicttoh5(to_save, outfile, overwrite_data=True, h5path='/{}'.format(self.name), mode='a')
 
+    @Trace.timed('save')
     def save_DataLine_HDF5(self, line, name, output_dir, results=None, extra=None):
         '''Save analysis results to the HDF5 file 
         Input:
@@ -1000,6 +1166,19 @@ class Protocol(object):
         dicttoh5(to_save, outfile, overwrite_data=True, h5path='/{}'.format(self.name), mode='a')
         
         
+    @Trace.timed('plot')
+    def submit_plot(self, datap, outfile, method='plot', **kwargs):
+        '''Plot the given data object (e.g. DataLine or Data2D) to outfile.
+        If the processor has a PlotQueue, the plot is rendered by a separate
+        pool of processes (so that analysis does not block on matplotlib);
+        otherwise datap.plot(save=outfile, **kwargs) is called directly.'''
+        
+        plot_queue = self._processor.plot_queue if hasattr(self, '_processor') and hasattr(self._processor, 'plot_queue') else None
+        
+        if plot_queue is None or not plot_queue.submit(datap, outfile, method=method, **kwargs):
+            getattr(datap, method)(save=outfile, **kwargs)
+        
+        
     def label_filename(self, data, datap=None, **run_args):
         '''Handle the common case where we want to apply the data's
         filename as the title for a graph.
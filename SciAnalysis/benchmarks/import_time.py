@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+Import-time (cold start) benchmark for SciAnalysis.
+
+Each measurement runs in a fresh Python interpreter, so that the timings
+reflect what a runXS.py invocation, a joblib worker, or a CGI-style call
+actually pays before doing any analysis. Two cases are measured:
+
+  runXS   : the standard runXS.py preamble (imports, Calibration, Mask,
+            ProcessorXS and a list of protocols).
+  worker  : a fresh process that imports SciAnalysis and unpickles a
+            Processor and its protocols (which is what joblib/multiprocessing
+            workers do).
+
+The heavy modules (pyplot, scipy submodules, lmfit, ...) that ended up being
+imported are also reported; these should only be loaded on first use.
+
+Usage:
+    python3 import_time.py [--repeats 7] [--max-seconds 1.5]
+'''
+
+import sys, os
+import time
+import json
+import pickle
+import argparse
+import subprocess
+import tempfile
+
+SciAnalysis_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+HEAVY_MODULES = ['pylab', 'matplotlib.pyplot', 'scipy.signal', 'scipy.ndimage', 'scipy.stats', 'scipy.interpolate', 'scipy.optimize', 'lmfit', 'h5py', 'pandas', 'databroker', 'skimage', 'cv2', 'sklearn']
+
+
+PREAMBLE = '''
+import sys, time, json
+start = time.perf_counter()
+sys.path.insert(0, {path!r})
+'''
+
+REPORT = '''
+took = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{'took': took, 'heavy': heavy}}))
+'''
+
+RUNXS = '''
+import glob
+from SciAnalysis import tools
+from SciAnalysis.XSAnalysis.Data import *
+from SciAnalysis.XSAnalysis import Protocols
+
+calibration = Calibration(wavelength_A=0.9184) # 13.5 keV
+calibration.set_image_size(487, height=619) # Pilatus300k
+calibration.set_pixel_size(pixel_size_um=172.0)
+calibration.set_beam_position(402.0, 443.0)
+calibration.set_distance(5.038)
+mask = Mask({mask!r})
+
+load_args = {{ 'calibration' : calibration, 'mask' : mask }}
+run_args = {{ 'verbosity' : 3 }}
+process = Protocols.ProcessorXS(load_args=load_args, run_args=run_args)
+protocols = [
+    Protocols.circular_average(ylog=True, plot_range=[0, 0.12, None, None]) ,
+    Protocols.thumbnails(crop=None, resize=1.0, blur=None, cmap=cmap_vge, ztrim=[0.0, 0.01]) ,
+    ]
+'''
+
+WORKER = '''
+import pickle
+with open({payload!r}, 'rb') as fin:
+    process, protocols = pickle.load(fin)
+'''
+
+
+def time_script(script, repeats):
+    '''Runs the script in fresh interpreters; returns the timings (s) of the
+    in-process section, the total wall-time, and the heavy modules loaded.'''
+    took, wall, heavy = [], [], []
+    for i in range(repeats):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+        wall.append(time.perf_counter() - start)
+        result = json.loads(out.strip().splitlines()[-1])
+        took.append(result['took'])
+        heavy = result['heavy']
+
+    return took, wall, heavy
+
+
+def summarize(name, took, wall, heavy):
+    took, wall = sorted(took), sorted(wall)
+    median = took[len(took)//2]
+    print('{:8s} import {:.3f}s median ({:.3f}s min) | process wall-time {:.3f}s median'.format(name, median, took[0], wall[len(wall)//2]))
+    print('{:8s} heavy modules loaded: {}'.format('', ', '.join(heavy) if heavy else 'none'))
+    return median
+
+
+def make_payload(outfile):
+    '''Pickles a Processor and protocols (as would be sent to a worker).'''
+    sys.path.insert(0, SciAnalysis_PATH)
+    from SciAnalysis.XSAnalysis.Data import Calibration
+    from SciAnalysis.XSAnalysis import Protocols
+
+    calibration = Calibration(wavelength_A=0.9184)
+    calibration.set_image_size(487, height=619)
+    calibration.set_pixel_size(pixel_size_um=172.0)
+    calibration.set_beam_position(402.0, 443.0)
+    calibration.set_distance(5.038)
+    process = Protocols.ProcessorXS(load_args={'calibration': calibration}, run_args={'verbosity': 3})
+    protocols = [ Protocols.circular_average(), Protocols.linecut_angle(q0=0.01, dq=0.001) ]
+
+    with open(outfile, 'wb') as fout:
+        pickle.dump((process, protocols), fout)
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure cold-start import time of SciAnalysis')
+    parser.add_argument('--repeats', type=int, default=7)
+    parser.add_argument('--max-seconds', type=float, default=None, help='Fail (exit code 1) if a median import time exceeds this')
+    args = parser.parse_args()
+
+    mask = os.path.join(SciAnalysis_PATH, 'SciAnalysis', 'XSAnalysis', 'masks', 'Dectris', 'Pilatus300k_main_gaps-mask.png')
+    header = PREAMBLE.format(path=SciAnalysis_PATH)
+    footer = REPORT.format(heavy=HEAVY_MODULES)
+
+    medians = {}
+
+    # Baseline: the interpreter plus numpy
+    script = header + 'import numpy\n' + footer
+    medians['numpy'] = summarize('numpy', *time_script(script, args.repeats))
+
+    script = header + RUNXS.format(mask=mask) + footer
+    medians['runXS'] = summarize('runXS', *time_script(script, args.repeats))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        payload = os.path.join(tmpdir, 'payload.pkl')
+        make_payload(payload)
+        script = header + WORKER.format(payload=payload) + footer
+        medians['worker'] = summarize('worker', *time_script(script, args.repeats))
+
+    if args.max_seconds is not None:
+        slow = [name for name in ['runXS', 'worker'] if medians[name]>args.max_seconds]
+        if slow:
+            print('FAILED: {} exceeded {:.3f}s'.format(', '.join(slow), args.max_seconds))
+            sys.exit(1)
@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+Benchmark of the XS (x-ray scattering) pipeline on synthetic detector images.
+
+Synthetic images are generated (offline, deterministically) for three
+geometries, using the Calibration's own q-maps:
+
+  saxs   : transmission SAXS; beam near the detector center, power-law
+           background, rings and (textured) Bragg peaks.
+  waxs   : short detector distance, beam off to one side; broad rings.
+  gisaxs : grazing-incidence; beam near the bottom edge, Yoneda band, Bragg
+           rods and a specular rod.
+
+All images include the inter-module gaps of an Eiger detector (masked) and
+Poisson noise. Sizes follow Eiger detectors: 1M (1030x1065), 4M (2070x2167)
+and 16M (4150x4371).
+
+For each image, the following are timed (median of --repeats runs, after a
+warm-up run; the q-maps are cached in the Calibration as in a real run):
+  maps, load, circular_average_q_bin, sector_average_q_bin, linecut_angle,
+  linecut_qr, linecut_qz, linecut_q, remesh_q_bin, fit_peaks, store_results
+
+Usage:
+    python3 xs_pipeline.py [--sizes 1M,4M] [--geometries saxs,gisaxs] [--repeats 5]
+    python3 xs_pipeline.py --save baseline.json
+    python3 xs_pipeline.py --baseline baseline.json [--tolerance 1.25]
+
+With --baseline, the run fails (exit code 1) if any operation is slower than
+the baseline median by more than the tolerance factor (a small absolute slack
+avoids flagging noise in very fast operations).
+'''
+
+import sys, os
+import time
+import json
+import argparse
+import tempfile
+import shutil
+import gc
+
+SciAnalysis_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+# Eiger detectors: (modules wide, modules high)
+SIZES = {
+    '1M' : (1, 2),
+    '4M' : (2, 4),
+    '16M' : (4, 8),
+    }
+MODULE_SIZE = (1030, 514) # pixels (width, height)
+MODULE_GAP = (10, 37) # pixels (between modules horizontally, vertically)
+
+GEOMETRIES = ['saxs', 'waxs', 'gisaxs']
+
+OPERATIONS = ['maps', 'load', 'circular_average_q_bin', 'sector_average_q_bin', 'linecut_angle', 'linecut_qr', 'linecut_qz', 'linecut_q', 'remesh_q_bin', 'fit_peaks', 'store_results']
+
+ABSOLUTE_SLACK = 0.005 # seconds
+
+
+
+# Synthetic data
+########################################
+
+def detector_shape(size):
+    nx, ny = SIZES[size]
+    width = nx*MODULE_SIZE[0] + (nx-1)*MODULE_GAP[0]
+    height = ny*MODULE_SIZE[1] + (ny-1)*MODULE_GAP[1]
+    return width, height
+
+
+def gap_mask(size):
+    '''Returns the mask (1 = valid pixel, 0 = gap) for an Eiger detector.'''
+    import numpy as np
+
+    width, height = detector_shape(size)
+    mask = np.ones((height, width))
+    nx, ny = SIZES[size]
+    for ix in range(1, nx):
+        x = ix*(MODULE_SIZE[0]+MODULE_GAP[0])
+        mask[:, x-MODULE_GAP[0]:x] = 0
+    for iy in range(1, ny):
+        y = iy*(MODULE_SIZE[1]+MODULE_GAP[1])
+        mask[y-MODULE_GAP[1]:y, :] = 0
+
+    return mask
+
+
+def make_calibration(geometry, size):
+    from SciAnalysis.XSAnalysis.Data import Calibration
+
+    width, height = detector_shape(size)
+    calibration = Calibration(wavelength_A=0.9184) # 13.5 keV
+    calibration.set_image_size(width, height=height)
+    calibration.set_pixel_size(pixel_size_um=75.0)
+
+    if geometry=='saxs':
+        calibration.set_beam_position(0.52*width, 0.47*height)
+        calibration.set_distance(5.0)
+    elif geometry=='waxs':
+        calibration.set_beam_position(-0.05*width, 0.55*height)
+        calibration.set_distance(0.25)
+    elif geometry=='gisaxs':
+        calibration.set_beam_position(0.5*width, 0.92*height)
+        calibration.set_distance(3.0)
+        calibration.set_angles(sample_normal=0, incident_angle=0.12)
+
+    return calibration
+
+
+def make_image(geometry, size, calibration, seed=0):
+    '''Returns a synthetic (Poisson-noise) detector image.'''
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+
+    Q = calibration.q_map()
+    CHI = np.radians(calibration.angle_map())
+    q_max = np.max(Q)
+    q0 = 0.25*q_max # Primary ring/peak position
+    sigma = 0.01*q_max
+
+    I = 1e-3*np.power(np.maximum(Q, 0.2*sigma), -2.5) # Power-law background
+    I *= 200.0/np.median(I)
+    I += 5.0 # Flat background
+
+    def gauss(x, x0, s):
+        return np.exp(-np.square(x-x0)/(2*s**2))
+
+    if geometry in ['saxs', 'waxs']:
+        # Rings (higher orders of a lamellar repeat)
+        for order, amplitude in [(1, 2000), (2, 300), (3, 80)]:
+            I += amplitude*gauss(Q, order*q0, sigma*(1+0.3*order))
+        # Textured Bragg peaks (hexagonal, with some orientational spread)
+        for chi0 in np.radians([0, 60, 120, 180, 240, 300]):
+            dchi = np.angle(np.exp(1j*(CHI-chi0)))
+            I += 5000*gauss(Q, np.sqrt(3)*q0, sigma)*gauss(dchi, 0, np.radians(4))
+
+    elif geometry=='gisaxs':
+        QZ = calibration.qz_map()
+        QR = calibration.qr_map()
+        alpha_c = 0.11 # degrees; critical angle
+        qz_yoneda = 2.0*calibration.get_k()*np.sin(np.radians(alpha_c+calibration.incident_angle)/2)
+        below = QZ<0 # Below the sample horizon
+        I[below] *= 0.01
+        I += 3000*gauss(QZ, qz_yoneda, 0.3*sigma)*np.exp(-np.abs(QR)/(5*q0)) # Yoneda band
+        for order in [1, 2, 3]:
+            # Bragg rods (vertical lamellae)
+            I += (2000/order)*(gauss(QR, order*q0, sigma) + gauss(QR, -order*q0, sigma))*(~below)*np.exp(-np.abs(QZ)/(3*q0))
+        I += 1e4*gauss(QR, 0, 0.5*sigma)*np.exp(-np.abs(QZ)/(2*q0))*(~below) # Specular rod
+
+    I = rng.poisson(I).astype(np.int32)
+    I *= gap_mask(size).astype(np.int32)
+
+    return I, q0
+
+
+
+# Harness
+########################################
+
+def time_operation(function, repeats, setup=None):
+    '''Times function (median and min over repeats, after a warm-up call).'''
+
+    timings = []
+    for i in range(repeats+1):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        took = time.perf_counter() - start
+        if i>0:
+            timings.append(took)
+
+    timings.sort()
+    return {'median': timings[len(timings)//2], 'min': timings[0], 'repeats': repeats}
+
+
+def benchmark_case(geometry, size, repeats, tmpdir, verbosity=3):
+
+    from PIL import Image
+    from SciAnalysis.XSAnalysis.Data import Mask
+    from SciAnalysis.XSAnalysis import Protocols
+
+    calibration = make_calibration(geometry, size)
+    image, q0 = make_image(geometry, size, calibration)
+
+    infile = os.path.join(tmpdir, '{}_{}.tif'.format(geometry, size))
+    Image.fromarray(image).save(infile)
+    mask = Mask()
+    mask.data = gap_mask(size)
+
+    load_args = { 'calibration' : calibration, 'mask' : mask }
+    process = Protocols.ProcessorXS(load_args=load_args, run_args={'verbosity' : 0})
+    data = process.load(infile, **load_args)
+
+    dq = 0.02*q0
+    timings = {}
+    def record(name, function, setup=None):
+        timings[name] = time_operation(function, repeats, setup=setup)
+        if verbosity>=3:
+            print('  {:8s} {:4s} {:24s} {:9.4f}s'.format(geometry, size, name, timings[name]['median']))
+
+    def maps():
+        calibration.clear_maps()
+        calibration.q_map()
+        calibration.angle_map()
+        calibration.qz_map()
+        calibration.qr_map()
+    record('maps', maps)
+
+    record('load', lambda: process.load(infile, **load_args))
+    record('circular_average_q_bin', lambda: data.circular_average_q_bin(error=True))
+    record('sector_average_q_bin', lambda: data.sector_average_q_bin(angle=60, dangle=30, error=True))
+    record('linecut_angle', lambda: data.linecut_angle(q0=q0, dq=dq))
+    record('linecut_qr', lambda: data.linecut_qr(qz=0.2*q0, dq=dq))
+    record('linecut_qz', lambda: data.linecut_qz(qr=q0, dq=dq))
+    record('linecut_q', lambda: data.linecut_q(chi0=60, dq=5))
+    record('remesh_q_bin', lambda: data.remesh_q_bin())
+
+    try:
+        line = data.circular_average_q_bin(error=True)
+        fitter = Protocols.fit_peaks()
+        fit_args = { 'q0' : q0, 'num_curves' : 1, 'fit_range' : [0.6*q0, 1.4*q0], 'verbosity' : 0 }
+        record('fit_peaks', lambda: fitter._fit_peaks(line, **fit_args))
+    except ImportError:
+        if verbosity>=1:
+            print('  {:8s} {:4s} {:24s} skipped (lmfit not installed)'.format(geometry, size, 'fit_peaks'))
+
+    protocol = Protocols.circular_average()
+    protocol.start_timestamp = protocol.end_timestamp = time.time()
+    results = { 'value{:d}'.format(i) : { 'value': 1.0*i, 'error': 0.1*i } for i in range(50) }
+    output_dir = os.path.join(tmpdir, 'output')
+    record('store_results', lambda: process.store_results(results, output_dir, infile, protocol), setup=lambda: shutil.rmtree(output_dir, ignore_errors=True))
+
+    return timings
+
+
+
+# Regression checks
+########################################
+
+def compare(results, baseline, tolerance):
+    '''Returns a list of operations that regressed relative to the baseline.'''
+
+    regressions = []
+    for case, timings in results.items():
+        if case not in baseline:
+            continue
+        for name, timing in timings.items():
+            if name not in baseline[case]:
+                continue
+            limit = baseline[case][name]['median']*tolerance + ABSOLUTE_SLACK
+            if timing['median']>limit:
+                regressions.append('{}/{}: {:.4f}s (baseline {:.4f}s)'.format(case, name, timing['median'], baseline[case][name]['median']))
+
+    return regressions
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the XS pipeline on synthetic detector images')
+    parser.add_argument('--sizes', default='1M', help='Comma-separated list of detector sizes ({})'.format(','.join(SIZES)))
+    parser.add_argument('--geometries', default=','.join(GEOMETRIES), help='Comma-separated list of geometries ({})'.format(','.join(GEOMETRIES)))
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=1, help='Number of BLAS/OpenMP threads (fixed for stable timings)')
+    parser.add_argument('--save', default=None, help='Save the timings (JSON) to this file (e.g. to use as a baseline)')
+    parser.add_argument('--baseline', default=None, help='Compare against timings (JSON) previously saved with --save')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='Allowed slow-down factor relative to the baseline')
+    args = parser.parse_args()
+
+    # Must be set before numpy is imported
+    for variable in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[variable] = str(args.threads)
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    sys.path.insert(0, SciAnalysis_PATH)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in args.sizes.split(','):
+            for geometry in args.geometries.split(','):
+                case = '{}-{}'.format(geometry, size)
+                results[case] = benchmark_case(geometry, size, args.repeats, tmpdir)
+
+    if args.save is not None:
+        with open(args.save, 'w') as fout:
+            json.dump(results, fout, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('FAILED: {} regression(s) beyond {:.2f}x the baseline:'.format(len(regressions), args.tolerance))
+            for regression in regressions:
+                print('  {}'.format(regression))
+            sys.exit(1)
+        print('OK: no regressions beyond {:.2f}x the baseline'.format(args.tolerance))
@@ -1,7 +1,9 @@
 #!/usr/bin/python3
 
 from pathlib import Path
+import os, sys
 import time, datetime
+import threading, queue, atexit, weakref
 
 import numpy as np
 
@@ -44,28 +46,35 @@ class Base():
         
         
     def msg(self, txt, threshold=3, indent=0, indent_txt='  ', verbosity=None, empty_lines=0, raw=False, **kwargs):
-        '''Outputs a status line indicating the current state of execution.'''
+        '''Outputs a status line indicating the current state of execution.
+        The txt can also be a function (e.g. a lambda) that returns the text;
+        it is only called if the message will actually be printed/logged.'''
         if verbosity is None:
             verbosity = self.verbosity
 
-        indent = np.clip(indent+self.indent_depth, 0, 10)
-        indent = indent_txt*indent
+        # Decide what to do before doing any formatting
+        do_print = verbosity>=threshold
+        if self.log_verbosity is None:
+            do_log = do_print and self._common
+        else:
+            do_log = self.log_verbosity>=threshold and self._common
+        if not (do_print or do_log):
+            return
+
+        if callable(txt):
+            txt = txt()
         if raw:
             message = txt
         else:
-            message = '{}> {}{}'.format(self.name, indent, txt)
+            indent = min(max(indent+self.indent_depth, 0), 10)
+            message = '{}> {}{}'.format(self.name, indent_txt*indent, txt)
             
-        if verbosity>=threshold:
+        if do_print:
             for i in range(empty_lines):
                 print('')
             print(message)
-            if self.log_verbosity is None and self._common:
-                for i in range(empty_lines):
-                    self._common.log('')
-                self._common.log(message, threshold=threshold)
-                
             
-        if self.log_verbosity is not None and self.log_verbosity>=threshold and self._common:
+        if do_log:
             for i in range(empty_lines):
                 self._common.log('')
             self._common.log(message, threshold=threshold)
@@ -212,55 +221,212 @@ class Base():
             
 # Common
 ########################################
+def _close_common(ref):
+    '''Closes the Common object (if it still exists) at exit; holds only a weak
+    reference, so that the object can still be garbage-collected.'''
+    common = ref()
+    if common is not None:
+        common.close()
+
+
 class Common():
     '''A class meant to hold settings and pointers to open files, which many
     different other classes/objects may need to access.'''
     
-    def __init__(self, settings=None, logdir='./logs/', log_verbosity=None, prepend_timestamp=True):
+    def __init__(self, settings=None, logdir='./logs/', log_verbosity=None, prepend_timestamp=True, asynchronous=True):
         
         self.settings = {} if settings is None else settings
         
         self.logdir = logdir
         self.log_verbosity = log_verbosity
         self._logfile = None
+        self._logfile_until = 0 # Time (epoch) at which the logfile must be rotated (next midnight)
         self.prepend_timestamp = prepend_timestamp
 
         self._accumulate = False
         self._accumulated_msgs = []
+        
+        # Log records are (by default) handed to a background thread, which
+        # does the formatting and file writing
+        self.asynchronous = asynchronous
+        self._queue = None
+        self._writer = None
+        self._writer_pid = None # Process in which the writer thread runs
+        self._writer_lock = threading.Lock()
+        self._atexit_registered = False
+        self._timestamp_cache = (None, '')
 
 
     def log(self, msg, prepend_timestamp=None, threshold=None):
-
+        
         if (threshold is None) or (self.log_verbosity is None) or (self.log_verbosity>=threshold):
 
             if self._accumulate:
                 self._accumulated_msgs.append(msg)
+                
+            if prepend_timestamp is None:
+                prepend_timestamp = self.prepend_timestamp
+            record = (time.time(), msg, prepend_timestamp)
             
-            logdir = Path(self.logdir)
-            logfile = '{}.log'.format(datetime.datetime.now().strftime("%Y-%m-%d"))
-            
-            if self._logfile is None:
-                # Open new logfile if none exists
-                logdir.mkdir(exist_ok=True)
-                logfile = Path(logdir, logfile)
-                self._logfile = open(logfile, 'a', buffering=1)
+            if self.asynchronous and self._writer_pid!=os.getpid():
+                # First message, or we are in a forked process (e.g. a joblib
+                # worker), where the parent's writer thread does not exist
+                self._start_writer()
                 
+            writer = self._writer # (close() may be clearing it in another thread)
+            if self.asynchronous and writer is not None and writer.is_alive():
+                self._queue.put(record)
             else:
-                # Check if existing logfile is from yesterday
-                cur_logfile = Path(self._logfile.name).name
-                if cur_logfile!=logfile:
-                    logdir.mkdir(exist_ok=True)
-                    logfile = Path(logdir, logfile)
-                    self._logfile = open(logfile, 'a', buffering=1)
+                self._drain()
+                self._write_safe([record])
+                
                 
+    def _start_writer(self):
+        if self._writer_pid!=os.getpid():
+            # The lock may have been copied (held) from the parent process
+            self._writer_lock = threading.Lock()
+        with self._writer_lock:
+            if self._writer_pid!=os.getpid():
+                self._queue = queue.SimpleQueue()
+                self._writer = threading.Thread(target=self._write_loop, name='Common.log', daemon=True)
+                self._writer_pid = os.getpid()
+                self._writer.start()
+                if not self._atexit_registered:
+                    # Don't lose queued messages at exit (registered once per
+                    # object; the handler is inherited by forked processes)
+                    atexit.register(_close_common, weakref.ref(self))
+                    self._atexit_registered = True
+        
+        
+    def _write_loop(self):
+        
+        while True:
+            records = [self._queue.get()]
+            try:
+                # Write everything that is already queued as one batch
+                while True:
+                    try:
+                        records.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                
+                # Non-tuple entries are markers: None (stop) or a threading.Event (flush)
+                self._write_safe([record for record in records if isinstance(record, tuple)])
+                
+            except Exception as exception:
+                print('Common.log writer error ({}): {}'.format(exception.__class__.__name__, exception), file=sys.stderr)
+                
+            finally:
+                for record in records:
+                    if isinstance(record, threading.Event):
+                        record.set()
+                        
+            if None in records:
+                break
+                
+                
+    def _drain(self):
+        '''Writes (synchronously) any records left in the queue of a writer
+        thread that is no longer running.'''
+        
+        writer = self._writer
+        if self._queue is None or self._writer_pid!=os.getpid() or (writer is not None and writer.is_alive()):
+            return
+        records = []
+        while True:
+            try:
+                records.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._write_safe([record for record in records if isinstance(record, tuple)])
+        
+        
+    def _write_safe(self, records):
+        '''Writes the records; if the logfile cannot be written, the messages
+        are printed to stderr instead (rather than being lost).'''
+        
+        try:
+            self._write(records)
+        except Exception as exception:
+            print('Common.log could not write to {} ({}: {})'.format(self.logdir, exception.__class__.__name__, exception), file=sys.stderr)
+            for timestamp, msg, prepend_timestamp in records:
+                print(msg, file=sys.stderr)
                 
-            if (prepend_timestamp is None and self.prepend_timestamp) or prepend_timestamp:
-                timestamp = datetime.datetime.now().strftime("%Y-%m-%d (%a %b %d) %H:%M:%S")
-                #timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-                msg = '[{}] {}'.format(timestamp, msg)
+                
+    def _write(self, records):
+        
+        for timestamp, msg, prepend_timestamp in records:
+            if timestamp>=self._logfile_until:
+                self._open_logfile(timestamp)
+                
+            if prepend_timestamp:
+                msg = '[{}] {}'.format(self._timestamp_str(timestamp), msg)
                 
             self._logfile.write('{}\n'.format(msg))
+            
+        if records:
+            self._logfile.flush()
+            
+            
+    def _open_logfile(self, timestamp):
+        '''Opens the logfile for the day of the given timestamp.'''
+        
+        if self._logfile is not None:
+            self._logfile.close()
+            self._logfile = None
+            
+        now = datetime.datetime.fromtimestamp(timestamp)
+        logdir = Path(self.logdir)
+        logdir.mkdir(parents=True, exist_ok=True)
+        logfile = Path(logdir, '{}.log'.format(now.strftime("%Y-%m-%d")))
+        self._logfile = open(logfile, 'a')
+        
+        midnight = datetime.datetime.combine(now.date()+datetime.timedelta(days=1), datetime.time())
+        self._logfile_until = midnight.timestamp()
+        
         
+    def _timestamp_str(self, timestamp):
+        # Messages within the same second share the formatted string
+        second = int(timestamp)
+        if second!=self._timestamp_cache[0]:
+            timestamp_str = datetime.datetime.fromtimestamp(second).strftime("%Y-%m-%d (%a %b %d) %H:%M:%S")
+            #timestamp_str = datetime.datetime.fromtimestamp(second).strftime("%H:%M:%S")
+            self._timestamp_cache = (second, timestamp_str)
+        return self._timestamp_cache[1]
+        
+        
+    def flush(self, timeout=10.0):
+        '''Blocks until all queued log messages have been written (or until
+        timeout seconds have passed). Returns False on timeout.'''
+        
+        writer = self._writer
+        if writer is None or self._writer_pid!=os.getpid():
+            return True
+        if not writer.is_alive():
+            self._drain()
+            return True
+        
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+            
+            
+    def close(self, timeout=10.0):
+        '''Writes any queued log messages, stops the writer thread and closes
+        the logfile.'''
+        with self._writer_lock:
+            if self._writer is not None and self._writer_pid==os.getpid():
+                if self._writer.is_alive():
+                    self._queue.put(None)
+                    self._writer.join(timeout)
+                self._drain()
+            self._writer = None
+            self._writer_pid = None
+                
+        if self._logfile is not None:
+            self._logfile.close()
+            self._logfile = None
+            self._logfile_until = 0
     
     
     def accumulate_msgs(self):
@@ -275,8 +441,7 @@ class Common():
         
     
     def __del__(self):
-        if self._logfile is not None:
-            self._logfile.close()
+        self.close()
         
         
     # End class Common()